@@ -0,0 +1,65 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Micro-benchmark for collecting Docker responses for post-hooks.
+
+Compares appending each response part to a ``str`` attribute, as
+``DockerProxyClient`` used to, against ``ResponseBuffer``, for growing
+response sizes.  The time per megabyte of ``ResponseBuffer`` should stay
+flat, whether the response is kept in memory or spilled to a temporary file.
+
+$ python benchmarks/bench_buffer.py
+"""
+
+import time
+
+from powerstrip._buffer import ResponseBuffer
+
+MEGABYTE = 2 ** 20
+
+# Twisted reads at most 64k from a socket at a time.
+PART = b"x" * 2 ** 16
+
+SIZES = [6, 12, 25, 50]
+
+
+class Concatenating(object):
+    """
+    The old accumulator: ``+=`` on an attribute, which copies the whole
+    buffer on every part.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+
+    def write(self, data):
+        self._buffer += data
+
+    def getvalue(self):
+        return self._buffer
+
+
+def timeCollect(buffer, size):
+    start = time.time()
+    for i in range(size * MEGABYTE // len(PART)):
+        buffer.write(PART)
+    body = buffer.getvalue()
+    elapsed = time.time() - start
+    assert len(body) == size * MEGABYTE
+    return elapsed
+
+
+def main():
+    print "%8s %16s %16s %16s" % (
+        "MB", "+= (ms/MB)", "memory (ms/MB)", "spilled (ms/MB)")
+    for size in SIZES:
+        results = [
+            timeCollect(Concatenating(), size),
+            timeCollect(ResponseBuffer(size * MEGABYTE), size),
+            timeCollect(ResponseBuffer(MEGABYTE), size)]
+        print "%8d %16.2f %16.2f %16.2f" % (
+            (size,) + tuple(result * 1e3 / size for result in results))
+
+
+if __name__ == '__main__':
+    main()
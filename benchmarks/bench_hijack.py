@@ -0,0 +1,163 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Stress benchmark for hijacked (``attach``) and chunked (``logs``) streams.
+
+Pumps ``--gigabytes`` of container output from the fake Docker of
+``powerstrip.testtools`` through the proxy, with ``--call attach`` or ``--call
+logs``, to a client reading at most ``--rate`` megabytes a second.  The proxy
+only reads from Docker as fast as the client reads, so the process's peak RSS
+should grow by no more than a few megabytes, however much is pumped; the
+benchmark exits with an error if it grows by more than ``--max-rss``
+megabytes.
+
+$ python benchmarks/bench_hijack.py --gigabytes 2 --rate 100 --call logs
+"""
+
+import json
+import resource
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import ClientCreator, Protocol
+from twisted.python import usage
+from twisted.python.filepath import FilePath
+
+from powerstrip._config import PluginConfiguration
+from powerstrip.powerstrip import ServerProtocolFactory
+from powerstrip.testtools import FakeDockerServer
+
+MEGABYTE = 2 ** 20
+
+REQUESTS = {
+    "attach": ("POST /containers/bench/attach?stdout=1 HTTP/1.1\r\n"
+               "Host: docker\r\nContent-Length: 0\r\n\r\n"),
+    "logs": ("GET /containers/bench/logs?follow=1&stdout=1 HTTP/1.1\r\n"
+             "Host: docker\r\nConnection: close\r\n\r\n"),
+}
+
+
+def peakRSS():
+    """
+    Return the peak resident set size of the process, in megabytes.
+    """
+    # Linux reports kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class SlowReader(Protocol):
+    """
+    Send ``request`` for a container's output, and read it at most ``rate``
+    bytes a second, pausing the connection when ahead.
+    """
+    paused = False
+
+    def __init__(self, request, rate):
+        self.request = request
+        self.rate = rate
+        self.received = 0
+        self.done = defer.Deferred()
+
+    def connectionMade(self):
+        self.started = time.time()
+        self.transport.write(self.request)
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        ahead = (float(self.received) / self.rate -
+                 (time.time() - self.started))
+        if ahead > 0.01 and not self.paused:
+            self.paused = True
+            self.transport.pauseProducing()
+            reactor.callLater(ahead, self._resume)
+
+    def _resume(self):
+        self.paused = False
+        self.transport.resumeProducing()
+
+    def connectionLost(self, reason):
+        self.done.callback(self.received)
+
+
+def pump(call, size, rate):
+    """
+    Pump ``size`` bytes of output through the proxy to a ``SlowReader``.
+
+    :param call: ``"attach"`` or ``"logs"``.
+
+    :return: A ``Deferred`` firing with a ``dict`` of results.
+    """
+    dockerAPI = FakeDockerServer()
+    dockerAPI.root.getStaticEntity("containers").outputSize = size
+    dockerServer = reactor.listenTCP(0, dockerAPI, interface="127.0.0.1")
+    path = FilePath(tempfile.mkdtemp()).child("adapters.yml")
+    path.setContent("endpoints: {}\nadapters: {}\n")
+    proxy = ServerProtocolFactory(
+        dockerAddr="127.0.0.1", dockerPort=dockerServer.getHost().port,
+        config=PluginConfiguration(path.path))
+    proxyServer = reactor.listenTCP(0, proxy, interface="127.0.0.1")
+    baseline = peakRSS()
+    started = time.time()
+    d = ClientCreator(reactor, SlowReader, REQUESTS[call], rate).connectTCP(
+        "127.0.0.1", proxyServer.getHost().port)
+    d.addCallback(lambda reader: reader.done)
+    def summarise(received):
+        seconds = time.time() - started
+        return {
+            "call": call,
+            "received_bytes": received,
+            "seconds": round(seconds, 3),
+            "megabytes_per_second": round(received / MEGABYTE / seconds, 1),
+            "rss_growth_megabytes": round(peakRSS() - baseline, 1),
+        }
+    d.addCallback(summarise)
+    def stop(result):
+        stopped = defer.gatherResults([dockerServer.stopListening(),
+                                       proxyServer.stopListening()])
+        return stopped.addCallback(lambda ignored: result)
+    d.addBoth(stop)
+    return d
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["gigabytes", "g", 1.0, "Gigabytes of output to pump.", float],
+        ["rate", "r", 50.0, "Megabytes a second the client reads at most.",
+         float],
+        ["max-rss", "m", 64.0, "Megabytes by which the peak RSS may grow.",
+         float],
+        ["call", "c", "attach", "'attach' for a hijacked stream, or 'logs' "
+         "for a chunked one."],
+    ]
+
+    def postOptions(self):
+        if self["call"] not in REQUESTS:
+            raise usage.UsageError("--call must be 'attach' or 'logs'.")
+
+
+def main(options):
+    results = []
+    d = pump(options["call"], int(options["gigabytes"] * 1024 * MEGABYTE),
+             options["rate"] * MEGABYTE)
+    d.addCallback(results.append)
+    d.addErrback(lambda reason: reason.printTraceback(file=sys.stderr))
+    d.addBoth(lambda ignored: reactor.stop())
+    reactor.run()
+    if not results:
+        raise SystemExit(1)
+    print json.dumps(results[0], indent=2, sort_keys=True,
+                     separators=(",", ": "))
+    if results[0]["rss_growth_megabytes"] > options["max-rss"]:
+        raise SystemExit("Peak RSS grew by more than %s MB." % (
+            options["max-rss"],))
+
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions()
+    except usage.UsageError as e:
+        raise SystemExit("%s\n\n%s" % (e, options))
+    main(options)
@@ -0,0 +1,393 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Load and latency benchmark for the proxy.
+
+Runs the proxy against the fake Docker and adapters from
+``powerstrip.testtools``, and drives it with a number of concurrent clients,
+for each of these scenarios:
+
+* no-hooks: JSON requests passed straight through to Docker.
+* hooks-1, hooks-5: the same requests through 1 or 5 serial pre-hooks and
+  post-hooks, each answered by a null adapter echoing what it is given.
+* large-json: a 1MB JSON request through 1 pre-hook and post-hook.
+* chunked-streaming: a chunked Docker response streamed to the client.
+* raw-stream-attach: a hijacked, raw-stream Docker response.
+
+The fakes and the proxy run in the benchmark's process by default.  With
+``--processes`` they each run in a process of their own, so that the proxy
+doesn't share its reactor with anything else.
+
+Clients connect to the proxy over TCP loopback, or over a UNIX socket with
+``--listen unix``, so that the two can be compared.
+
+Throughput and latency percentiles are written as JSON, to standard output
+or to the ``--output`` file, so that results can be compared from release to
+release.
+
+$ python benchmarks/bench_load.py --concurrency 20 --requests 2000 \\
+    --output load.json
+"""
+
+from collections import namedtuple
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import treq
+import twisted
+from treq.client import HTTPClient
+from twisted.internet import defer, reactor
+from twisted.python import usage
+from twisted.python.filepath import FilePath
+from twisted.web import server, resource
+from twisted.web.client import Agent, HTTPConnectionPool
+
+from powerstrip._config import PluginConfiguration
+from powerstrip._upstream import DockerAgent
+from powerstrip.powerstrip import ServerProtocolFactory
+from powerstrip.testtools import FakeDockerServer, NullAdapterResource
+
+
+class Scenario(namedtuple("Scenario", ["name", "hooks", "bodySize",
+                                       "dockerArgs", "persistent"])):
+    """
+    :param hooks: The number of pre-hooks and post-hooks requests go
+        through.
+
+    :param bodySize: The approximate size of request bodies, in bytes.
+
+    :param dockerArgs: Keyword arguments for ``FakeDockerServer``.
+
+    :param persistent: Whether clients keep their connections to the proxy
+        alive between requests.  Hijacked connections can't be.
+    """
+
+
+SCENARIOS = [
+    Scenario("no-hooks", 0, 0, {}, True),
+    Scenario("hooks-1", 1, 0, {}, True),
+    Scenario("hooks-5", 5, 0, {}, True),
+    Scenario("large-json", 1, 2 ** 20, {}, True),
+    Scenario("chunked-streaming", 0, 0, {"chunkedResponse": True}, True),
+    Scenario("raw-stream-attach", 0, 0, {"rawStream": True}, False),
+]
+
+_byName = dict((scenario.name, scenario) for scenario in SCENARIOS)
+
+
+def makeBody(size):
+    """
+    Return a JSON request body for the fake Docker of about ``size`` bytes.
+    """
+    body = {"Number": 1}
+    if size:
+        body["Padding"] = ["x" * 1000] * (size // 1004)
+    return json.dumps(body)
+
+
+def adapterConfiguration(hooks, adapterPort):
+    """
+    Return the YAML configuration routing ``POST /towel`` through ``hooks``
+    serial pre-hooks and post-hooks.
+    """
+    names = ["null%d" % (i,) for i in range(hooks)]
+    lines = ["endpoints:"]
+    if names:
+        lines.extend([
+            '  "POST /towel":',
+            "    pre: [%s]" % (", ".join(names),),
+            "    post: [%s]" % (", ".join(names),)])
+    else:
+        lines[0] += " {}"
+    lines.append("adapters:" if names else "adapters: {}")
+    for name in names:
+        lines.append("  %s: http://127.0.0.1:%d/null-adapter" % (
+            name, adapterPort))
+    return "\n".join(lines) + "\n"
+
+
+def listenFakes(scenario):
+    """
+    Start the fake Docker and null adapter.
+
+    :return: A ``tuple`` of the Docker port, the adapter port and a
+        ``list`` of listening ports.
+    """
+    dockerServer = reactor.listenTCP(0, FakeDockerServer(
+        **scenario.dockerArgs), interface="127.0.0.1")
+    root = resource.Resource()
+    root.putChild("null-adapter", NullAdapterResource())
+    adapterServer = reactor.listenTCP(0, server.Site(root),
+                                      interface="127.0.0.1")
+    return (dockerServer.getHost().port, adapterServer.getHost().port,
+            [dockerServer, adapterServer])
+
+
+def listenProxy(scenario, dockerPort, adapterPort, listen="tcp"):
+    """
+    Start the proxy, in front of the fake Docker.
+
+    :param listen: ``"tcp"`` to listen on a loopback port, or ``"unix"`` to
+        listen on a UNIX socket.
+
+    :return: A ``tuple`` of the proxy address, as a ``dict`` with the
+        ``port`` or ``socket`` path, and the listening port.
+    """
+    directory = FilePath(tempfile.mkdtemp())
+    path = directory.child("adapters.yml")
+    path.setContent(adapterConfiguration(scenario.hooks, adapterPort))
+    config = PluginConfiguration()
+    config._default_file = path.path
+    proxy = ServerProtocolFactory(dockerAddr="127.0.0.1",
+                                  dockerPort=dockerPort, config=config)
+    if listen == "unix":
+        socket = directory.child("proxy.sock").path
+        return {"socket": socket}, reactor.listenUNIX(socket, proxy)
+    proxyServer = reactor.listenTCP(0, proxy, interface="127.0.0.1")
+    return {"port": proxyServer.getHost().port}, proxyServer
+
+
+def percentile(values, fraction):
+    """
+    Return the nearest-rank percentile of sorted ``values``.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(fraction * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def summarise(latencies, errors, seconds, concurrency):
+    latencies = sorted(latencies)
+    milliseconds = lambda value: (
+        None if value is None else round(value * 1e3, 3))
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "concurrency": concurrency,
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(len(latencies) / seconds, 1),
+        "latency_ms": {
+            "mean": milliseconds(
+                sum(latencies) / len(latencies) if latencies else None),
+            "p50": milliseconds(percentile(latencies, 0.5)),
+            "p90": milliseconds(percentile(latencies, 0.9)),
+            "p99": milliseconds(percentile(latencies, 0.99)),
+            "max": milliseconds(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def drive(scenario, proxyAddress, concurrency, requests):
+    """
+    Send ``requests`` requests to the proxy from ``concurrency`` clients,
+    each sending its next request as soon as it has read the response to
+    the previous one.
+
+    :return: A ``Deferred`` firing with the summary of the run.
+    """
+    pool = HTTPConnectionPool(reactor, persistent=scenario.persistent)
+    pool.maxPersistentPerHost = concurrency
+    if "socket" in proxyAddress:
+        client = HTTPClient(DockerAgent(
+            reactor, pool, dockerSocket=proxyAddress["socket"]))
+        url = "http://docker/towel"
+    else:
+        client = HTTPClient(Agent(reactor, pool=pool))
+        url = "http://127.0.0.1:%d/towel" % (proxyAddress["port"],)
+    body = makeBody(scenario.bodySize)
+    latencies = []
+    errors = [0]
+    remaining = [requests]
+
+    def sendNext(ignored=None):
+        if not remaining[0]:
+            return defer.succeed(None)
+        remaining[0] -= 1
+        sent = time.time()
+        d = client.post(url, body,
+                        headers={"Content-Type": ["application/json"]})
+        d.addCallback(treq.content)
+        def read(content):
+            json.loads(content)
+            latencies.append(time.time() - sent)
+        def failed(reason):
+            errors[0] += 1
+        d.addCallbacks(read, failed)
+        d.addCallback(sendNext)
+        return d
+
+    started = time.time()
+    d = defer.gatherResults([sendNext() for i in range(concurrency)])
+    d.addCallback(lambda ignored: summarise(
+        latencies, errors[0], time.time() - started, concurrency))
+    def closed(result):
+        d = pool.closeCachedConnections()
+        d.addCallback(lambda ignored: result)
+        return d
+    d.addCallback(closed)
+    return d
+
+
+def runInProcess(scenario, concurrency, requests, warmup, listen):
+    dockerPort, adapterPort, ports = listenFakes(scenario)
+    proxyAddress, proxyServer = listenProxy(scenario, dockerPort,
+                                            adapterPort, listen)
+    d = drive(scenario, proxyAddress, concurrency, warmup)
+    d.addCallback(lambda ignored: drive(
+        scenario, proxyAddress, concurrency, requests))
+    def stop(result):
+        d = defer.gatherResults([port.stopListening()
+                                 for port in [proxyServer] + ports])
+        d.addCallback(lambda ignored: result)
+        return d
+    d.addBoth(stop)
+    return d
+
+
+def spawn(*args):
+    """
+    Run this script in a child process with ``args``, and return it with
+    the JSON it announced its ports with.
+    """
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__)] + list(args),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return process, json.loads(process.stdout.readline())
+
+
+def runInProcesses(scenario, concurrency, requests, warmup, listen):
+    fakes, ports = spawn("--serve", "fakes", "--scenario", scenario.name)
+    proxy, proxyAddress = spawn(
+        "--serve", "proxy", "--scenario", scenario.name,
+        "--docker-port", str(ports["docker"]),
+        "--adapter-port", str(ports["adapter"]), "--listen", listen)
+    d = drive(scenario, proxyAddress, concurrency, warmup)
+    d.addCallback(lambda ignored: drive(
+        scenario, proxyAddress, concurrency, requests))
+    def stop(result):
+        for process in proxy, fakes:
+            process.stdin.close()
+            process.wait()
+        return result
+    d.addBoth(stop)
+    return d
+
+
+def serve(options):
+    """
+    Run the fakes or the proxy for a parent benchmark process, announcing
+    their ports on standard output, until standard input is closed.
+    """
+    scenario = _byName[options["scenario"][0]]
+    if options["serve"] == "fakes":
+        dockerPort, adapterPort, ports = listenFakes(scenario)
+        announced = {"docker": dockerPort, "adapter": adapterPort}
+    else:
+        announced, proxyServer = listenProxy(
+            scenario, int(options["docker-port"]),
+            int(options["adapter-port"]), options["listen"])
+    sys.stdout.write(json.dumps(announced) + "\n")
+    sys.stdout.flush()
+    reactor.callInThread(_stopOnEOF)
+    reactor.run()
+
+
+def _stopOnEOF():
+    sys.stdin.read()
+    reactor.callFromThread(reactor.stop)
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["concurrency", "c", 10, "Number of concurrent clients.", int],
+        ["requests", "n", 1000, "Number of requests per scenario.", int],
+        ["warmup", "w", 100, "Number of requests sent before measuring.",
+         int],
+        ["listen", "l", "tcp", "How clients connect to the proxy: 'tcp' "
+         "over loopback, or 'unix' over a UNIX socket."],
+        ["output", "o", None, "File to write the JSON results to, rather "
+         "than standard output."],
+        # Used by --processes to start the child processes.
+        ["serve", None, None, "Run the 'fakes' or 'proxy' for a parent "
+         "benchmark process."],
+        ["docker-port", None, None, "Port of the fake Docker, for "
+         "--serve proxy."],
+        ["adapter-port", None, None, "Port of the null adapter, for "
+         "--serve proxy."],
+    ]
+
+    optFlags = [
+        ["processes", "p", "Run the fakes and the proxy in separate "
+         "processes."],
+    ]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self["scenario"] = []
+
+    def opt_scenario(self, name):
+        """
+        Run only the named scenario; may be given several times.
+        """
+        if name not in _byName:
+            raise usage.UsageError("Unknown scenario %r; choose from: %s" % (
+                name, ", ".join(_byName)))
+        self["scenario"].append(name)
+
+    def postOptions(self):
+        if self["listen"] not in ("tcp", "unix"):
+            raise usage.UsageError("--listen must be 'tcp' or 'unix'.")
+        if not self["scenario"]:
+            self["scenario"] = [scenario.name for scenario in SCENARIOS]
+
+
+def main(options):
+    run = runInProcesses if options["processes"] else runInProcess
+    results = {}
+    d = defer.succeed(None)
+    for name in options["scenario"]:
+        def runScenario(ignored, scenario=_byName[name]):
+            sys.stderr.write("%s...\n" % (scenario.name,))
+            d = run(scenario, options["concurrency"], options["requests"],
+                    options["warmup"], options["listen"])
+            d.addCallback(lambda summary: results.__setitem__(
+                scenario.name, summary))
+            return d
+        d.addCallback(runScenario)
+    def report(ignored):
+        text = json.dumps({
+            "benchmark": "load",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "twisted": twisted.__version__,
+            "mode": "processes" if options["processes"] else "in-process",
+            "listen": options["listen"],
+            "results": results,
+        }, indent=2, sort_keys=True, separators=(",", ": "))
+        if options["output"]:
+            FilePath(options["output"]).setContent(text + "\n")
+        else:
+            print text
+    d.addCallback(report)
+    d.addErrback(lambda reason: reason.printTraceback(file=sys.stderr))
+    d.addBoth(lambda ignored: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions()
+    except usage.UsageError as e:
+        raise SystemExit("%s\n\n%s" % (e, options))
+    if options["serve"]:
+        serve(options)
+    else:
+        main(options)
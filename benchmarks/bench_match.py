@@ -0,0 +1,84 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Micro-benchmark for endpoint matching.
+
+Compares the compiled ``EndpointIndex`` against trying every endpoint
+expression with ``fnmatch``, for growing numbers of configured endpoints.
+
+$ python benchmarks/bench_match.py
+"""
+
+import fnmatch
+import random
+import timeit
+
+from powerstrip._parser import EndpointIndex
+
+METHODS = ["GET", "POST", "DELETE", "PUT"]
+
+SIZES = [10, 100, 1000]
+
+
+def makeEndpoints(count, seed=0):
+    """
+    Return ``count`` endpoint expressions shaped like typical adapter
+    configuration.
+    """
+    rand = random.Random(seed)
+    endpoints = []
+    for i in range(count):
+        method = rand.choice(METHODS)
+        shape = i % 3
+        if shape == 0:
+            endpoints.append("%s /*/resource%d/*/action" % (method, i))
+        elif shape == 1:
+            endpoints.append("%s /v1.16/resource%d/create" % (method, i))
+        else:
+            endpoints.append("* /v*/resource%d/*/json" % (i,))
+    return endpoints
+
+
+def makeRequests(count, seed=1):
+    rand = random.Random(seed)
+    return [(rand.choice(METHODS),
+             "/v1.16/resource%d/%s" % (
+                 rand.randrange(count),
+                 rand.choice(["abc/action", "create", "abc/json", "info"])))
+            for i in range(200)]
+
+
+def scan(endpoints, method, request):
+    match_str = "%s %s" % (method, request)
+    return set(endpoint for endpoint in endpoints
+               if fnmatch.fnmatch(match_str, endpoint))
+
+
+def timePerMatch(function, requests, repeat=3):
+    def run():
+        for method, request in requests:
+            function(method, request)
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(requests)
+
+
+def main():
+    print "%8s %14s %14s" % ("patterns", "fnmatch (us)", "index (us)")
+    for size in SIZES:
+        endpoints = makeEndpoints(size)
+        requests = makeRequests(size)
+        index = EndpointIndex(endpoints)
+        # fnmatch's small regular expression cache makes scanning many
+        # expressions very slow, so only time it on a sample.
+        sample = requests[:20]
+        for method, request in sample:
+            assert index.match(method, request) == scan(
+                endpoints, method, request)
+        scanTime = timePerMatch(
+            lambda method, request: scan(endpoints, method, request),
+            sample, repeat=1)
+        indexTime = timePerMatch(index.match, requests)
+        print "%8d %14.2f %14.2f" % (size, scanTime * 1e6, indexTime * 1e6)
+
+
+if __name__ == '__main__':
+    main()
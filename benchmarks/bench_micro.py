@@ -0,0 +1,370 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Micro-benchmarks for the functions every request goes through, gated on
+stored baselines.
+
+Each case is scored against a fixed calibration workload, so that results
+from faster or slower machines stay comparable.  Both are timed back to back,
+several rounds over, and the score is the median of the ratios of the two, so
+that neither a lucky calibration nor a machine which slows down for a moment
+skews it.  A case fails if its score is over its baseline in
+``baselines.json`` by more than the tolerance (30% unless the baseline sets
+its own, as the noisier cases do).  The exit status is 1 if any case failed.
+
+$ python benchmarks/bench_micro.py
+$ python benchmarks/bench_micro.py --case envelope --case match
+$ python benchmarks/bench_micro.py --update
+
+``--update`` records the current results as the new baselines; only run it
+for a change which is meant to make a case slower, or when adding cases.
+"""
+
+from collections import OrderedDict
+import json
+import shutil
+import sys
+import tempfile
+import timeit
+
+from twisted.python import usage
+from twisted.python.filepath import FilePath
+from twisted.web.resource import getChildForRequest
+from twisted.web.test.test_web import DummyRequest
+
+from powerstrip._buffer import ResponseBuffer
+from powerstrip._config import Adapter, PluginConfiguration
+from powerstrip._metrics import Metrics
+from powerstrip._parser import EndpointParser
+from powerstrip._protocol import HookBody, postHookResponse
+from powerstrip.powerstrip import (
+        DockerProxy, DockerProxyClient, _callPostHook, _callPreHook)
+
+BASELINES = FilePath(__file__).sibling("baselines.json")
+
+DEFAULT_TOLERANCE = 0.3
+
+DEFAULT_ROUNDS = 9
+
+# Twisted reads at most 64k from a socket at a time.
+PART = b"x" * 2 ** 16
+
+
+def calibration():
+    """
+    A fixed workload of the kinds of operations the cases are made of.
+    """
+    data = {"Key%d" % (i,): ["value", i, {"nested": i * 0.5}]
+            for i in range(50)}
+    for i in range(20):
+        json.loads(json.dumps(data))
+    "/".join("segment%d" % (i,) for i in range(200)).split("/")
+
+
+def callsPerRun(function, minimum=0.05):
+    """
+    Return the number of calls to ``function`` which take at least
+    ``minimum`` seconds.
+    """
+    number = 1
+    while True:
+        elapsed = timeit.timeit(function, number=number)
+        if elapsed >= minimum:
+            return number
+        number *= 2 if elapsed == 0 else max(
+            2, int(minimum / elapsed * 1.2))
+
+
+def timePerCall(function, number):
+    """
+    Return the time, in seconds, taken by one call to ``function``, over a
+    run of ``number`` calls.
+    """
+    return timeit.timeit(function, number=number) / number
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure(function, calibrationCalls, rounds):
+    """
+    Time ``function`` against ``calibration``, timing one right after the
+    other in each round.
+
+    :return: A ``tuple`` of the median time, in seconds, of one call to
+        ``function``, the median ratio of that to the time of one call to
+        ``calibration``, and the median time of the latter.
+    """
+    number = callsPerRun(function)
+    seconds = []
+    units = []
+    ratios = []
+    for i in range(rounds):
+        unit = timePerCall(calibration, calibrationCalls)
+        elapsed = timePerCall(function, number)
+        units.append(unit)
+        seconds.append(elapsed)
+        ratios.append(elapsed / unit)
+    return median(seconds), median(ratios), median(units)
+
+
+def writeConfiguration(directory, endpoints):
+    """
+    Write an adapter configuration with ``endpoints`` endpoint expressions,
+    each with its own pre-hook and post-hook adapter.
+
+    :return: A ``PluginConfiguration`` reading it.
+    """
+    lines = ["endpoints:"]
+    for i in range(endpoints):
+        lines.extend([
+            '  "POST /*/resource%d/*/action":' % (i,),
+            "    pre: [adapter%d]" % (i,),
+            "    post: [adapter%d]" % (i,)])
+    lines.append("adapters:")
+    for i in range(endpoints):
+        lines.extend([
+            "  adapter%d:" % (i,),
+            "    uri: http://adapter%d/adapter" % (i,),
+            "    timeout: 30"])
+    path = directory.child("adapters-%d.yml" % (endpoints,))
+    path.setContent("\n".join(lines) + "\n")
+    config = PluginConfiguration()
+    config._default_file = path.path
+    return config
+
+
+def matchCase(directory, endpoints):
+    config = writeConfiguration(directory, endpoints)
+    config.read_and_parse()
+    parser = EndpointParser(config)
+    requests = [("POST", "/v1.16/resource%d/abc/action" % (i,))
+                for i in range(0, endpoints, max(1, endpoints // 20))]
+    requests.append(("GET", "/v1.16/containers/json"))
+    def run():
+        for method, request in requests:
+            parser.match_endpoint(method, request)
+    return run
+
+
+def readAndParseCase(directory, endpoints):
+    return writeConfiguration(directory, endpoints).read_and_parse
+
+
+class _Request(object):
+    method = "POST"
+    uri = "/v1.16/containers/create"
+
+
+class _EnvelopeBreakers(object):
+    """
+    Stand in for ``Breakers``, encoding the hook as ``_postHook`` would
+    without sending it anywhere.
+    """
+
+    def call(self, adapter, f, client, sameAdapter, hook, body, metrics,
+             readBody):
+        json.dumps(body)
+        return _Finished()
+
+
+class _Finished(object):
+    def addCallback(self, *args):
+        return self
+
+    addErrback = addCallback
+
+
+def makeJSON(size):
+    """
+    Return a JSON object, encoded, of about ``size`` bytes.
+    """
+    return json.dumps({"Image": "busybox",
+                       "Env": ["VAR%d=%s" % (i, "x" * 40)
+                               for i in range(size // 50)]})
+
+
+def envelopeCase(hook, protocol, size):
+    """
+    Build and encode the hook sent to an adapter, for a JSON body of about
+    ``size`` bytes, starting from the body as it is read.
+    """
+    adapter = Adapter("adapter", "http://adapter/", protocol=protocol)
+    request = _Request()
+    body = makeJSON(size)
+    metrics = Metrics(None)
+    breakers = _EnvelopeBreakers()
+    if hook == "pre":
+        def run():
+            _callPreHook(None, None, adapter, request, HookBody(body),
+                         metrics, breakers)
+    else:
+        def run():
+            response = postHookResponse({
+                "PowerstripProtocolVersion": 1,
+                "ModifiedServerResponse": {
+                    "Code": 200, "ContentType": "application/json",
+                    "Body": body}})
+            _callPostHook(response, None, adapter, request, HookBody(body),
+                          metrics, breakers)
+    return run
+
+
+def responsePartCase(size):
+    """
+    Collect a ``size`` MB Docker response for post-hooks, as
+    ``DockerProxyClient`` does.
+    """
+    def run():
+        client = DockerProxyClient("GET", "/info", "HTTP/1.1", {}, "", None)
+        client.responseBuffer = ResponseBuffer(64 * 2 ** 20)
+        for i in range(size * 16):
+            client.handleResponsePart(PART)
+        client.responseBuffer.getvalue()
+        client.responseBuffer.close()
+    return run
+
+
+def getChildCase(directory, uri):
+    """
+    Find the resource for ``uri``, as twisted.web does for every request.
+    """
+    root = DockerProxy("127.0.0.1", 2375,
+                       config=writeConfiguration(directory, 10))
+    segments = uri.split("/")[1:]
+    def run():
+        request = DummyRequest(segments)
+        request.uri = uri
+        getChildForRequest(root, request)
+    return run
+
+
+def cases(directory):
+    """
+    Return an ``OrderedDict`` mapping case names to functions returning the
+    callable to time.
+    """
+    found = OrderedDict()
+    for count in (10, 100, 1000):
+        found["match_endpoint/%d" % (count,)] = (
+            lambda count=count: matchCase(directory, count))
+    for count in (100, 1000):
+        found["read_and_parse/%d" % (count,)] = (
+            lambda count=count: readAndParseCase(directory, count))
+    for hook in ("pre", "post"):
+        for protocol in (1, 2):
+            for label, size in (("1k", 2 ** 10), ("64k", 2 ** 16),
+                                ("1m", 2 ** 20)):
+                found["envelope/%s/v%d/%s" % (hook, protocol, label)] = (
+                    lambda hook=hook, protocol=protocol, size=size:
+                    envelopeCase(hook, protocol, size))
+    for size in (1, 16):
+        found["handle_response_part/%dm" % (size,)] = (
+            lambda size=size: responsePartCase(size))
+    for uri in ("/v1.16/info",
+                "/v1.16/containers/%s/json" % ("a" * 64,),
+                "/v1.16/images/registry.example.com:5000/org/team/app/"
+                "json"):
+        segments = uri.count("/")
+        found["get_child/%d" % (segments,)] = (
+            lambda uri=uri: getChildCase(directory, uri))
+    return found
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["tolerance", "t", None, "Fraction a case may be slower than its "
+         "baseline by, overriding the stored tolerances.", float],
+        ["rounds", "r", DEFAULT_ROUNDS, "Number of times each case is timed "
+         "against the calibration.", int],
+    ]
+
+    optFlags = [
+        ["update", "u", "Record the results as the new baselines."],
+    ]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self["case"] = []
+
+    def opt_case(self, name):
+        """
+        Run only the cases whose names contain this; may be given several
+        times.
+        """
+        self["case"].append(name)
+
+
+def main(options):
+    directory = FilePath(tempfile.mkdtemp())
+    try:
+        return _run(options, directory)
+    finally:
+        shutil.rmtree(directory.path)
+
+
+def _run(options, directory):
+    if BASELINES.exists():
+        baselines = json.loads(BASELINES.getContent())
+    else:
+        baselines = {}
+    calibrationCalls = callsPerRun(calibration)
+    results = OrderedDict()
+    units = []
+    failed = []
+    print "%-34s %12s %10s %10s  %s" % (
+        "case", "us/call", "score", "baseline", "result")
+    for name, setUp in cases(directory).items():
+        if options["case"] and not any(
+                pattern in name for pattern in options["case"]):
+            continue
+        seconds, score, unit = measure(setUp(), calibrationCalls,
+                                       options["rounds"])
+        results[name] = score
+        units.append(unit)
+        baseline = baselines.get("cases", {}).get(name)
+        if baseline is None:
+            verdict = "new"
+            limit = None
+        else:
+            tolerance = options["tolerance"]
+            if tolerance is None:
+                tolerance = baseline.get("tolerance", DEFAULT_TOLERANCE)
+            limit = baseline["score"] * (1 + tolerance)
+            verdict = "ok" if score <= limit else "FAIL"
+            if verdict == "FAIL":
+                failed.append(name)
+        print "%-34s %12.2f %10.4f %10s  %s" % (
+            name, seconds * 1e6, score,
+            "-" if baseline is None else "%.4f" % (baseline["score"],),
+            verdict)
+        sys.stdout.flush()
+    if options["update"]:
+        stored = baselines.setdefault("cases", {})
+        for name, score in results.items():
+            entry = stored.setdefault(name, {})
+            entry["score"] = float("%.4g" % (score,))
+        baselines["calibration_us"] = round(median(units) * 1e6, 2)
+        BASELINES.setContent(
+            json.dumps(baselines, indent=2, sort_keys=True,
+                       separators=(",", ": ")) + "\n")
+        print "Baselines updated."
+        return 0
+    if failed:
+        print "%d case(s) regressed: %s" % (len(failed), ", ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions()
+    except usage.UsageError as e:
+        raise SystemExit("%s\n\n%s" % (e, options))
+    sys.exit(main(options))
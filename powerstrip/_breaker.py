@@ -0,0 +1,270 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_breaker -*-
+
+"""
+Timeouts and circuit breakers for calls to adapters, so that an adapter
+which has gone away or hangs fails fast rather than holding up every request
+it hooks.
+"""
+
+from collections import deque
+import json
+
+from twisted.internet.defer import fail, maybeDeferred
+from twisted.python.failure import Failure
+from twisted.web import resource
+
+# The states of a circuit breaker.  A ``CLOSED`` breaker lets calls through,
+# an ``OPEN`` one fails them straight away, and a ``HALF_OPEN`` one lets a
+# single call through to find out whether the adapter has recovered.
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class AdapterFailed(Exception):
+    """
+    An adapter could not be called, or did not answer a hook successfully.
+
+    self.adapter: The name of the adapter.
+
+    self.code: The HTTP status code to answer the client with: the one the
+        adapter answered with, or a gateway error.
+
+    self.body: The body to answer the client with.
+
+    self.contentType: The content type of ``body``.
+    """
+
+    def __init__(self, adapter, code, body, contentType="text/plain"):
+        Exception.__init__(self, adapter, code, body)
+        self.adapter = adapter
+        self.code = code
+        self.body = body
+        self.contentType = contentType
+
+    @property
+    def unavailable(self):
+        """
+        ``True`` if the adapter failed rather than rejected the hook: it
+        couldn't be reached, timed out or answered with a server error.
+        """
+        return self.code >= 500
+
+
+class CircuitBreaker(object):
+    """
+    Track the failures of calls to one adapter, and stop calling it for a
+    while once too many of them failed within a window.
+
+    self.state: ``CLOSED``, ``OPEN`` or ``HALF_OPEN``.
+
+    self.openedAt: When the breaker last opened, or ``None``.
+
+    self.trips: The number of times the breaker opened.
+
+    self.shortCircuited: The number of calls failed without calling the
+        adapter.
+    """
+
+    state = CLOSED
+    openedAt = None
+    trips = 0
+    shortCircuited = 0
+    _probing = False
+
+    def __init__(self, settings, clock):
+        """
+        :param settings: A ``BreakerConfiguration``.
+
+        :param clock: An ``IReactorTime`` provider.
+        """
+        self._clock = clock
+        self._failures = deque()
+        self.configure(settings)
+
+    def configure(self, settings):
+        """
+        Apply new settings.  Turning the breaker off closes it.
+        """
+        self.settings = settings
+        if not settings.failures:
+            self.state = CLOSED
+            self._failures.clear()
+
+    def allow(self):
+        """
+        Return ``True`` if the adapter may be called, ``False`` if the call
+        must fail straight away.
+        """
+        if self.state == OPEN:
+            if (self._clock.seconds() <
+                    self.openedAt + self.settings.cooldown):
+                self.shortCircuited += 1
+                return False
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self._probing:
+                self.shortCircuited += 1
+                return False
+            self._probing = True
+        return True
+
+    def succeeded(self):
+        """
+        Record a call which succeeded, closing a half-open breaker.
+        """
+        if self.state == OPEN:
+            # The call started before the breaker opened.
+            return
+        self._probing = False
+        self.state = CLOSED
+        self._failures.clear()
+
+    def failed(self):
+        """
+        Record a call which failed, opening the breaker if there were too
+        many failures within the window, or if it was half-open.
+        """
+        if self.state == OPEN or not self.settings.failures:
+            return
+        now = self._clock.seconds()
+        if self.state == HALF_OPEN:
+            self._open(now)
+            return
+        self._failures.append(now)
+        self._expire(now)
+        if len(self._failures) >= self.settings.failures:
+            self._open(now)
+
+    def _open(self, now):
+        self.state = OPEN
+        self.openedAt = now
+        self.trips += 1
+        self._probing = False
+        self._failures.clear()
+
+    def _expire(self, now):
+        while self._failures and (
+                self._failures[0] <= now - self.settings.window):
+            self._failures.popleft()
+
+    def describe(self):
+        """
+        Return a JSON serializable ``dict`` describing the breaker.
+        """
+        self._expire(self._clock.seconds())
+        retryAt = None
+        if self.state == OPEN:
+            retryAt = self.openedAt + self.settings.cooldown
+        return {
+            "state": self.state,
+            "recent_failures": len(self._failures),
+            "trips": self.trips,
+            "short_circuited": self.shortCircuited,
+            "opened_at": self.openedAt,
+            "retry_at": retryAt,
+            "failures": self.settings.failures,
+            "window": self.settings.window,
+            "cooldown": self.settings.cooldown,
+        }
+
+
+class Breakers(object):
+    """
+    Call adapters with a timeout, through a ``CircuitBreaker`` for each
+    adapter.  Breakers are kept by adapter name, so that they survive
+    configuration reloads.
+    """
+
+    def __init__(self, clock):
+        """
+        :param clock: An ``IReactorTime`` provider.
+        """
+        self.clock = clock
+        self._breakers = {}
+
+    def breaker(self, adapter):
+        """
+        Return the ``CircuitBreaker`` of an ``Adapter``, configured with its
+        current settings.
+        """
+        breaker = self._breakers.get(adapter.name)
+        if breaker is None:
+            breaker = self._breakers[adapter.name] = CircuitBreaker(
+                adapter.breaker, self.clock)
+        elif breaker.settings != adapter.breaker:
+            breaker.configure(adapter.breaker)
+        return breaker
+
+    def call(self, adapter, f, *args):
+        """
+        Call an adapter, unless its breaker is open.
+
+        :param adapter: The ``Adapter`` being called.
+
+        :param f: A callable taking ``args`` which calls the adapter, and
+            returns a ``Deferred``.  It is cancelled if it hasn't fired within
+            the adapter's timeout.
+
+        :return: A ``Deferred`` firing with the result of ``f``, or failing
+            with ``AdapterFailed``.
+        """
+        breaker = self.breaker(adapter)
+        if not breaker.allow():
+            return fail(AdapterFailed(
+                adapter.name, 503,
+                "Adapter '%s' is unavailable: its circuit breaker is open." %
+                    (adapter.name,)))
+        d = maybeDeferred(f, *args)
+        timedOut = []
+        def expire():
+            timedOut.append(True)
+            d.cancel()
+        delayed = self.clock.callLater(adapter.timeout, expire)
+        d.addBoth(self._finished, adapter, breaker, delayed, timedOut)
+        return d
+
+    def _finished(self, result, adapter, breaker, delayed, timedOut):
+        if delayed.active():
+            delayed.cancel()
+        if not isinstance(result, Failure):
+            breaker.succeeded()
+            return result
+        if timedOut:
+            result = Failure(AdapterFailed(
+                adapter.name, 504, "Adapter '%s' did not answer within %s "
+                "seconds." % (adapter.name, adapter.timeout)))
+        elif not result.check(AdapterFailed):
+            result = Failure(AdapterFailed(
+                adapter.name, 502, "Adapter '%s' failed: %s" % (
+                    adapter.name, result.getErrorMessage())))
+        if result.value.unavailable:
+            breaker.failed()
+        else:
+            # The adapter is up, even if it didn't like this request.
+            breaker.succeeded()
+        return result
+
+    def describe(self):
+        """
+        Return a JSON serializable ``dict`` mapping adapter names to the
+        description of their breaker.
+        """
+        return dict((name, breaker.describe())
+                    for name, breaker in self._breakers.iteritems())
+
+
+class BreakersResource(resource.Resource):
+    """
+    Serve the state of the circuit breakers of adapters as JSON.
+    """
+    isLeaf = True
+
+    def __init__(self, breakers):
+        resource.Resource.__init__(self)
+        self.breakers = breakers
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps(self.breakers.describe(), sort_keys=True)
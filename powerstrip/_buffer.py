@@ -0,0 +1,104 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_buffer -*-
+
+"""
+Buffering of Docker responses which are handed to post-hooks.
+"""
+
+import tempfile
+
+
+class ResponseTooLarge(Exception):
+    """
+    A response is larger than the most which may be buffered.
+
+    self.maxSize: That size, in bytes.
+    """
+
+    def __init__(self, maxSize):
+        Exception.__init__(self, maxSize)
+        self.maxSize = maxSize
+
+    def __str__(self):
+        return ("The Docker response is larger than the %d bytes which can "
+                "be buffered for post-hooks (response_buffer.max_size)." % (
+                    self.maxSize,))
+
+
+class ResponseBuffer(object):
+    """
+    Collect the parts of a response in linear time.  Parts are kept in a list
+    in memory until their total size exceeds a limit, after which the whole
+    response is written to an anonymous temporary file instead.
+
+    The whole response is read back into memory for the post-hooks, so a
+    response may not grow past a hard cap either.
+
+    self.size: The number of bytes written so far.
+    """
+
+    size = 0
+    _file = None
+
+    def __init__(self, memoryLimit, maxSize=None):
+        """
+        :param memoryLimit: The number of bytes to keep in memory before
+            spilling to a temporary file.
+
+        :param maxSize: The most bytes the response may have, or ``None``
+            for no limit.
+        """
+        self._memoryLimit = memoryLimit
+        self._maxSize = maxSize
+        self._parts = []
+
+    @property
+    def spilled(self):
+        """
+        Whether the response has been spilled to a temporary file.
+        """
+        return self._file is not None
+
+    def write(self, data):
+        """
+        Add a part to the end of the response.
+
+        :raises: ``ResponseTooLarge`` if the response would grow past the
+            most bytes it may have.  What was collected is released.
+        """
+        if not data:
+            return
+        if (self._maxSize is not None and
+                self.size + len(data) > self._maxSize):
+            self.close()
+            raise ResponseTooLarge(self._maxSize)
+        self.size += len(data)
+        if self._file is not None:
+            self._file.write(data)
+        elif self.size > self._memoryLimit:
+            self._file = tempfile.TemporaryFile()
+            for part in self._parts:
+                self._file.write(part)
+            self._file.write(data)
+            self._parts = None
+        else:
+            self._parts.append(data)
+
+    def getvalue(self):
+        """
+        Return the whole response as a ``str``.
+        """
+        if self._file is not None:
+            self._file.seek(0, 0)
+            return self._file.read()
+        return b"".join(self._parts)
+
+    def close(self):
+        """
+        Release the memory or temporary file holding the response.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._parts = []
+        self.size = 0
@@ -0,0 +1,359 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_cache -*-
+
+"""
+Sharing of Docker responses to read-only API calls which are polled often,
+such as ``GET /info`` or ``GET /containers/json``: between identical
+requests in flight at the same time, and through a cache.
+"""
+
+from collections import OrderedDict
+
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Protocol
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from ._config import CacheConfiguration
+from ._parser import EndpointIndex
+from ._upstream import DEDICATED_ENDPOINTS, NoPostHooks
+
+# Requests with these methods change the state of Docker, so that cached
+# responses may no longer be right.
+MUTATING_METHODS = frozenset(["POST", "PUT", "DELETE"])
+
+# Response headers which are not replayed from the cache.
+_NOT_REPLAYED = frozenset(["content-length", "date", "connection",
+                           "transfer-encoding"])
+
+
+class ResponseCache(object):
+    """
+    Docker responses kept for a limited time, up to a total size, evicting
+    the least recently used ones first.
+
+    Every invalidation starts a new generation.  A response is only stored
+    if no invalidation happened since its request was made, so that a
+    response racing a change to Docker isn't kept.
+
+    self.generation: The number of invalidations so far.
+
+    self.size: The total size of the cached response bodies.
+
+    self.hits, self.misses, self.evictions, self.invalidations: Counters.
+    """
+
+    generation = 0
+    size = 0
+    hits = 0
+    misses = 0
+    evictions = 0
+    invalidations = 0
+
+    def __init__(self, clock):
+        """
+        :param clock: An ``IReactorTime`` provider.
+        """
+        self._clock = clock
+        self._entries = OrderedDict()
+        self.configure(CacheConfiguration())
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def enabled(self):
+        return bool(self.settings.endpoints)
+
+    def configure(self, settings):
+        """
+        Apply new settings, dropping whatever was cached under the old ones.
+
+        :param settings: A ``CacheConfiguration``.
+        """
+        self.settings = settings
+        self._index = EndpointIndex(settings.endpoints)
+        self.invalidate()
+
+    def cacheable(self, method, path):
+        """
+        Return ``True`` if responses to a request may be cached.
+
+        :param path: The request path, without a query part.
+        """
+        if not self.enabled or method != "GET":
+            return False
+        return bool(self._index.match(method, path) and
+                    not DEDICATED_ENDPOINTS.match(method, path))
+
+    def key(self, method, uri, headers):
+        """
+        Return the key a request is cached under: its method, its URI
+        including the query, and the values of the ``vary`` headers.
+
+        :param headers: The ``Headers`` of the request.
+        """
+        return (method, uri) + tuple(
+            tuple(headers.getRawHeaders(name, ())) for name in
+            self.settings.vary)
+
+    def get(self, key):
+        """
+        Return the cached ``(response, headers)`` for ``key``, or ``None``.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, response, headers = entry
+            if expires > self._clock.seconds():
+                self.hits += 1
+                # Mark the entry as the most recently used.
+                del self._entries[key]
+                self._entries[key] = entry
+                return _copyResponse(response), headers
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, generation, response, headers):
+        """
+        Store a response, unless the cache was invalidated since
+        ``generation``, or ``key`` is cached already.
+
+        :param response: The Docker response, as given to post-hooks.
+
+        :param headers: A ``list`` of ``(name, values)`` response headers.
+        """
+        if generation != self.generation or key in self._entries:
+            return
+        size = len(response["ModifiedServerResponse"]["Body"])
+        if size > self.settings.max_bytes:
+            return
+        while self.size + size > self.settings.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+        self._entries[key] = (self._clock.seconds() + self.settings.ttl,
+                              _copyResponse(response), headers)
+        self.size += size
+
+    def _remove(self, key):
+        expires, response, headers = self._entries.pop(key)
+        self.size -= len(response["ModifiedServerResponse"]["Body"])
+
+    def invalidate(self):
+        """
+        Drop all cached responses.
+        """
+        self.generation += 1
+        self.invalidations += 1
+        self._entries.clear()
+        self.size = 0
+
+
+class SingleFlight(object):
+    """
+    Coalesce identical requests in flight at the same time, so that only
+    the first of them (the leader) is sent to Docker, and its response is
+    shared with the others.
+
+    The leader must call either ``land`` or ``abort`` once it has its
+    response, or has failed to get one it can share.
+
+    self.flights: The number of requests sent to Docker as leaders.
+
+    self.coalesced: The number of requests which waited for a leader rather
+        than being sent to Docker themselves.
+    """
+
+    flights = 0
+    coalesced = 0
+
+    def __init__(self):
+        self._waiting = {}
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def join(self, key):
+        """
+        Join the flight of requests with ``key``.
+
+        :return: ``None`` if there is no such flight, in which case the
+            caller leads a new one.  Otherwise, a ``Deferred`` firing with the
+            ``(response, headers)`` shared by the leader, or with ``None`` if
+            the leader couldn't share its response.
+        """
+        waiting = self._waiting.get(key)
+        if waiting is None:
+            self._waiting[key] = []
+            self.flights += 1
+            return None
+        d = Deferred()
+        waiting.append(d)
+        self.coalesced += 1
+        return d
+
+    def land(self, key, response, headers):
+        """
+        Share the leader's response with the requests waiting for it.
+
+        :param response: The Docker response, as given to post-hooks.
+
+        :param headers: A ``list`` of ``(name, values)`` response headers.
+        """
+        for d in self._waiting.pop(key):
+            d.callback((_copyResponse(response), headers))
+
+    def abort(self, key):
+        """
+        Tell the requests waiting for the leader to go to Docker themselves.
+        """
+        for d in self._waiting.pop(key):
+            d.callback(None)
+
+
+def _copyResponse(response):
+    return {"PowerstripProtocolVersion": response["PowerstripProtocolVersion"],
+            "ModifiedServerResponse": dict(response["ModifiedServerResponse"])}
+
+
+class CachedDockerClient(object):
+    """
+    Answer a request with a cached or shared Docker response, offering the
+    same ``registerListener`` and ``setStreamingMode`` interface as
+    ``DockerProxyClient``.
+    """
+
+    def __init__(self, father, response, headers, hookExempt):
+        """
+        :param father: The ``Request`` from the client.
+
+        :param response: The Docker response.
+
+        :param headers: The Docker response headers.
+
+        :param hookExempt: If ``True``, the response is sent to the client
+            as it is, without running post-hooks.
+        """
+        self.father = father
+        self._response = response
+        self._hookExempt = hookExempt
+        serverResponse = response["ModifiedServerResponse"]
+        father.setResponseCode(serverResponse["Code"])
+        for name, values in headers:
+            if name.lower() not in _NOT_REPLAYED:
+                father.responseHeaders.setRawHeaders(name, values)
+
+    def registerListener(self, d):
+        if not self._hookExempt:
+            d.callback(self._response)
+            return
+        body = self._response["ModifiedServerResponse"]["Body"]
+        self.father.responseHeaders.setRawHeaders(
+            "content-length", [str(len(body))])
+        self.father.write(body)
+        self.father.finish()
+        d.callback(Failure(NoPostHooks()))
+
+    def setStreamingMode(self, streamingMode):
+        # The response has been handed over already.
+        pass
+
+    def setShareLimit(self, limit):
+        # The response is whole already.
+        pass
+
+
+class DockerEventWatcher(object):
+    """
+    Subscribe to Docker's ``/events`` stream, calling back whenever
+    something changes, and whenever the subscription is lost (since changes
+    may have been missed).  A lost subscription is retried after
+    ``retryDelay`` seconds.
+    """
+
+    retryDelay = 5
+    _running = False
+    _request = None
+    _receiver = None
+    _delayed = None
+
+    def __init__(self, agent, onChange, clock):
+        """
+        :param agent: A ``DockerAgent`` not sharing its connections with
+            other requests.
+
+        :param onChange: A callable taking no arguments.
+
+        :param clock: An ``IReactorTime`` provider.
+        """
+        self._agent = agent
+        self._onChange = onChange
+        self._clock = clock
+
+    def start(self):
+        """
+        Subscribe, if not subscribed already.
+        """
+        if self._running:
+            return
+        self._running = True
+        self._subscribe()
+
+    def stop(self):
+        """
+        Close the subscription, and stop retrying it.
+        """
+        self._running = False
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+        self._delayed = None
+        if self._request is not None:
+            self._request.cancel()
+        if self._receiver is not None:
+            self._receiver.transport.stopProducing()
+
+    def _subscribe(self):
+        self._delayed = None
+        d = self._request = self._agent.dockerRequest(
+            "GET", "/events", {}, None, 0)
+        d.addCallbacks(self._subscribed, self._lost)
+
+    def _subscribed(self, response):
+        self._request = None
+        self._receiver = _EventReceiver(self, response.code == 200)
+        response.deliverBody(self._receiver)
+
+    def _changed(self):
+        self._onChange()
+
+    def _lost(self, reason):
+        self._request = None
+        self._receiver = None
+        self._onChange()
+        if self._running:
+            log.msg("Lost the subscription to Docker events: %s" % (
+                reason.getErrorMessage(),))
+            self._delayed = self._clock.callLater(self.retryDelay,
+                                                  self._subscribe)
+
+
+class _EventReceiver(Protocol):
+    """
+    Pass the events read by ``DockerEventWatcher`` on to it.
+    """
+
+    def __init__(self, watcher, subscribed):
+        """
+        :param subscribed: ``False`` if Docker refused the subscription, in
+            which case the response is only read to its end.
+        """
+        self.watcher = watcher
+        self.subscribed = subscribed
+
+    def dataReceived(self, data):
+        if self.subscribed:
+            self.watcher._changed()
+
+    def connectionLost(self, reason):
+        self.watcher._lost(reason)
@@ -2,11 +2,18 @@
 # -*- test-case-name: powerstrip.test.test_config -*-
 
 from collections import namedtuple
+import os
 
 from twisted.python.filepath import FilePath
 from yaml import safe_load
 from yaml.error import YAMLError
 
+from ._parser import EndpointIndex
+from ._protocol import PROTOCOL_VERSIONS
+
+# The failed stamp of a configuration file which has not failed to be read.
+_NOT_FAILED = object()
+
 class NoConfiguration(Exception):
     """
     The configuration file was not found.
@@ -31,18 +38,47 @@ class PluginConfiguration(object):
 
     _default_file = b"/etc/powerstrip/adapters.yml"
 
-    def __init__(self):
+    def __init__(self, path=None):
         """
         Initializes ``PluginConfiguration`` attributes.
 
-        self._endpoints: A dict of Docker API endpoint expressions mapping to
-            dicts ``pre`` and ``post`` adapter lists. Each adapter in the adapters
-            references the ``_adapters`` attribute.
+        :param path: The path of the configuration file, if not the default
+            one.
+
+        self._snapshot: The current ``ConfigurationSnapshot``.  It is replaced
+            as a whole whenever a new configuration has been parsed
+            successfully, so anyone holding a reference to it keeps a
+            consistent view of the configuration.
+
+        self._stamp: The ``os.stat`` derived stamp of the configuration file
+            at the time it was last read, or ``None`` if it has not been read
+            yet.
+
+        self._failed_stamp: The stamp of the configuration file at the time
+            it last failed to be read or parsed, so that it isn't read again
+            until it changes.
+        """
+        self._parse_adapters({"endpoints": {}, "adapters": {}})
+        self._stamp = None
+        self._failed_stamp = _NOT_FAILED
+        if path is not None:
+            self._default_file = path
 
-        self._adapters: A dict mapping adapter names to URIs.
+    @property
+    def _endpoints(self):
+        """
+        A dict of Docker API endpoint expressions mapping to dicts ``pre`` and
+        ``post`` adapter lists. Each adapter in the adapters references the
+        ``_adapters`` attribute.
+        """
+        return self._snapshot.endpoints
+
+    @property
+    def _adapters(self):
+        """
+        A dict mapping adapter names to URIs.
         """
-        self._endpoints = {}
-        self._adapters = {}
+        return self._snapshot.adapters
 
     def read_and_parse(self):
         """
@@ -52,9 +88,69 @@ class PluginConfiguration(object):
 
         :raises: ``InvalidConfiguration`` if the file was not valid configuration.
         """
-        self.__init__() # reset all attributes
-        config_struct = self._read_from_yaml_file(None)
-        self._parse_adapters(config_struct)
+        # Stamp before reading, so that a change made while we are reading is
+        # picked up by the next call to ``reload_if_changed``.
+        stamp = self._file_stamp()
+        try:
+            config_struct = self._read_from_yaml_file(None)
+            self._parse_adapters(config_struct)
+        except (NoConfiguration, InvalidConfiguration):
+            self._failed_stamp = stamp
+            raise
+        self._stamp = stamp
+        self._failed_stamp = _NOT_FAILED
+
+    def reload_if_changed(self, force=False):
+        """
+        Read and parse the adapter configuration, but only if it has not been
+        read yet or the file has changed (by path, device, inode, size or
+        modification time) since it was last read.
+
+        :param force: If ``True``, read and parse the configuration even if
+            the file seems unchanged.
+
+        If reading or parsing fails, the previous configuration stays in
+        place, and the file isn't read again until it changes.
+
+        :raises: ``NoConfiguration`` if the configuration file was not found.
+
+        :raises: ``InvalidConfiguration`` if the file was not valid configuration.
+
+        :return: ``True`` if the configuration was reloaded, ``False``
+            otherwise.
+        """
+        if not force:
+            stamp = self._file_stamp()
+            if self._stamp is not None and stamp == self._stamp:
+                return False
+            if stamp == self._failed_stamp:
+                return False
+        self.read_and_parse()
+        return True
+
+    def loaded(self):
+        """
+        Return ``True`` if a configuration has been read and parsed.
+        """
+        return self._stamp is not None
+
+    def snapshot(self):
+        """
+        Return the current ``ConfigurationSnapshot``.
+        """
+        return self._snapshot
+
+    def _file_stamp(self):
+        """
+        Return a value which changes whenever the configuration file is
+        replaced or modified, or ``None`` if the file can not be found.
+        """
+        try:
+            st = os.stat(self._default_file)
+        except OSError:
+            return None
+        return (self._default_file, st.st_dev, st.st_ino, st.st_size,
+                st.st_mtime)
 
     def _read_from_yaml_file(self, path):
         """
@@ -83,32 +179,34 @@ class PluginConfiguration(object):
     def _parse_adapters(self, datastructure):
         """
         Take the decoded YAML configuration and store it as usable
-        datastructures. See ``self.__init__``.
+        datastructures in a new ``ConfigurationSnapshot``. See
+        ``self.__init__``.
 
         :raises: ``InvalidConfiguration`` if the configuration is invalid.
         """
         try:
-            self._endpoints = datastructure["endpoints"]
+            endpoints = datastructure["endpoints"]
         except KeyError:
             raise InvalidConfiguration("Required key 'endpoints' is missing.")
         except TypeError:
             raise InvalidConfiguration("Could not parse adapters file.")
         try:
-            self._adapters = datastructure["adapters"]
+            adapters = datastructure["adapters"]
         except KeyError:
             raise InvalidConfiguration("Required key 'adapters' is missing.")
+        adapters, options = self._parse_adapter_definitions(adapters)
 
         # Sanity check that all referenced adapters exist and that optional pre
         # and post keys are added, with no unknown keys
-        known_adapters = self.adapters()
+        known_adapters = set(adapters.keys())
         referenced_adapters = set()
-        for endpoint, config in self._endpoints.iteritems():
+        for endpoint, config in endpoints.iteritems():
             config_keys = set(config.keys())
             if not config_keys:
                 raise InvalidConfiguration(
                     "No configuration found for endpoint '%s'" % (endpoint,))
 
-            unknown_keys = config_keys - set(["pre", "post"])
+            unknown_keys = config_keys - set(["pre", "post", "notify"])
             if unknown_keys:
                 raise InvalidConfiguration(
                     "Unkonwn keys found in endpoint configuration: %s" %
@@ -121,6 +219,7 @@ class PluginConfiguration(object):
 
             referenced_adapters.update(config['pre'])
             referenced_adapters.update(config['post'])
+            referenced_adapters.update(config.get('notify', []))
 
         unkown_adapters = referenced_adapters - known_adapters
         if unkown_adapters:
@@ -128,6 +227,390 @@ class PluginConfiguration(object):
                 "Plugins were referenced in endpoint configuration but not "
                 "defined: %s" % (", ".join(unkown_adapters)))
 
+        # Only replace the current configuration once the new one has been
+        # validated completely.
+        self._snapshot = ConfigurationSnapshot(
+            endpoints=endpoints, adapters=adapters,
+            index=EndpointIndex(endpoints.keys()),
+            routes=RouteTable(endpoints, adapters, options),
+            adapter_pool=self._parse_pool(
+                datastructure.get("adapter_pool"), "adapter_pool"),
+            docker_pool=self._parse_pool(
+                datastructure.get("docker_pool"), "docker_pool"),
+            response_buffer=self._parse_buffer(
+                datastructure.get("response_buffer")),
+            notify_queue=self._parse_notify_queue(
+                datastructure.get("notify_queue")),
+            coalesce=self._parse_coalesce(datastructure.get("coalesce")),
+            response_cache=self._parse_cache(
+                datastructure.get("response_cache")),
+            listen=self._parse_listen(datastructure.get("listen")),
+            events=self._parse_events(datastructure.get("events")),
+            admin=self._parse_admin(datastructure.get("admin")))
+
+    def _parse_adapter_definitions(self, adapters):
+        """
+        Split the adapter definitions into their URIs and their other
+        settings.  An adapter is defined either by its URI alone, or by a
+        mapping with a ``uri`` and optional ``mode``, ``timeout``,
+        ``failure_policy``, ``breaker``, ``protocol``, ``stream`` and
+        ``body`` settings.
+
+        :return: A tuple of a dict mapping adapter names to URIs, and a dict
+            mapping adapter names to dicts of ``Adapter`` keyword arguments.
+
+        :raises: ``InvalidConfiguration`` if a definition is invalid.
+        """
+        uris = {}
+        options = {}
+        for name, definition in adapters.iteritems():
+            if not isinstance(definition, dict):
+                uris[name] = definition
+                options[name] = {}
+                continue
+            unknown_keys = set(definition.keys()) - set(
+                ["uri", "mode", "timeout", "failure_policy", "breaker",
+                 "protocol", "stream", "body"])
+            if unknown_keys:
+                raise InvalidConfiguration(
+                    "Unknown keys found in configuration of adapter '%s': %s" %
+                        (name, ", ".join(unknown_keys)))
+            if "uri" not in definition:
+                raise InvalidConfiguration(
+                    "Required key 'uri' is missing for adapter '%s'." % (name,))
+            mode = definition.get("mode", MODIFY)
+            if mode not in (MODIFY, OBSERVE):
+                raise InvalidConfiguration(
+                    "Adapter '%s' has unknown mode '%s'." % (name, mode))
+            timeout = definition.get("timeout", DEFAULT_ADAPTER_TIMEOUT)
+            if (not isinstance(timeout, (int, long, float)) or
+                    isinstance(timeout, bool) or timeout <= 0):
+                raise InvalidConfiguration(
+                    "The timeout of adapter '%s' must be a positive number." %
+                        (name,))
+            failure_policy = definition.get("failure_policy", FAIL_CLOSED)
+            if failure_policy not in (FAIL_CLOSED, FAIL_OPEN):
+                raise InvalidConfiguration(
+                    "The failure_policy of adapter '%s' must be '%s' or "
+                    "'%s'." % (name, FAIL_CLOSED, FAIL_OPEN))
+            protocol = definition.get("protocol", 1)
+            if (protocol not in PROTOCOL_VERSIONS or
+                    isinstance(protocol, bool)):
+                raise InvalidConfiguration(
+                    "The protocol of adapter '%s' must be one of: %s." % (
+                        name, ", ".join(map(str, PROTOCOL_VERSIONS))))
+            stream = definition.get("stream")
+            if stream is not None and (
+                    not isinstance(stream, (int, long)) or
+                    isinstance(stream, bool) or stream < 1):
+                raise InvalidConfiguration(
+                    "The stream setting of adapter '%s' must be a positive "
+                    "whole number of messages." % (name,))
+            body = definition.get("body", FULL_BODY)
+            if body not in (FULL_BODY, NO_BODY):
+                raise InvalidConfiguration(
+                    "The body setting of adapter '%s' must be '%s' or "
+                    "'%s'." % (name, FULL_BODY, NO_BODY))
+            if body == NO_BODY and stream is not None:
+                raise InvalidConfiguration(
+                    "Adapter '%s' can't be given messages without bodies." %
+                        (name,))
+            uris[name] = definition["uri"]
+            options[name] = dict(
+                mode=mode, timeout=timeout, failure_policy=failure_policy,
+                breaker=self._parse_breaker(definition.get("breaker"), name),
+                protocol=protocol, stream=stream, body=body)
+        return uris, options
+
+    def _parse_breaker(self, datastructure, name):
+        """
+        Parse the optional circuit ``breaker`` settings of an adapter.
+
+        :return: A ``BreakerConfiguration``.
+
+        :raises: ``InvalidConfiguration`` if the settings are invalid.
+        """
+        if datastructure is None:
+            return BreakerConfiguration()
+        if not isinstance(datastructure, dict):
+            raise InvalidConfiguration(
+                "The breaker of adapter '%s' must be a mapping of settings." %
+                    (name,))
+        unknown_keys = (set(datastructure.keys()) -
+                        set(BreakerConfiguration._fields))
+        if unknown_keys:
+            raise InvalidConfiguration(
+                "Unknown keys found in breaker configuration of adapter "
+                "'%s': %s" % (name, ", ".join(unknown_keys)))
+        breaker = BreakerConfiguration(**datastructure)
+        if (not isinstance(breaker.failures, (int, long)) or
+                isinstance(breaker.failures, bool) or breaker.failures < 0):
+            raise InvalidConfiguration(
+                "breaker.failures of adapter '%s' must be a whole number." %
+                    (name,))
+        for key in ("window", "cooldown"):
+            value = getattr(breaker, key)
+            if (not isinstance(value, (int, long, float)) or
+                    isinstance(value, bool) or value <= 0):
+                raise InvalidConfiguration(
+                    "breaker.%s of adapter '%s' must be a positive number." %
+                        (key, name))
+        return breaker
+
+    def _parse_pool(self, datastructure, key):
+        """
+        Parse the optional connection pool settings found under ``key``.
+
+        :return: A ``PoolConfiguration``.
+
+        :raises: ``InvalidConfiguration`` if the settings are invalid.
+        """
+        if datastructure is None:
+            return PoolConfiguration()
+        if not isinstance(datastructure, dict):
+            raise InvalidConfiguration(
+                "'%s' must be a mapping of settings." % (key,))
+        unknown_keys = set(datastructure.keys()) - set(PoolConfiguration._fields)
+        if unknown_keys:
+            raise InvalidConfiguration(
+                "Unknown keys found in %s configuration: %s" %
+                    (key, ", ".join(unknown_keys)))
+        pool = PoolConfiguration(**datastructure)
+        if (not isinstance(pool.max_per_host, (int, long)) or
+                isinstance(pool.max_per_host, bool) or pool.max_per_host < 0):
+            raise InvalidConfiguration(
+                "%s.max_per_host must be a whole number." % (key,))
+        if (not isinstance(pool.idle_timeout, (int, long, float)) or
+                isinstance(pool.idle_timeout, bool) or pool.idle_timeout <= 0):
+            raise InvalidConfiguration(
+                "%s.idle_timeout must be a positive number." % (key,))
+        if not isinstance(pool.prewarm, bool):
+            raise InvalidConfiguration(
+                "%s.prewarm must be true or false." % (key,))
+        return pool
+
+    def _parse_buffer(self, datastructure):
+        """
+        Parse the optional ``response_buffer`` settings.
+
+        :return: A ``BufferConfiguration``.
+
+        :raises: ``InvalidConfiguration`` if the settings are invalid.
+        """
+        if datastructure is None:
+            return BufferConfiguration()
+        if not isinstance(datastructure, dict):
+            raise InvalidConfiguration(
+                "'response_buffer' must be a mapping of settings.")
+        unknown_keys = set(datastructure.keys()) - set(BufferConfiguration._fields)
+        if unknown_keys:
+            raise InvalidConfiguration(
+                "Unknown keys found in response_buffer configuration: %s" %
+                    (", ".join(unknown_keys)))
+        buffer = BufferConfiguration(**datastructure)
+        if (not isinstance(buffer.memory_limit, (int, long)) or
+                isinstance(buffer.memory_limit, bool) or
+                buffer.memory_limit < 0):
+            raise InvalidConfiguration(
+                "response_buffer.memory_limit must be a number of bytes.")
+        if buffer.max_size is not None and (
+                not isinstance(buffer.max_size, (int, long)) or
+                isinstance(buffer.max_size, bool) or
+                buffer.max_size <= 0):
+            raise InvalidConfiguration(
+                "response_buffer.max_size must be a number of bytes, or "
+                "null for no limit.")
+        return buffer
+
+    def _parse_notify_queue(self, datastructure):
+        """
+        Parse the optional ``notify_queue`` settings.
+
+        :return: A ``NotifyQueueConfiguration``.
+
+        :raises: ``InvalidConfiguration`` if the settings are invalid.
+        """
+        if datastructure is None:
+            return NotifyQueueConfiguration()
+        if not isinstance(datastructure, dict):
+            raise InvalidConfiguration(
+                "'notify_queue' must be a mapping of settings.")
+        unknown_keys = (set(datastructure.keys()) -
+                        set(NotifyQueueConfiguration._fields))
+        if unknown_keys:
+            raise InvalidConfiguration(
+                "Unknown keys found in notify_queue configuration: %s" %
+                    (", ".join(unknown_keys)))
+        queue = NotifyQueueConfiguration(**datastructure)
+        for key in ("max_size", "concurrency", "batch_size"):
+            value = getattr(queue, key)
+            if (not isinstance(value, (int, long)) or
+                    isinstance(value, bool) or value < 1):
+                raise InvalidConfiguration(
+                    "notify_queue.%s must be a whole number of at least 1." %
+                        (key,))
+        if queue.overflow not in (DROP_NEWEST, DROP_OLDEST):
+            raise InvalidConfiguration(
+                "notify_queue.overflow must be '%s' or '%s'." %
+                    (DROP_NEWEST, DROP_OLDEST))
+        return queue
+
+    def _parse_coalesce(self, datastructure):
+        """
+        Parse the optional ``coalesce`` settings.
+
+        :return: A ``CoalesceConfiguration``.
+
+        :raises: ``InvalidConfiguration`` if the settings are invalid.
+        """
+        if datastructure is None:
+            return CoalesceConfiguration()
+        if not isinstance(datastructure, dict):
+            raise InvalidConfiguration(
+                "'coalesce' must be a mapping of settings.")
+        unknown_keys = (set(datastructure.keys()) -
+                        set(CoalesceConfiguration._fields))
+        if unknown_keys:
+            raise InvalidConfiguration(
+                "Unknown keys found in coalesce configuration: %s" %
+                    (", ".join(unknown_keys)))
+        coalesce = CoalesceConfiguration(**datastructure)
+        if not isinstance(coalesce.enabled, bool):
+            raise InvalidConfiguration(
+                "coalesce.enabled must be true or false.")
+        if (not isinstance(coalesce.max_bytes, (int, long)) or
+                isinstance(coalesce.max_bytes, bool) or
+                coalesce.max_bytes < 0):
+            raise InvalidConfiguration(
+                "coalesce.max_bytes must be a number of bytes.")
+        return coalesce
+
+    def _parse_cache(self, datastructure):
+        """
+        Parse the optional ``response_cache`` settings.
+
+        :return: A ``CacheConfiguration``.
+
+        :raises: ``InvalidConfiguration`` if the settings are invalid.
+        """
+        if datastructure is None:
+            return CacheConfiguration()
+        if not isinstance(datastructure, dict):
+            raise InvalidConfiguration(
+                "'response_cache' must be a mapping of settings.")
+        unknown_keys = (set(datastructure.keys()) -
+                        set(CacheConfiguration._fields))
+        if unknown_keys:
+            raise InvalidConfiguration(
+                "Unknown keys found in response_cache configuration: %s" %
+                    (", ".join(unknown_keys)))
+        cache = CacheConfiguration(**datastructure)
+        if (not isinstance(cache.endpoints, (list, tuple)) or
+                not all(isinstance(endpoint, basestring) and
+                        endpoint.startswith("GET ")
+                        for endpoint in cache.endpoints)):
+            raise InvalidConfiguration(
+                "response_cache.endpoints must be a list of GET endpoint "
+                "expressions.")
+        if (not isinstance(cache.ttl, (int, long, float)) or
+                isinstance(cache.ttl, bool) or cache.ttl <= 0):
+            raise InvalidConfiguration(
+                "response_cache.ttl must be a positive number.")
+        if (not isinstance(cache.max_bytes, (int, long)) or
+                isinstance(cache.max_bytes, bool) or cache.max_bytes < 0):
+            raise InvalidConfiguration(
+                "response_cache.max_bytes must be a number of bytes.")
+        if (not isinstance(cache.vary, (list, tuple)) or
+                not all(isinstance(name, basestring) for name in cache.vary)):
+            raise InvalidConfiguration(
+                "response_cache.vary must be a list of header names.")
+        for key in ("hook_exempt", "watch_events"):
+            if not isinstance(getattr(cache, key), bool):
+                raise InvalidConfiguration(
+                    "response_cache.%s must be true or false." % (key,))
+        return cache._replace(endpoints=tuple(cache.endpoints),
+                              vary=tuple(name.lower() for name in cache.vary))
+
+    def _parse_events(self, datastructure):
+        """
+        Parse the optional ``events`` settings.
+
+        :return: An ``EventsConfiguration``.
+
+        :raises: ``InvalidConfiguration`` if the settings are invalid.
+        """
+        if datastructure is None:
+            return EventsConfiguration()
+        if not isinstance(datastructure, dict):
+            raise InvalidConfiguration(
+                "'events' must be a mapping of settings.")
+        unknown_keys = (set(datastructure.keys()) -
+                        set(EventsConfiguration._fields))
+        if unknown_keys:
+            raise InvalidConfiguration(
+                "Unknown keys found in events configuration: %s" %
+                    (", ".join(unknown_keys)))
+        events = EventsConfiguration(**datastructure)
+        if not isinstance(events.multiplex, bool):
+            raise InvalidConfiguration(
+                "events.multiplex must be true or false.")
+        for key in ("buffer", "replay"):
+            value = getattr(events, key)
+            if (not isinstance(value, (int, long)) or
+                    isinstance(value, bool) or value < 0):
+                raise InvalidConfiguration(
+                    "events.%s must be a whole number." % (key,))
+        return events
+
+    def _parse_listen(self, datastructure):
+        """
+        Parse the optional ``listen`` list of listeners.
+
+        :return: A ``tuple`` of ``ListenerConfiguration``, empty if no
+            listeners are configured.
+
+        :raises: ``InvalidConfiguration`` if the settings are invalid.
+        """
+        if datastructure is None:
+            return ()
+        if not isinstance(datastructure, list) or not datastructure:
+            raise InvalidConfiguration(
+                "'listen' must be a list of listeners.")
+        return tuple(parse_listener(listener, "listen[%d]" % (i,))
+                     for i, listener in enumerate(datastructure))
+
+    def _parse_admin(self, datastructure):
+        """
+        Parse the optional ``admin`` settings.
+
+        :return: An ``AdminConfiguration``.
+
+        :raises: ``InvalidConfiguration`` if the settings are invalid.
+        """
+        if datastructure is None:
+            return AdminConfiguration()
+        if not isinstance(datastructure, dict):
+            raise InvalidConfiguration(
+                "'admin' must be a mapping of settings.")
+        unknown_keys = (set(datastructure.keys()) -
+                        set(AdminConfiguration._fields))
+        if unknown_keys:
+            raise InvalidConfiguration(
+                "Unknown keys found in admin configuration: %s" %
+                    (", ".join(unknown_keys)))
+        admin = AdminConfiguration(**datastructure)
+        if admin.port is not None and (
+                not isinstance(admin.port, (int, long)) or
+                isinstance(admin.port, bool) or
+                not 0 <= admin.port <= 65535):
+            raise InvalidConfiguration(
+                "admin.port must be a port number, or null for no admin "
+                "port.")
+        if not isinstance(admin.interface, basestring):
+            raise InvalidConfiguration(
+                "admin.interface must be an address.")
+        return admin
+
     def endpoints(self):
         """
         Return a ``set`` of endpoint expressions.
@@ -161,11 +644,541 @@ class PluginConfiguration(object):
         return self._adapters[adapter]
 
 
-class EndpointConfiguration(namedtuple("EndpointConfiguration", ["pre", "post"])):
+class EndpointConfiguration(namedtuple("EndpointConfiguration", ["pre", "post", "notify"])):
     """
     A representation of the configured adapters for an endpoint.
 
     :param pre: A adapter ``list`` to call before passing this call to Docker.
 
     :param post: A adapter ``list`` to call after passing this call to Docker.
+
+    :param notify: A adapter ``list`` to notify once the response has been
+        sent to the client.
+    """
+
+    def __new__(cls, pre, post, notify=()):
+        return super(EndpointConfiguration, cls).__new__(cls, pre, post, notify)
+
+
+class ConfigurationSnapshot(namedtuple("ConfigurationSnapshot",
+                                       ["endpoints", "adapters", "index",
+                                        "routes", "adapter_pool",
+                                        "docker_pool", "response_buffer",
+                                        "notify_queue", "coalesce",
+                                        "response_cache", "listen", "events",
+                                        "admin"])):
+    """
+    An immutable view of a parsed adapter configuration.  It must not be
+    modified once created; a new snapshot is created whenever the
+    configuration is reloaded.
+
+    :param endpoints: A dict of Docker API endpoint expressions mapping to
+        dicts with ``pre`` and ``post`` adapter lists.
+
+    :param adapters: A dict mapping adapter names to URIs.
+
+    :param index: An ``EndpointIndex`` compiled from the endpoint expressions.
+
+    :param routes: A ``RouteTable`` resolved from the endpoints and adapters.
+
+    :param adapter_pool: The ``PoolConfiguration`` for connections to
+        adapters.
+
+    :param docker_pool: The ``PoolConfiguration`` for keep-alive connections
+        to the Docker daemon.
+
+    :param response_buffer: The ``BufferConfiguration`` for Docker responses
+        collected for post-hooks.
+
+    :param notify_queue: The ``NotifyQueueConfiguration`` for delivering
+        notifications.
+
+    :param coalesce: The ``CoalesceConfiguration`` for sharing Docker
+        responses between identical requests in flight.
+
+    :param response_cache: The ``CacheConfiguration`` for caching Docker
+        responses.
+
+    :param listen: A ``tuple`` of ``ListenerConfiguration`` for the sockets
+        to serve the Docker API on, empty if not configured.  Listeners are
+        only set up when powerstrip starts, so changes to them need a
+        restart.
+
+    :param events: The ``EventsConfiguration`` for sharing Docker's
+        ``/events`` streams.
+
+    :param admin: The ``AdminConfiguration`` of the admin port.  Like
+        listeners, it is only set up when powerstrip starts.
+    """
+
+
+class PoolConfiguration(namedtuple("PoolConfiguration",
+                                   ["max_per_host", "idle_timeout",
+                                    "prewarm"])):
     """
+    Settings for a pool of persistent HTTP connections.
+
+    :param max_per_host: The maximum number of idle connections kept per
+        host.  0 turns off persistent connections.
+
+    :param idle_timeout: The number of seconds an idle connection is kept.
+
+    :param prewarm: Whether connections are opened when powerstrip starts,
+        rather than when they are first needed.
+    """
+
+    def __new__(cls, max_per_host=2, idle_timeout=240, prewarm=False):
+        return super(PoolConfiguration, cls).__new__(
+            cls, max_per_host, idle_timeout, prewarm)
+
+
+class BufferConfiguration(namedtuple("BufferConfiguration",
+                                     ["memory_limit", "max_size"])):
+    """
+    Settings for collecting Docker responses for post-hooks.
+
+    :param memory_limit: The number of bytes of a response kept in memory;
+        larger responses are spilled to a temporary file.
+
+    :param max_size: The most bytes a response may have, or ``None`` (the
+        default) for no limit; larger responses are refused, since post-hooks
+        are given them whole.
+    """
+
+    def __new__(cls, memory_limit=4 * 1024 * 1024, max_size=None):
+        return super(BufferConfiguration, cls).__new__(
+            cls, memory_limit, max_size)
+
+
+class CoalesceConfiguration(namedtuple("CoalesceConfiguration",
+                                       ["enabled", "max_bytes"])):
+    """
+    Settings for sharing the Docker response to a request with identical
+    requests made while it is in flight.
+
+    :param enabled: Whether identical requests are coalesced.
+
+    :param max_bytes: The most bytes of a response collected to share it.
+        A response to a request without post-hooks which grows larger is
+        streamed to its client instead, and the other requests are sent to
+        Docker themselves.
+    """
+
+    def __new__(cls, enabled=False, max_bytes=1024 * 1024):
+        return super(CoalesceConfiguration, cls).__new__(
+            cls, enabled, max_bytes)
+
+
+class CacheConfiguration(namedtuple("CacheConfiguration",
+                                    ["endpoints", "ttl", "max_bytes", "vary",
+                                     "hook_exempt", "watch_events"])):
+    """
+    Settings for caching Docker responses to read-only API calls.
+
+    :param endpoints: A ``tuple`` of ``GET`` endpoint expressions whose
+        responses are cached.  The cache is off if there are none.
+
+    :param ttl: The number of seconds a response is cached.
+
+    :param max_bytes: The total size of the cached response bodies.
+
+    :param vary: A ``tuple`` of lower case request header names whose values
+        are part of the cache key, along with the method and the URI.
+
+    :param hook_exempt: If ``True``, responses served from the cache skip
+        post-hooks; otherwise post-hooks run on them as on responses from
+        Docker.
+
+    :param watch_events: Whether to drop the cached responses whenever
+        Docker's ``/events`` stream reports a change.
+    """
+
+    def __new__(cls, endpoints=(), ttl=1.0, max_bytes=16 * 1024 * 1024,
+                vary=("accept", "authorization", "x-registry-auth"),
+                hook_exempt=False, watch_events=True):
+        return super(CacheConfiguration, cls).__new__(
+            cls, endpoints, ttl, max_bytes, vary, hook_exempt, watch_events)
+
+
+class EventsConfiguration(namedtuple("EventsConfiguration",
+                                     ["multiplex", "buffer", "replay"])):
+    """
+    Settings for sharing Docker's ``/events`` streams between clients.
+
+    :param multiplex: Whether clients subscribing with the same query share
+        one stream from Docker.
+
+    :param buffer: The number of events queued for a client which doesn't
+        keep up, before it is disconnected.
+
+    :param replay: The number of events of a stream subscribed with
+        ``since`` kept for clients joining it late.
+    """
+
+    def __new__(cls, multiplex=True, buffer=1000, replay=256):
+        return super(EventsConfiguration, cls).__new__(
+            cls, multiplex, buffer, replay)
+
+
+class ListenerConfiguration(namedtuple("ListenerConfiguration",
+                                       ["unix", "tcp", "interface",
+                                        "backlog", "mode", "owner",
+                                        "group"])):
+    """
+    A socket to serve the Docker API on: either a UNIX socket or a TCP port.
+
+    :param unix: The path of the UNIX socket, or ``None`` for a TCP port.
+
+    :param tcp: The TCP port number, or ``None`` for a UNIX socket.
+
+    :param interface: The interface to listen on, for a TCP port.
+
+    :param backlog: The number of connections waiting to be accepted the
+        kernel queues.
+
+    :param mode: The permissions of the UNIX socket.
+
+    :param owner: The user name or id owning the UNIX socket, or ``None`` to
+        leave it owned by the user powerstrip runs as.
+
+    :param group: The group name or id of the UNIX socket, or ``None``.
+    """
+
+    def __new__(cls, unix=None, tcp=None, interface="0.0.0.0", backlog=50,
+                mode=0660, owner=None, group=None):
+        return super(ListenerConfiguration, cls).__new__(
+            cls, unix, tcp, interface, backlog, mode, owner, group)
+
+
+class AdminConfiguration(namedtuple("AdminConfiguration",
+                                    ["port", "interface"])):
+    """
+    The admin port, serving metrics and the state of circuit breakers.
+
+    :param port: The TCP port number, or ``None`` for no admin port.
+
+    :param interface: The interface to listen on.  By default only this host
+        can reach the admin port; serving it to others has to be asked for.
+    """
+
+    def __new__(cls, port=2378, interface="127.0.0.1"):
+        return super(AdminConfiguration, cls).__new__(cls, port, interface)
+
+
+def parse_listener(datastructure, key):
+    """
+    Parse the settings of a listener, such as
+    ``{"unix": "/var/run/powerstrip.sock", "group": "docker"}`` or
+    ``{"tcp": 2375, "interface": "127.0.0.1"}``.
+
+    :param key: Where the settings were found, for error messages.
+
+    :return: A ``ListenerConfiguration``.
+
+    :raises: ``InvalidConfiguration`` if the settings are invalid.
+    """
+    if not isinstance(datastructure, dict):
+        raise InvalidConfiguration(
+            "%s must be a mapping of settings." % (key,))
+    unknown_keys = (set(datastructure.keys()) -
+                    set(ListenerConfiguration._fields))
+    if unknown_keys:
+        raise InvalidConfiguration(
+            "Unknown keys found in %s configuration: %s" %
+                (key, ", ".join(unknown_keys)))
+    listener = ListenerConfiguration(**datastructure)
+    if (listener.unix is None) == (listener.tcp is None):
+        raise InvalidConfiguration(
+            "%s must have either a 'unix' path or a 'tcp' port." % (key,))
+    if listener.unix is not None:
+        if not isinstance(listener.unix, basestring) or not listener.unix:
+            raise InvalidConfiguration(
+                "%s.unix must be the path of a socket." % (key,))
+        if isinstance(listener.mode, basestring):
+            try:
+                listener = listener._replace(mode=int(listener.mode, 8))
+            except ValueError:
+                pass
+        if (not isinstance(listener.mode, (int, long)) or
+                isinstance(listener.mode, bool) or
+                not 0 <= listener.mode <= 0777):
+            raise InvalidConfiguration(
+                "%s.mode must be octal permissions, such as 0660." % (key,))
+        for name in ("owner", "group"):
+            value = getattr(listener, name)
+            if value is not None and (
+                    isinstance(value, bool) or
+                    not isinstance(value, (basestring, int, long))):
+                raise InvalidConfiguration(
+                    "%s.%s must be a name or a numeric id." % (key, name))
+    else:
+        if (not isinstance(listener.tcp, (int, long)) or
+                isinstance(listener.tcp, bool) or
+                not 0 <= listener.tcp <= 65535):
+            raise InvalidConfiguration(
+                "%s.tcp must be a port number." % (key,))
+        if not isinstance(listener.interface, basestring):
+            raise InvalidConfiguration(
+                "%s.interface must be an address." % (key,))
+        if "mode" in datastructure or "owner" in datastructure or (
+                "group" in datastructure):
+            raise InvalidConfiguration(
+                "%s: mode, owner and group only apply to UNIX sockets." %
+                    (key,))
+    if (not isinstance(listener.backlog, (int, long)) or
+            isinstance(listener.backlog, bool) or listener.backlog < 1):
+        raise InvalidConfiguration(
+            "%s.backlog must be a whole number of at least 1." % (key,))
+    return listener
+
+
+# What to do with a notification when the queue of its adapter is full.
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+
+
+class NotifyQueueConfiguration(namedtuple("NotifyQueueConfiguration",
+                                          ["max_size", "concurrency",
+                                           "batch_size", "overflow"])):
+    """
+    Settings for the queues of notifications to adapters.
+
+    :param max_size: The number of notifications kept per adapter while
+        waiting to be delivered.
+
+    :param concurrency: The number of deliveries in progress per adapter.
+
+    :param batch_size: The number of notifications delivered at most in one
+        request.
+
+    :param overflow: ``DROP_NEWEST`` to discard new notifications when a
+        queue is full, or ``DROP_OLDEST`` to discard the oldest queued one.
+    """
+
+    def __new__(cls, max_size=1000, concurrency=2, batch_size=10,
+                overflow=DROP_OLDEST):
+        return super(NotifyQueueConfiguration, cls).__new__(
+            cls, max_size, concurrency, batch_size, overflow)
+
+
+# Adapter modes: the responses of ``MODIFY`` adapters replace the request or
+# response, while ``OBSERVE`` adapters are only told about it.
+MODIFY = "modify"
+OBSERVE = "observe"
+
+# What to do when an adapter can't be reached, times out or answers with a
+# server error: ``FAIL_CLOSED`` returns an error to the client, while
+# ``FAIL_OPEN`` skips the adapter as if it had not changed anything.
+FAIL_CLOSED = "fail-closed"
+FAIL_OPEN = "fail-open"
+
+# What adapters are given of a response body: ``FULL_BODY`` adapters are given
+# the body, while ``NO_BODY`` adapters are only given the status code and
+# content type, and can't change the body.
+FULL_BODY = "full"
+NO_BODY = "none"
+
+# The number of seconds an adapter has to answer a hook, unless configured.
+DEFAULT_ADAPTER_TIMEOUT = 300
+
+
+class BreakerConfiguration(namedtuple("BreakerConfiguration",
+                                      ["failures", "window", "cooldown"])):
+    """
+    Settings for the circuit breaker of an adapter.
+
+    :param failures: The number of failures within ``window`` which open the
+        breaker.  0 turns off the breaker.
+
+    :param window: The number of seconds failures are counted over.
+
+    :param cooldown: The number of seconds an open breaker fails calls
+        straight away, before letting a single call through to find out
+        whether the adapter has recovered.
+    """
+
+    def __new__(cls, failures=5, window=60, cooldown=30):
+        return super(BreakerConfiguration, cls).__new__(
+            cls, failures, window, cooldown)
+
+
+class Adapter(namedtuple("Adapter", ["name", "uri", "mode", "timeout",
+                                     "failure_policy", "breaker",
+                                     "protocol", "stream", "body"])):
+    """
+    A configured adapter, resolved from its name.
+
+    :param name: The name the adapter is configured with.
+
+    :param uri: The URI to POST hooks to.
+
+    :param mode: ``MODIFY`` or ``OBSERVE``.
+
+    :param timeout: The number of seconds the adapter has to answer a hook.
+
+    :param failure_policy: ``FAIL_CLOSED`` or ``FAIL_OPEN``.
+
+    :param breaker: The ``BreakerConfiguration`` of the adapter.
+
+    :param protocol: The version of the hook protocol to send hooks in.
+
+    :param stream: The most messages of a streamed JSON response to send the
+        adapter in one post-hook, or ``None`` if it is only to be given whole
+        responses.
+
+    :param body: ``FULL_BODY`` or ``NO_BODY``.
+    """
+
+    def __new__(cls, name, uri, mode=MODIFY, timeout=DEFAULT_ADAPTER_TIMEOUT,
+                failure_policy=FAIL_CLOSED, breaker=BreakerConfiguration(),
+                protocol=1, stream=None, body=FULL_BODY):
+        return super(Adapter, cls).__new__(
+            cls, name, uri, mode, timeout, failure_policy, breaker, protocol,
+            stream, body)
+
+
+class HookChain(namedtuple("HookChain", ["pre", "post", "preObservers",
+                                         "postObservers", "notify"])):
+    """
+    The resolved adapters to call for a request.
+
+    :param pre: A ``tuple`` of ``MODIFY`` ``Adapter`` to call, in order,
+        before passing the request to Docker.
+
+    :param post: A ``tuple`` of ``MODIFY`` ``Adapter`` to call, in order,
+        after Docker has responded.
+
+    :param preObservers: A ``tuple`` of ``OBSERVE`` ``Adapter`` to call
+        concurrently with the ``pre`` hooks.
+
+    :param postObservers: A ``tuple`` of ``OBSERVE`` ``Adapter`` to call
+        concurrently with the ``post`` hooks.
+
+    :param notify: A ``tuple`` of ``Adapter`` to notify once the response
+        has been sent to the client.
+    """
+
+    def __new__(cls, pre, post, preObservers=(), postObservers=(),
+                notify=()):
+        return super(HookChain, cls).__new__(
+            cls, pre, post, preObservers, postObservers, notify)
+
+    @property
+    def hasPreHooks(self):
+        return bool(self.pre or self.preObservers)
+
+    @property
+    def hasPostHooks(self):
+        return bool(self.post or self.postObservers)
+
+    @property
+    def messageBatch(self):
+        """
+        The most messages of a streamed JSON response to pass through the
+        post-hooks at a time, or ``None`` unless all of them take messages:
+        the smallest ``stream`` setting of the post-hook adapters.
+        """
+        adapters = self.post + self.postObservers
+        if not adapters or any(a.stream is None for a in adapters):
+            return None
+        return min(a.stream for a in adapters)
+
+    @property
+    def headersOnly(self):
+        """
+        Whether there are post-hooks, none of which are given the response
+        body, so that they can be run as soon as the headers arrive.
+        """
+        adapters = self.post + self.postObservers
+        return bool(adapters) and all(a.body == NO_BODY for a in adapters)
+
+    def __add__(self, other):
+        """
+        Join two chains, running the hooks of ``other`` after ours.
+        """
+        return HookChain(pre=self.pre + other.pre, post=self.post + other.post,
+                         preObservers=self.preObservers + other.preObservers,
+                         postObservers=self.postObservers + other.postObservers,
+                         notify=self.notify + other.notify)
+
+
+EMPTY_CHAIN = HookChain(pre=(), post=())
+
+
+class RouteTable(object):
+    """
+    An immutable mapping from endpoint expressions to the ``HookChain`` to
+    run for requests matching them, resolved when the configuration is
+    loaded.
+
+    Identical chains are shared between endpoints, and the chain for every
+    combination of matched endpoints is only built once.
+    """
+
+    # Bound the number of remembered combinations, in case matching produces
+    # a lot of them.
+    _maxCombinations = 1024
+
+    def __init__(self, endpoints, adapters, options=None):
+        """
+        :param endpoints: A dict of endpoint expressions mapping to dicts with
+            ``pre`` and ``post`` lists of adapter names.
+
+        :param adapters: A dict mapping adapter names to URIs.
+
+        :param options: A dict mapping adapter names to dicts of further
+            ``Adapter`` keyword arguments.  Adapters which are missing get the
+            defaults.
+        """
+        if options is None:
+            options = {}
+        resolved = dict((name, Adapter(name=name, uri=uri,
+                                       **options.get(name, {})))
+                        for name, uri in adapters.iteritems())
+        chains = {}
+        self._routes = {}
+        for endpoint, config in endpoints.iteritems():
+            pre = [resolved[name] for name in config["pre"]]
+            post = [resolved[name] for name in config["post"]]
+            chain = HookChain(
+                pre=tuple(a for a in pre if a.mode == MODIFY),
+                post=tuple(a for a in post if a.mode == MODIFY),
+                preObservers=tuple(a for a in pre if a.mode == OBSERVE),
+                postObservers=tuple(a for a in post if a.mode == OBSERVE),
+                notify=tuple(resolved[name]
+                             for name in config.get("notify", ())))
+            self._routes[endpoint] = chains.setdefault(chain, chain)
+        self._combinations = {}
+
+    def route(self, endpoint):
+        """
+        Return the ``HookChain`` for a single endpoint expression.
+
+        :raises: `KeyError` if the endpoint expression was not found.
+        """
+        return self._routes[endpoint]
+
+    def chain(self, endpoints):
+        """
+        Return the ``HookChain`` for a request which matched all of the
+        given endpoint expressions.  The chains of the endpoints are joined in
+        the sorted order of the expressions.
+
+        :param endpoints: A ``set`` of endpoint expressions, as returned by
+            ``EndpointParser.match_endpoint``.
+        """
+        if not endpoints:
+            return EMPTY_CHAIN
+        if len(endpoints) == 1:
+            for endpoint in endpoints:
+                return self._routes[endpoint]
+        key = frozenset(endpoints)
+        chain = self._combinations.get(key)
+        if chain is None:
+            chain = EMPTY_CHAIN
+            for endpoint in sorted(key):
+                chain += self._routes[endpoint]
+            if len(self._combinations) >= self._maxCombinations:
+                self._combinations.clear()
+            self._combinations[key] = chain
+        return chain
@@ -0,0 +1,411 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_events -*-
+
+"""
+Sharing Docker's ``/events`` streams between the clients subscribing to them.
+
+Clients subscribing with the same API version and query (``filters``,
+``since``...) share one stream from Docker.  Each event read from it is
+written to every subscriber; a subscriber which can't keep up is queued up to
+a limit, and disconnected beyond it.
+
+A stream subscribed with ``since`` starts with past events.  A client joining
+it late is first sent the events already read from it, kept in a replay
+buffer, as long as none have been dropped from there; otherwise it gets a
+stream of its own.  Clients subscribing without ``since`` only get the events
+from then on, as they would from Docker.
+"""
+
+from collections import deque
+from urlparse import parse_qsl
+
+from zope.interface import implementer
+
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Protocol
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
+
+from ._config import EventsConfiguration
+from ._jsonstream import JSONStreamParser
+from ._parser import EndpointIndex
+from ._upstream import NoPostHooks
+
+EVENTS_ENDPOINTS = EndpointIndex(["GET /*events"])
+
+# Headers of Docker's response which apply to its connection to powerstrip.
+_NOT_RELAYED = frozenset([
+    "connection", "keep-alive", "transfer-encoding", "content-length"])
+
+
+class EventsMultiplexer(object):
+    """
+    Share upstream ``/events`` streams between subscribers.
+
+    self.events: The number of events read from Docker.
+
+    self.slowSubscribers: The number of subscribers disconnected for not
+        keeping up.
+    """
+
+    events = 0
+    slowSubscribers = 0
+
+    def __init__(self, agent, settings=EventsConfiguration()):
+        """
+        :param agent: A ``DockerAgent`` not sharing its connections with
+            other requests.
+
+        :param settings: The ``EventsConfiguration``.
+        """
+        self._agent = agent
+        self.settings = settings
+        self._upstreams = {}
+        self._all = set()
+
+    def configure(self, settings):
+        """
+        Apply new settings, to the streams subscribed from then on.
+        """
+        self.settings = settings
+
+    def multiplexable(self, method, path, query):
+        """
+        Return ``True`` if a request can share an ``/events`` stream.
+        Streams ending at a given time (``until``) aren't shared.
+
+        :param path: The request path, without the query.
+
+        :param query: The query part of the request URI.
+        """
+        return (self.settings.multiplex and
+                bool(EVENTS_ENDPOINTS.match(method, path)) and
+                "until" not in dict(parse_qsl(query)))
+
+    def upstreams(self):
+        """
+        Return the number of streams from Docker.
+        """
+        return len(self._all)
+
+    def subscribers(self):
+        """
+        Return the number of subscribers to all streams.
+        """
+        return sum(len(upstream.subscribers) for upstream in self._all)
+
+    def subscribe(self, request, path, query):
+        """
+        Subscribe a client to the stream of events for its request.
+
+        :param request: The ``Request`` from the client.
+
+        :param path: The request path, without the query.
+
+        :param query: The query part of the request URI.
+
+        :return: An object offering the ``registerListener`` and
+            ``setStreamingMode`` interface of ``DockerProxyClient``.
+        """
+        pairs = parse_qsl(query, keep_blank_values=True)
+        key = (path, tuple(sorted(pairs)))
+        upstream = self._upstreams.get(key)
+        if upstream is None or not upstream.joinable():
+            upstream = _Upstream(self, key, path + ("?" + query if query
+                                                    else ""),
+                                 replay="since" in dict(pairs))
+            self._upstreams[key] = upstream
+            self._all.add(upstream)
+            upstream.connect(self._agent)
+        subscriber = _Subscriber(request, upstream, self.settings.buffer)
+        upstream.add(subscriber)
+        return subscriber
+
+    def stop(self):
+        """
+        Close all streams, and the connections of their subscribers.
+        """
+        for upstream in list(self._all):
+            upstream.close()
+
+    def _ended(self, upstream):
+        self._all.discard(upstream)
+        if self._upstreams.get(upstream.key) is upstream:
+            del self._upstreams[upstream.key]
+
+
+class _Upstream(object):
+    """
+    A stream of events from Docker, and its subscribers.
+    """
+
+    _response = None
+    _request = None
+    _receiver = None
+    _evicted = False
+    _error = False
+    _done = False
+
+    def __init__(self, multiplexer, key, rest, replay):
+        """
+        :param rest: The request path, including any query part.
+
+        :param replay: Whether clients joining late are sent the events read
+            so far.
+        """
+        self.multiplexer = multiplexer
+        self.key = key
+        self.rest = rest
+        self.subscribers = []
+        self._replay = None
+        if replay:
+            self._replay = deque()
+            self._replayLimit = multiplexer.settings.replay
+        self._parser = JSONStreamParser()
+
+    def joinable(self):
+        """
+        Return ``True`` if a new subscriber can share this stream.
+        """
+        return not (self._done or self._error or self._evicted)
+
+    def connect(self, agent):
+        d = self._request = agent.dockerRequest("GET", self.rest, {}, None, 0)
+        d.addCallbacks(self._gotResponse, self._failed)
+        d.addErrback(log.err, "while subscribing to Docker events")
+
+    def add(self, subscriber):
+        self.subscribers.append(subscriber)
+        if self._response is not None:
+            subscriber.start(self._response)
+            if self._replay is not None:
+                for raw in self._replay:
+                    subscriber.send(raw)
+
+    def remove(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+            if not self.subscribers:
+                self.close()
+
+    def close(self):
+        """
+        Stop reading from Docker, and disconnect the subscribers.
+        """
+        if self._done:
+            return
+        self._done = True
+        self.multiplexer._ended(self)
+        if self._request is not None:
+            self._request.cancel()
+        if self._receiver is not None:
+            self._receiver.transport.stopProducing()
+        for subscriber in list(self.subscribers):
+            subscriber.disconnect()
+
+    def _gotResponse(self, response):
+        self._request = None
+        if self._done:
+            response.deliverBody(_Discard())
+            return
+        headers = [(name, values)
+                   for name, values in response.headers.getAllRawHeaders()
+                   if name.lower() not in _NOT_RELAYED]
+        self._response = (response.code, response.phrase, headers)
+        if response.code != 200:
+            # Errors are passed on as they are, to the clients waiting for
+            # them only.
+            self._error = True
+            self._replay = None
+            self._parser = None
+        for subscriber in list(self.subscribers):
+            subscriber.start(self._response)
+        self._receiver = _EventsReceiver(self)
+        response.deliverBody(self._receiver)
+
+    def _failed(self, reason):
+        self._request = None
+        if self._done:
+            return
+        self._done = True
+        self.multiplexer._ended(self)
+        log.msg("Could not subscribe to Docker events: %s" % (
+            reason.getErrorMessage(),))
+        for subscriber in list(self.subscribers):
+            subscriber.fail()
+
+    def _dataReceived(self, data):
+        if self._parser is None:
+            for subscriber in list(self.subscribers):
+                subscriber.send(data)
+            return
+        try:
+            documents = self._parser.feed(data)
+        except ValueError:
+            log.err(None, "while reading Docker events")
+            self.close()
+            return
+        for raw, value in documents:
+            self.multiplexer.events += 1
+            if self._replay is not None and not self._evicted:
+                if len(self._replay) < self._replayLimit:
+                    self._replay.append(raw)
+                else:
+                    self._evicted = True
+                    self._replay = None
+            for subscriber in list(self.subscribers):
+                subscriber.send(raw)
+
+    def _connectionLost(self, reason):
+        self._receiver = None
+        if self._done:
+            return
+        self._done = True
+        self.multiplexer._ended(self)
+        complete = reason.check(ResponseDone, PotentialDataLoss)
+        for subscriber in list(self.subscribers):
+            if complete:
+                subscriber.finish()
+            else:
+                subscriber.disconnect()
+
+
+class _EventsReceiver(Protocol):
+    """
+    Pass the events stream from ``Response.deliverBody`` on to an
+    ``_Upstream``.
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+
+    def dataReceived(self, data):
+        self.upstream._dataReceived(data)
+
+    def connectionLost(self, reason):
+        self.upstream._connectionLost(reason)
+
+
+class _Discard(Protocol):
+    """
+    Stop reading a response nobody wants any more.
+    """
+
+    def connectionMade(self):
+        self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        pass
+
+
+@implementer(IPushProducer)
+class _Subscriber(object):
+    """
+    A client subscribed to an ``_Upstream``.  While the connection to the
+    client can't take more, events are queued, up to ``limit`` of them.
+    """
+
+    _paused = False
+    _started = False
+    _gone = False
+
+    def __init__(self, request, upstream, limit):
+        self.request = request
+        self.upstream = upstream
+        self.limit = limit
+        self._queue = deque()
+        request.notifyFinish().addBoth(self._lost)
+
+    def registerListener(self, d):
+        # The multiplexer answers the client itself; there are no post-hooks
+        # for streams of events.
+        d.callback(Failure(NoPostHooks()))
+
+    def setStreamingMode(self, streamingMode):
+        pass
+
+    def start(self, response):
+        """
+        Send the status and headers of the stream.
+        """
+        if self._gone:
+            return
+        code, phrase, headers = response
+        self._started = True
+        self.request.setResponseCode(code, phrase)
+        for name, values in headers:
+            self.request.responseHeaders.setRawHeaders(name, values)
+        # Send the headers straight away, as Docker does.
+        self.request.write(b"")
+        self.request.registerProducer(self, True)
+
+    def send(self, data):
+        if self._gone:
+            return
+        if not self._paused:
+            self.request.write(data)
+            return
+        self._queue.append(data)
+        if len(self._queue) > self.limit:
+            log.msg("Disconnecting an events subscriber which fell %d "
+                    "events behind." % (self.limit,))
+            self.upstream.multiplexer.slowSubscribers += 1
+            self.disconnect()
+
+    def finish(self):
+        """
+        End the response, once the stream from Docker has ended.
+        """
+        if self._gone:
+            return
+        self._gone = True
+        self.request.unregisterProducer()
+        for data in self._queue:
+            self.request.write(data)
+        self._queue.clear()
+        self.request.finish()
+
+    def fail(self):
+        """
+        Tell the client Docker couldn't be reached, as ``twisted.web.proxy``
+        does.
+        """
+        if self._gone:
+            return
+        self._gone = True
+        self.request.setResponseCode(501, "Gateway error")
+        self.request.responseHeaders.setRawHeaders(
+            "content-type", ["text/html"])
+        self.request.write("<H1>Could not connect</H1>")
+        self.request.finish()
+
+    def disconnect(self):
+        """
+        Drop the connection to the client.
+        """
+        if self._gone:
+            return
+        self._gone = True
+        self._queue.clear()
+        if self._started:
+            self.request.unregisterProducer()
+        self.request.transport.abortConnection()
+
+    def _lost(self, ignored):
+        self._gone = True
+        self._queue.clear()
+        self.upstream.remove(self)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        while self._queue and not self._paused and not self._gone:
+            self.request.write(self._queue.popleft())
+
+    def stopProducing(self):
+        self._gone = True
+        self._queue.clear()
@@ -0,0 +1,81 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_jsonstream -*-
+
+"""
+Splitting the streams of JSON documents Docker sends, such as ``/events``, into
+documents.  Depending on its version, Docker separates them with newlines or
+sends them back to back, and documents may be split across reads.
+"""
+
+import json
+
+_decoder = json.JSONDecoder()
+
+_WHITESPACE = " \t\r\n"
+
+
+class JSONStreamParser(object):
+    """
+    Split a stream of JSON objects or arrays into documents, as they arrive.
+    """
+
+    def __init__(self, maxSize=2 ** 20):
+        """
+        :param maxSize: The number of bytes a document may take; more without
+            a complete document means the stream isn't JSON.
+        """
+        self.maxSize = maxSize
+        self._buffer = b""
+
+    def feed(self, data):
+        """
+        Add data read from the stream.
+
+        :return: A ``list`` of ``(raw, value)`` for the documents completed by
+            ``data``: the bytes of each document, including any whitespace
+            around it, so that the stream can be passed on as it came, and the
+            decoded document.
+
+        :raises: ``ValueError`` if the stream isn't JSON.
+        """
+        buffer = self._buffer + data
+        documents = []
+        if self._buffer.strip(_WHITESPACE) and (
+                b"}" not in data and b"]" not in data):
+            # A document can only be completed by a byte closing an object
+            # or array; don't decode the incomplete one again until then.
+            self._buffer = buffer
+            self._checkSize()
+            return documents
+        start = 0
+        while True:
+            position = start
+            while position < len(buffer) and buffer[position] in _WHITESPACE:
+                position += 1
+            if position == len(buffer):
+                break
+            if buffer[position] not in b"{[":
+                raise ValueError("Not a stream of JSON objects or arrays.")
+            try:
+                value, end = _decoder.raw_decode(buffer, position)
+            except ValueError:
+                # Incomplete, unless it is already too big to be.
+                break
+            while end < len(buffer) and buffer[end] in _WHITESPACE:
+                end += 1
+            documents.append((buffer[start:end], value))
+            start = end
+        self._buffer = buffer[start:]
+        self._checkSize()
+        return documents
+
+    def pending(self):
+        """
+        Return the bytes fed which aren't part of a complete document yet.
+        """
+        return self._buffer
+
+    def _checkSize(self):
+        if len(self._buffer) > self.maxSize:
+            raise ValueError("JSON document bigger than %d bytes." % (
+                self.maxSize,))
@@ -0,0 +1,172 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_listen -*-
+
+"""
+The sockets powerstrip serves the Docker API on.
+
+Listeners are taken from the ``POWERSTRIP_LISTEN`` environment variable if it
+is set, then from the ``listen`` section of the adapter configuration, and
+default to TCP port 2375 on all interfaces.  ``POWERSTRIP_LISTEN`` holds
+addresses in the form of ``DOCKER_HOST``, separated by spaces or commas, with
+settings as query arguments:
+
+    unix:///var/run/powerstrip.sock?mode=0660&group=docker tcp://0.0.0.0:2375
+
+The admin port is taken from the ``admin`` section of the adapter
+configuration, and defaults to TCP port 2378 on the loopback interface only.
+``POWERSTRIP_ADMIN_PORT`` overrides its port number, or turns it off when set
+to an empty string.
+"""
+
+import grp
+import os
+import pwd
+from urlparse import parse_qsl, urlparse
+
+from twisted.application import internet
+
+from ._config import (
+        InvalidConfiguration, ListenerConfiguration, parse_listener)
+
+DEFAULT_LISTENERS = (ListenerConfiguration(tcp=2375),)
+
+# Settings given as query arguments which are numbers.
+_NUMBERS = ("backlog",)
+
+
+def parseListenAddress(address):
+    """
+    Parse a listener address such as ``unix:///var/run/powerstrip.sock`` or
+    ``tcp://127.0.0.1:2375?backlog=128``.
+
+    :return: A ``ListenerConfiguration``.
+
+    :raises: ``InvalidConfiguration`` if the address is invalid.
+    """
+    parsed = urlparse(address)
+    if parsed.scheme == "unix":
+        settings = {"unix": parsed.netloc + parsed.path}
+    elif parsed.scheme == "tcp":
+        try:
+            port = parsed.port
+        except ValueError:
+            port = None
+        if port is None:
+            raise InvalidConfiguration(
+                "Listener %r has no port." % (address,))
+        settings = {"tcp": port, "interface": parsed.hostname or ""}
+    else:
+        raise InvalidConfiguration(
+            "Listener %r is neither unix:// nor tcp://." % (address,))
+    for name, value in parse_qsl(parsed.query):
+        if name in _NUMBERS or (name in ("owner", "group") and
+                                value.isdigit()):
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+        settings[name] = value
+    return parse_listener(settings, address)
+
+
+def configuredListeners(environ, config):
+    """
+    Return the listeners to serve the Docker API on.
+
+    :param environ: The environment, which may set ``POWERSTRIP_LISTEN``.
+
+    :param config: A ``PluginConfiguration`` which has been read.
+
+    :return: A ``tuple`` of ``ListenerConfiguration``.
+
+    :raises: ``InvalidConfiguration`` if ``POWERSTRIP_LISTEN`` is invalid.
+    """
+    addresses = environ.get("POWERSTRIP_LISTEN", "").replace(",", " ").split()
+    if addresses:
+        return tuple(parseListenAddress(address) for address in addresses)
+    return config.snapshot().listen or DEFAULT_LISTENERS
+
+
+def configuredAdmin(environ, config):
+    """
+    Return the settings of the admin port.
+
+    :param environ: The environment, which may set ``POWERSTRIP_ADMIN_PORT``.
+
+    :param config: A ``PluginConfiguration`` which has been read.
+
+    :return: An ``AdminConfiguration``.
+
+    :raises: ``InvalidConfiguration`` if ``POWERSTRIP_ADMIN_PORT`` is invalid.
+    """
+    admin = config.snapshot().admin
+    port = environ.get("POWERSTRIP_ADMIN_PORT")
+    if port is None:
+        return admin
+    if not port:
+        return admin._replace(port=None)
+    try:
+        return admin._replace(port=int(port))
+    except ValueError:
+        raise InvalidConfiguration(
+            "POWERSTRIP_ADMIN_PORT %r is not a port number." % (port,))
+
+
+def _userID(owner):
+    if owner is None or isinstance(owner, (int, long)):
+        return owner
+    return pwd.getpwnam(owner).pw_uid
+
+
+def _groupID(group):
+    if group is None or isinstance(group, (int, long)):
+        return group
+    return grp.getgrnam(group).gr_gid
+
+
+class UNIXServer(internet.UNIXServer):
+    """
+    A ``UNIXServer`` which gives the socket an owner and group once it is
+    listening.
+    """
+
+    def __init__(self, path, factory, backlog, mode, uid=None, gid=None):
+        """
+        :param uid: The user id to own the socket, or ``None``.
+
+        :param gid: The group id of the socket, or ``None``.
+        """
+        # wantPID makes the port remove a socket left behind by a previous
+        # process, rather than failing to bind.
+        internet.UNIXServer.__init__(self, path, factory, backlog=backlog,
+                                     mode=mode, wantPID=True)
+        self.path = path
+        self.uid = uid
+        self.gid = gid
+
+    def _getPort(self):
+        port = internet.UNIXServer._getPort(self)
+        if self.uid is not None or self.gid is not None:
+            self._chown(self.path, -1 if self.uid is None else self.uid,
+                        -1 if self.gid is None else self.gid)
+        return port
+
+    _chown = staticmethod(os.chown)
+
+
+def listenerService(listener, factory):
+    """
+    Return a service serving ``factory`` on a listener.
+
+    :param listener: A ``ListenerConfiguration``.
+
+    :raises: ``KeyError`` if the owner or group of a UNIX socket doesn't
+        exist.
+    """
+    if listener.unix is not None:
+        return UNIXServer(listener.unix, factory, listener.backlog,
+                          listener.mode, _userID(listener.owner),
+                          _groupID(listener.group))
+    return internet.TCPServer(listener.tcp, factory,
+                              backlog=listener.backlog,
+                              interface=listener.interface)
@@ -0,0 +1,164 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_messages -*-
+
+"""
+Passing the messages of streamed JSON responses, such as the progress of
+``POST /images/create`` or the output of ``POST /build``, through post-hooks
+as they arrive, rather than buffering a response which may take minutes.
+
+The messages are split out of the stream as Docker sends them, and passed
+through the post-hooks a batch at a time: whatever has arrived while the
+previous batch was with the adapters, up to a limit.  What the adapters
+answer is written to the client in the order the messages came in.  Docker is
+only read from while the client takes what is written, and no more than a
+batch is waiting for the adapters.
+"""
+
+from zope.interface import implementer
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+
+from ._jsonstream import JSONStreamParser
+from ._upstream import StreamedResponse
+
+
+@implementer(IPushProducer)
+class MessageStream(object):
+    """
+    Relay a streamed JSON response from Docker to the client through
+    ``runHooks``, a batch of messages at a time.
+
+    This is the producer of the client's connection, and pauses the reads
+    from Docker either while the client's connection can't take more, or
+    while a whole batch is waiting for the post-hooks.
+    """
+
+    _inFlight = False
+    _ended = False
+    _done = False
+    _clientPaused = False
+    _readingPaused = False
+
+    def __init__(self, request, producer, metrics, runHooks, batch):
+        """
+        :param request: The ``Request`` from the client.
+
+        :param producer: The ``IPushProducer`` reading the response from
+            Docker.
+
+        :param metrics: The ``Metrics`` to record the peak buffering in.
+
+        :param runHooks: A callable taking the bytes of a batch of messages,
+            and returning a ``Deferred`` firing with the bytes to write to
+            the client instead.
+
+        :param batch: The most messages to pass to ``runHooks`` at a time.
+        """
+        self.producer = producer
+        self.runHooks = runHooks
+        self.batch = batch
+        self._parser = JSONStreamParser()
+        self._pending = []
+        self._response = StreamedResponse(request, self, metrics)
+
+    def write(self, data):
+        """
+        Add data read from Docker.
+        """
+        if self._done:
+            return
+        try:
+            documents = self._parser.feed(data)
+        except ValueError:
+            log.err(None, "while reading a stream of JSON messages")
+            self.abort()
+            return
+        self._pending.extend(raw for raw, value in documents)
+        self._next()
+
+    def finish(self):
+        """
+        The response from Docker is complete: finish the response to the
+        client once the messages still waiting have been through the
+        post-hooks.
+        """
+        self._ended = True
+        self._next()
+
+    def abort(self):
+        """
+        Stop reading from Docker, and drop the client.
+        """
+        if self._done:
+            return
+        self._done = True
+        self._pending = []
+        self._response.abort()
+        self.producer.stopProducing()
+
+    def _next(self):
+        """
+        Pass the next batch of messages through the post-hooks, unless a
+        batch is with them already, and pause or resume reading from Docker.
+        """
+        if self._done:
+            return
+        if not self._inFlight:
+            if self._pending:
+                batch = self._pending[:self.batch]
+                del self._pending[:self.batch]
+                self._inFlight = True
+                d = defer.maybeDeferred(self.runHooks, b"".join(batch))
+                d.addCallbacks(self._answered, self._failed)
+            elif self._ended:
+                self._done = True
+                # An incomplete message at the end isn't one the post-hooks
+                # can be given; pass it on as Docker sent it.
+                self._write(self._parser.pending())
+                self._response.finish()
+        self._pauseOrResume()
+
+    def _answered(self, data):
+        self._inFlight = False
+        if self._done:
+            return
+        self._write(data)
+        self._next()
+
+    def _write(self, data):
+        # An empty write would end a chunked response.
+        if data:
+            self._response.write(data)
+
+    def _failed(self, reason):
+        self._inFlight = False
+        log.err(reason, "while passing messages through post-hooks")
+        self.abort()
+
+    def _pauseOrResume(self):
+        if self._done:
+            return
+        paused = (self._clientPaused or
+                  len(self._pending) >= self.batch) and not self._ended
+        if paused and not self._readingPaused:
+            self._readingPaused = True
+            self.producer.pauseProducing()
+        elif self._readingPaused and not paused:
+            self._readingPaused = False
+            self.producer.resumeProducing()
+
+    def pauseProducing(self):
+        self._clientPaused = True
+        self._pauseOrResume()
+
+    def resumeProducing(self):
+        self._clientPaused = False
+        self._pauseOrResume()
+
+    def stopProducing(self):
+        """
+        The client has gone: stop reading from Docker.
+        """
+        self.abort()
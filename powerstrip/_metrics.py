@@ -0,0 +1,364 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_metrics -*-
+
+"""
+Histograms and counters of what the proxy spends its time on, served in the
+Prometheus text format.
+"""
+
+from bisect import bisect_left
+
+from twisted.web import resource, server
+
+# Bucket upper bounds, in seconds, for latencies.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Bucket upper bounds, in bytes, for response sizes: 1k to 256M.
+SIZE_BUCKETS = tuple(4 ** i * 1024 for i in range(10))
+
+# Modes a Docker response can be relayed to the client in.
+BUFFERED = "buffered"
+STREAMING = "streaming"
+HIJACKED = "hijacked"
+
+
+class Histogram(object):
+    """
+    Counts of observed values falling into buckets.
+
+    self.counts: A ``list`` with the number of observations in each bucket,
+        not cumulative, followed by the number of observations above the
+        last bound.
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        """
+        :param bounds: A sorted ``tuple`` of bucket upper bounds.
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    A registry of labelled histograms and counters.  Recording a value is a
+    dictionary lookup and a binary search; all formatting is left to
+    ``render``.
+    """
+
+    _histograms = (
+        ("powerstrip_request_duration_seconds",
+         "Time from receiving a request to finishing its response, by "
+         "matched endpoint expressions.", LATENCY_BUCKETS),
+        ("powerstrip_adapter_duration_seconds",
+         "Time taken by an adapter to answer a hook, by adapter and hook "
+         "type.", LATENCY_BUCKETS),
+        ("powerstrip_docker_first_byte_seconds",
+         "Time from sending a request to Docker to its response starting.",
+         LATENCY_BUCKETS),
+        ("powerstrip_docker_duration_seconds",
+         "Time from sending a request to Docker to its response ending.",
+         LATENCY_BUCKETS),
+        ("powerstrip_response_buffered_bytes",
+         "Size of Docker responses buffered for post-hooks.", SIZE_BUCKETS),
+        ("powerstrip_stream_buffered_bytes",
+         "Most bytes of a streamed Docker response left waiting to be sent "
+         "to the client.", SIZE_BUCKETS),
+    )
+
+    _counters = (
+        ("powerstrip_docker_responses_total",
+         "Docker responses, by how they were relayed to the client."),
+        ("powerstrip_adapter_answers_total",
+         "Answers of modifying adapters, by adapter, hook type and whether "
+         "they modified the request or response."),
+    )
+
+    def __init__(self, clock):
+        """
+        :param clock: An ``IReactorTime`` provider to time with.
+        """
+        self.clock = clock
+        self._bounds = dict((name, bounds)
+                            for name, help, bounds in self._histograms)
+        self._values = {}
+        self._collectors = []
+
+    def seconds(self):
+        return self.clock.seconds()
+
+    def observe(self, name, labels, value):
+        """
+        Record a value in a histogram.
+
+        :param name: The name of one of the histograms in ``_histograms``.
+
+        :param labels: A ``tuple`` of ``(label, value)`` pairs.
+        """
+        key = (name, labels)
+        histogram = self._values.get(key)
+        if histogram is None:
+            histogram = self._values[key] = Histogram(self._bounds[name])
+        histogram.observe(value)
+
+    def observeSince(self, name, labels, started):
+        """
+        Record the seconds elapsed since ``started`` in a histogram.
+        """
+        self.observe(name, labels, self.clock.seconds() - started)
+
+    def timed(self, d, name, labels):
+        """
+        Record the time until ``d`` fires in a histogram, whether it
+        succeeds or fails.
+
+        :return: ``d``
+        """
+        d.addBoth(self._observeResult, name, labels, self.clock.seconds())
+        return d
+
+    def _observeResult(self, result, name, labels, started):
+        self.observeSince(name, labels, started)
+        return result
+
+    def increment(self, name, labels):
+        """
+        Add one to a counter.
+        """
+        key = (name, labels)
+        self._values[key] = self._values.get(key, 0) + 1
+
+    def addCollector(self, collector):
+        """
+        Add a source of further samples for ``render``.
+
+        :param collector: A callable returning a ``list`` of ``(name, type,
+            help, labels, value)`` tuples, where ``type`` is ``"counter"`` or
+            ``"gauge"``.
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        byName = {}
+        for (name, labels), value in self._values.iteritems():
+            byName.setdefault(name, []).append((labels, value))
+        for name, help, bounds in self._histograms:
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s histogram" % (name,))
+            for labels, histogram in sorted(byName.get(name, [])):
+                cumulative = 0
+                for bound, count in zip(bounds + ("+Inf",),
+                                        histogram.counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (
+                        name, _formatLabels(labels + (("le", bound),)),
+                        cumulative))
+                lines.append("%s_sum%s %r" % (
+                    name, _formatLabels(labels), histogram.sum))
+                lines.append("%s_count%s %d" % (
+                    name, _formatLabels(labels), histogram.count))
+        for name, help in self._counters:
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s counter" % (name,))
+            for labels, value in sorted(byName.get(name, [])):
+                lines.append("%s%s %d" % (name, _formatLabels(labels), value))
+        described = set()
+        for collector in self._collectors:
+            for name, kind, help, labels, value in collector():
+                if name not in described:
+                    described.add(name)
+                    lines.append("# HELP %s %s" % (name, help))
+                    lines.append("# TYPE %s %s" % (name, kind))
+                lines.append("%s%s %r" % (name, _formatLabels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % (",".join(
+        '%s="%s"' % (label, _escape(value)) for label, value in labels),)
+
+
+def _escape(value):
+    if isinstance(value, float):
+        return repr(value)
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def notifierCollector(notifier):
+    """
+    Return a collector for ``Metrics.addCollector`` reporting the counters
+    of a ``Notifier``.
+    """
+    def collect():
+        counters = notifier.counters()
+        help = "Notifications, by what became of them."
+        return [
+            ("powerstrip_notify_queue_depth", "gauge",
+             "Notifications waiting to be delivered.", (),
+             counters["depth"]),
+            ("powerstrip_notify_active", "gauge",
+             "Deliveries of notifications in progress.", (),
+             counters["active"]),
+        ] + [("powerstrip_notifications_total", "counter", help,
+              (("outcome", outcome),), counters[outcome])
+             for outcome in ("enqueued", "delivered", "dropped", "failed")
+        ] + [
+            ("powerstrip_notify_latency_seconds_total", "counter",
+             "Total time delivered notifications spent queued.", (),
+             counters["latency_seconds_total"]),
+            ("powerstrip_notify_latency_seconds_max", "gauge",
+             "Longest time a delivered notification spent queued.", (),
+             counters["latency_seconds_max"]),
+        ]
+    return collect
+
+
+def breakerCollector(breakers):
+    """
+    Return a collector for ``Metrics.addCollector`` reporting the circuit
+    breakers of adapters, from a ``Breakers``.
+    """
+    def collect():
+        samples = []
+        for name, breaker in sorted(breakers.describe().iteritems()):
+            labels = (("adapter", name),)
+            samples.extend([
+                ("powerstrip_adapter_breaker_open", "gauge",
+                 "Whether the circuit breaker of an adapter is open (1), "
+                 "half-open (0.5) or closed (0).", labels,
+                 {"open": 1.0, "half-open": 0.5}.get(breaker["state"], 0.0)),
+                ("powerstrip_adapter_breaker_trips_total", "counter",
+                 "Times the circuit breaker of an adapter opened.", labels,
+                 breaker["trips"]),
+                ("powerstrip_adapter_short_circuited_total", "counter",
+                 "Calls to an adapter failed by its open circuit breaker.",
+                 labels, breaker["short_circuited"]),
+            ])
+        return samples
+    return collect
+
+
+def cacheCollector(cache):
+    """
+    Return a collector for ``Metrics.addCollector`` reporting the counters
+    of a ``ResponseCache``.
+    """
+    def collect():
+        return [
+            ("powerstrip_cache_requests_total", "counter",
+             "Lookups in the response cache, by result.",
+             (("result", "hit"),), cache.hits),
+            ("powerstrip_cache_requests_total", "counter",
+             "Lookups in the response cache, by result.",
+             (("result", "miss"),), cache.misses),
+            ("powerstrip_cache_evictions_total", "counter",
+             "Responses evicted to make room in the response cache.", (),
+             cache.evictions),
+            ("powerstrip_cache_invalidations_total", "counter",
+             "Times the response cache was emptied.",
+             (), cache.invalidations),
+            ("powerstrip_cache_entries", "gauge",
+             "Responses in the response cache.", (), len(cache)),
+            ("powerstrip_cache_bytes", "gauge",
+             "Size of the responses in the response cache.", (), cache.size),
+        ]
+    return collect
+
+
+def flightCollector(flights):
+    """
+    Return a collector for ``Metrics.addCollector`` reporting the counters
+    of a ``SingleFlight``.
+    """
+    def collect():
+        return [
+            ("powerstrip_docker_flights_total", "counter",
+             "Coalescable requests sent to Docker.", (), flights.flights),
+            ("powerstrip_coalesced_requests_total", "counter",
+             "Requests which shared the Docker response of an identical "
+             "request in flight.", (), flights.coalesced),
+            ("powerstrip_docker_flights_active", "gauge",
+             "Coalescable requests waiting for Docker.", (), len(flights)),
+        ]
+    return collect
+
+
+def poolCollector(pool):
+    """
+    Return a collector for ``Metrics.addCollector`` reporting how often a
+    ``ConnectionPool`` of connections to Docker had a connection to reuse.
+    """
+    def collect():
+        help = "Connections to Docker used, by whether they were reused."
+        return [
+            ("powerstrip_docker_connections_total", "counter", help,
+             (("result", "reused"),), pool.hits),
+            ("powerstrip_docker_connections_total", "counter", help,
+             (("result", "new"),), pool.misses),
+        ]
+    return collect
+
+
+def eventsCollector(events):
+    """
+    Return a collector for ``Metrics.addCollector`` reporting the state of
+    an ``EventsMultiplexer``.
+    """
+    def collect():
+        return [
+            ("powerstrip_events_upstreams", "gauge",
+             "Streams of events from Docker shared between clients.", (),
+             events.upstreams()),
+            ("powerstrip_events_subscribers", "gauge",
+             "Clients subscribed to shared streams of events.", (),
+             events.subscribers()),
+            ("powerstrip_events_total", "counter",
+             "Events read from Docker for shared streams.", (),
+             events.events),
+            ("powerstrip_events_slow_subscribers_total", "counter",
+             "Clients disconnected for falling behind a shared stream of "
+             "events.", (), events.slowSubscribers),
+        ]
+    return collect
+
+
+class MetricsResource(resource.Resource):
+    """
+    Serve ``Metrics`` in the Prometheus text format.
+    """
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return self.metrics.render()
+
+
+def MetricsSite(metrics):
+    """
+    Return a ``Site`` for the admin port, serving ``metrics`` at
+    ``/metrics``.
+    """
+    root = resource.Resource()
+    root.putChild("metrics", MetricsResource(metrics))
+    return server.Site(root)
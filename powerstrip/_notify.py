@@ -0,0 +1,260 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_notify -*-
+
+"""
+Delivery of notifications to adapters, after the response has been sent to
+the client.
+"""
+
+from collections import deque
+import json
+
+from twisted.internet.defer import (
+        Deferred, gatherResults, maybeDeferred, succeed)
+from twisted.python import log
+import treq
+
+from ._config import DROP_NEWEST
+
+
+class NotificationFailed(Exception):
+    """
+    An adapter did not accept a batch of notifications.
+    """
+
+
+def httpPoster(client):
+    """
+    Return a callable which POSTs a batch of notifications with ``client``,
+    as ``NotificationQueue`` expects.
+
+    :param client: A ``treq.client.HTTPClient``.
+    """
+    def post(uri, body):
+        d = client.post(uri, json.dumps(body),
+                        headers={'Content-Type': ['application/json']})
+        d.addCallback(_checkAccepted)
+        return d
+    return post
+
+
+def _checkAccepted(response):
+    d = treq.content(response)
+    if response.code >= 300:
+        def failed(ignored):
+            raise NotificationFailed(response.code)
+        d.addCallback(failed)
+    return d
+
+
+class NotificationQueue(object):
+    """
+    A bounded queue of notifications for one adapter, delivered in batches by
+    a limited number of concurrent requests.
+
+    self.active: The number of deliveries in progress.
+
+    self.enqueued: The number of notifications put into the queue.
+
+    self.delivered: The number of notifications the adapter accepted.
+
+    self.dropped: The number of notifications discarded because the queue was
+        full.
+
+    self.failed: The number of notifications whose delivery failed.
+
+    self.latencyTotal: The total number of seconds between putting delivered
+        notifications into the queue and their delivery.
+
+    self.latencyMax: The longest of those times.
+    """
+
+    active = 0
+    enqueued = 0
+    delivered = 0
+    dropped = 0
+    failed = 0
+    latencyTotal = 0.0
+    latencyMax = 0.0
+
+    def __init__(self, uri, post, settings, clock):
+        """
+        :param uri: The URI of the adapter.
+
+        :param post: A callable taking a URI and a JSON serializable batch,
+            returning a ``Deferred`` which fires once the adapter accepted it.
+
+        :param settings: A ``NotifyQueueConfiguration``.
+
+        :param clock: An ``IReactorTime`` provider.
+        """
+        self.uri = uri
+        self._post = post
+        self._clock = clock
+        self._pending = deque()
+        self._idleWaiters = []
+        self.configure(settings)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def configure(self, settings):
+        """
+        Apply new settings.  Notifications over the new ``max_size`` are
+        discarded according to the overflow policy.
+        """
+        self._settings = settings
+        while len(self._pending) > settings.max_size:
+            self.dropped += 1
+            if settings.overflow == DROP_NEWEST:
+                self._pending.pop()
+            else:
+                self._pending.popleft()
+        self._dispatch()
+
+    def put(self, notification):
+        """
+        Queue a notification for delivery.
+        """
+        self.enqueued += 1
+        if len(self._pending) >= self._settings.max_size:
+            self.dropped += 1
+            if self._settings.overflow == DROP_NEWEST:
+                return
+            self._pending.popleft()
+        self._pending.append((self._clock.seconds(), notification))
+        self._dispatch()
+
+    def whenIdle(self):
+        """
+        Return a ``Deferred`` which fires once every queued notification has
+        been delivered, or has failed to be.
+        """
+        if not self._pending and not self.active:
+            return succeed(None)
+        d = Deferred()
+        self._idleWaiters.append(d)
+        return d
+
+    def _dispatch(self):
+        """
+        Start delivering batches of queued notifications, up to the
+        concurrency limit.
+        """
+        while self._pending and self.active < self._settings.concurrency:
+            batch = [self._pending.popleft() for i in range(
+                min(self._settings.batch_size, len(self._pending)))]
+            self.active += 1
+            d = maybeDeferred(self._post, self.uri, {
+                "PowerstripProtocolVersion": 1,
+                "Type": "notify",
+                "Notifications": [notification
+                                  for queuedAt, notification in batch]})
+            d.addCallbacks(self._delivered, self._failed,
+                           callbackArgs=(batch,), errbackArgs=(batch,))
+        if not self._pending and not self.active:
+            waiters, self._idleWaiters = self._idleWaiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def _delivered(self, ignored, batch):
+        self.active -= 1
+        now = self._clock.seconds()
+        self.delivered += len(batch)
+        for queuedAt, notification in batch:
+            latency = now - queuedAt
+            self.latencyTotal += latency
+            self.latencyMax = max(self.latencyMax, latency)
+        self._dispatch()
+
+    def _failed(self, reason, batch):
+        self.active -= 1
+        self.failed += len(batch)
+        log.msg("Failed to deliver %d notifications to %s: %s" % (
+            len(batch), self.uri, reason.getErrorMessage()))
+        self._dispatch()
+
+
+class Notifier(object):
+    """
+    Deliver notifications to adapters, through a ``NotificationQueue`` for
+    each adapter so that a slow adapter doesn't hold up the others.
+    """
+
+    def __init__(self, post, settings, clock, breakers=None):
+        """
+        :param post: The callable to deliver batches with, see
+            ``NotificationQueue``.
+
+        :param settings: A ``NotifyQueueConfiguration``.
+
+        :param clock: An ``IReactorTime`` provider.
+
+        :param breakers: The ``Breakers`` to deliver batches through, so that
+            they time out after the adapter's ``timeout`` and their failures
+            count towards its circuit breaker, or ``None``.
+        """
+        self._post = post
+        self._settings = settings
+        self._clock = clock
+        self._breakers = breakers
+        self._queues = {}
+        self._adapters = {}
+
+    def configure(self, settings):
+        """
+        Apply new settings to all queues.
+        """
+        self._settings = settings
+        for queue in self._queues.values():
+            queue.configure(settings)
+
+    def notify(self, adapters, notification):
+        """
+        Queue a notification for each of the given adapters.
+
+        :param adapters: An iterable of ``Adapter``.
+
+        :param notification: A JSON serializable description of the request.
+        """
+        for adapter in adapters:
+            self._adapters[adapter.uri] = adapter
+            queue = self._queues.get(adapter.uri)
+            if queue is None:
+                queue = self._queues[adapter.uri] = NotificationQueue(
+                    adapter.uri, self._deliver, self._settings, self._clock)
+            queue.put(notification)
+
+    def _deliver(self, uri, body):
+        if self._breakers is None:
+            return self._post(uri, body)
+        return self._breakers.call(self._adapters[uri], self._post, uri, body)
+
+    def whenIdle(self):
+        """
+        Return a ``Deferred`` which fires once all queues are idle, see
+        ``NotificationQueue.whenIdle``.
+        """
+        return gatherResults(
+            [queue.whenIdle() for queue in self._queues.values()])
+
+    def counters(self):
+        """
+        Return a ``dict`` of counters summed over all queues: ``depth`` (the
+        number of notifications waiting), ``active``, ``enqueued``,
+        ``delivered``, ``dropped``, ``failed``, ``latency_seconds_total``
+        and ``latency_seconds_max``.
+        """
+        queues = self._queues.values()
+        return {
+            "depth": sum(len(queue) for queue in queues),
+            "active": sum(queue.active for queue in queues),
+            "enqueued": sum(queue.enqueued for queue in queues),
+            "delivered": sum(queue.delivered for queue in queues),
+            "dropped": sum(queue.dropped for queue in queues),
+            "failed": sum(queue.failed for queue in queues),
+            "latency_seconds_total": sum(
+                queue.latencyTotal for queue in queues),
+            "latency_seconds_max": max(
+                [queue.latencyMax for queue in queues] or [0.0]),
+        }
@@ -2,6 +2,7 @@
 # -*- test-case-name: powerstrip.test.test_parser -*-
 
 import fnmatch
+import re
 
 class InvalidRequest(Exception):
     """
@@ -9,6 +10,235 @@ class InvalidRequest(Exception):
     """
 
 
+# Characters which make an endpoint expression a glob rather than a literal.
+_GLOB_CHARS = "*?["
+
+
+class EndpointIndex(object):
+    """
+    A compiled index of endpoint expressions, which finds the expressions
+    matching a request without trying every one of them.
+
+    Expressions are bucketed by their HTTP method when the method is a
+    literal, and kept in a shared bucket otherwise.  Literal expressions are
+    found with a dictionary lookup.  Within a bucket, each glob expression is
+    indexed by one of the path segments it requires literally (e.g.
+    ``containers`` in ``POST /*/containers/*/start``), picking the segment
+    shared by the fewest expressions.  Expressions without such a segment are
+    indexed by their literal prefix and literal suffix in a pair of tries.
+    Only the candidates found this way are matched against their compiled
+    regular expression.
+    """
+
+    def __init__(self, endpoints):
+        """
+        :param endpoints: An iterable of endpoint expressions, e.g.
+            ``"POST /*/containers/create"``.
+        """
+        self._literals = {}
+        self._buckets = {}
+        self._anyMethod = _GlobBucket()
+        for endpoint in endpoints:
+            if not any(c in endpoint for c in _GLOB_CHARS):
+                self._literals[endpoint] = endpoint
+                continue
+            method, space, rest = endpoint.partition(" ")
+            if space and not any(c in method for c in _GLOB_CHARS):
+                bucket = self._buckets.get(method)
+                if bucket is None:
+                    bucket = self._buckets[method] = _GlobBucket()
+            else:
+                bucket = self._anyMethod
+            bucket.add(endpoint)
+        for bucket in self._buckets.values() + [self._anyMethod]:
+            bucket.compile()
+
+    def match(self, method, request):
+        """
+        Return a ``set`` of endpoint expressions which match the provided
+        ``method`` and ``request``, exactly as ``fnmatch.fnmatch`` would.
+
+        :param method: An HTTP method string, e.g. "GET" or "POST".
+
+        :param request: An HTTP request path string, without a query part.
+        """
+        match_str = "%s %s" % (method, request)
+        matched = set()
+        literal = self._literals.get(match_str)
+        if literal is not None:
+            matched.add(literal)
+        segments = None
+        for bucket in (self._buckets.get(method), self._anyMethod):
+            if bucket is None or not bucket.size:
+                continue
+            if segments is None:
+                segments = set(match_str.split("/"))
+            bucket.match(match_str, segments, matched)
+        return matched
+
+
+class _GlobBucket(object):
+    """
+    The glob endpoint expressions of an ``EndpointIndex`` which share an HTTP
+    method.
+
+    self._bySegment: A dict mapping a path segment to the list of expressions
+        which require it.
+
+    self._prefixes: A trie of nested dicts keyed by character, built from the
+        literal prefix of each expression which requires no path segment.  The
+        ``None`` key of a node holds the list of expressions whose prefix ends
+        there.
+
+    self._suffixes: As ``self._prefixes``, but built from the reversed
+        literal suffix of each expression.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._bySegment = {}
+        self._prefixes = {}
+        self._suffixes = {}
+        self.size = 0
+
+    def add(self, endpoint):
+        runs = _literalRuns(endpoint)
+        prefix = runs[0][0] if runs and runs[0][1] else ""
+        suffix = runs[-1][0] if runs and runs[-1][2] else ""
+        regex = re.compile(fnmatch.translate(endpoint))
+        self._entries.append(((endpoint, regex.match, prefix, suffix),
+                              _requiredSegments(runs)))
+        self.size += 1
+
+    def compile(self):
+        """
+        Build the lookup structures from the expressions added so far.
+        """
+        counts = {}
+        for entry, segments in self._entries:
+            for segment in segments:
+                counts[segment] = counts.get(segment, 0) + 1
+        for entry, segments in self._entries:
+            if segments:
+                rarest = min(segments, key=lambda segment: counts[segment])
+                self._bySegment.setdefault(rarest, []).append(entry)
+            else:
+                endpoint, match, prefix, suffix = entry
+                _trieInsert(self._prefixes, prefix, entry)
+                _trieInsert(self._suffixes, suffix[::-1], entry)
+        del self._entries
+
+    def match(self, match_str, segments, matched):
+        """
+        Add the expressions in this bucket which match ``match_str`` to the
+        ``matched`` set.
+
+        :param segments: A ``set`` of the ``/`` separated parts of
+            ``match_str``.
+        """
+        for segment in segments:
+            for endpoint, match, prefix, suffix in self._bySegment.get(
+                    segment, ()):
+                if match(match_str):
+                    matched.add(endpoint)
+        byPrefix = _trieLookup(self._prefixes, match_str)
+        if not byPrefix:
+            return
+        bySuffix = _trieLookup(self._suffixes, reversed(match_str))
+        if len(byPrefix) <= len(bySuffix):
+            for endpoint, match, prefix, suffix in byPrefix:
+                if match_str.endswith(suffix) and match(match_str):
+                    matched.add(endpoint)
+        else:
+            for endpoint, match, prefix, suffix in bySuffix:
+                if match_str.startswith(prefix) and match(match_str):
+                    matched.add(endpoint)
+
+
+def _literalRuns(endpoint):
+    """
+    Split ``endpoint`` into the runs of characters which ``fnmatch`` matches
+    literally.
+
+    :return: A ``list`` of ``(run, atStart, atEnd)`` tuples, where ``atStart``
+        and ``atEnd`` tell whether the run is anchored to the start or end of
+        the expression.
+    """
+    runs = []
+    current = []
+    currentStart = 0
+    i, n = 0, len(endpoint)
+    while i < n:
+        c = endpoint[i]
+        if c in "*?":
+            glob = 1
+        elif c == "[":
+            # Mirror fnmatch.translate: an unterminated bracket is literal.
+            j = i + 1
+            if j < n and endpoint[j] == "!":
+                j += 1
+            if j < n and endpoint[j] == "]":
+                j += 1
+            while j < n and endpoint[j] != "]":
+                j += 1
+            glob = 0 if j >= n else j - i + 1
+        else:
+            glob = 0
+        if glob:
+            if current:
+                runs.append(("".join(current), currentStart == 0, False))
+                current = []
+            i += glob
+            currentStart = i
+        else:
+            current.append(c)
+            i += 1
+    if current:
+        runs.append(("".join(current), currentStart == 0, True))
+    return runs
+
+
+def _requiredSegments(runs):
+    """
+    Return the path segments which any string matching an expression made of
+    the literal ``runs`` must contain as a whole ``/`` separated part.
+    """
+    segments = set()
+    for run, atStart, atEnd in runs:
+        parts = run.split("/")
+        # Only the parts with a "/" on both sides, or at the end of the
+        # expression, are known to be whole segments.
+        last = len(parts) if atEnd else len(parts) - 1
+        for part in parts[1:last]:
+            if part:
+                segments.add(part)
+    return segments
+
+
+def _trieInsert(trie, key, entry):
+    node = trie
+    for c in key:
+        node = node.setdefault(c, {})
+    node.setdefault(None, []).append(entry)
+
+
+def _trieLookup(trie, chars):
+    """
+    Return the entries of all keys in ``trie`` which are a prefix of
+    ``chars``.
+    """
+    node = trie
+    found = list(node.get(None, ()))
+    for c in chars:
+        node = node.get(c)
+        if node is None:
+            break
+        entries = node.get(None)
+        if entries:
+            found.extend(entries)
+    return found
+
+
 class EndpointParser(object):
     """
     Translate incoming requests into chains of adapters.
@@ -39,11 +269,4 @@ class EndpointParser(object):
         """
         if "?" in request:
             raise InvalidRequest()
-        all_endpoints = self.config.endpoints()
-        match_str = "%s %s" % (method, request)
-        matched_endpoints = set()
-        # Note: fnmatch.filter seemed to be broken when trying to do exaclty this.
-        for endpoint in all_endpoints:
-            if fnmatch.fnmatch(match_str, endpoint):
-                matched_endpoints.add(endpoint)
-        return matched_endpoints
+        return self.config.snapshot().index.match(method, request)
@@ -0,0 +1,97 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_pool -*-
+
+"""
+Persistent HTTP connections to adapters and to Docker.
+"""
+
+from urlparse import urlparse
+
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.python import log
+from twisted.web.client import HTTPConnectionPool
+
+
+class ConnectionPool(HTTPConnectionPool):
+    """
+    An ``HTTPConnectionPool`` which counts how often a cached connection
+    could be reused.
+
+    self.hits: The number of connections handed out from the pool.
+
+    self.misses: The number of connections which had to be opened because
+        none was cached.
+    """
+
+    hits = 0
+    misses = 0
+
+    def configure(self, poolConfig):
+        """
+        Apply pool settings from the configuration.  Connections already
+        cached are kept.  A ``max_per_host`` of 0 turns off persistent
+        connections.
+
+        :param poolConfig: A ``PoolConfiguration``.
+        """
+        self.persistent = poolConfig.max_per_host > 0
+        self.maxPersistentPerHost = max(poolConfig.max_per_host, 1)
+        self.cachedConnectionTimeout = poolConfig.idle_timeout
+
+    def getConnection(self, key, endpoint):
+        connections = self._connections.get(key, ())
+        if any(c.state == "QUIESCENT" for c in connections):
+            self.hits += 1
+        else:
+            self.misses += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def prewarm(self, uris, endpointFactory=None):
+        """
+        Open ``maxPersistentPerHost`` connections to the host of every given
+        URI and add them to the pool, so the first requests don't pay for
+        connection setup.
+
+        :param uris: An iterable of URIs.
+
+        :param endpointFactory: A callable taking a scheme, host and port and
+            returning the endpoint to connect to.  By default, only plain HTTP
+            URIs are pre-warmed, over TCP.
+
+        :return: A ``list`` of ``Deferred``s which fire once each connection
+            is in the pool, or has failed to connect.
+        """
+        if not self.persistent:
+            return []
+        if endpointFactory is None:
+            endpointFactory = self._tcpEndpoint
+        keys = set()
+        for uri in uris:
+            # Build the same key as ``Agent.request`` does.
+            parsed = urlparse(uri)
+            host = parsed.netloc
+            port = 443 if parsed.scheme == "https" else 80
+            if ":" in host:
+                host, port = host.split(":", 1)
+                port = int(port)
+            if host:
+                keys.add((parsed.scheme, host, port))
+        results = []
+        for key in sorted(keys):
+            scheme, host, port = key
+            endpoint = endpointFactory(scheme, host, port)
+            if endpoint is None:
+                continue
+            for i in range(self.maxPersistentPerHost):
+                d = HTTPConnectionPool.getConnection(self, key, endpoint)
+                d.addCallback(self._prewarmed, key)
+                d.addErrback(log.err, "while pre-warming %s:%d" % (host, port))
+                results.append(d)
+        return results
+
+    def _prewarmed(self, connection, key):
+        self._putConnection(key, connection)
+
+    def _tcpEndpoint(self, scheme, host, port):
+        if scheme == "http":
+            return TCP4ClientEndpoint(self._reactor, host, port)
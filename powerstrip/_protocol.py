@@ -0,0 +1,181 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_protocol -*-
+
+"""
+The bodies of requests and responses passed along hook chains, in the forms
+the versions of the hook protocol expect.
+
+Version 1 passes bodies as strings, so adapters have to decode JSON bodies
+and encode them again.  Version 2 embeds JSON bodies as JSON values under
+``Body``, and passes any other body as a string under ``RawBody``.
+
+In either version, an adapter which leaves the request or response as it was
+can say so with a ``204 No Content`` answer, or with ``{"Unmodified": true}``,
+instead of sending the body back.
+"""
+
+import json
+
+# The versions of the hook protocol adapters can be configured with.
+PROTOCOL_VERSIONS = (1, 2)
+
+# Read from the answers of adapters which leave the request or response as it
+# was.
+UNMODIFIED = object()
+
+_MISSING = object()
+
+
+class HookBody(object):
+    """
+    A request or response body, kept as text, as a decoded JSON value, or
+    both.  Each form is only computed once, when first needed, so a chain of
+    adapters speaking the same version never encodes or decodes it again.
+    """
+
+    _invalid = False
+
+    def __init__(self, text=None, value=_MISSING, isJSON=True):
+        """
+        :param text: The body as a ``str`` or ``unicode``, or ``None`` if
+            there is no body.
+
+        :param value: The body as a decoded JSON value, if known.
+
+        :param isJSON: Whether the content type of the body is JSON.
+        """
+        self._text = text
+        self._value = value
+        self.isJSON = isJSON
+
+    def text(self):
+        """
+        Return the body as text, or ``None`` if there is none.
+        """
+        if self._text is None and self._value is not _MISSING:
+            self._text = json.dumps(self._value)
+        return self._text
+
+    def value(self):
+        """
+        Return the body as a decoded JSON value, or ``None`` if there is no
+        body.
+
+        :raises: ``ValueError`` if the body isn't JSON.
+        """
+        if self._value is _MISSING:
+            if self._invalid or not self.isJSON:
+                raise ValueError("Not a JSON body.")
+            if self._text is None:
+                self._value = None
+            else:
+                try:
+                    self._value = json.loads(self._text)
+                except ValueError:
+                    self._invalid = True
+                    raise
+        return self._value
+
+    def fields(self, version):
+        """
+        Return the fields describing the body in a hook of the given
+        protocol version.
+        """
+        if version == 1 or self.text() is None:
+            return {"Body": self.text()}
+        try:
+            return {"Body": self.value()}
+        except ValueError:
+            return {"Body": None, "RawBody": self.text()}
+
+
+def bodyFields(body, version):
+    """
+    Return the fields describing a ``HookBody``, or the lack of a body if
+    ``body`` is ``None``, in a hook of the given protocol version.
+    """
+    if body is None:
+        return {"Body": None}
+    return body.fields(version)
+
+
+def readHookBody(fields, version, isJSON=True):
+    """
+    Return the ``HookBody`` described by the fields of an adapter's answer.
+
+    :param version: The protocol version the adapter answered with.
+
+    :param isJSON: Whether the content type of the body is JSON.
+    """
+    if version >= 2:
+        if fields.get("RawBody") is not None:
+            return HookBody(fields["RawBody"], isJSON=isJSON)
+        if fields.get("Body") is None:
+            return HookBody(isJSON=isJSON)
+        return HookBody(value=fields["Body"], isJSON=isJSON)
+    return HookBody(fields.get("Body"), isJSON=isJSON)
+
+
+def readClientRequest(answer):
+    """
+    Return the ``HookBody`` of the request modified by a pre-hook, or
+    ``UNMODIFIED``.
+
+    :param answer: The decoded answer of the pre-hook.
+    """
+    if answer.get("Unmodified") is True:
+        return UNMODIFIED
+    return readHookBody(answer["ModifiedClientRequest"],
+                        answer.get("PowerstripProtocolVersion", 1))
+
+
+def isJSONContentType(contentType):
+    """
+    Return ``True`` if a ``Content-Type`` header value is JSON.
+    """
+    return (contentType is not None and
+            contentType.split(";", 1)[0].strip().lower() ==
+            "application/json")
+
+
+def postHookResponse(result):
+    """
+    Return the Docker response as the post-hook chain passes it along: a
+    ``dict`` with the ``Code``, ``ContentType`` and ``HookBody``.
+
+    :param result: The Docker response, with a ``ModifiedServerResponse``.
+    """
+    response = result["ModifiedServerResponse"]
+    return {"Code": response["Code"],
+            "ContentType": response["ContentType"],
+            "Body": HookBody(response["Body"], isJSON=isJSONContentType(
+                response["ContentType"]))}
+
+
+def readServerResponse(answer):
+    """
+    Return the response modified by a post-hook, as ``postHookResponse``
+    does for the Docker response, or ``UNMODIFIED``.
+
+    :param answer: The decoded answer of the post-hook.
+    """
+    if answer.get("Unmodified") is True:
+        return UNMODIFIED
+    version = answer.get("PowerstripProtocolVersion", 1)
+    response = answer["ModifiedServerResponse"]
+    return {"Code": response["Code"],
+            "ContentType": response["ContentType"],
+            "Body": readHookBody(response, version,
+                             isJSONContentType(response["ContentType"]))}
+
+
+def postHookResult(response):
+    """
+    Turn a response from the post-hook chain back into the form the Docker
+    response came in.
+    """
+    return {"PowerstripProtocolVersion": 1,
+            "ModifiedServerResponse": {
+                "Code": response["Code"],
+                "ContentType": response["ContentType"],
+                "Body": response["Body"].text() or ""}}
@@ -0,0 +1,510 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_upstream -*-
+
+"""
+Keep-alive connections to the Docker daemon for requests which get a plain,
+complete HTTP response.
+"""
+
+from twisted.internet.endpoints import TCP4ClientEndpoint, UNIXClientEndpoint
+from twisted.internet.protocol import Protocol
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, FileBodyProducer, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from ._buffer import ResponseBuffer, ResponseTooLarge
+from ._metrics import BUFFERED, STREAMING
+from ._parser import EndpointIndex
+
+
+class NoPostHooks(Exception):
+    """
+    Do not run any post-hooks, because of an incompatible Docker response type
+    (streaming/hijacked or chunked).
+    """
+
+
+# Docker API calls which hijack the connection (attach, exec) or stream their
+# response for as long as the client listens (events, logs, stats, pull,
+# build...).  These keep a dedicated connection to Docker.
+DEDICATED_ENDPOINTS = EndpointIndex([
+    "POST /*containers/*/attach",
+    "GET /*containers/*/attach/ws",
+    "POST /*exec/*/start",
+    "GET /*events",
+    "GET /*containers/*/logs",
+    "GET /*containers/*/stats",
+    "GET /*containers/*/export",
+    "GET /*containers/*/archive",
+    "PUT /*containers/*/archive",
+    "POST /*containers/*/copy",
+    "POST /*containers/*/wait",
+    "GET /*images/*/get",
+    "GET /*images/get",
+    "POST /*images/create",
+    "POST /*images/load",
+    "POST /*images/*/push",
+    "POST /*build",
+])
+
+# Response content types which post-hooks can't be given, because they can't
+# be JSON encoded, and which may be far too big to buffer (e.g. the tarballs
+# of ``docker export`` and ``docker save``).
+BINARY_CONTENT_TYPES = frozenset([
+    "application/x-tar", "application/tar", "application/octet-stream"])
+
+# Headers which only apply to one connection, and must not be forwarded.
+_HOP_BY_HOP = frozenset([
+    "connection", "keep-alive", "proxy-connection", "transfer-encoding",
+    "te", "trailer", "upgrade", "content-length"])
+
+
+def isPoolable(method, path, headers):
+    """
+    Return ``True`` if a request to Docker can use a keep-alive connection
+    from the pool: its response is neither hijacked nor streamed.
+
+    :param method: The HTTP method of the request.
+
+    :param path: The request path, without a query part.
+
+    :param headers: A dict of lower case request header names to values.
+    """
+    if "upgrade" in headers:
+        return False
+    return not DEDICATED_ENDPOINTS.match(method, path)
+
+
+def isBinaryContentType(value):
+    """
+    Return ``True`` if a ``Content-Type`` header value is one of
+    ``BINARY_CONTENT_TYPES``, ignoring any parameters.
+    """
+    return value.split(";", 1)[0].strip().lower() in BINARY_CONTENT_TYPES
+
+
+def refuseTooLarge(request, error):
+    """
+    Answer the client with a gateway error instead of a Docker response
+    which is too large to buffer for post-hooks.
+
+    :param request: The ``Request`` from the client.
+
+    :param error: The ``ResponseTooLarge``.
+    """
+    log.msg(str(error))
+    body = str(error)
+    request.setResponseCode(502, "Bad Gateway")
+    request.responseHeaders.setRawHeaders(b"content-type", [b"text/plain"])
+    request.responseHeaders.setRawHeaders(b"content-length",
+                                          [str(len(body))])
+    request.write(body)
+    request.finish()
+
+
+class DockerAgent(Agent):
+    """
+    An ``Agent`` which sends every request to the Docker daemon, over its UNIX
+    socket or TCP.
+    """
+
+    def __init__(self, reactor, pool, dockerAddr=None, dockerPort=None,
+                 dockerSocket=None):
+        Agent.__init__(self, reactor, pool=pool)
+        self._dockerAddr = dockerAddr
+        self._dockerPort = dockerPort
+        self._dockerSocket = dockerSocket
+        if dockerSocket:
+            self._base = "http://docker"
+        else:
+            self._base = "http://%s:%d" % (dockerAddr, dockerPort)
+
+    def _getEndpoint(self, scheme, host, port):
+        if self._dockerSocket:
+            return UNIXClientEndpoint(self._reactor, self._dockerSocket)
+        return TCP4ClientEndpoint(self._reactor, self._dockerAddr,
+                                  self._dockerPort)
+
+    def dockerRequest(self, method, rest, headers, body, length):
+        """
+        Send a request to Docker.
+
+        :param rest: The request path, including any query part.
+
+        :param headers: A dict of lower case request header names to values.
+
+        :param body: A file-like object positioned at the start of the request
+            body.  It is streamed to Docker as the connection can take it, and
+            closed afterwards.
+
+        :param length: The length of ``body``.
+        """
+        requestHeaders = Headers()
+        for name, value in headers.iteritems():
+            if name not in _HOP_BY_HOP:
+                requestHeaders.setRawHeaders(name, [value])
+        bodyProducer = None
+        if length or method in ("POST", "PUT"):
+            bodyProducer = FileBodyProducer(body)
+        return self.request(method, self._base + rest, requestHeaders,
+                            bodyProducer)
+
+    def prewarm(self):
+        """
+        Open keep-alive connections to Docker ahead of the first request.
+        """
+        return self._pool.prewarm([self._base], self._getEndpoint)
+
+
+def writeBufferSize(transport):
+    """
+    Return the number of bytes written to a transport and not yet sent, or 0
+    if the transport doesn't tell.
+    """
+    # The write buffer of ``twisted.internet.abstract.FileDescriptor``.
+    try:
+        return (len(transport.dataBuffer) - transport.offset +
+                transport._tempDataLen)
+    except AttributeError:
+        return 0
+
+
+class StreamedResponse(object):
+    """
+    Relay a response streamed from Docker to the client, pausing the reads
+    from Docker while the client's connection can't take more, and record
+    the most bytes left waiting to be sent to the client.
+
+    self.clientGone: Whether the client has gone away.
+
+    self.peak: The most bytes written to the client's connection and not
+        yet sent.
+    """
+
+    clientGone = False
+
+    def __init__(self, request, producer, metrics):
+        """
+        :param request: The ``Request`` from the client.
+
+        :param producer: The ``IPushProducer`` reading the response from
+            Docker.
+
+        :param metrics: The ``Metrics`` to record the peak in.
+        """
+        self.request = request
+        self.metrics = metrics
+        self.peak = 0
+        request.registerProducer(producer, True)
+        request.notifyFinish().addErrback(self._lostClient)
+
+    def _lostClient(self, reason):
+        self.clientGone = True
+
+    def write(self, data):
+        if self.clientGone:
+            return
+        self.request.write(data)
+        self.peak = max(self.peak, writeBufferSize(self.request.transport))
+
+    def _end(self):
+        self.request.unregisterProducer()
+        self.metrics.observe("powerstrip_stream_buffered_bytes", (),
+                             self.peak)
+
+    def finish(self):
+        """
+        The response is complete: finish the request, unless the client has
+        gone.
+        """
+        self._end()
+        if not self.clientGone:
+            self.request.finish()
+
+    def abort(self):
+        """
+        Docker went away mid-response: drop the client.
+        """
+        self._end()
+        if not self.clientGone:
+            self.request.transport.loseConnection()
+
+
+class PooledDockerClient(object):
+    """
+    Proxy one request to Docker over a connection from the pool, and relay
+    the response to the client.  This offers the same ``registerListener``
+    and ``setStreamingMode`` interface as ``DockerProxyClient``.
+
+    In streaming mode, the response is written to the client as it arrives.
+    Otherwise it is collected and handed to the listener for the post-hooks.
+    """
+
+    _listener = None
+    _streaming = False
+    _result = None
+    _clientGone = False
+    _stream = None
+    _headerHooks = None
+    _held = None
+    _heldEnd = None
+    _discard = False
+    _shareLimit = None
+    _length = UNKNOWN_LENGTH
+
+    def __init__(self, father, bufferSettings, metrics):
+        """
+        :param father: The ``Request`` from the client.
+
+        :param bufferSettings: The ``BufferConfiguration`` to collect the
+            response for the post-hooks with.
+
+        :param metrics: The ``Metrics`` to record timings in.
+        """
+        self.father = father
+        self.metrics = metrics
+        self._buffer = ResponseBuffer(bufferSettings.memory_limit,
+                                      bufferSettings.max_size)
+        father.notifyFinish().addErrback(self._lostClient)
+
+    def _lostClient(self, reason):
+        self._clientGone = True
+
+    def send(self, agent, method, rest, headers, body, length):
+        """
+        Send the request with a ``DockerAgent``.
+        """
+        self._started = self.metrics.seconds()
+        d = agent.dockerRequest(method, rest, headers, body, length)
+        d.addCallbacks(self._gotResponse, self._failed)
+
+    def registerListener(self, d):
+        self._listener = d
+        if self._result is not None:
+            self._fireListener(self._result)
+
+    def setStreamingMode(self, streamingMode):
+        self._streaming = streamingMode
+        if streamingMode:
+            self._fireListener(Failure(NoPostHooks()))
+
+    def setMessageHooks(self, runHooks, batch):
+        """
+        Streams of messages are only read over dedicated connections, by
+        ``DockerProxyClient``; responses over pooled ones are given to the
+        post-hooks whole.
+        """
+
+    def setHeaderHooks(self, runHooks):
+        """
+        Once the status and headers of the response have arrived, call
+        ``runHooks``, and hold the body back until it fires: with ``True``
+        to stream the body to the client, or with ``False`` if the client has
+        been answered otherwise.
+        """
+        self._headerHooks = runHooks
+
+    def setShareLimit(self, limit):
+        """
+        Collect the response to share it with other requests, but no more
+        than ``limit`` bytes of it: should it grow larger, stream it to the
+        client instead, and tell the listener there is nothing to share.
+        """
+        self._shareLimit = limit
+
+    def _fireListener(self, result):
+        if self._listener is not None:
+            d = self._listener
+            self._listener = None
+            d.callback(result)
+        else:
+            self._result = result
+
+    def _gotResponse(self, response):
+        self.metrics.observeSince("powerstrip_docker_first_byte_seconds", (),
+                                  self._started)
+        father = self.father
+        father.setResponseCode(response.code, response.phrase)
+        for name, values in response.headers.getAllRawHeaders():
+            lowered = name.lower()
+            if lowered in _HOP_BY_HOP:
+                continue
+            if (lowered == "content-type" and not self._streaming and
+                    isBinaryContentType(values[0])):
+                # Post-hooks can't be given tarballs; stream them instead.
+                self.setStreamingMode(True)
+            # t.w.server.Request sets defaults for these in its 'process'
+            # method, which Docker's values must replace.
+            if lowered in ("server", "date", "content-type"):
+                father.responseHeaders.setRawHeaders(name, values)
+            else:
+                for value in values:
+                    father.responseHeaders.addRawHeader(name, value)
+        if self._headerHooks is not None:
+            self.setStreamingMode(True)
+            self._held = []
+        self._length = response.length
+        if self._streaming and response.length is not UNKNOWN_LENGTH:
+            father.responseHeaders.setRawHeaders(
+                "content-length", [str(response.length)])
+        self._receiver = _BodyReceiver(self)
+        response.deliverBody(self._receiver)
+        if self._held is not None:
+            # Don't read the body until the post-hooks have answered; some
+            # of it, or all, may have been read already.
+            if self._heldEnd is None:
+                self._receiver.transport.pauseProducing()
+            d = self._headerHooks()
+            d.addCallback(self._headersChecked)
+            d.addErrback(self._headerHooksFailed)
+
+    def _headersChecked(self, proceed):
+        """
+        Stream the body to the client once the post-hooks have answered, or
+        stop reading it if the client has been answered otherwise.
+        """
+        held, self._held = self._held, None
+        if not proceed or self._clientGone:
+            self._stopReading()
+            return
+        for data in held:
+            self._dataReceived(data)
+        if self._heldEnd is not None:
+            self._bodyDone(self._heldEnd)
+        else:
+            self._receiver.transport.resumeProducing()
+
+    def _headerHooksFailed(self, reason):
+        self._held = None
+        log.err(reason, "while running post-hooks on response headers")
+        self._stopReading()
+        if not self._clientGone:
+            self.father.transport.loseConnection()
+
+    def _stopReading(self):
+        """
+        Drop the rest of the body.
+        """
+        self._discard = True
+        if self._heldEnd is None:
+            self._receiver.transport.stopProducing()
+        else:
+            self._bodyDone(self._heldEnd)
+
+    def _dataReceived(self, data):
+        if self._held is not None:
+            self._held.append(data)
+            return
+        if self._clientGone or self._discard:
+            return
+        if self._streaming:
+            if self._stream is None:
+                self._stream = StreamedResponse(
+                    self.father, self._receiver.transport, self.metrics)
+            self._stream.write(data)
+        elif (self._shareLimit is not None and
+                self._buffer.size + len(data) > self._shareLimit):
+            self._stopSharing(data)
+        else:
+            try:
+                self._buffer.write(data)
+            except ResponseTooLarge as e:
+                self._discard = True
+                self._receiver.transport.stopProducing()
+                refuseTooLarge(self.father, e)
+                self._fireListener(Failure(NoPostHooks()))
+
+    def _stopSharing(self, data):
+        """
+        Stream a response which outgrew the share limit to the client,
+        starting with what was collected of it.
+        """
+        collected = self._buffer.getvalue()
+        self._buffer.close()
+        if self._length is not UNKNOWN_LENGTH:
+            self.father.responseHeaders.setRawHeaders(
+                "content-length", [str(self._length)])
+        self.setStreamingMode(True)
+        if collected:
+            self._dataReceived(collected)
+        self._dataReceived(data)
+
+    def _bodyDone(self, reason):
+        if self._held is not None:
+            # The post-hooks on the headers haven't answered yet.
+            self._heldEnd = reason
+            return
+        self.metrics.observeSince("powerstrip_docker_duration_seconds", (),
+                                  self._started)
+        self.metrics.increment(
+            "powerstrip_docker_responses_total",
+            (("mode", STREAMING if self._streaming else BUFFERED),))
+        if self._discard:
+            return
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            # Docker went away mid-response; all we can do is drop the client.
+            if self._stream is not None:
+                self._stream.abort()
+            elif not self._clientGone:
+                self.father.transport.loseConnection()
+            self._fireListener(Failure(NoPostHooks()))
+            return
+        if self._stream is not None:
+            self._stream.finish()
+            return
+        if self._streaming:
+            if not self._clientGone:
+                self.father.finish()
+            return
+        if self._clientGone:
+            # What was received has been dropped; there is nobody to run
+            # post-hooks for, or to share the response with.
+            self._buffer.close()
+            self._fireListener(Failure(NoPostHooks()))
+            return
+        contentType = self.father.responseHeaders.getRawHeaders("content-type")
+        if contentType:
+            contentType = contentType[0]
+        else:
+            contentType = None
+        self.metrics.observe("powerstrip_response_buffered_bytes", (),
+                             self._buffer.size)
+        body = self._buffer.getvalue()
+        self._buffer.close()
+        self._fireListener(
+                {"PowerstripProtocolVersion": 1,
+                 "ModifiedServerResponse":
+                    {"Body": body,
+                     "Code": self.father.code,
+                     "ContentType": contentType}})
+
+    def _failed(self, reason):
+        """
+        Report a failure to talk to Docker to the client, as
+        ``twisted.web.proxy`` does.
+        """
+        father = self.father
+        father.setResponseCode(501, "Gateway error")
+        father.responseHeaders.setRawHeaders("content-type", ["text/html"])
+        father.write("<H1>Could not connect</H1>")
+        father.finish()
+        self._fireListener(Failure(NoPostHooks()))
+
+
+class _BodyReceiver(Protocol):
+    """
+    Pass a response body from ``Response.deliverBody`` on to a
+    ``PooledDockerClient``.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def dataReceived(self, data):
+        self.client._dataReceived(data)
+
+    def connectionLost(self, reason):
+        self.client._bodyDone(reason)
@@ -0,0 +1,567 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+# -*- test-case-name: powerstrip.test.test_workers -*-
+
+"""
+Running the proxy in several worker processes sharing one listening socket,
+so that encoding and decoding hooks can use more than one core.
+
+The supervisor binds the TCP sockets of the configured listeners and spawns
+the workers, passing the sockets to each of them as file descriptors from
+``LISTEN_FDS`` on.  A worker announces the port its admin site listens on, on
+file descriptor ``CONTROL_FD``, so that the supervisor can aggregate the
+metrics of all workers.
+
+Workers can't share UNIX sockets, which the version of Twisted we use can't
+adopt.
+
+Signals sent to the supervisor:
+
+* ``SIGHUP``: every worker reads the adapter configuration again.
+* ``SIGUSR2``: the workers are replaced, one at a time.  Each is only told to
+  stop once its replacement is ready.
+
+A worker told to stop with ``SIGTERM`` stops accepting connections, closes
+the idle ones, and exits once the others are done, or the grace period is
+over.
+"""
+
+from collections import OrderedDict
+import json
+import os
+import signal
+import socket
+import sys
+from urlparse import urlparse
+
+import treq
+from treq.client import HTTPClient
+from twisted.application import service
+from twisted.internet import defer, error, protocol
+from twisted.protocols.policies import WrappingFactory
+from twisted.python import log
+from twisted.web import resource, server
+from twisted.web.client import Agent, HTTPConnectionPool
+
+from ._config import InvalidConfiguration, PluginConfiguration
+from .powerstrip import ServerProtocolFactory
+
+# File descriptors of the pipe workers announce their admin port on, and of
+# the first listening socket, in worker processes.
+CONTROL_FD = 3
+LISTEN_FDS = 4
+
+_WORKER_MAIN = "from powerstrip._workers import runWorker; runWorker()"
+
+
+def dockerAPIFromEnvironment(environ, config=None):
+    """
+    Return the ``ServerProtocolFactory`` for the Docker daemon given by the
+    ``DOCKER_HOST`` environment variable, which defaults to the socket
+    bind-mounted into the container we run in.
+
+    :param config: The ``PluginConfiguration`` to use, by default one reading
+        the file given by ``POWERSTRIP_CONFIG``, if set.
+    """
+    dockerHost = environ.get('DOCKER_HOST')
+    if dockerHost is None:
+        dockerHost = "unix:///var/run/docker.sock"
+    if "://" not in dockerHost:
+        dockerHost = "tcp://" + dockerHost
+    if config is None:
+        config = PluginConfiguration(environ.get('POWERSTRIP_CONFIG'))
+    if dockerHost.startswith("tcp://"):
+        parsed = urlparse(dockerHost)
+        return ServerProtocolFactory(dockerAddr=parsed.hostname,
+                                     dockerPort=parsed.port, config=config)
+    elif dockerHost.startswith("unix://"):
+        return ServerProtocolFactory(dockerSocket=dockerHost[len("unix://"):],
+                                     config=config)
+    raise ValueError("Unsupported DOCKER_HOST: %s" % (dockerHost,))
+
+
+def aggregateMetrics(texts):
+    """
+    Combine the metrics of several workers, in the Prometheus text format,
+    into one.  Samples of counters and histograms are summed by name and
+    labels.  Gauges are not: the state of a circuit breaker or the longest
+    latency mean nothing added up, so the gauges of each worker are kept
+    apart by a ``worker`` label.
+
+    :param texts: A ``list`` of ``(number, text)``, the metrics of each
+        worker by its number, or by ``None`` for metrics not of a worker.
+    """
+    families = OrderedDict()
+    for number, text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                name = line.split(" ", 3)[2]
+                family = families.setdefault(
+                    name, {"help": line, "type": None,
+                           "samples": OrderedDict()})
+            elif line.startswith("# TYPE "):
+                name = line.split(" ", 3)[2]
+                family = families.setdefault(
+                    name, {"help": None, "type": None,
+                           "samples": OrderedDict()})
+                family["type"] = line
+            elif line and not line.startswith("#") and family is not None:
+                key, value = line.rsplit(" ", 1)
+                if (number is not None and
+                        family["type"] is not None and
+                        family["type"].split(" ")[3] == "gauge"):
+                    key = _withLabel(key, "worker", number)
+                samples = family["samples"]
+                samples[key] = samples.get(key, 0.0) + float(value)
+    lines = []
+    for family in families.values():
+        for header in family["help"], family["type"]:
+            if header is not None:
+                lines.append(header)
+        for key, value in family["samples"].items():
+            lines.append("%s %s" % (key, _formatValue(value)))
+    return "\n".join(lines) + "\n"
+
+
+def _withLabel(key, name, value):
+    """
+    Add a label to the name and labels of a sample.
+    """
+    label = '%s="%s"' % (name, value)
+    if key.endswith("}"):
+        return "%s,%s}" % (key[:-1], label)
+    return "%s{%s}" % (key, label)
+
+
+def _formatValue(value):
+    if value == int(value):
+        return "%d" % (value,)
+    return repr(value)
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    A worker process, as seen from the supervisor.
+
+    self.adminPort: The port of the worker's admin site, once it is ready.
+    """
+
+    adminPort = None
+    ended = False
+
+    def __init__(self, supervisor, number):
+        """
+        :param number: The number of the worker, from 0; its replacements get
+            the same number.
+        """
+        self.supervisor = supervisor
+        self.number = number
+        self._control = b""
+        self._whenReady = []
+        self._whenEnded = []
+
+    def whenReady(self):
+        """
+        Return a ``Deferred`` firing with this worker once it is ready, or
+        failing if it ends before that.
+        """
+        if self.adminPort is not None:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._whenReady.append(d)
+        return d
+
+    def whenEnded(self):
+        """
+        Return a ``Deferred`` firing once the process has ended.
+        """
+        if self.ended:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._whenEnded.append(d)
+        return d
+
+    def signal(self, name):
+        """
+        Send the signal ``name`` (e.g. ``"TERM"``) to the process, if it is
+        still running.
+        """
+        try:
+            self.transport.signalProcess(name)
+        except error.ProcessExitedAlready:
+            pass
+
+    def childDataReceived(self, childFD, data):
+        if childFD != CONTROL_FD:
+            for line in data.splitlines():
+                log.msg("worker %d: %s" % (self.number, line))
+            return
+        self._control += data
+        while b"\n" in self._control:
+            line, self._control = self._control.split(b"\n", 1)
+            self.adminPort = json.loads(line)["admin_port"]
+            waiting, self._whenReady = self._whenReady, []
+            for d in waiting:
+                d.callback(self)
+
+    def processEnded(self, reason):
+        self.ended = True
+        waiting, self._whenReady = self._whenReady, []
+        for d in waiting:
+            d.errback(reason)
+        waiting, self._whenEnded = self._whenEnded, []
+        for d in waiting:
+            d.callback(None)
+        self.supervisor._workerEnded(self, reason)
+
+
+class Supervisor(service.Service):
+    """
+    Bind the listening sockets, and keep ``workers`` worker processes serving
+    them.  A worker which dies is replaced after ``restartDelay`` seconds.
+
+    self.restarts: The number of workers replaced because they died.
+    """
+
+    restartDelay = 1
+    restarts = 0
+    _sockets = ()
+    _restarting = None
+
+    def __init__(self, workers, listeners, environ=None,
+                 gracePeriod=30, reactor=None, installSignalHandlers=True,
+                 executable=sys.executable):
+        """
+        :param workers: The number of worker processes.
+
+        :param listeners: The ``ListenerConfiguration`` of each TCP socket to
+            listen on.
+
+        :raises: ``InvalidConfiguration`` if any of the listeners is a UNIX
+            socket.
+
+        :param environ: The environment of the workers, by default that of
+            this process.
+
+        :param gracePeriod: The number of seconds a stopping worker waits for
+            requests in progress before exiting anyway.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.workers = workers
+        for listener in listeners:
+            if listener.unix is not None:
+                raise InvalidConfiguration(
+                    "Worker processes can't share the UNIX socket %s." % (
+                        listener.unix,))
+        self.listeners = listeners
+        self.environ = dict(os.environ if environ is None else environ)
+        self.gracePeriod = gracePeriod
+        self._reactor = reactor
+        self._installSignalHandlers = installSignalHandlers
+        self._executable = executable
+        self._processes = {}
+        self._client = HTTPClient(Agent(
+            reactor, pool=HTTPConnectionPool(reactor, persistent=False)))
+
+    @property
+    def ports(self):
+        """
+        The ports the workers listen on, in the order of the listeners.
+        """
+        return [skt.getsockname()[1] for skt in self._sockets]
+
+    def startService(self):
+        service.Service.startService(self)
+        self._sockets = [self._bind(listener) for listener in self.listeners]
+        for number in range(self.workers):
+            self._spawn(number)
+        if self._installSignalHandlers:
+            signal.signal(signal.SIGHUP, lambda *args:
+                          self._reactor.callFromThread(self.reloadConfig))
+            signal.signal(signal.SIGUSR2, lambda *args:
+                          self._reactor.callFromThread(self.restartWorkers))
+
+    def _bind(self, listener):
+        skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        skt.bind((listener.interface, listener.tcp))
+        skt.listen(listener.backlog)
+        skt.setblocking(False)
+        return skt
+
+    def stopService(self):
+        """
+        Tell every worker to stop, and close the socket once they have.
+        """
+        service.Service.stopService(self)
+        ended = []
+        for worker in self._processes.values():
+            worker.signal("TERM")
+            ended.append(worker.whenEnded())
+        # Workers give up on requests in progress after the grace period;
+        # don't wait for them much longer than that.
+        killer = self._reactor.callLater(
+            self.gracePeriod + 5, self._kill)
+        d = defer.gatherResults(ended)
+        def stopped(ignored):
+            if killer.active():
+                killer.cancel()
+            for skt in self._sockets:
+                skt.close()
+        d.addCallback(stopped)
+        return d
+
+    def _kill(self):
+        for worker in self._processes.values():
+            worker.signal("KILL")
+
+    def _spawn(self, number):
+        """
+        Start worker ``number``, replacing any previous one in the
+        supervisor's records.
+
+        :return: The ``WorkerProcess``.
+        """
+        worker = WorkerProcess(self, number)
+        environ = dict(self.environ, POWERSTRIP_WORKER=str(number),
+                       POWERSTRIP_WORKER_GRACE=str(self.gracePeriod),
+                       POWERSTRIP_LISTEN_FDS=str(len(self._sockets)))
+        childFDs = {0: "w", 1: "r", 2: "r", CONTROL_FD: "r"}
+        for i, skt in enumerate(self._sockets):
+            childFDs[LISTEN_FDS + i] = skt.fileno()
+        self._reactor.spawnProcess(
+            worker, self._executable, [self._executable, "-c", _WORKER_MAIN],
+            env=environ, childFDs=childFDs)
+        self._processes[number] = worker
+        return worker
+
+    def _workerEnded(self, worker, reason):
+        if self._processes.get(worker.number) is not worker or not self.running:
+            # Replaced or told to stop.
+            return
+        log.msg("Worker %d died: %s; restarting it in %s seconds." % (
+            worker.number, reason.getErrorMessage(), self.restartDelay))
+        self.restarts += 1
+        self._reactor.callLater(self.restartDelay, self._respawn, worker)
+
+    def _respawn(self, worker):
+        if self._processes.get(worker.number) is worker and self.running:
+            self._spawn(worker.number)
+
+    def reloadConfig(self):
+        """
+        Tell every worker to read the adapter configuration again.
+        """
+        for worker in self._processes.values():
+            worker.signal("HUP")
+
+    def restartWorkers(self):
+        """
+        Replace the workers one at a time, stopping each only once its
+        replacement is ready, so that the socket is always being served.
+
+        :return: A ``Deferred`` firing once all workers have been replaced.
+        """
+        if self._restarting is not None:
+            return self._restarting
+        d = self._restarting = defer.succeed(None)
+        for number in sorted(self._processes):
+            d.addCallback(lambda ignored, number=number: self._replace(number))
+            d.addErrback(log.err, "while replacing worker %d" % (number,))
+        def done(ignored):
+            self._restarting = None
+        d.addCallback(done)
+        return d
+
+    def _replace(self, number):
+        old = self._processes[number]
+        d = self._spawn(number).whenReady()
+        def ready(new):
+            old.signal("TERM")
+            return old.whenEnded()
+        d.addCallback(ready)
+        return d
+
+    def _fromWorkers(self, path):
+        """
+        GET ``path`` from the admin site of every ready worker.
+
+        :return: A ``Deferred`` firing with a ``list`` of ``(number, body)``
+            for the workers which answered.
+        """
+        requests = []
+        for number, worker in sorted(self._processes.items()):
+            if worker.adminPort is None:
+                continue
+            d = self._client.get("http://127.0.0.1:%d%s" % (
+                worker.adminPort, path))
+            d.addCallback(treq.content)
+            d.addCallback(lambda body, number=number: (number, body))
+            d.addErrback(log.err, "while reading %s of worker %d" % (
+                path, number))
+            requests.append(d)
+        d = defer.gatherResults(requests)
+        d.addCallback(lambda results: [result for result in results
+                                       if result is not None])
+        return d
+
+    def metrics(self):
+        """
+        Return a ``Deferred`` firing with the metrics of all workers combined
+        by ``aggregateMetrics``, and those of the supervisor, in the
+        Prometheus text format.
+        """
+        d = self._fromWorkers("/metrics")
+        def aggregate(results):
+            return aggregateMetrics(
+                results + [(None, "\n".join([
+                    "# HELP powerstrip_workers Worker processes serving "
+                    "requests.",
+                    "# TYPE powerstrip_workers gauge",
+                    "powerstrip_workers %d" % (len(results),),
+                    "# HELP powerstrip_worker_restarts_total Workers "
+                    "replaced because they died.",
+                    "# TYPE powerstrip_worker_restarts_total counter",
+                    "powerstrip_worker_restarts_total %d" % (
+                        self.restarts,)]))])
+        d.addCallback(aggregate)
+        return d
+
+    def breakers(self):
+        """
+        Return a ``Deferred`` firing with the circuit breakers of each worker,
+        as a ``dict`` mapping worker numbers to what their ``/breakers``
+        serves.
+        """
+        d = self._fromWorkers("/breakers")
+        d.addCallback(lambda results: dict(
+            (str(number), json.loads(body)) for number, body in results))
+        return d
+
+    def metricsSite(self):
+        """
+        Return a ``Site`` serving the aggregated ``/metrics`` and the
+        ``/breakers`` of all workers, to be run on the admin port.
+        """
+        root = resource.Resource()
+        root.putChild("metrics", _DeferredResource(
+            self.metrics, "text/plain; version=0.0.4"))
+        root.putChild("breakers", _DeferredResource(
+            lambda: self.breakers().addCallback(json.dumps),
+            "application/json"))
+        return server.Site(root)
+
+
+class _DeferredResource(resource.Resource):
+    """
+    Serve the text a ``Deferred`` fires with.
+    """
+    isLeaf = True
+
+    def __init__(self, render, contentType):
+        """
+        :param render: A callable returning a ``Deferred`` firing with the
+            body to serve.
+        """
+        resource.Resource.__init__(self)
+        self._render = render
+        self._contentType = contentType
+
+    def render_GET(self, request):
+        d = self._render()
+        def write(body):
+            request.setHeader("Content-Type", self._contentType)
+            request.write(body)
+            request.finish()
+        def failed(reason):
+            log.err(reason, "while serving %s" % (request.uri,))
+            request.setResponseCode(500)
+            request.finish()
+        d.addCallbacks(write, failed)
+        return server.NOT_DONE_YET
+
+
+class Worker(object):
+    """
+    The serving side of a worker process, which stops gracefully.
+    """
+
+    _stopping = False
+
+    def __init__(self, ports, connections, gracePeriod, clock, stop):
+        """
+        :param ports: The ``IListeningPort`` providers serving the proxy.
+
+        :param connections: The ``WrappingFactory`` whose ``protocols`` are
+            the connections being served.
+
+        :param gracePeriod: The number of seconds to wait for requests in
+            progress when stopping.
+
+        :param clock: An ``IReactorTime`` provider.
+
+        :param stop: A callable to call once it is time to exit.
+        """
+        self.ports = ports
+        self.connections = connections
+        self.gracePeriod = gracePeriod
+        self.clock = clock
+        self._stop = stop
+
+    def stop(self):
+        """
+        Stop accepting connections, and call ``stop`` once all connections
+        are closed, or the grace period is over.
+        """
+        if self._stopping:
+            return
+        self._stopping = True
+        for port in self.ports:
+            port.stopListening()
+        self._drain(self.clock.seconds() + self.gracePeriod)
+
+    def _drain(self, deadline):
+        for connection in list(self.connections.protocols):
+            if not connection.wrappedProtocol.requests:
+                connection.transport.loseConnection()
+        if not self.connections.protocols or self.clock.seconds() >= deadline:
+            self._stop()
+        else:
+            self.clock.callLater(0.1, self._drain, deadline)
+
+
+def runWorker(environ=None, reactor=None):
+    """
+    Serve the listening sockets inherited from the supervisor, until told to
+    stop.
+    """
+    if environ is None:
+        environ = os.environ
+    if reactor is None:
+        from twisted.internet import reactor
+    log.startLogging(sys.stdout, setStdout=False)
+    dockerAPI = dockerAPIFromEnvironment(environ)
+    connections = WrappingFactory(dockerAPI)
+    ports = []
+    for fd in range(LISTEN_FDS,
+                    LISTEN_FDS + int(environ["POWERSTRIP_LISTEN_FDS"])):
+        ports.append(reactor.adoptStreamPort(fd, socket.AF_INET, connections))
+        os.close(fd)
+    admin = reactor.listenTCP(0, dockerAPI.metricsSite(),
+                              interface="127.0.0.1")
+    worker = Worker(ports, connections,
+                    float(environ.get("POWERSTRIP_WORKER_GRACE", 30)),
+                    reactor, reactor.stop)
+    def installSignalHandlers():
+        # Replace the handlers the reactor installed: the supervisor decides
+        # when workers stop.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda *args:
+                      reactor.callFromThread(worker.stop))
+        signal.signal(signal.SIGHUP, lambda *args:
+                      reactor.callFromThread(dockerAPI.reloadConfig))
+        os.write(CONTROL_FD, json.dumps(
+            {"admin_port": admin.getHost().port}) + "\n")
+    reactor.callWhenRunning(installSignalHandlers)
+    reactor.run()
@@ -1,26 +1,532 @@
-from ._config import PluginConfiguration
-from ._parser import EndpointParser
+from ._breaker import AdapterFailed, Breakers, BreakersResource
+from ._buffer import ResponseBuffer, ResponseTooLarge
+from ._cache import (
+        CachedDockerClient, DockerEventWatcher, ResponseCache, SingleFlight,
+        MUTATING_METHODS)
+from ._config import (
+        BufferConfiguration, PluginConfiguration, NoConfiguration,
+        InvalidConfiguration, FAIL_OPEN, MODIFY, NO_BODY)
+from ._events import EventsMultiplexer
+from ._messages import MessageStream
+from ._metrics import (
+        Metrics, MetricsSite, breakerCollector, cacheCollector,
+        eventsCollector, flightCollector, notifierCollector, poolCollector,
+        BUFFERED, STREAMING, HIJACKED)
+from ._notify import Notifier, httpPoster
+from ._pool import ConnectionPool
+from ._protocol import (
+        HookBody, bodyFields, isJSONContentType, postHookResponse,
+        postHookResult, readClientRequest, readServerResponse, UNMODIFIED)
+from ._upstream import (
+        NoPostHooks, DockerAgent, PooledDockerClient, StreamedResponse,
+        isBinaryContentType, isPoolable, refuseTooLarge)
 from treq.client import HTTPClient
 from twisted.internet import reactor, defer
-from twisted.internet.interfaces import IHalfCloseableProtocol
+from twisted.internet.interfaces import IHalfCloseableProtocol, IPushProducer
 from twisted.python import log
+from twisted.protocols.basic import FileSender
 from twisted.python.failure import Failure
-from twisted.web import server, proxy
+from twisted.web import http, server, proxy
 from twisted.web.client import Agent
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 from urllib import quote as urlquote
-from zope.interface import directlyProvides
+from zope.interface import directlyProvides, implementer
 import StringIO
 import json
 import treq
 import urlparse
 
-class NoPostHooks(Exception):
+def _postHook(client, adapter, hook, body, metrics, readBody):
     """
-    Do not run any post-hooks, because of an incompatible Docker response type
-    (streaming/hijacked or chunked).
+    POST a hook to an adapter, and read its response with ``readBody``.  An
+    error response fails with ``AdapterFailed``.
+
+    :param hook: ``"pre"`` or ``"post"``.
+    """
+    d = client.post(adapter.uri, json.dumps(body),
+                    headers={'Content-Type': ['application/json']})
+    d.addCallback(_readAdapterResponse, adapter, readBody)
+    return metrics.timed(d, "powerstrip_adapter_duration_seconds",
+                         (("adapter", adapter.name), ("hook", hook)))
+
+
+def _readAdapterResponse(response, adapter, readBody):
+    if response.code < 400:
+        return readBody(response)
+    contentType = response.headers.getRawHeaders("content-type")
+    d = treq.content(response)
+    def failed(body):
+        raise AdapterFailed(adapter.name, response.code, body,
+                            contentType[0] if contentType else "text/plain")
+    d.addCallback(failed)
+    return d
+
+
+def _skipFailedOpen(failure, adapter, result):
     """
+    Skip an adapter with the ``FAIL_OPEN`` policy which is unavailable, by
+    passing on the result it was given.  Other failures stop the chain.
+    """
+    failure.trap(AdapterFailed)
+    if adapter.failure_policy != FAIL_OPEN or not failure.value.unavailable:
+        return failure
+    log.msg("Skipping adapter %s: %s" % (adapter.name, failure.value.body))
+    return result
+
+
+def _readAnswer(response, read):
+    """
+    Read the answer of a modifying adapter with ``read``, unless it is a
+    ``204 No Content`` answer, which leaves the request or response as it
+    was.
+    """
+    if response.code == http.NO_CONTENT:
+        d = treq.content(response)
+        d.addCallback(lambda ignored: UNMODIFIED)
+        return d
+    d = treq.json_content(response)
+    d.addCallback(read)
+    return d
+
+
+def _readModifiedClientRequest(response):
+    """
+    Read the request body a pre-hook adapter answered with, in the version
+    of the protocol it answered in.
+
+    :return: A ``Deferred`` firing with a ``HookBody``, or ``UNMODIFIED``.
+    """
+    return _readAnswer(response, readClientRequest)
+
+
+def _readModifiedServerResponse(response):
+    """
+    Read the response a post-hook adapter answered with, in the version of
+    the protocol it answered in.
+    """
+    return _readAnswer(response, readServerResponse)
+
+
+def _keepUnmodified(answer, result, adapter, hook, metrics):
+    """
+    Pass on ``result`` as it is if the adapter left it unmodified, without
+    decoding or encoding anything, and count which it was.
+    """
+    if answer is UNMODIFIED:
+        outcome = "unmodified"
+        answer = result
+    else:
+        outcome = "modified"
+    metrics.increment("powerstrip_adapter_answers_total",
+                      (("adapter", adapter.name), ("hook", hook),
+                       ("result", outcome)))
+    return answer
+
+
+def _callPreHook(result, client, adapter, request, originalRequestBody,
+                 metrics, breakers, readBody=_readModifiedClientRequest):
+    """
+    POST the client request to a pre-hook adapter, and read its response
+    with ``readBody``.
+
+    :param result: The ``HookBody`` of the request as modified by the
+        previous pre-hook, or ``None`` if this is the first one.
+
+    :param originalRequestBody: The ``HookBody`` of the client request, or
+        ``None`` if it wasn't read.
+    """
+    if result is None:
+        newRequestBody = originalRequestBody
+    else:
+        newRequestBody = result
+    clientRequest = {"Method": request.method, "Request": request.uri}
+    clientRequest.update(bodyFields(newRequestBody, adapter.protocol))
+    d = breakers.call(adapter, _postHook, client, adapter, "pre", {
+                "PowerstripProtocolVersion": adapter.protocol,
+                "Type": "pre-hook",
+                "ClientRequest": clientRequest,
+            }, metrics, readBody)
+    if adapter.mode == MODIFY:
+        d.addCallback(_keepUnmodified, result, adapter, "pre", metrics)
+    d.addErrback(_skipFailedOpen, adapter, result)
+    return d
+
+
+def _observe(d):
+    """
+    Log failures to call an observer, so that they don't affect the request.
+    """
+    d.addErrback(log.err, 'while calling observer')
+    return d
+
+
+def _waitForObservers(result, observers):
+    """
+    Pass ``result`` on once all of the ``observers`` have been called.
+    """
+    if not observers:
+        return result
+    d = defer.DeferredList(observers)
+    d.addCallback(lambda ignored: result)
+    return d
+
+
+def _runPreHooks(ignored, client, chain, request, originalRequestBody,
+                 metrics, breakers):
+    """
+    Call the pre-hook observers of ``chain`` with the client request, while
+    passing it through the modifying pre-hooks one after the other.
+
+    :return: A ``Deferred`` which fires with the ``HookBody`` of the request
+        as modified by the last modifying pre-hook, or ``None`` if there were
+        none, once the observers have been called as well.
+    """
+    observers = [_observe(_callPreHook(None, client, adapter, request,
+                                       originalRequestBody, metrics,
+                                       breakers, treq.content))
+                 for adapter in chain.preObservers]
+    d = defer.succeed(None)
+    for adapter in chain.pre:
+        d.addCallback(_callPreHook, client, adapter, request,
+                      originalRequestBody, metrics, breakers)
+    d.addCallback(_waitForObservers, observers)
+    return d
+
+
+def _runPostHooks(result, client, chain, request, originalRequestBody,
+                  metrics, breakers):
+    """
+    Call the post-hook observers of ``chain`` with the Docker response, while
+    passing it through the modifying post-hooks one after the other.
+
+    :return: A ``Deferred`` which fires with the response of the last
+        modifying post-hook, or the Docker response if there were none, once
+        the observers have been called as well.
+    """
+    d = _chainPostHooks(postHookResponse(result), client, chain, request,
+                        originalRequestBody, metrics, breakers)
+    d.addCallback(postHookResult)
+    return d
+
+
+def _chainPostHooks(response, client, chain, request, originalRequestBody,
+                    metrics, breakers, streamed=False):
+    """
+    Pass a response, as returned by ``postHookResponse``, through the
+    post-hooks of ``chain``, calling the observers with it meanwhile.
+
+    :param streamed: Whether ``response`` holds messages of a streamed
+        response, rather than a whole one.
+    """
+    observers = [_observe(_callPostHook(response, client, adapter, request,
+                                        originalRequestBody, metrics,
+                                        breakers, treq.content, streamed))
+                 for adapter in chain.postObservers]
+    d = defer.succeed(response)
+    for adapter in chain.post:
+        d.addCallback(_callPostHook, client, adapter, request,
+                      originalRequestBody, metrics, breakers,
+                      streamed=streamed)
+    d.addCallback(_waitForObservers, observers)
+    return d
+
+
+def _runMessageHooks(messages, client, chain, request, originalRequestBody,
+                     metrics, breakers):
+    """
+    Pass a batch of messages of a streamed JSON response through the
+    post-hooks of ``chain``.  The status and headers have been sent to the
+    client already, so only the body the post-hooks answer with is used.
+
+    :param messages: The bytes of the messages, as Docker sent them.
+
+    :return: A ``Deferred`` firing with the bytes to send the client
+        instead.
+    """
+    contentType = request.responseHeaders.getRawHeaders("content-type")
+    response = {"Code": request.code,
+                "ContentType": contentType[0] if contentType else None,
+                "Body": HookBody(messages)}
+    d = _chainPostHooks(response, client, chain, request, originalRequestBody,
+                        metrics, breakers, streamed=True)
+    def encode(response):
+        body = response["Body"].text() or b""
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        # Keep the messages apart from the next ones, as Docker does.
+        if body and not body.endswith(b"\n"):
+            body += b"\r\n"
+        return body
+    d.addCallback(encode)
+    return d
+
+
+def _runHeaderHooks(client, chain, request, originalRequestBody, metrics,
+                    breakers):
+    """
+    Pass the status code and content type of the Docker response through the
+    post-hooks of ``chain``, none of which are given the body, before
+    anything has been sent to the client.
+
+    :return: A ``Deferred`` firing with ``True`` once what the post-hooks
+        answered has been applied to ``request``, or with ``False`` if an
+        adapter failed and the client has been answered with its error.
+    """
+    contentType = request.responseHeaders.getRawHeaders("content-type")
+    response = {"Code": request.code,
+                "ContentType": contentType[0] if contentType else None,
+                "Body": None}
+    d = _chainPostHooks(response, client, chain, request, originalRequestBody,
+                        metrics, breakers)
+    def apply(response):
+        if response["Code"] != request.code:
+            request.setResponseCode(response["Code"])
+        contentType = response["ContentType"]
+        if contentType is not None:
+            # Adapters give us text.
+            if isinstance(contentType, unicode):
+                contentType = contentType.encode("utf-8")
+            request.responseHeaders.setRawHeaders(b"content-type",
+                                                  [contentType])
+        return True
+    def refuse(failure):
+        _sendAdapterFailure(failure, request)
+        return False
+    d.addCallbacks(apply, refuse)
+    return d
+
+
+def _inspect(client, chain, shareLimit=None, runMessageHooks=None,
+             runHeaderHooks=None):
+    """
+    Register for the Docker response.  If there are no post-hooks, and the
+    response isn't going to be cached or shared with other requests, allow it
+    to be streamed back to the client, rather than buffered.  Notifications
+    about streamed responses have no body.  A response to be cached or
+    shared is only collected up to ``shareLimit`` bytes when there are no
+    post-hooks, and streamed if it grows larger.
+
+    Otherwise, unless the response is shared, the body needn't be buffered
+    either if none of the post-hooks are given it: they are run with
+    ``runHeaderHooks`` once the headers arrive, and the body is streamed.
+    If all of the post-hooks take the messages of streamed JSON responses,
+    such a response passes through them with ``runMessageHooks`` as it
+    streams.
+    """
+    d = defer.Deferred()
+    client.registerListener(d)
+    shared = shareLimit is not None
+    if not (chain.hasPostHooks or shared):
+        client.setStreamingMode(True)
+    elif not chain.hasPostHooks:
+        client.setShareLimit(shareLimit)
+    elif not shared and chain.headersOnly:
+        client.setHeaderHooks(runHeaderHooks)
+    elif not shared and chain.messageBatch is not None:
+        client.setMessageHooks(runMessageHooks, chain.messageBatch)
+    return d
+
+
+def _land(result, flights, key, request):
+    """
+    Share the Docker response of the leader of a flight with the requests
+    waiting for it, before any post-hooks change it.
+    """
+    flights.land(key, result,
+                 list(request.responseHeaders.getAllRawHeaders()))
+    return result
+
+
+def _abortFlight(failure, flights, key):
+    flights.abort(key)
+    return failure
+
+
+def _storeInCache(result, cache, key, generation, request):
+    """
+    Cache a successful Docker response, before any post-hooks change it.
+    """
+    if result["ModifiedServerResponse"]["Code"] == 200:
+        cache.put(key, generation, result,
+                  list(request.responseHeaders.getAllRawHeaders()))
+    return result
+
+
+def _callPostHook(result, client, adapter, request, originalRequestBody,
+                  metrics, breakers, readBody=_readModifiedServerResponse,
+                  streamed=False):
+    """
+    POST the Docker response to a post-hook adapter, and read its response
+    with ``readBody``.
+
+    :param result: The Docker response, or the response of the previous
+        post-hook, as returned by ``postHookResponse``.
+
+    :param streamed: Whether ``result`` holds messages of a streamed
+        response, which the adapter is told with ``Streamed``.
+    """
+    clientRequest = {"Method": request.method, "Request": request.uri}
+    clientRequest.update(bodyFields(originalRequestBody, adapter.protocol))
+    serverResponse = {"ContentType": result["ContentType"],
+                      "Code": result["Code"]}
+    if adapter.body == NO_BODY:
+        serverResponse["Body"] = None
+    else:
+        serverResponse.update(bodyFields(result["Body"], adapter.protocol))
+    if streamed:
+        serverResponse["Streamed"] = True
+    d = breakers.call(adapter, _postHook, client, adapter, "post", {
+                "PowerstripProtocolVersion": adapter.protocol,
+                "Type": "post-hook",
+                "ClientRequest": clientRequest,
+                "ServerResponse": serverResponse,
+            }, metrics, readBody)
+    if adapter.mode == MODIFY:
+        d.addCallback(_keepUnmodified, result, adapter, "post", metrics)
+        if adapter.body == NO_BODY:
+            d.addCallback(_keepBody, result)
+    d.addErrback(_skipFailedOpen, adapter, result)
+    return d
+
+
+def _keepBody(answer, result):
+    """
+    Keep the body of ``result`` in the answer of an adapter which wasn't
+    given it.
+    """
+    answer = dict(answer)
+    answer["Body"] = result["Body"]
+    return answer
+
+
+def _sendFinalResponseToClient(result, request):
+    resultBody = result["ModifiedServerResponse"]["Body"]
+    # Adapters give us text, but Docker responses are passed on as they are.
+    if isinstance(resultBody, unicode):
+        resultBody = resultBody.encode("utf-8")
+    # Update the Content-Length, since we're modifying the request object in-place.
+    request.responseHeaders.setRawHeaders(
+        b"content-length",
+        [str(len(resultBody))]
+    )
+    # Write the final response to the client.
+    request.write(resultBody)
+    request.finish()
+    return result
+
+
+def _sendAdapterFailure(failure, request):
+    """
+    Stop the chain when an adapter fails, and answer the client with its
+    error instead.
+    """
+    failure.trap(AdapterFailed)
+    error = failure.value
+    log.msg("Adapter %s failed with %d: %s" % (
+        error.adapter, error.code, error.body))
+    request.setResponseCode(error.code)
+    request.responseHeaders.setRawHeaders(b"content-type",
+                                          [error.contentType])
+    request.responseHeaders.setRawHeaders(b"content-length",
+                                          [str(len(error.body))])
+    request.write(error.body)
+    request.finish()
+
+
+def _squashNoPostHooks(failure):
+    failure.trap(NoPostHooks)
+
+
+def _requestFinished(ignored, metrics, matched, started):
+    """
+    Record how long a request took, by the endpoint expressions it matched.
+    """
+    if len(matched) == 1:
+        endpoint, = matched
+    elif matched:
+        endpoint = ", ".join(sorted(matched))
+    else:
+        endpoint = ""
+    metrics.observeSince("powerstrip_request_duration_seconds",
+                         (("endpoint", endpoint),), started)
+
+
+def _notify(result, notifier, chain, request, originalRequestBody):
+    """
+    Queue notifications for the adapters of ``chain`` about a request whose
+    response has been sent to the client.
+
+    :param result: The final response, or ``None`` if it was streamed to the
+        client, in which case the notification has no response body and is
+        only queued once the response is complete.
+    """
+    if result is None and not request.finished:
+        d = request.notifyFinish()
+        d.addBoth(_notifyStreamed, notifier, chain, request,
+                  originalRequestBody)
+    else:
+        _queueNotification(result, notifier, chain, request,
+                           originalRequestBody)
+
+
+def _notifyStreamed(ignored, notifier, chain, request, originalRequestBody):
+    """
+    Queue notifications once a streamed response is complete, or the client
+    has gone away.
+    """
+    _queueNotification(None, notifier, chain, request, originalRequestBody)
+
+
+def _queueNotification(result, notifier, chain, request, originalRequestBody):
+    if result is None:
+        contentType = request.responseHeaders.getRawHeaders("content-type")
+        serverResponse = {
+            "ContentType": contentType[0] if contentType else None,
+            "Body": None,
+            "Code": request.code,
+        }
+    else:
+        serverResponse = result["ModifiedServerResponse"]
+    notifier.notify(chain.notify, {
+        "ClientRequest": {
+            "Method": request.method,
+            "Request": request.uri,
+            "Body": bodyFields(originalRequestBody, 1)["Body"],
+        },
+        "ServerResponse": {
+            "ContentType": serverResponse["ContentType"],
+            "Body": serverResponse["Body"],
+            "Code": serverResponse["Code"],
+        },
+    })
+
+
+@implementer(IPushProducer)
+class _HijackedPeer(object):
+    """
+    One side of a hijacked connection, registered as the producer of the
+    other side's transport: reading from it stops while the other side's
+    write buffer is full, so that a slow reader on either side holds up the
+    writer instead of growing the proxy's memory.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        # The other side has gone.  A transport doesn't close while it has a
+        # paused producer, so let go of ours first.
+        if self.transport.producer is not None:
+            self.transport.unregisterProducer()
+        self.transport.loseConnection()
+
 
 class DockerProxyClient(proxy.ProxyClient):
     """
@@ -30,12 +536,30 @@ class DockerProxyClient(proxy.ProxyClient):
     self.http: A boolean which reflects whether the connection is in HTTP mode
         (True) or "hijack" mode (False). See
         https://docs.docker.com/reference/api/docker_remote_api_v1.14/#32-hijacking
+
+    self.responseBuffer: The ``ResponseBuffer`` collecting the response for
+        the post-hooks, set by the factory.
+
+    self.metrics: The ``Metrics`` to record timings in, set by the factory.
+
+    self.started: When the request to Docker was made, or ``None`` once its
+        response has been recorded in the metrics.
     """
 
     http = True
     _streaming = False
+    _stream = None
+    _messageHooks = None
+    _messages = None
+    _headerHooks = None
+    _held = None
+    _heldEnd = False
+    _clientGone = False
     _listener = None
-    _responsePartBuffer = b""
+    _shareLimit = None
+    responseBuffer = None
+    metrics = None
+    started = None
 
     def _fireListener(self, result):
         if self._listener is not None:
@@ -63,6 +587,35 @@ class DockerProxyClient(proxy.ProxyClient):
         """
         self._listener = d
 
+    def setMessageHooks(self, runHooks, batch):
+        """
+        If the response turns out to be a stream of JSON messages, pass them
+        through the post-hooks with ``runHooks`` as they arrive, ``batch``
+        at most at a time, rather than buffering the whole response.
+        """
+        self._messageHooks = (runHooks, batch)
+
+    def setShareLimit(self, limit):
+        """
+        Collect the response to share it with other requests, but no more
+        than ``limit`` bytes of it: should it grow larger, stream it to the
+        client instead, and tell the listener there is nothing to share.
+        """
+        self._shareLimit = limit
+
+    def setHeaderHooks(self, runHooks):
+        """
+        Once the status and headers of the response have arrived, call
+        ``runHooks``, and hold the body back until it fires: with ``True``
+        to stream the body to the client, or with ``False`` if the client has
+        been answered otherwise.
+        """
+        self._headerHooks = runHooks
+        self.father.notifyFinish().addErrback(self._lostClient)
+
+    def _lostClient(self, reason):
+        self._clientGone = True
+
     def _handleRawStream(self):
         """
         Switch the current connection to be a "hijacked" aka raw stream: one
@@ -70,6 +623,10 @@ class DockerProxyClient(proxy.ProxyClient):
         """
         def loseWriteConnectionReason(reason):
             # discard the reason, for compatibility with readConnectionLost
+            if self.transport.producer is not None:
+                # Nothing more is to be read from the client; a paused
+                # producer would keep Docker's write side open.
+                self.transport.unregisterProducer()
             self.transport.loseWriteConnection()
         self.father.transport.readConnectionLost = loseWriteConnectionReason
         directlyProvides(self.father.transport, IHalfCloseableProtocol)
@@ -81,24 +638,156 @@ class DockerProxyClient(proxy.ProxyClient):
         def stdinHandler(data):
             self.transport.write(data)
         self.father.transport.protocol.dataReceived = stdinHandler
+        # Pair the connections both ways, so that neither side is read
+        # faster than the other side writes.  The request body must have
+        # been sent before the client can take over as the producer of the
+        # connection to Docker.
+        self.father.transport.registerProducer(
+            _HijackedPeer(self.transport), True)
+        self._bodySent.addCallback(
+            lambda ignored: self.transport.registerProducer(
+                _HijackedPeer(self.father.transport), True))
         self.setStreamingMode(True)
+        self.metrics.increment("powerstrip_docker_responses_total",
+                               (("mode", HIJACKED),))
+
+    def connectionMade(self):
+        """
+        Send the request, streaming the body from the file it was spooled to
+        rather than copying it into memory, so that large build contexts cost
+        a constant amount of memory.  ``FileSender`` only reads the next chunk
+        once the transport has written the last one.
+        """
+        self.sendCommand(self.command, self.rest)
+        for header, value in self.headers.items():
+            self.sendHeader(header, value)
+        self.endHeaders()
+        d = self._bodySent = FileSender().beginFileTransfer(
+            self.data, self.transport)
+        # If Docker goes away mid-upload, the response handling deals with it.
+        d.addErrback(lambda reason: None)
+
+    def handleStatus(self, version, code, message):
+        self.metrics.observeSince("powerstrip_docker_first_byte_seconds", (),
+                                  self.started)
+        return proxy.ProxyClient.handleStatus(self, version, code, message)
+
+    def _recordEnd(self, mode):
+        """
+        Record the end of the Docker response in the metrics, once.
+        """
+        if self.started is None:
+            return
+        self.metrics.observeSince("powerstrip_docker_duration_seconds", (),
+                                  self.started)
+        self.started = None
+        if mode is not None:
+            self.metrics.increment("powerstrip_docker_responses_total",
+                                   (("mode", mode),))
 
     def handleHeader(self, key, value):
-        if (key.lower() == "content-type" and
-                value == "application/vnd.docker.raw-stream"):
-            self._handleRawStream()
+        if key.lower() == "content-type":
+            if value == "application/vnd.docker.raw-stream":
+                self._handleRawStream()
+            elif isBinaryContentType(value):
+                # Stream tarballs (export, save) straight to the client:
+                # post-hooks can't be given them anyway.
+                self.setStreamingMode(True)
         return proxy.ProxyClient.handleHeader(self, key, value)
 
+    def handleEndHeaders(self):
+        """
+        Run the post-hooks which are only given the headers.
+
+        Otherwise, a JSON response without a length is a stream of messages,
+        such as the progress of a pull; pass them through message post-hooks,
+        if there are any, as they arrive.
+        """
+        if self.http and self._headerHooks is not None:
+            # Don't read the body until the post-hooks have answered; some
+            # of it may have come with the headers.
+            self._held = []
+            self.transport.pauseProducing()
+            self.setStreamingMode(True)
+            d = self._headerHooks()
+            d.addCallback(self._headersChecked)
+            d.addErrback(self._headerHooksFailed)
+        elif (self.http and not self._streaming and self.length is None and
+                self._messageHooks is not None and isJSONContentType(
+                    self.father.responseHeaders.getRawHeaders(
+                        "content-type", [None])[0])):
+            runHooks, batch = self._messageHooks
+            self._messages = MessageStream(
+                self.father, self.transport, self.metrics, runHooks, batch)
+            self.setStreamingMode(True)
+        return proxy.ProxyClient.handleEndHeaders(self)
+
+    def _headersChecked(self, proceed):
+        """
+        Stream the body to the client once the post-hooks have answered, or
+        stop reading it if the client has been answered otherwise.
+        """
+        held, self._held = self._held, None
+        if not proceed or self._clientGone:
+            self._finished = True
+            self.transport.loseConnection()
+            return
+        for data in held:
+            self.handleResponsePart(data)
+        if self._heldEnd:
+            self.handleResponseEnd()
+        else:
+            self.transport.resumeProducing()
+
+    def _headerHooksFailed(self, reason):
+        self._held = None
+        log.err(reason, "while running post-hooks on response headers")
+        self._finished = True
+        self.transport.loseConnection()
+        if not self._clientGone:
+            self.father.transport.loseConnection()
 
     def handleResponsePart(self, buffer):
         """
         If we're not in streaming mode, buffer the response part(s).
+        Otherwise write them to the client, reading from Docker only as fast
+        as the client takes them.
         """
-        if self._streaming:
-            proxy.ProxyClient.handleResponsePart(self, buffer)
-        else:
-            self._responsePartBuffer += buffer
+        if self._held is not None:
+            self._held.append(buffer)
+        elif self._messages is not None:
+            self._messages.write(buffer)
+        elif self._streaming:
+            if self._stream is None:
+                self._stream = StreamedResponse(
+                    self.father, self.transport, self.metrics)
+            self._stream.write(buffer)
+        elif not self._finished:
+            if (self._shareLimit is not None and
+                    self.responseBuffer.size + len(buffer) >
+                    self._shareLimit):
+                self._stopSharing(buffer)
+                return
+            try:
+                self.responseBuffer.write(buffer)
+            except ResponseTooLarge as e:
+                self._finished = True
+                self.transport.loseConnection()
+                refuseTooLarge(self.father, e)
+                self._fireListener(Failure(NoPostHooks()))
+
 
+    def _stopSharing(self, buffer):
+        """
+        Stream a response which outgrew the share limit to the client,
+        starting with what was collected of it.
+        """
+        collected = self.responseBuffer.getvalue()
+        self.responseBuffer.close()
+        self.setStreamingMode(True)
+        if collected:
+            self.handleResponsePart(collected)
+        self.handleResponsePart(buffer)
 
     def handleResponseEnd(self):
         """
@@ -111,15 +800,35 @@ class DockerProxyClient(proxy.ProxyClient):
         close.
         """
         if self.http:
-            if self._streaming:
-                return proxy.ProxyClient.handleResponseEnd(self)
-            else:
+            if self._held is not None:
+                # The post-hooks on the headers haven't answered yet.
+                self._heldEnd = True
+            elif self._messages is not None:
+                self._recordEnd(STREAMING)
+                if not self._finished:
+                    self._finished = True
+                    self._messages.finish()
+                    self.transport.loseConnection()
+            elif self._streaming:
+                self._recordEnd(STREAMING)
+                if self._stream is None:
+                    return proxy.ProxyClient.handleResponseEnd(self)
+                if not self._finished:
+                    self._finished = True
+                    self._stream.finish()
+                    self.transport.loseConnection()
+            elif not self._finished:
+                self._finished = True
+                self._recordEnd(BUFFERED)
+                self.metrics.observe("powerstrip_response_buffered_bytes", (),
+                                     self.responseBuffer.size)
                 contentType = self.father.responseHeaders.getRawHeaders("content-type")
                 if contentType:
                     contentType = contentType[0]
                 else:
                     contentType = None
-                body = self._responsePartBuffer
+                body = self.responseBuffer.getvalue()
+                self.responseBuffer.close()
                 self._fireListener(
                         {"PowerstripProtocolVersion": 1,
                          "ModifiedServerResponse":
@@ -127,6 +836,10 @@ class DockerProxyClient(proxy.ProxyClient):
                              "Code": self.father.code,
                              "ContentType": contentType}})
         else:
+            # The hijacked mode was counted when it started.
+            self._recordEnd(None)
+            if self.father.transport.producer is not None:
+                self.father.transport.unregisterProducer()
             self.father.transport.loseConnection()
 
 
@@ -140,6 +853,12 @@ class DockerProxyClient(proxy.ProxyClient):
 class DockerProxyClientFactory(proxy.ProxyClientFactory):
     protocol = DockerProxyClient
     _listener = None
+    # The ``BufferConfiguration`` of the response buffer of the client.
+    bufferSettings = BufferConfiguration()
+    # The ``Metrics`` of the client, and when the request was made.
+    metrics = None
+    started = None
+
     def onCreate(self, d):
         self._listener = d
 
@@ -151,6 +870,10 @@ class DockerProxyClientFactory(proxy.ProxyClientFactory):
 
     def buildProtocol(self, addr):
         client = proxy.ProxyClientFactory.buildProtocol(self, addr)
+        client.responseBuffer = ResponseBuffer(
+            self.bufferSettings.memory_limit, self.bufferSettings.max_size)
+        client.metrics = self.metrics
+        client.started = self.started
         self._fireListener(client)
         return client
 
@@ -163,21 +886,23 @@ class DockerProxy(proxy.ReverseProxyResource):
     proxyClientFactoryClass = DockerProxyClientFactory
 
 
+    # The attributes which the root resource sets up, and which every child
+    # resource it creates shares.
+    _shared = ("config", "pool", "client", "dockerPool", "dockerAgent",
+               "notifier", "breakers", "cache", "eventWatcher", "flights",
+               "events", "metrics")
+
     def __init__(self, dockerAddr=None, dockerPort=None, dockerSocket=None,
-            path='', reactor=reactor, config=None):
+            path='', reactor=reactor, config=None, root=None):
         """
         A docker proxy resource which knows how to connect to real Docker
         daemon either via socket (dockerSocket specified) or address + port for
         TCP connection (dockerAddr + dockerPort specified).
+
+        :param root: The root ``DockerProxy`` whose configuration, connection
+            pools and clients this resource shares, or ``None`` if this is the
+            root resource.
         """
-        if config is None:
-            # Try to get the configuration from the default place on the
-            # filesystem.
-            self.config = PluginConfiguration()
-        else:
-            self.config = config
-        self.config.read_and_parse()
-        self.parser = EndpointParser(self.config)
         Resource.__init__(self)
         self.host = dockerAddr
         self.port = dockerPort
@@ -185,156 +910,319 @@ class DockerProxy(proxy.ReverseProxyResource):
         self.path = path
         self.reactor = reactor
         proxy.ReverseProxyResource.__init__(self, dockerAddr, dockerPort, path, reactor) # NB dockerAddr is not actually used
-        self.agent = Agent(reactor) # no connectionpool
-        self.client = HTTPClient(self.agent)
+        if root is None:
+            self._setUpRoot(config)
+        else:
+            for name in self._shared:
+                setattr(self, name, getattr(root, name))
+
+
+    def _setUpRoot(self, config):
+        """
+        Read the configuration and create the connection pools and clients
+        for talking to adapters and to Docker.
+        """
+        if config is None:
+            # Try to get the configuration from the default place on the
+            # filesystem.
+            self.config = PluginConfiguration()
+        else:
+            self.config = config
+        # Changes are picked up per request in render.
+        if not self.config.loaded():
+            self.config.read_and_parse()
+        snapshot = self.config.snapshot()
+        self.pool = ConnectionPool(self.reactor)
+        self.pool.configure(snapshot.adapter_pool)
+        self.client = HTTPClient(Agent(self.reactor, pool=self.pool))
+        self.dockerPool = ConnectionPool(self.reactor)
+        self.dockerPool.configure(snapshot.docker_pool)
+        self.dockerAgent = DockerAgent(self.reactor, self.dockerPool,
+                                       self.host, self.port, self.socket)
+        self.breakers = Breakers(self.reactor)
+        self.notifier = Notifier(httpPoster(self.client),
+                                 snapshot.notify_queue, self.reactor,
+                                 self.breakers)
+        self.cache = ResponseCache(self.reactor)
+        self.cache.configure(snapshot.response_cache)
+        # Subscribe to events over a connection of its own, rather than
+        # taking one from the pool for good.
+        self.eventWatcher = DockerEventWatcher(
+            DockerAgent(self.reactor, None, self.host, self.port,
+                        self.socket),
+            self.cache.invalidate, self.reactor)
+        self.flights = SingleFlight()
+        # Each stream of events shared between clients has a connection of
+        # its own, too.
+        self.events = EventsMultiplexer(
+            DockerAgent(self.reactor, None, self.host, self.port,
+                        self.socket),
+            snapshot.events)
+        self.metrics = Metrics(self.reactor)
+        self.metrics.addCollector(notifierCollector(self.notifier))
+        self.metrics.addCollector(breakerCollector(self.breakers))
+        self.metrics.addCollector(cacheCollector(self.cache))
+        self.metrics.addCollector(flightCollector(self.flights))
+        self.metrics.addCollector(eventsCollector(self.events))
+        self.metrics.addCollector(poolCollector(self.dockerPool))
+
+
+    def _reloadConfig(self, force=False):
+        """
+        Pick up changes to the adapter configuration file.  If the new
+        configuration can't be used, keep serving requests with the previous
+        one.
+
+        :param force: If ``True``, read the file even if it seems unchanged.
+        """
+        try:
+            if self.config.reload_if_changed(force):
+                snapshot = self.config.snapshot()
+                self.pool.configure(snapshot.adapter_pool)
+                self.dockerPool.configure(snapshot.docker_pool)
+                self.notifier.configure(snapshot.notify_queue)
+                self.events.configure(snapshot.events)
+                if snapshot.response_cache != self.cache.settings:
+                    self.cache.configure(snapshot.response_cache)
+                    self.watchEvents()
+        except (NoConfiguration, InvalidConfiguration):
+            log.err(None, 'while reloading adapter configuration')
+
+
+    def watchEvents(self):
+        """
+        Subscribe to Docker events if the response cache relies on them, or
+        unsubscribe if it doesn't.
+        """
+        if self.cache.enabled and self.cache.settings.watch_events:
+            self.eventWatcher.start()
+        else:
+            self.eventWatcher.stop()
 
 
     def render(self, request, reactor=reactor):
         # We are processing a leaf request.
-        # Get the original request body from the client.
+        started = self.metrics.seconds()
+        self._reloadConfig()
+        snapshot = self.config.snapshot()
+        path = request.uri.split("?")[0]
+        matched = snapshot.index.match(request.method, path)
+        chain = snapshot.routes.chain(matched)
+        request.notifyFinish().addBoth(
+            _requestFinished, self.metrics, matched, started)
+        cacheKey = flightKey = waiting = shareLimit = None
+        # Streams of events can be shared, unless post-hooks are to change
+        # them.
+        subscribe = not chain.hasPostHooks and self.events.multiplexable(
+            request.method, path, urlparse.urlparse(request.uri)[4])
+        if request.method in MUTATING_METHODS:
+            # Drop cached responses both before and after Docker makes the
+            # change, since responses to requests made meanwhile may or may
+            # not reflect it.
+            self.cache.invalidate()
+            request.notifyFinish().addBoth(
+                lambda ignored: self.cache.invalidate())
+        elif self._coalescable(request, path):
+            key = self.cache.key(request.method, request.uri,
+                                 request.requestHeaders)
+            if self.cache.cacheable(request.method, path):
+                cacheKey = key
+                shareLimit = snapshot.response_cache.max_bytes
+            if snapshot.coalesce.enabled:
+                # A flight which took off before the last change to Docker
+                # may not reflect it, so requests made since don't join it.
+                flightKey = (self.cache.generation,) + key
+                waiting = self.flights.join(flightKey)
+                shareLimit = max(shareLimit or 0,
+                                 snapshot.coalesce.max_bytes)
+            if (shareLimit is not None and
+                    snapshot.response_buffer.max_size is not None):
+                # Stream a response rather than refuse it, when there are no
+                # post-hooks to give it to.
+                shareLimit = min(shareLimit,
+                                 snapshot.response_buffer.max_size)
+        # Get the original request body from the client, if any adapter is
+        # going to see it.  Otherwise it is streamed to Docker untouched.
         skipPreHooks = False
-        if request.requestHeaders.getRawHeaders('content-type') == ["application/json"]:
-            originalRequestBody = request.content.read()
-            request.content.seek(0) # hee hee
-        elif request.requestHeaders.getRawHeaders('content-type') == ["application/tar"]:
+        originalRequestBody = None
+        contentType = request.requestHeaders.getRawHeaders('content-type')
+        if contentType == ["application/json"]:
+            if chain.hasPreHooks or chain.hasPostHooks or chain.notify:
+                originalRequestBody = HookBody(request.content.read())
+                request.content.seek(0) # hee hee
+        elif contentType == ["application/tar"]:
             # We can't JSON encode binary data, so don't even try.
             skipPreHooks = True
-            originalRequestBody = None
-        else:
-            originalRequestBody = None
-        preHooks = []
-        postHooks = []
         d = defer.succeed(None)
-        for endpoint in self.parser.match_endpoint(request.method, request.uri.split("?")[0]):
-            # It's possible for a request to match multiple endpoint
-            # definitions.  Order of matched endpoint is not defined in
-            # that case.
-            adapters = self.config.endpoint(endpoint)
-            preHooks.extend(adapters.pre)
-            postHooks.extend(adapters.post)
-        def callPreHook(result, hookURL):
-            if result is None:
-                newRequestBody = originalRequestBody
-            else:
-                newRequestBody = result["ModifiedClientRequest"]["Body"]
-            return self.client.post(hookURL, json.dumps({
-                        "PowerstripProtocolVersion": 1,
-                        "Type": "pre-hook",
-                        "ClientRequest": {
-                            "Method": request.method,
-                            "Request": request.uri,
-                            "Body": newRequestBody,
-                        }
-                    }), headers={'Content-Type': ['application/json']})
-        if not skipPreHooks:
-            for preHook in preHooks:
-                hookURL = self.config.adapter_uri(preHook)
-                d.addCallback(callPreHook, hookURL=hookURL)
-                d.addCallback(treq.json_content)
-        def doneAllPrehooks(result):
-            # Finally pass through the request to actual Docker.  For now we
-            # mutate request in-place in such a way that ReverseProxyResource
-            # understands it.
-            if result is not None:
-                requestBody = b""
-                bodyFromAdapter = result["ModifiedClientRequest"]["Body"]
-                if bodyFromAdapter is not None:
-                    requestBody = bodyFromAdapter.encode("utf-8")
-                request.content = StringIO.StringIO(requestBody)
-                request.requestHeaders.setRawHeaders(b"content-length",
-                        [str(len(requestBody))])
-            ###########################
-            # The following code is copied from t.w.proxy.ReverseProxy so that
-            # clientFactory reference can be kept.
-            if not self.socket:
-                if self.port == 80:
-                    host = self.host
-                else:
-                    host = "%s:%d" % (self.host, self.port)
-                request.requestHeaders.setRawHeaders(b"host", [host])
-            request.content.seek(0, 0)
-            qs = urlparse.urlparse(request.uri)[4]
-            if qs:
-                rest = self.path + '?' + qs
-            else:
-                rest = self.path
-            allRequestHeaders = request.getAllHeaders()
-            if allRequestHeaders.get("transfer-encoding") == "chunked":
-                del allRequestHeaders["transfer-encoding"]
-            # XXX Streaming the contents of the request body into memory could
-            # cause OOM issues for large build contexts POSTed through
-            # powerstrip. See https://github.com/ClusterHQ/powerstrip/issues/51
-            body = request.content.read()
-            allRequestHeaders["content-length"] = str(len(body))
-            clientFactory = self.proxyClientFactoryClass(
-                request.method, rest, request.clientproto,
-                allRequestHeaders, body, request)
-            ###########################
-            if self.socket:
-                self.reactor.connectUNIX(self.socket, clientFactory)
-            else:
-                self.reactor.connectTCP(self.host, self.port, clientFactory)
-            d = defer.Deferred()
-            clientFactory.onCreate(d)
-            return d
-        d.addCallback(doneAllPrehooks)
-        def inspect(client):
-            # If there are no post-hooks, allow the response to be streamed
-            # back to the client, rather than buffered.
-            d = defer.Deferred()
-            client.registerListener(d)
-            if not postHooks:
-                client.setStreamingMode(True)
-            return d
-        d.addCallback(inspect)
-        def callPostHook(result, hookURL):
-            serverResponse = result["ModifiedServerResponse"]
-            return self.client.post(hookURL, json.dumps({
-                        # TODO Write tests for the information provided to the adapter.
-                        "PowerstripProtocolVersion": 1,
-                        "Type": "post-hook",
-                        "ClientRequest": {
-                            "Method": request.method,
-                            "Request": request.uri,
-                            "Body": originalRequestBody,
-                            },
-                        "ServerResponse": {
-                            "ContentType": serverResponse["ContentType"],
-                            "Body": serverResponse["Body"],
-                            "Code": serverResponse["Code"],
-                        },
-                    }), headers={'Content-Type': ['application/json']})
-        # XXX Need to skip post-hooks for tar archives from e.g. docker export.
-        # https://github.com/ClusterHQ/powerstrip/issues/52
-        for postHook in postHooks:
-            hookURL = self.config.adapter_uri(postHook)
-            d.addCallback(callPostHook, hookURL=hookURL)
-            d.addCallback(treq.json_content)
-        def sendFinalResponseToClient(result):            
-            resultBody = result["ModifiedServerResponse"]["Body"].encode("utf-8")
-            # Update the Content-Length, since we're modifying the request object in-place.
-            request.responseHeaders.setRawHeaders(
-                b"content-length",
-                [str(len(resultBody))]
-            )
-            # Write the final response to the client.
-            request.write(resultBody)
-            request.finish()
-        d.addCallback(sendFinalResponseToClient)
-        def squashNoPostHooks(failure):
-            failure.trap(NoPostHooks)
-        d.addErrback(squashNoPostHooks)
+        if chain.hasPreHooks and not skipPreHooks:
+            d.addCallback(_runPreHooks, self.client, chain, request,
+                          originalRequestBody, self.metrics, self.breakers)
+        d.addCallback(self._doneAllPrehooks, request,
+                      snapshot.response_buffer, cacheKey, waiting, subscribe)
+        d.addCallback(_inspect, chain, shareLimit,
+                      lambda messages: _runMessageHooks(
+                          messages, self.client, chain, request,
+                          originalRequestBody, self.metrics, self.breakers),
+                      lambda: _runHeaderHooks(
+                          self.client, chain, request, originalRequestBody,
+                          self.metrics, self.breakers))
+        if flightKey is not None and waiting is None:
+            # This request leads the flight.
+            d.addCallbacks(_land, _abortFlight,
+                           callbackArgs=(self.flights, flightKey, request),
+                           errbackArgs=(self.flights, flightKey))
+        if cacheKey is not None:
+            d.addCallback(_storeInCache, self.cache, cacheKey,
+                          self.cache.generation, request)
+        if chain.hasPostHooks:
+            d.addCallback(_runPostHooks, self.client, chain, request,
+                          originalRequestBody, self.metrics, self.breakers)
+        d.addCallback(_sendFinalResponseToClient, request)
+        d.addErrback(_sendAdapterFailure, request)
+        d.addErrback(_squashNoPostHooks)
+        if chain.notify:
+            d.addCallback(_notify, self.notifier, chain, request,
+                          originalRequestBody)
         d.addErrback(log.err, 'while running chain')
         return NOT_DONE_YET
 
 
+    def _coalescable(self, request, path):
+        """
+        Return ``True`` if a request can share its Docker response with
+        identical requests in flight at the same time: it is a ``GET``
+        without a body, whose response is neither hijacked nor streamed.
+        """
+        if request.method != "GET":
+            return False
+        body = request.content
+        body.seek(0, 2)
+        length = body.tell()
+        body.seek(0, 0)
+        return not length and isPoolable(
+            request.method, path, request.getAllHeaders())
+
+
+    def _doneAllPrehooks(self, result, request, bufferSettings,
+                         cacheKey=None, waiting=None, subscribe=False):
+        """
+        Pass the request on to Docker, once the pre-hooks have run.
+
+        :param bufferSettings: The ``BufferConfiguration`` of the snapshot
+            the request is handled with.
+
+        :param cacheKey: The key to look the request up in the cache with,
+            or ``None`` if it isn't cacheable.
+
+        :param waiting: A ``Deferred`` from ``SingleFlight.join`` if the
+            request waits for an identical one to get the response, or
+            ``None``.
+
+        :param subscribe: Whether to subscribe the request to a shared
+            stream of events, rather than sending it to Docker.
+
+        :return: A client offering ``registerListener`` and
+            ``setStreamingMode``, or a ``Deferred`` firing with one.
+        """
+        # Answer from the cache, if we can.
+        if cacheKey is not None:
+            cached = self.cache.get(cacheKey)
+            if cached is not None:
+                response, headers = cached
+                return CachedDockerClient(
+                    request, response, headers,
+                    self.cache.settings.hook_exempt)
+        # For now we mutate request in-place in such a way that
+        # ReverseProxyResource understands it.
+        if result is not None:
+            # The body is only encoded once, whichever versions of the
+            # protocol the pre-hooks spoke.
+            requestBody = result.text() or b""
+            if isinstance(requestBody, unicode):
+                requestBody = requestBody.encode("utf-8")
+            request.content = StringIO.StringIO(requestBody)
+            request.requestHeaders.setRawHeaders(b"content-length",
+                    [str(len(requestBody))])
+        if waiting is not None:
+            waiting.addCallback(self._sharedResponse, request,
+                                bufferSettings)
+            return waiting
+        if subscribe:
+            return self.events.subscribe(
+                request, self.path, urlparse.urlparse(request.uri)[4])
+        return self._sendToDocker(request, bufferSettings)
+
+
+    def _sharedResponse(self, shared, request, bufferSettings):
+        """
+        Answer a request with the response shared by the leader of its
+        flight, or send it to Docker if there is none.
+        """
+        if shared is None:
+            return self._sendToDocker(request, bufferSettings)
+        response, headers = shared
+        return CachedDockerClient(request, response, headers, False)
+
+
+    def _sendToDocker(self, request, bufferSettings):
+        # Finally pass through the request to actual Docker.
+        ###########################
+        # The following code is copied from t.w.proxy.ReverseProxy so that
+        # clientFactory reference can be kept.
+        if not self.socket:
+            if self.port == 80:
+                host = self.host
+            else:
+                host = "%s:%d" % (self.host, self.port)
+            request.requestHeaders.setRawHeaders(b"host", [host])
+        qs = urlparse.urlparse(request.uri)[4]
+        if qs:
+            rest = self.path + '?' + qs
+        else:
+            rest = self.path
+        allRequestHeaders = request.getAllHeaders()
+        if allRequestHeaders.get("transfer-encoding") == "chunked":
+            del allRequestHeaders["transfer-encoding"]
+        # twisted.web has spooled large request bodies (such as build
+        # contexts) to a temporary file; stream them on from there rather
+        # than reading them into memory.
+        # See https://github.com/ClusterHQ/powerstrip/issues/51
+        body = request.content
+        body.seek(0, 2)
+        length = body.tell()
+        body.seek(0, 0)
+        allRequestHeaders["content-length"] = str(length)
+        ###########################
+        if self.dockerPool.persistent and isPoolable(
+                request.method, request.uri.split("?")[0], allRequestHeaders):
+            # Neither hijacked nor streaming: use a keep-alive connection.
+            client = PooledDockerClient(request, bufferSettings,
+                                        self.metrics)
+            client.send(self.dockerAgent, request.method, rest,
+                        allRequestHeaders, body, length)
+            return client
+        clientFactory = self.proxyClientFactoryClass(
+            request.method, rest, request.clientproto,
+            allRequestHeaders, body, request)
+        clientFactory.bufferSettings = bufferSettings
+        clientFactory.metrics = self.metrics
+        clientFactory.started = self.metrics.seconds()
+        if self.socket:
+            self.reactor.connectUNIX(self.socket, clientFactory)
+        else:
+            self.reactor.connectTCP(self.host, self.port, clientFactory)
+        d = defer.Deferred()
+        clientFactory.onCreate(d)
+        return d
+
+
     def getChild(self, path, request):
         fragments = request.uri.split("/")
         fragments.pop(0)
         proxyArgs = (self.host, self.port, self.socket, self.path + '/' + urlquote(path, safe=""),
                      self.reactor)
         #if not request.postpath:
-        resource = DockerProxy(*proxyArgs, config=self.config)
+        resource = DockerProxy(*proxyArgs, root=self)
         return resource
 
 
@@ -342,3 +1230,40 @@ class ServerProtocolFactory(server.Site):
     def __init__(self, dockerAddr=None, dockerPort=None, dockerSocket=None, config=None):
         self.root = DockerProxy(dockerAddr, dockerPort, dockerSocket, config=config)
         server.Site.__init__(self, self.root)
+
+    def startFactory(self):
+        """
+        Pre-warm the connection pools, if configured to.
+        """
+        server.Site.startFactory(self)
+        snapshot = self.root.config.snapshot()
+        if snapshot.adapter_pool.prewarm:
+            self.root.pool.prewarm(snapshot.adapters.values())
+        if snapshot.docker_pool.prewarm:
+            self.root.dockerAgent.prewarm()
+        self.root.watchEvents()
+
+    def reloadConfig(self):
+        """
+        Read the adapter configuration file again, whether or not it seems
+        to have changed.
+        """
+        self.root._reloadConfig(force=True)
+
+    def stopFactory(self):
+        """
+        Unsubscribe from Docker events.
+        """
+        self.root.eventWatcher.stop()
+        self.root.events.stop()
+        server.Site.stopFactory(self)
+
+    def metricsSite(self):
+        """
+        Return a ``Site`` serving the metrics of this proxy at ``/metrics``,
+        and the state of the circuit breakers of adapters at ``/breakers``,
+        to be run on an admin port.
+        """
+        site = MetricsSite(self.root.metrics)
+        site.resource.putChild("breakers", BreakersResource(self.root.breakers))
+        return site
@@ -0,0 +1,193 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._breaker``.
+"""
+
+import json
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.test.test_web import DummyRequest
+
+from .._breaker import (
+        AdapterFailed, Breakers, BreakersResource, CircuitBreaker, CLOSED,
+        OPEN, HALF_OPEN)
+from .._config import Adapter, BreakerConfiguration
+
+
+class CircuitBreakerTests(TestCase):
+    """
+    Tests for ``CircuitBreaker``.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker(
+            BreakerConfiguration(failures=3, window=10, cooldown=30),
+            self.clock)
+
+    def test_opens_after_failures(self):
+        """
+        The breaker opens once ``failures`` calls failed within the window,
+        and then refuses calls.
+        """
+        for i in range(3):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.failed()
+        self.assertEqual((self.breaker.state, self.breaker.allow(),
+                          self.breaker.trips, self.breaker.shortCircuited),
+                         (OPEN, False, 1, 1))
+
+    def test_failures_expire(self):
+        """
+        Failures older than the window don't count towards opening the
+        breaker.
+        """
+        self.breaker.failed()
+        self.breaker.failed()
+        self.clock.advance(10)
+        self.breaker.failed()
+        self.assertEqual((self.breaker.state,
+                          self.breaker.describe()["recent_failures"]),
+                         (CLOSED, 1))
+
+    def test_success_resets(self):
+        """
+        A call which succeeds clears the failures counted so far.
+        """
+        self.breaker.failed()
+        self.breaker.failed()
+        self.breaker.succeeded()
+        self.breaker.failed()
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_half_open(self):
+        """
+        Once the cool-down has passed, a single call is let through: the
+        breaker closes if it succeeds.
+        """
+        for i in range(3):
+            self.breaker.failed()
+        self.clock.advance(30)
+        self.assertEqual((self.breaker.allow(), self.breaker.state,
+                          self.breaker.allow()),
+                         (True, HALF_OPEN, False))
+        self.breaker.succeeded()
+        self.assertEqual((self.breaker.state, self.breaker.allow()),
+                         (CLOSED, True))
+
+    def test_half_open_fails(self):
+        """
+        If the call let through by a half-open breaker fails, the breaker
+        opens again for another cool-down.
+        """
+        for i in range(3):
+            self.breaker.failed()
+        self.clock.advance(30)
+        self.breaker.allow()
+        self.breaker.failed()
+        self.clock.advance(29)
+        self.assertEqual((self.breaker.state, self.breaker.allow(),
+                          self.breaker.trips), (OPEN, False, 2))
+
+    def test_disabled(self):
+        """
+        A breaker configured with no ``failures`` never opens, and turning it
+        off closes it.
+        """
+        for i in range(3):
+            self.breaker.failed()
+        self.breaker.configure(BreakerConfiguration(failures=0))
+        for i in range(10):
+            self.breaker.failed()
+        self.assertEqual((self.breaker.state, self.breaker.allow()),
+                         (CLOSED, True))
+
+
+class BreakersTests(TestCase):
+    """
+    Tests for ``Breakers``.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.breakers = Breakers(self.clock)
+        self.adapter = Adapter("flocker", "http://flocker/", timeout=5,
+                               breaker=BreakerConfiguration(failures=2))
+
+    def test_success(self):
+        """
+        ``call`` fires with the result of the call.
+        """
+        d = self.breakers.call(self.adapter, succeed, 42)
+        self.assertEqual(self.successResultOf(d), 42)
+
+    def test_timeout(self):
+        """
+        A call which hasn't finished within the adapter's timeout is
+        cancelled, and fails with a gateway timeout.
+        """
+        called = Deferred()
+        d = self.breakers.call(self.adapter, lambda: called)
+        self.clock.advance(5)
+        self.assertEqual(self.failureResultOf(d, AdapterFailed).value.code,
+                         504)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_error(self):
+        """
+        Failures other than ``AdapterFailed`` are reported as bad gateway
+        errors.
+        """
+        d = self.breakers.call(self.adapter, fail, ValueError("not JSON"))
+        error = self.failureResultOf(d, AdapterFailed).value
+        self.assertEqual((error.adapter, error.code, error.body),
+                         ("flocker", 502, "Adapter 'flocker' failed: not JSON"))
+
+    def test_short_circuit(self):
+        """
+        Once the breaker of an adapter is open, calls fail with a service
+        unavailable error without calling the adapter.
+        """
+        for i in range(2):
+            self.breakers.call(self.adapter, fail, ValueError()).addErrback(
+                lambda reason: None)
+        calls = []
+        d = self.breakers.call(self.adapter, calls.append, None)
+        self.assertEqual(
+            (self.failureResultOf(d, AdapterFailed).value.code, calls),
+            (503, []))
+
+    def test_rejection_not_counted(self):
+        """
+        An adapter which rejects a hook with a client error is working, and
+        doesn't count towards opening its breaker.
+        """
+        for i in range(3):
+            self.breakers.call(self.adapter, fail, AdapterFailed(
+                "flocker", 403, "no")).addErrback(lambda reason: None)
+        self.assertEqual(self.breakers.breaker(self.adapter).state, CLOSED)
+
+    def test_reconfigured(self):
+        """
+        The breaker of an adapter is kept by name, and picks up new settings.
+        """
+        breaker = self.breakers.breaker(self.adapter)
+        changed = self.adapter._replace(
+            breaker=BreakerConfiguration(failures=7))
+        self.assertIdentical(self.breakers.breaker(changed), breaker)
+        self.assertEqual(breaker.settings.failures, 7)
+
+    def test_resource(self):
+        """
+        ``BreakersResource`` serves the description of every breaker as JSON.
+        """
+        self.breakers.breaker(self.adapter).failed()
+        request = DummyRequest([""])
+        body = BreakersResource(self.breakers).render_GET(request)
+        self.assertEqual(json.loads(body), {"flocker": {
+            "state": "closed", "recent_failures": 1, "trips": 0,
+            "short_circuited": 0, "opened_at": None, "retry_at": None,
+            "failures": 2, "window": 60, "cooldown": 30}})
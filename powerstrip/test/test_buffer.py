@@ -0,0 +1,80 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._buffer``.
+"""
+
+from twisted.trial.unittest import TestCase
+
+from .._buffer import ResponseBuffer, ResponseTooLarge
+
+
+class ResponseBufferTests(TestCase):
+    """
+    Tests for ``ResponseBuffer``.
+    """
+
+    def test_in_memory(self):
+        """
+        Parts up to the memory limit are kept in memory and joined in order.
+        """
+        buffer = ResponseBuffer(10)
+        for part in ["abc", "", "def", "ghij"]:
+            buffer.write(part)
+        self.assertEqual((buffer.getvalue(), buffer.size, buffer.spilled),
+                         ("abcdefghij", 10, False))
+
+    def test_spilled(self):
+        """
+        Once the memory limit is exceeded the response is written to a
+        temporary file, and still read back whole and in order.
+        """
+        buffer = ResponseBuffer(4)
+        for part in ["abc", "def", "ghi"]:
+            buffer.write(part)
+        self.assertEqual((buffer.getvalue(), buffer.size, buffer.spilled),
+                         ("abcdefghi", 9, True))
+
+    def test_no_memory(self):
+        """
+        A limit of 0 spills any non-empty response.
+        """
+        buffer = ResponseBuffer(0)
+        buffer.write("")
+        self.assertFalse(buffer.spilled)
+        buffer.write("x")
+        self.assertTrue(buffer.spilled)
+
+    def test_close(self):
+        """
+        ``close`` discards the response.
+        """
+        buffer = ResponseBuffer(2)
+        buffer.write("abc")
+        buffer.close()
+        self.assertEqual((buffer.getvalue(), buffer.size, buffer.spilled),
+                         ("", 0, False))
+
+    def test_max_size(self):
+        """
+        A response may grow up to the most bytes it may have, but writing
+        past that raises ``ResponseTooLarge`` and releases what was
+        collected, so a response costs no more than that in memory.
+        """
+        buffer = ResponseBuffer(4, 8)
+        buffer.write("abcd")
+        buffer.write("efgh")
+        exception = self.assertRaises(ResponseTooLarge, buffer.write, "i")
+        self.assertEqual(
+            (exception.maxSize, buffer.getvalue(), buffer.size,
+             buffer.spilled),
+            (8, "", 0, False))
+
+    def test_no_max_size(self):
+        """
+        Without a most bytes, a response may grow as large as it is.
+        """
+        buffer = ResponseBuffer(4)
+        for i in range(100):
+            buffer.write("x" * 1024)
+        self.assertEqual(buffer.size, 100 * 1024)
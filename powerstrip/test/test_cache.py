@@ -0,0 +1,207 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._cache``.
+"""
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.http_headers import Headers
+
+from .._cache import ResponseCache, DockerEventWatcher, SingleFlight
+from .._config import CacheConfiguration
+
+
+def response(body):
+    return {"PowerstripProtocolVersion": 1,
+            "ModifiedServerResponse": {"Body": body, "Code": 200,
+                                       "ContentType": "application/json"}}
+
+
+class ResponseCacheTests(TestCase):
+    """
+    Tests for ``ResponseCache``.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ResponseCache(self.clock)
+        self.cache.configure(CacheConfiguration(
+            endpoints=("GET /*/info", "GET /*/containers/*"), ttl=2,
+            max_bytes=10))
+
+    def test_cacheable(self):
+        """
+        Only ``GET`` requests matching the configured endpoints are
+        cacheable, and never streaming ones.
+        """
+        self.assertEqual(
+            [self.cache.cacheable(method, path) for method, path in [
+                ("GET", "/v1.16/info"), ("GET", "/v1.16/containers/json"),
+                ("GET", "/v1.16/containers/abc/logs"), ("GET", "/v1.16/version"),
+                ("HEAD", "/v1.16/info")]],
+            [True, True, False, False, False])
+
+    def test_disabled(self):
+        """
+        Nothing is cacheable without configured endpoints.
+        """
+        self.cache.configure(CacheConfiguration())
+        self.assertEqual((self.cache.enabled,
+                          self.cache.cacheable("GET", "/v1.16/info")),
+                         (False, False))
+
+    def test_key_varies(self):
+        """
+        The key of a request includes its URI and the ``vary`` headers, but
+        not other headers.
+        """
+        def key(uri, **headers):
+            return self.cache.key("GET", uri, Headers(
+                dict((name, [value]) for name, value in headers.items())))
+        self.assertEqual(key("/info", **{"user-agent": "a"}),
+                         key("/info", **{"user-agent": "b"}))
+        self.assertNotEqual(key("/info"), key("/info?all=1"))
+        self.assertNotEqual(key("/info", authorization="a"),
+                            key("/info", authorization="b"))
+
+    def test_ttl(self):
+        """
+        A response is served for ``ttl`` seconds.
+        """
+        self.cache.put("a", self.cache.generation, response("12"), [])
+        self.clock.advance(1.5)
+        self.assertEqual(self.cache.get("a"), (response("12"), []))
+        self.clock.advance(0.5)
+        self.assertEqual((self.cache.get("a"), len(self.cache),
+                          self.cache.size), (None, 0, 0))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        """
+        Once ``max_bytes`` is reached, the least recently used responses are
+        evicted, and responses bigger than the whole cache aren't stored.
+        """
+        generation = self.cache.generation
+        self.cache.put("a", generation, response("1234"), [])
+        self.cache.put("b", generation, response("1234"), [])
+        self.cache.get("a")
+        self.cache.put("c", generation, response("1234"), [])
+        self.cache.put("d", generation, response("12345678901"), [])
+        self.assertEqual(
+            [self.cache.get(key) is not None for key in "abcd"],
+            [True, False, True, False])
+        self.assertEqual((self.cache.size, self.cache.evictions), (8, 1))
+
+    def test_invalidate(self):
+        """
+        Invalidating drops all responses, and responses to requests made
+        before the invalidation aren't stored.
+        """
+        generation = self.cache.generation
+        self.cache.put("a", generation, response("1"), [])
+        self.cache.invalidate()
+        self.cache.put("b", generation, response("1"), [])
+        self.assertEqual((self.cache.get("a"), self.cache.get("b")),
+                         (None, None))
+
+    def test_copies(self):
+        """
+        Changing a response after storing or getting it doesn't change the
+        cached one.
+        """
+        stored = response("1")
+        self.cache.put("a", self.cache.generation, stored, [])
+        stored["ModifiedServerResponse"]["Body"] = "2"
+        got, headers = self.cache.get("a")
+        got["ModifiedServerResponse"]["Body"] = "3"
+        self.assertEqual(self.cache.get("a"), (response("1"), []))
+
+
+class SingleFlightTests(TestCase):
+    """
+    Tests for ``SingleFlight``.
+    """
+
+    def setUp(self):
+        self.flights = SingleFlight()
+
+    def test_land(self):
+        """
+        The first request with a key leads the flight, and the response it
+        lands with is shared with the requests which joined it meanwhile.
+        """
+        self.assertIdentical(self.flights.join("a"), None)
+        first = self.flights.join("a")
+        second = self.flights.join("a")
+        other = self.flights.join("b")
+        self.flights.land("a", response("1"), [("server", ["Docker"])])
+        self.assertEqual(
+            (self.successResultOf(first), self.successResultOf(second),
+             other),
+            ((response("1"), [("server", ["Docker"])]),) * 2 + (None,))
+        self.assertEqual((self.flights.flights, self.flights.coalesced,
+                          len(self.flights)), (2, 2, 1))
+
+    def test_abort(self):
+        """
+        If the leader aborts, the requests waiting for it get ``None``, and
+        the next request with the key leads a new flight.
+        """
+        self.flights.join("a")
+        waiting = self.flights.join("a")
+        self.flights.abort("a")
+        self.assertEqual((self.successResultOf(waiting),
+                          self.flights.join("a")), (None, None))
+
+
+class FakeAgent(object):
+    """
+    Record Docker requests, to be answered by the test.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def dockerRequest(self, method, rest, headers, body, length):
+        d = Deferred()
+        self.requests.append((method, rest, d))
+        return d
+
+
+class DockerEventWatcherTests(TestCase):
+    """
+    Tests for ``DockerEventWatcher``.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.agent = FakeAgent()
+        self.changes = []
+        self.watcher = DockerEventWatcher(
+            self.agent, lambda: self.changes.append(None), self.clock)
+
+    def test_retry(self):
+        """
+        A failed subscription counts as a change, and is retried after
+        ``retryDelay`` seconds.
+        """
+        self.watcher.start()
+        self.watcher.start()
+        [(method, rest, d)] = self.agent.requests
+        self.assertEqual((method, rest), ("GET", "/events"))
+        d.errback(Exception("refused"))
+        self.assertEqual(len(self.changes), 1)
+        self.clock.advance(self.watcher.retryDelay)
+        self.assertEqual(len(self.agent.requests), 2)
+
+    def test_stop(self):
+        """
+        Stopping cancels the subscription, and doesn't retry it.
+        """
+        self.watcher.start()
+        [(method, rest, d)] = self.agent.requests
+        self.watcher.stop()
+        self.assertEqual((d.called, self.clock.getDelayedCalls()),
+                         (True, []))
@@ -9,7 +9,11 @@ from twisted.python.filepath import FilePath
 
 from .._config import (
         PluginConfiguration, NoConfiguration, InvalidConfiguration,
-        EndpointConfiguration)
+        EndpointConfiguration, Adapter, HookChain, RouteTable, EMPTY_CHAIN,
+        PoolConfiguration, BufferConfiguration, NotifyQueueConfiguration,
+        BreakerConfiguration, CacheConfiguration, MODIFY, OBSERVE, DROP_NEWEST, FAIL_CLOSED,
+        FAIL_OPEN, ListenerConfiguration, EventsConfiguration, FULL_BODY,
+        NO_BODY, AdminConfiguration, CoalesceConfiguration)
 
 class PluginConfigurationTests(TestCase):
     """
@@ -272,6 +276,150 @@ adapters:
             }))
 
 
+class ReloadIfChangedTests(TestCase):
+    """
+    Tests for ``PluginConfiguration.reload_if_changed``.
+    """
+
+    def setUp(self):
+        self.config = PluginConfiguration()
+        self.path = FilePath(self.mktemp())
+        self.config._default_file = self.path.path
+        self.path.setContent("""endpoints:
+  "POST /*/containers/create":
+    pre: [flocker]
+adapters:
+  flocker: http://flocker/flocker-adapter""")
+
+    def test_first_load(self):
+        """
+        ``reload_if_changed`` reads the configuration if it has not been read
+        yet.
+        """
+        self.assertFalse(self.config.loaded())
+        self.assertTrue(self.config.reload_if_changed())
+        self.assertTrue(self.config.loaded())
+        self.assertEquals(self.config.endpoints(),
+                          set(["POST /*/containers/create"]))
+
+    def test_unchanged(self):
+        """
+        ``reload_if_changed`` does not read the file again if it has not
+        changed, and the snapshot stays the same object.
+        """
+        self.config.reload_if_changed()
+        snapshot = self.config.snapshot()
+        reads = []
+        original = self.config._read_from_yaml_file
+        def recording(path):
+            reads.append(path)
+            return original(path)
+        self.config._read_from_yaml_file = recording
+
+        self.assertFalse(self.config.reload_if_changed())
+        self.assertEquals(reads, [])
+        self.assertIdentical(self.config.snapshot(), snapshot)
+
+    def test_forced(self):
+        """
+        ``reload_if_changed`` reads the file again even if it has not changed
+        when ``force`` is ``True``.
+        """
+        self.config.reload_if_changed()
+        snapshot = self.config.snapshot()
+
+        self.assertTrue(self.config.reload_if_changed(force=True))
+        self.assertNotIdentical(self.config.snapshot(), snapshot)
+
+    def test_path(self):
+        """
+        ``PluginConfiguration`` reads the file at the path it is given.
+        """
+        config = PluginConfiguration(self.path.path)
+        config.read_and_parse()
+        self.assertEquals(config.endpoints(),
+                          set(["POST /*/containers/create"]))
+
+    def test_changed(self):
+        """
+        ``reload_if_changed`` re-reads the file after it has been replaced, and
+        swaps in a new snapshot while leaving the old one untouched.
+        """
+        self.config.reload_if_changed()
+        snapshot = self.config.snapshot()
+        self.path.setContent("""endpoints:
+  "GET /info":
+    post: [weave]
+adapters:
+  weave: http://weave/weave-adapter""")
+
+        self.assertTrue(self.config.reload_if_changed())
+        self.assertEquals(self.config.endpoints(), set(["GET /info"]))
+        self.assertEquals(set(snapshot.endpoints.keys()),
+                          set(["POST /*/containers/create"]))
+
+    def test_invalid_change_keeps_previous(self):
+        """
+        If the changed file is not valid configuration, ``reload_if_changed``
+        raises ``InvalidConfiguration`` and the previous configuration stays
+        in place.
+        """
+        self.config.reload_if_changed()
+        snapshot = self.config.snapshot()
+        self.path.setContent("this is garbage")
+
+        self.assertRaises(InvalidConfiguration, self.config.reload_if_changed)
+        self.assertIdentical(self.config.snapshot(), snapshot)
+
+    def test_removed(self):
+        """
+        If the file has been removed, ``reload_if_changed`` raises
+        ``NoConfiguration`` and the previous configuration stays in place.
+        """
+        self.config.reload_if_changed()
+        snapshot = self.config.snapshot()
+        self.path.remove()
+
+        self.assertRaises(NoConfiguration, self.config.reload_if_changed)
+        self.assertIdentical(self.config.snapshot(), snapshot)
+
+    def test_invalid_not_read_again(self):
+        """
+        Once the file failed to be read, ``reload_if_changed`` doesn't read it
+        again until it changes.
+        """
+        self.config.reload_if_changed()
+        self.path.setContent("this is garbage")
+        self.assertRaises(InvalidConfiguration, self.config.reload_if_changed)
+        reads = []
+        original = self.config._read_from_yaml_file
+        def recording(path):
+            reads.append(path)
+            return original(path)
+        self.config._read_from_yaml_file = recording
+
+        self.assertFalse(self.config.reload_if_changed())
+        self.assertEquals(reads, [])
+        self.path.setContent("""endpoints:
+  "GET /info":
+    post: [weave]
+adapters:
+  weave: http://weave/weave-adapter""")
+        self.assertTrue(self.config.reload_if_changed())
+        self.assertEquals(self.config.endpoints(), set(["GET /info"]))
+
+    def test_missing_not_read_again(self):
+        """
+        If the file was never found, ``reload_if_changed`` doesn't try to
+        read it again until it appears.
+        """
+        self.path.remove()
+        self.assertRaises(NoConfiguration, self.config.reload_if_changed)
+
+        self.assertFalse(self.config.reload_if_changed())
+        self.assertFalse(self.config.loaded())
+
+
 class ConfigurationValidationTests(TestCase):
     """
     Tests for validation in ``PluginConfiguration._parse_adapters``.
@@ -351,6 +499,433 @@ class ConfigurationValidationTests(TestCase):
         del self.good_config['adapters']['flocker']
         self.assertRaises(InvalidConfiguration, self.config._parse_adapters, self.good_config)
 
+    def test_adapter_mode(self):
+        """
+        An adapter can be defined by a mapping with its ``uri`` and ``mode``.
+        Its URI is reported like that of any other adapter, and its mode is
+        resolved into the routes.
+        """
+        self.good_config['adapters']['weave'] = {
+            "uri": "http://weave/weave-adapter", "mode": "observe"}
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.adapter_uri("weave"),
+                          "http://weave/weave-adapter")
+        weave = Adapter("weave", "http://weave/weave-adapter", OBSERVE)
+        flocker = Adapter("flocker", "http://flocker/flocker-adapter")
+        self.assertEquals(
+            self.config.snapshot().routes.route("POST /*/containers/create"),
+            HookChain(pre=(flocker,), post=(flocker,),
+                      preObservers=(weave,), postObservers=(weave,)))
+
+    def test_adapter_mode_default(self):
+        """
+        An adapter defined by a mapping without a ``mode`` modifies.
+        """
+        self.good_config['adapters']['weave'] = {
+            "uri": "http://weave/weave-adapter"}
+        self.config._parse_adapters(self.good_config)
+        route = self.config.snapshot().routes.route(
+            "POST /*/containers/create")
+        self.assertEquals([adapter.mode for adapter in route.pre],
+                          [MODIFY, MODIFY])
+
+    def test_adapter_mode_invalid(self):
+        """
+        Adapter definitions with an unknown mode, an unknown key or no URI
+        are invalid.
+        """
+        for definition in [{"uri": "http://weave/", "mode": "watch"},
+                           {"uri": "http://weave/", "retries": 3},
+                           {"mode": "observe"}]:
+            self.good_config['adapters']['weave'] = definition
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
+    def test_adapter_failure_handling(self):
+        """
+        An adapter definition can set its ``timeout``, ``failure_policy`` and
+        ``breaker`` settings, which are resolved into the routes with
+        defaults for missing ones.
+        """
+        self.good_config['adapters']['weave'] = {
+            "uri": "http://weave/weave-adapter", "timeout": 2.5,
+            "failure_policy": "fail-open", "breaker": {"failures": 3}}
+        self.config._parse_adapters(self.good_config)
+        weave, flocker = self.config.snapshot().routes.route(
+            "POST /*/containers/create").post
+        self.assertEquals(
+            [(a.timeout, a.failure_policy, a.breaker) for a in weave, flocker],
+            [(2.5, FAIL_OPEN, BreakerConfiguration(failures=3, window=60,
+                                                   cooldown=30)),
+             (300, FAIL_CLOSED, BreakerConfiguration())])
+
+    def test_adapter_failure_handling_invalid(self):
+        """
+        Adapter ``timeout``, ``failure_policy`` and ``breaker`` settings must
+        have sensible values.
+        """
+        for settings in [{"timeout": 0}, {"timeout": "5s"},
+                         {"failure_policy": "fail-silently"},
+                         {"breaker": {"failures": -1}},
+                         {"breaker": {"window": 0}},
+                         {"breaker": {"cooldown": True}},
+                         {"breaker": {"threshold": 5}}, {"breaker": 5}]:
+            self.good_config['adapters']['weave'] = dict(
+                settings, uri="http://weave/")
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
+    def test_adapter_protocol(self):
+        """
+        An adapter definition can choose the ``protocol`` version hooks are
+        sent in, which is 1 by default and must be a known version.
+        """
+        self.good_config['adapters']['weave'] = {
+            "uri": "http://weave/weave-adapter", "protocol": 2}
+        self.config._parse_adapters(self.good_config)
+        weave, flocker = self.config.snapshot().routes.route(
+            "POST /*/containers/create").post
+        self.assertEquals((weave.protocol, flocker.protocol), (2, 1))
+        for protocol in [3, "2", True]:
+            self.good_config['adapters']['weave']["protocol"] = protocol
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
+    def test_adapter_stream(self):
+        """
+        An adapter definition can ask for the messages of streamed responses
+        with ``stream``, a positive number of messages per hook.  A chain
+        passes messages through its post-hooks in batches of the smallest
+        setting, if all of them take messages.
+        """
+        self.good_config['adapters']['weave'] = {
+            "uri": "http://weave/weave-adapter", "stream": 10}
+        self.good_config['adapters']['flocker'] = {
+            "uri": "http://flocker/flocker-adapter", "stream": 1,
+            "mode": "observe"}
+        self.config._parse_adapters(self.good_config)
+        route = self.config.snapshot().routes.route(
+            "POST /*/containers/create")
+        self.assertEquals(
+            ([a.stream for a in route.post + route.postObservers],
+             route.messageBatch, HookChain(pre=(), post=()).messageBatch,
+             HookChain(pre=(), post=route.post + (
+                 Adapter("audit", "http://audit/"),)).messageBatch),
+            ([10, 1], 1, None, None))
+        for stream in [0, 1.5, "10", True]:
+            self.good_config['adapters']['weave']["stream"] = stream
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
+    def test_adapter_body(self):
+        """
+        An adapter definition can ask not to be given response bodies with
+        ``body: none``.  A chain whose post-hooks all ask so only needs the
+        headers.
+        """
+        self.good_config['adapters']['weave'] = {
+            "uri": "http://weave/weave-adapter", "body": "none"}
+        self.config._parse_adapters(self.good_config)
+        route = self.config.snapshot().routes.route(
+            "POST /*/containers/create")
+        weave, flocker = route.post
+        self.assertEquals(
+            ((weave.body, flocker.body), route.headersOnly,
+             HookChain(pre=(), post=(weave,)).headersOnly,
+             HookChain(pre=(), post=()).headersOnly),
+            ((NO_BODY, FULL_BODY), False, True, False))
+        for body in ["headers", None, False]:
+            self.good_config['adapters']['weave']["body"] = body
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+        self.good_config['adapters']['weave'] = {
+            "uri": "http://weave/weave-adapter", "body": "none", "stream": 1}
+        self.assertRaises(InvalidConfiguration,
+                          self.config._parse_adapters, self.good_config)
+
+    def test_notify(self):
+        """
+        Endpoints can list adapters to ``notify``, which must be defined and
+        are resolved into the routes.
+        """
+        self.good_config['endpoints']['GET /info'] = {"notify": ["weave"]}
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(
+            (self.config.endpoint("GET /info"),
+             self.config.snapshot().routes.route("GET /info")),
+            (EndpointConfiguration(pre=[], post=[], notify=["weave"]),
+             HookChain(pre=(), post=(), notify=(
+                 Adapter("weave", "http://weave/weave-adapter"),))))
+        self.good_config['endpoints']['GET /info'] = {"notify": ["audit"]}
+        self.assertRaises(InvalidConfiguration, self.config._parse_adapters, self.good_config)
+
+    def test_notify_queue(self):
+        """
+        ``notify_queue`` settings are parsed into a
+        ``NotifyQueueConfiguration``, with defaults for missing ones.
+        """
+        self.good_config['notify_queue'] = {
+            "max_size": 10, "overflow": "drop-newest"}
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().notify_queue,
+                          NotifyQueueConfiguration(
+                              max_size=10, concurrency=2, batch_size=10,
+                              overflow=DROP_NEWEST))
+
+    def test_notify_queue_bad_values(self):
+        """
+        ``notify_queue`` settings must have sensible values.
+        """
+        for queue in [{"max_size": 0}, {"concurrency": 1.5},
+                      {"batch_size": True}, {"overflow": "block"},
+                      {"workers": 2}, []]:
+            self.good_config['notify_queue'] = queue
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
+    def test_adapter_pool_default(self):
+        """
+        ``adapter_pool`` is optional, and defaults to Twisted's pool settings
+        without pre-warming.
+        """
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().adapter_pool,
+                          PoolConfiguration(max_per_host=2, idle_timeout=240,
+                                            prewarm=False))
+
+    def test_adapter_pool(self):
+        """
+        ``adapter_pool`` settings are parsed into a ``PoolConfiguration``.
+        """
+        self.good_config['adapter_pool'] = {
+            "max_per_host": 8, "idle_timeout": 30, "prewarm": True}
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().adapter_pool,
+                          PoolConfiguration(max_per_host=8, idle_timeout=30,
+                                            prewarm=True))
+
+    def test_adapter_pool_unknown_key(self):
+        """
+        Unknown ``adapter_pool`` settings are invalid.
+        """
+        self.good_config['adapter_pool'] = {"max_connections": 8}
+        self.assertRaises(InvalidConfiguration, self.config._parse_adapters, self.good_config)
+
+    def test_adapter_pool_bad_values(self):
+        """
+        ``adapter_pool`` settings must have sensible values.
+        """
+        for pool in [{"max_per_host": -1}, {"max_per_host": 1.5},
+                     {"idle_timeout": "soon"}, {"prewarm": "yes"}, []]:
+            self.good_config['adapter_pool'] = pool
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
+    def test_docker_pool(self):
+        """
+        ``docker_pool`` settings are parsed into a ``PoolConfiguration`` of
+        their own, with the same defaults as ``adapter_pool``.
+        """
+        self.good_config['docker_pool'] = {"max_per_host": 0}
+        self.config._parse_adapters(self.good_config)
+        snapshot = self.config.snapshot()
+        self.assertEquals(
+            (snapshot.docker_pool, snapshot.adapter_pool),
+            (PoolConfiguration(max_per_host=0, idle_timeout=240,
+                               prewarm=False),
+             PoolConfiguration(max_per_host=2, idle_timeout=240,
+                               prewarm=False)))
+
+    def test_docker_pool_bad_values(self):
+        """
+        ``docker_pool`` settings are validated like ``adapter_pool``.
+        """
+        self.good_config['docker_pool'] = {"idle_timeout": 0}
+        self.assertRaises(InvalidConfiguration, self.config._parse_adapters, self.good_config)
+
+    def test_response_buffer(self):
+        """
+        ``response_buffer`` is optional, and its ``memory_limit`` is parsed
+        into a ``BufferConfiguration``.
+        """
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().response_buffer,
+                          BufferConfiguration(memory_limit=4 * 1024 * 1024))
+        self.good_config['response_buffer'] = {"memory_limit": 0}
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().response_buffer,
+                          BufferConfiguration(memory_limit=0))
+
+    def test_response_buffer_max_size(self):
+        """
+        ``response_buffer.max_size`` doesn't cap responses by default, and
+        can be a number of bytes, or ``null`` for no limit.
+        """
+        self.assertEquals(BufferConfiguration().max_size, None)
+        for max_size in [1024, None]:
+            self.good_config['response_buffer'] = {"max_size": max_size}
+            self.config._parse_adapters(self.good_config)
+            self.assertEquals(self.config.snapshot().response_buffer,
+                              BufferConfiguration(max_size=max_size))
+
+    def test_response_buffer_bad_values(self):
+        """
+        ``response_buffer`` settings must have sensible values.
+        """
+        for buffer in [{"memory_limit": -1}, {"memory_limit": "4M"},
+                       {"max": 10}, {"max_size": 0}, {"max_size": "64M"},
+                       {"max_size": True}, []]:
+            self.good_config['response_buffer'] = buffer
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
+    def test_response_cache(self):
+        """
+        ``response_cache`` is optional and off by default, and its settings
+        are parsed into a ``CacheConfiguration`` with lower case ``vary``
+        headers.
+        """
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().response_cache,
+                          CacheConfiguration())
+        self.good_config['response_cache'] = {
+            "endpoints": ["GET /*/info"], "ttl": 0.5, "vary": ["Accept"]}
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().response_cache,
+                          CacheConfiguration(endpoints=("GET /*/info",),
+                                             ttl=0.5, vary=("accept",)))
+
+    def test_response_cache_bad_values(self):
+        """
+        ``response_cache`` settings must have sensible values, and only
+        ``GET`` endpoints can be cached.
+        """
+        for cache in [{"endpoints": ["POST /*/containers/create"]},
+                      {"endpoints": "GET /info"}, {"ttl": 0},
+                      {"max_bytes": -1}, {"vary": "accept"},
+                      {"hook_exempt": "yes"}, {"watch_events": 1},
+                      {"size": 10}, []]:
+            self.good_config['response_cache'] = cache
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
+    def test_listen(self):
+        """
+        ``listen`` is optional, and its listeners are parsed into
+        ``ListenerConfiguration``, with octal modes given as strings or
+        numbers.
+        """
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().listen, ())
+        self.good_config['listen'] = [
+            {"unix": "/var/run/powerstrip.sock", "mode": "0600",
+             "group": "docker"},
+            {"unix": "/tmp/powerstrip.sock", "mode": 0666, "owner": 0},
+            {"tcp": 2375, "interface": "127.0.0.1", "backlog": 128}]
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().listen, (
+            ListenerConfiguration(unix="/var/run/powerstrip.sock",
+                                  mode=0600, group="docker"),
+            ListenerConfiguration(unix="/tmp/powerstrip.sock", mode=0666,
+                                  owner=0),
+            ListenerConfiguration(tcp=2375, interface="127.0.0.1",
+                                  backlog=128)))
+
+    def test_listen_bad_values(self):
+        """
+        ``listen`` must be a list of listeners with sensible values, each of
+        them either a UNIX socket or a TCP port.
+        """
+        for listen in [{"tcp": 2375}, [], ["tcp://0.0.0.0:2375"], [{}],
+                       [{"tcp": 2375, "unix": "/tmp/powerstrip.sock"}],
+                       [{"tcp": "2375"}], [{"tcp": 65536}],
+                       [{"tcp": 2375, "backlog": 0}],
+                       [{"tcp": 2375, "mode": 0600}],
+                       [{"unix": ""}], [{"unix": "/tmp/p.sock", "mode": "rw"}],
+                       [{"unix": "/tmp/p.sock", "mode": 01777}],
+                       [{"unix": "/tmp/p.sock", "group": True}],
+                       [{"unix": "/tmp/p.sock", "port": 2375}]]:
+            self.good_config['listen'] = listen
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
+    def test_events(self):
+        """
+        ``events`` is optional, with ``/events`` streams shared by default,
+        and its settings are parsed into an ``EventsConfiguration``.
+        """
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().events,
+                          EventsConfiguration(multiplex=True, buffer=1000,
+                                              replay=256))
+        self.good_config['events'] = {"multiplex": False, "buffer": 10,
+                                      "replay": 0}
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().events,
+                          EventsConfiguration(multiplex=False, buffer=10,
+                                              replay=0))
+
+    def test_coalesce(self):
+        """
+        ``coalesce`` is optional, with coalescing off by default, and its
+        settings are parsed into a ``CoalesceConfiguration``.
+        """
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().coalesce,
+                          CoalesceConfiguration(enabled=False,
+                                                max_bytes=1024 * 1024))
+        self.good_config['coalesce'] = {"enabled": True, "max_bytes": 0}
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().coalesce,
+                          CoalesceConfiguration(enabled=True, max_bytes=0))
+
+    def test_coalesce_bad_values(self):
+        """
+        ``coalesce`` settings must have sensible values.
+        """
+        for coalesce in [{"enabled": "yes"}, {"max_bytes": -1},
+                         {"max_bytes": "1M"}, {"max_bytes": True},
+                         {"ttl": 1}, []]:
+            self.good_config['coalesce'] = coalesce
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
+    def test_admin(self):
+        """
+        ``admin`` is optional, with the admin port served to this host only
+        by default, and its settings are parsed into an
+        ``AdminConfiguration``.
+        """
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().admin,
+                          AdminConfiguration(port=2378,
+                                             interface="127.0.0.1"))
+        self.good_config['admin'] = {"port": None, "interface": "0.0.0.0"}
+        self.config._parse_adapters(self.good_config)
+        self.assertEquals(self.config.snapshot().admin,
+                          AdminConfiguration(port=None, interface="0.0.0.0"))
+
+    def test_admin_bad_values(self):
+        """
+        ``admin`` settings must have sensible values.
+        """
+        for admin in [{"port": "2378"}, {"port": 70000}, {"port": True},
+                      {"interface": 0}, {"host": "0.0.0.0"}, []]:
+            self.good_config['admin'] = admin
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
+    def test_events_bad_values(self):
+        """
+        ``events`` settings must have sensible values.
+        """
+        for events in [{"multiplex": "yes"}, {"buffer": -1},
+                       {"replay": "256"}, {"buffer": True},
+                       {"subscribers": 10}, []]:
+            self.good_config['events'] = events
+            self.assertRaises(InvalidConfiguration,
+                              self.config._parse_adapters, self.good_config)
+
 
 class EndpointConfigurationTests(TestCase):
     """
@@ -365,3 +940,120 @@ class EndpointConfigurationTests(TestCase):
         endpoint_config = EndpointConfiguration(pre="foo", post="bar")
         self.assertEquals((endpoint_config.pre, endpoint_config.post),
             ("foo", "bar"))
+
+
+class RouteTableTests(TestCase):
+    """
+    Tests for ``RouteTable``.
+    """
+
+    def setUp(self):
+        self.adapters = {
+            "flocker": "http://flocker/flocker-adapter",
+            "weave": "http://weave/weave-adapter",
+        }
+        self.flocker = Adapter("flocker", "http://flocker/flocker-adapter")
+        self.weave = Adapter("weave", "http://weave/weave-adapter")
+        self.routes = RouteTable({
+            "POST /*/containers/create": {
+                "pre": ["flocker", "weave"],
+                "post": ["weave"],
+            },
+            "POST /v1.16/containers/create": {
+                "pre": ["flocker", "weave"],
+                "post": ["weave"],
+            },
+            "POST /*/containers/*": {
+                "pre": ["weave", "weave"],
+                "post": [],
+            },
+        }, self.adapters)
+
+    def test_route(self):
+        """
+        ``route`` returns the ``HookChain`` for an endpoint expression, with
+        adapter names resolved to ``Adapter`` objects in configured order.
+        """
+        self.assertEquals(
+            self.routes.route("POST /*/containers/*"),
+            HookChain(pre=(self.weave, self.weave), post=()))
+
+    def test_route_error(self):
+        """
+        ``route`` raises ``KeyError`` for an unknown endpoint expression.
+        """
+        self.assertRaises(KeyError, self.routes.route, "GET /info")
+
+    def test_identical_chains_shared(self):
+        """
+        Endpoints configured with the same adapters share one ``HookChain``.
+        """
+        self.assertIdentical(
+            self.routes.route("POST /*/containers/create"),
+            self.routes.route("POST /v1.16/containers/create"))
+
+    def test_chain_empty(self):
+        """
+        ``chain`` returns ``EMPTY_CHAIN`` when no endpoint matched.
+        """
+        self.assertIdentical(self.routes.chain(set()), EMPTY_CHAIN)
+        self.assertFalse(EMPTY_CHAIN.hasPreHooks)
+        self.assertFalse(EMPTY_CHAIN.hasPostHooks)
+
+    def test_chain_single(self):
+        """
+        ``chain`` returns the route of a single matched endpoint.
+        """
+        self.assertIdentical(
+            self.routes.chain(set(["POST /*/containers/*"])),
+            self.routes.route("POST /*/containers/*"))
+
+    def test_chain_combined(self):
+        """
+        ``chain`` joins the routes of several matched endpoints in the sorted
+        order of their expressions, and builds that combination only once.
+        """
+        matched = set(["POST /*/containers/create", "POST /*/containers/*"])
+        chain = self.routes.chain(matched)
+        self.assertEquals(chain, HookChain(
+            pre=(self.weave, self.weave, self.flocker, self.weave),
+            post=(self.weave,)))
+        self.assertIdentical(self.routes.chain(set(matched)), chain)
+
+    def test_snapshot_routes(self):
+        """
+        Parsing a configuration resolves its ``RouteTable``.
+        """
+        config = PluginConfiguration()
+        config._parse_adapters({
+            "endpoints": {"GET /info": {"post": ["flocker"]}},
+            "adapters": self.adapters})
+        self.assertEquals(config.snapshot().routes.route("GET /info"),
+                          HookChain(pre=(), post=(self.flocker,)))
+
+    def test_observers(self):
+        """
+        ``OBSERVE`` adapters are kept apart from the modifying adapters of a
+        route, in configured order, and joined like them when chains are
+        combined.
+        """
+        routes = RouteTable({
+            "POST /*/containers/create": {
+                "pre": ["audit", "flocker"],
+                "post": ["audit"],
+            },
+            "POST /*/containers/*": {
+                "pre": ["weave", "inventory"],
+                "post": [],
+            },
+        }, dict(self.adapters, audit="http://audit/", inventory="http://inv/"),
+            {"audit": {"mode": OBSERVE}, "inventory": {"mode": OBSERVE},
+             "weave": {"mode": MODIFY}})
+        audit = Adapter("audit", "http://audit/", OBSERVE)
+        inventory = Adapter("inventory", "http://inv/", OBSERVE)
+        chain = routes.chain(
+            set(["POST /*/containers/create", "POST /*/containers/*"]))
+        self.assertEquals(chain, HookChain(
+            pre=(self.weave, self.flocker), post=(),
+            preObservers=(inventory, audit), postObservers=(audit,)))
+        self.assertTrue(chain.hasPostHooks)
@@ -6,15 +6,54 @@ Test the actual proxy implementation, given certain configurations.
 
 from twisted.trial.unittest import TestCase
 from twisted.internet import reactor, defer
-from twisted.web.client import Agent
+from twisted.internet.protocol import ClientCreator, Protocol
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.client import Agent, ResponseNeverReceived
+from twisted.web.http_headers import Headers
 from treq.client import HTTPClient
+import StringIO
+import hashlib
 import json
 import treq
 
-from ..testtools import AdderPlugin, GenerallyUsefulPowerstripTestMixin
+from ..testtools import (
+        AdderPlugin, GenerallyUsefulPowerstripTestMixin, FAKE_EXPORT_SIZE,
+        ObserverPlugin, UnmodifiedPlugin, fakeExportChunks)
+from .._breaker import AdapterFailed
+from .._config import InvalidConfiguration
+from .._metrics import Metrics
+from ..powerstrip import DockerProxyClient
 
 from twisted.protocols.policies import TrafficLoggingFactory
 
+class SlowReader(Protocol):
+    """
+    Send a request for a container's output, without reading the output
+    until ``read`` is called.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.received = 0
+        self.done = defer.Deferred()
+
+    def connectionMade(self):
+        self.transport.pauseProducing()
+        self.transport.write(self.request)
+
+    def read(self):
+        self.transport.resumeProducing()
+        return self.done
+
+    def dataReceived(self, data):
+        self.received += len(data)
+
+    def connectionLost(self, reason):
+        self.done.callback(self.received)
+
+
 class ProxyTests(TestCase, GenerallyUsefulPowerstripTestMixin):
 
     def setUp(self):
@@ -28,13 +67,25 @@ class ProxyTests(TestCase, GenerallyUsefulPowerstripTestMixin):
         self.client = HTTPClient(self.agent)
 
     def tearDown(self):
+        events = self.dockerAPI.root.getStaticEntity("events")
         shutdowns = [
+            events.whenUnsubscribed(),
             self.dockerServer.stopListening(),
-            self.proxyServer.stopListening()]
+            self.proxyServer.stopListening(),
+            self.proxyAPI.root.pool.closeCachedConnections(),
+            self.proxyAPI.root.dockerPool.closeCachedConnections()]
         if hasattr(self, 'adderServer'):
             shutdowns.append(self.adderServer.stopListening())
         if hasattr(self, 'adderTwoServer'):
             shutdowns.append(self.adderTwoServer.stopListening())
+        if hasattr(self, 'nullServer'):
+            shutdowns.append(self.nullServer.stopListening())
+        if hasattr(self, 'observerServer'):
+            shutdowns.append(self.observerServer.stopListening())
+        if hasattr(self, 'unmodifiedServer'):
+            shutdowns.append(self.unmodifiedServer.stopListening())
+        if hasattr(self, 'metricsServer'):
+            shutdowns.append(self.metricsServer.stopListening())
         return defer.gatherResults(shutdowns)
 
     def test_empty_endpoints(self):
@@ -91,6 +142,49 @@ adapters: {}""" % (endpoint,))
         d.addCallback(verify)
         return d
 
+    def test_config_read_once(self):
+        """
+        The adapter configuration is read once, rather than once per path
+        segment of every request.
+        """
+        self._configure("endpoints: {}\nadapters: {}")
+        reads = []
+        original = self.config.read_and_parse
+        def recording():
+            reads.append(None)
+            return original()
+        self.config.read_and_parse = recording
+        d = self.client.post('http://127.0.0.1:%d/v1.16/containers/create' % (
+                                self.proxyPort,),
+                      json.dumps({"hiding": "things"}),
+                      headers={'Content-Type': ['application/json']})
+        d.addCallback(treq.content)
+        def verify(ignored):
+            self.assertEqual(reads, [])
+        d.addCallback(verify)
+        return d
+
+    def test_invalid_config_logged_once(self):
+        """
+        While the adapter configuration file is invalid, requests are served
+        with the previous configuration, and the error is logged once rather
+        than for every request.
+        """
+        self._configure("endpoints: {}\nadapters: {}")
+        FilePath(self.config._default_file).setContent("this is garbage")
+        def get(ignored):
+            d = self.client.get(
+                'http://127.0.0.1:%d/info?return=it' % (self.proxyPort,))
+            d.addCallback(treq.content)
+            return d
+        d = get(None)
+        d.addCallback(get)
+        def verify(ignored):
+            self.assertEqual(
+                len(self.flushLoggedErrors(InvalidConfiguration)), 1)
+        d.addCallback(verify)
+        return d
+
     def _getAdder(self, *args, **kw):
         self.adderAPI = TrafficLoggingFactory(AdderPlugin(*args, **kw), "adder-")
         self.adderServer = reactor.listenTCP(0, self.adderAPI)
@@ -106,6 +200,20 @@ adapters: {}""" % (endpoint,))
         """
         Generalised version of a pre-hook test.
         """
+        d = self._hookRequest(config_yml, adderArgs, adderTwoArgs)
+        d.addCallback(treq.json_content)
+        def debug(result, *args, **kw):
+            return result
+        d.addCallback(debug)
+        return d
+
+    def _hookRequest(self, config_yml, adderArgs=dict(pre=True), adderTwoArgs=dict(pre=True)):
+        """
+        Set up the adders and the proxy, and make a request through the hooks
+        configured by ``config_yml``.
+
+        :return: A ``Deferred`` firing with the response.
+        """
         self._getAdder(**adderArgs)
         self._getAdderTwo(**adderTwoArgs)
         self.dockerEndpoint = "/towel"
@@ -119,12 +227,36 @@ adapters: {}""" % (endpoint,))
         d = self.client.post('http://127.0.0.1:%(proxyPort)d%(dockerEndpoint)s' % self.args,
                       json.dumps({"Number": 1}),
                       headers={'Content-Type': ['application/json']})
-        d.addCallback(treq.json_content)
-        def debug(result, *args, **kw):
-            return result
-        d.addCallback(debug)
         return d
 
+    def _errorTest(self, config_yml, **kw):
+        """
+        Make a request through the hooks configured by ``config_yml``, which
+        is expected to fail.
+
+        :return: A ``Deferred`` firing with the response code and body.
+        """
+        d = self._hookRequest(config_yml, **kw)
+        def read(response):
+            d = treq.content(response)
+            d.addCallback(lambda body: (response.code, body))
+            return d
+        d.addCallback(read)
+        return d
+
+    def _recordDockerCalls(self):
+        """
+        Record the requests the fake Docker gets for ``/towel``.
+        """
+        calls = []
+        towel = self.dockerAPI.root.getStaticEntity("towel")
+        original = towel.render_POST
+        def render_POST(request):
+            calls.append(request.uri)
+            return original(request)
+        towel.render_POST = render_POST
+        return calls
+
     def test_adding_pre_hook_adapter(self):
         """
         A adapter has a pre-hook which increments an integral field in the JSON
@@ -186,6 +318,203 @@ adapters:
         d.addCallback(verify)
         return d
 
+    def test_adapter_connections_reused(self):
+        """
+        Hook calls reuse persistent connections to the adapter, across
+        requests.
+        """
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [adder, adder]
+    post: []
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s""")
+        def again(ignored):
+            d = self.client.post(
+                'http://127.0.0.1:%(proxyPort)d%(dockerEndpoint)s' % self.args,
+                json.dumps({"Number": 1}),
+                headers={'Content-Type': ['application/json']})
+            d.addCallback(treq.json_content)
+            return d
+        d.addCallback(again)
+        def verify(response):
+            self.assertEqual(response, {"Number": 3, "SeenByFakeDocker": 42})
+            pool = self.proxyAPI.root.pool
+            self.assertEqual((pool.misses, pool.hits), (1, 3))
+        d.addCallback(verify)
+        return d
+
+    def _getObserver(self, hold=False):
+        self.observerAPI = ObserverPlugin(hold)
+        self.observerServer = reactor.listenTCP(0, self.observerAPI)
+        self.observerPort = self.observerServer.getHost().port
+
+    def test_pre_hook_observer(self):
+        """
+        A pre-hook observer gets the original client request, and its
+        response does not change the request passed on to Docker.
+        """
+        self._getObserver()
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [watcher, adder]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  watcher:
+    uri: http://127.0.0.1:""" + str(self.observerPort) + """/watcher
+    mode: observe""")
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 2, "SeenByFakeDocker": 42})
+            [hook] = self.observerAPI.root.hooks
+            self.assertEqual((hook["Type"], json.loads(hook["ClientRequest"]["Body"])),
+                             ("pre-hook", {"Number": 1}))
+        d.addCallback(verify)
+        return d
+
+    def test_post_hook_observer(self):
+        """
+        A post-hook observer gets the Docker response, and its response does
+        not change the response passed on to the client.
+        """
+        self._getObserver()
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    post: [adder, watcher]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  watcher:
+    uri: http://127.0.0.1:""" + str(self.observerPort) + """/watcher
+    mode: observe""", adderArgs=dict(post=True))
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 2, "SeenByFakeDocker": 42})
+            [hook] = self.observerAPI.root.hooks
+            self.assertEqual((hook["Type"], json.loads(hook["ServerResponse"]["Body"])),
+                             ("post-hook", {"Number": 1, "SeenByFakeDocker": 42}))
+        d.addCallback(verify)
+        return d
+
+    def test_observers_concurrent(self):
+        """
+        Observers are called at the same time rather than one after the
+        other, and the request is only passed on to Docker once all of them
+        have answered.
+        """
+        self._getObserver(hold=True)
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [first, second, adder]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  first:
+    uri: http://127.0.0.1:""" + str(self.observerPort) + """/first
+    mode: observe
+  second:
+    uri: http://127.0.0.1:""" + str(self.observerPort) + """/second
+    mode: observe""")
+        answered = []
+        d.addCallback(answered.append)
+        def bothCalled(ignored):
+            self.assertEqual(answered, [])
+            self.observerAPI.root.release()
+            return d
+        waiting = self.observerAPI.root.waitForHooks(2)
+        waiting.addCallback(bothCalled)
+        def verify(ignored):
+            self.assertEqual(answered, [{"Number": 2, "SeenByFakeDocker": 42}])
+        waiting.addCallback(verify)
+        return waiting
+
+    def test_notify(self):
+        """
+        ``notify`` adapters are sent the request and the final response once
+        the client has had it, without the client waiting for them.
+        """
+        self._getObserver(hold=True)
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    post: [adder]
+    notify: [audit]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  audit: http://127.0.0.1:""" + str(self.observerPort) + "/audit",
+            adderArgs=dict(post=True))
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 2, "SeenByFakeDocker": 42})
+            return self.observerAPI.root.waitForHooks(1)
+        d.addCallback(verify)
+        def notified(ignored):
+            [hook] = self.observerAPI.root.hooks
+            [notification] = hook["Notifications"]
+            self.assertEqual(
+                (hook["Type"], json.loads(notification["ClientRequest"]["Body"]),
+                 json.loads(notification["ServerResponse"]["Body"]),
+                 notification["ServerResponse"]["Code"]),
+                ("notify", {"Number": 1},
+                 {"Number": 2, "SeenByFakeDocker": 42}, 200))
+            self.assertEqual(
+                self.proxyAPI.root.notifier.counters()["active"], 1)
+            self.observerAPI.root.release()
+            return self.proxyAPI.root.notifier.whenIdle()
+        d.addCallback(notified)
+        def delivered(ignored):
+            counters = self.proxyAPI.root.notifier.counters()
+            self.assertEqual((counters["delivered"], counters["depth"]),
+                             (1, 0))
+        d.addCallback(delivered)
+        return d
+
+    def test_notify_streamed(self):
+        """
+        Notifications about responses which were streamed to the client have
+        no response body.
+        """
+        self._getObserver()
+        self._configure("""endpoints:
+  "GET /containers/*/export":
+    notify: [audit]
+adapters:
+  audit: http://127.0.0.1:%d/audit""" % (self.observerPort,))
+        d = self.client.get(
+            'http://127.0.0.1:%d/containers/abc/export' % (self.proxyPort,))
+        d.addCallback(treq.content)
+        d.addCallback(lambda ignored: self.observerAPI.root.waitForHooks(1))
+        def notified(ignored):
+            [hook] = self.observerAPI.root.hooks
+            [notification] = hook["Notifications"]
+            self.assertEqual(notification["ServerResponse"],
+                             {"ContentType": "application/x-tar",
+                              "Body": None, "Code": 200})
+            return self.proxyAPI.root.notifier.whenIdle()
+        d.addCallback(notified)
+        return d
+
+    def test_notify_only_streams(self):
+        """
+        Responses to requests which only have notifications are streamed to
+        the client rather than buffered, and the notification has no body.
+        """
+        self._getObserver()
+        d = self._pull("""endpoints:
+  "POST /images/create":
+    notify: [audit]
+adapters:
+  audit: http://127.0.0.1:%d/audit""" % (self.observerPort,))
+        d.addCallback(lambda ignored: self.observerAPI.root.waitForHooks(1))
+        def notified(ignored):
+            [hook] = self.observerAPI.root.hooks
+            [notification] = hook["Notifications"]
+            self.assertEqual(
+                (notification["ServerResponse"]["Body"],
+                 ("powerstrip_response_buffered_bytes", ()) in
+                 self.proxyAPI.root.metrics._values),
+                (None, False))
+            return self.proxyAPI.root.notifier.whenIdle()
+        d.addCallback(notified)
+        return d
+
     def test_adding_post_hook_adapter(self):
         """
         A adapter has a post-hook which increments an integral field in the JSON
@@ -220,6 +549,126 @@ adapters:
         d.addCallback(verify)
         return d
 
+    def test_post_hook_spilled_response(self):
+        """
+        A Docker response bigger than ``response_buffer.memory_limit`` is
+        still handed to the post-hooks whole.
+        """
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    post: [adder]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+response_buffer:
+  memory_limit: 8""", adderArgs=dict(post=True))
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 2, "SeenByFakeDocker": 42})
+        d.addCallback(verify)
+        return d
+
+    def test_post_hook_spilled_response_dedicated(self):
+        """
+        Responses are spilled to a temporary file on dedicated connections to
+        Docker too.
+        """
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    post: [adder]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+response_buffer:
+  memory_limit: 8
+docker_pool:
+  max_per_host: 0""", adderArgs=dict(post=True))
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 2, "SeenByFakeDocker": 42})
+        d.addCallback(verify)
+        return d
+
+    def _tooLargeTest(self, extra_yml=""):
+        """
+        Make a request whose Docker response is over
+        ``response_buffer.max_size``, and check the client is told so.
+        """
+        d = self._hookRequest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    post: [adder]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+response_buffer:
+  memory_limit: 8
+  max_size: 16""" + extra_yml, adderArgs=dict(post=True))
+        def gotResponse(response):
+            d = treq.content(response)
+            d.addCallback(lambda body: (response.code, body))
+            return d
+        d.addCallback(gotResponse)
+        def verify((code, body)):
+            self.assertEqual(
+                (code, body),
+                (502, "The Docker response is larger than the 16 bytes "
+                      "which can be buffered for post-hooks "
+                      "(response_buffer.max_size)."))
+        d.addCallback(verify)
+        return d
+
+    def test_response_too_large(self):
+        """
+        A Docker response bigger than ``response_buffer.max_size`` isn't
+        given to the post-hooks; the client is answered with an error.
+        """
+        return self._tooLargeTest()
+
+    def test_response_too_large_dedicated(self):
+        """
+        Responses over ``response_buffer.max_size`` are refused on dedicated
+        connections to Docker too.
+        """
+        return self._tooLargeTest("""
+docker_pool:
+  max_per_host: 0""")
+
+    def test_metrics(self):
+        """
+        The time taken by the request, its adapters and Docker, and the size
+        of the buffered response are recorded, and served by the metrics
+        site.
+        """
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [adder]
+    post: [adderTwo]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  adderTwo: http://127.0.0.1:%(adderTwoPort)d%(adapterEndpoint)s""",
+            adderTwoArgs=dict(post=True))
+        def getMetrics(response):
+            self.metricsServer = reactor.listenTCP(
+                0, self.proxyAPI.metricsSite())
+            return self.client.get('http://127.0.0.1:%d/metrics' % (
+                self.metricsServer.getHost().port,))
+        d.addCallback(getMetrics)
+        d.addCallback(treq.content)
+        def verify(text):
+            lines = text.splitlines()
+            for line in [
+                    'powerstrip_adapter_duration_seconds_count'
+                    '{adapter="adder",hook="pre"} 1',
+                    'powerstrip_adapter_duration_seconds_count'
+                    '{adapter="adderTwo",hook="post"} 1',
+                    'powerstrip_docker_first_byte_seconds_count 1',
+                    'powerstrip_docker_duration_seconds_count 1',
+                    'powerstrip_docker_responses_total{mode="buffered"} 1',
+                    'powerstrip_response_buffered_bytes_sum 37.0',
+                    'powerstrip_docker_connections_total{result="new"} 1',
+                    'powerstrip_request_duration_seconds_count'
+                    '{endpoint="POST /towel"} 1']:
+                self.assertIn(line, lines)
+        d.addCallback(verify)
+        return d
+
     def test_adding_post_hook_twice_adapter(self):
         """
         Chaining post-hooks: adding twice means you get +2.
@@ -239,6 +688,131 @@ adapters:
         d.addCallback(verify)
         return d
 
+    def test_protocol_two_pre_hooks(self):
+        """
+        Pre-hooks of both versions of the protocol can be chained: an adapter
+        configured with ``protocol: 2`` gets the request body as JSON rather
+        than as a string, and answers likewise.
+        """
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [adder, adder2, adder]
+    post: []
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  adder2:
+    uri: http://127.0.0.1:%(adderTwoPort)d%(adapterEndpoint)s
+    protocol: 2""", adderTwoArgs=dict(pre=True, protocol=2))
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 5, "SeenByFakeDocker": 42})
+        d.addCallback(verify)
+        return d
+
+    def test_protocol_two_post_hooks(self):
+        """
+        Post-hooks of both versions of the protocol can be chained: an
+        adapter configured with ``protocol: 2`` gets the Docker response body
+        as JSON rather than as a string, and answers likewise.
+        """
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: []
+    post: [adder2, adder]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  adder2:
+    uri: http://127.0.0.1:%(adderTwoPort)d%(adapterEndpoint)s
+    protocol: 2""",
+            adderArgs=dict(post=True),
+            adderTwoArgs=dict(post=True, protocol=2))
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 4, "SeenByFakeDocker": 42})
+        d.addCallback(verify)
+        return d
+
+    def _getUnmodified(self, noContent=True):
+        self.unmodifiedAPI = UnmodifiedPlugin(noContent)
+        self.unmodifiedServer = reactor.listenTCP(0, self.unmodifiedAPI)
+        self.unmodifiedPort = self.unmodifiedServer.getHost().port
+
+    def _answerCounts(self):
+        """
+        Return the lines of the counters of adapter answers.
+        """
+        return [line for line in self.proxyAPI.root.metrics.render(
+            ).splitlines()
+                if line.startswith("powerstrip_adapter_answers_total{")]
+
+    def test_unmodified_pre_hook(self):
+        """
+        A pre-hook answering with ``204 No Content`` passes on the request as
+        it was given to it, and is counted as leaving it unmodified.
+        """
+        self._getUnmodified()
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [adder, unmodified, adder2]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  adder2: http://127.0.0.1:%(adderTwoPort)d%(adapterEndpoint)s
+  unmodified: http://127.0.0.1:""" + str(self.unmodifiedPort) + "/")
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 4, "SeenByFakeDocker": 42})
+            self.assertEqual(self.unmodifiedAPI.root.hooks, 1)
+            self.assertEqual(sorted(self._answerCounts()), [
+                'powerstrip_adapter_answers_total'
+                '{adapter="adder",hook="pre",result="modified"} 1',
+                'powerstrip_adapter_answers_total'
+                '{adapter="adder2",hook="pre",result="modified"} 1',
+                'powerstrip_adapter_answers_total'
+                '{adapter="unmodified",hook="pre",result="unmodified"} 1'])
+        d.addCallback(verify)
+        return d
+
+    def test_unmodified_request_untouched(self):
+        """
+        If every pre-hook leaves the request unmodified, the client's request
+        body is passed on to Docker as it is.
+        """
+        self._getUnmodified()
+        d = self._hookRequest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [unmodified]
+adapters:
+  unmodified: http://127.0.0.1:""" + str(self.unmodifiedPort) + "/")
+        d.addCallback(treq.json_content)
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 1, "SeenByFakeDocker": 42})
+        d.addCallback(verify)
+        return d
+
+    def test_unmodified_post_hook(self):
+        """
+        A post-hook answering with ``{"Unmodified": true}`` passes on the
+        response as it was given to it.
+        """
+        self._getUnmodified(noContent=False)
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    post: [adder, unmodified]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  unmodified: http://127.0.0.1:""" + str(self.unmodifiedPort) + "/",
+            adderArgs=dict(post=True))
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 2, "SeenByFakeDocker": 42})
+            self.assertIn(
+                'powerstrip_adapter_answers_total'
+                '{adapter="unmodified",hook="post",result="unmodified"} 1',
+                self._answerCounts())
+        d.addCallback(verify)
+        return d
+
     def test_stream_endpoint(self):
         """
         A streaming (aka hijacking) endpoint like /attach is permitted with no
@@ -258,45 +832,265 @@ adapters:
         d.addCallback(verify)
         return d
 
-    def test_chunked_endpoint(self):
+    def test_stream_endpoint_dedicated(self):
         """
-        A chunking endpoint like /pull is permitted with no post-hooks (the
-        Docker response's Content-Encoding is chunked).
+        With keep-alive connections to Docker turned off, a streaming (aka
+        hijacking) response is still detected on the dedicated connection.
         """
-        self._configure("endpoints: {}\nadapters: {}", dockerArgs=dict(chunkedResponse=True))
+        self._configure("endpoints: {}\nadapters: {}\n"
+                        "docker_pool: {max_per_host: 0}",
+                        dockerArgs=dict(rawStream=True))
         d = self.client.post('http://127.0.0.1:%d/towel' % (self.proxyPort,),
-                      json.dumps({"chunked": "response"}),
+                      json.dumps({"raw": "stream"}),
                       headers={'Content-Type': ['application/json']})
         def verify(response):
-            self.assertEqual(response.headers.getRawHeaders("transfer-encoding"),
-                             ["chunked"])
+            self.assertEqual(response.headers.getRawHeaders("content-type"),
+                             ["application/vnd.docker.raw-stream"])
+            self.assertEqual(self.proxyAPI.root.dockerPool.misses, 0)
+            return treq.content(response)
         d.addCallback(verify)
         return d
-    test_chunked_endpoint.skip = ("Doesn't work yet. "
-            "Need a fake docker which can emit chunked encodings.")
 
-    def test_endpoint_GET_args(self):
+    def test_stream_endpoint_backpressure(self):
         """
-        An endpoint is matched when it has ?-style GET arguments (and no JSON
-        body), and the GET request is passed through.
+        A hijacked stream is only read from Docker as fast as the client
+        reads it, rather than being buffered by the proxy.
         """
-        self._configure("endpoints: {}\nadapters: {}", dockerArgs=dict(chunkedResponse=True))
-        d = self.client.get('http://127.0.0.1:%d/info?return=fish' % (self.proxyPort,))
-        d.addCallback(treq.content)
-        def verify(response):
-            self.assertEqual(response,
-                    "INFORMATION FOR YOU: fish")
+        self._configure("endpoints: {}\nadapters: {}")
+        return self._slowRead("POST /containers/abc/attach?stdout=1 "
+                              "HTTP/1.1\r\nHost: docker\r\n"
+                              "Content-Length: 0\r\n\r\n")
+
+    def test_chunked_endpoint_backpressure(self):
+        """
+        A streamed chunked response is only read from Docker as fast as the
+        client reads it, and the most bytes left waiting to be sent to the
+        client are recorded.
+        """
+        self._configure("endpoints: {}\nadapters: {}")
+        d = self._slowRead("GET /containers/abc/logs?follow=1&stdout=1 "
+                           "HTTP/1.1\r\nHost: docker\r\n"
+                           "Connection: close\r\n\r\n")
+        def verify(ignored):
+            histogram = self.proxyAPI.root.metrics._values[
+                ("powerstrip_stream_buffered_bytes", ())]
+            self.assertEqual(
+                (histogram.count, 0 < histogram.sum < 2 ** 20), (1, True))
         d.addCallback(verify)
         return d
 
-    def test_stream_endpoint_reject_post_hook(self):
+    def _slowRead(self, request):
         """
-        A streaming (aka hijacking) endpoint like /attach is rejected if a
-        post-hook is attached: a runtime error is raised when the Content-Type
-        is detected.
+        Send ``request`` for a container's output through the proxy from a
+        client which doesn't read the response until Docker has stopped
+        sending it, and check that Docker was held up.
         """
-    test_stream_endpoint_reject_post_hook.skip = "not implemented yet"
-
+        containers = self.dockerAPI.root.getStaticEntity("containers")
+        containers.outputSize = 32 * 2 ** 20
+        d = ClientCreator(reactor, SlowReader, request).connectTCP(
+            "127.0.0.1", self.proxyPort)
+        def wait(reader):
+            self.addCleanup(reader.transport.loseConnection)
+            d = self._waitFor(lambda: containers.outputs)
+            d.addCallback(lambda ignored: self._waitForStall(
+                containers.outputs[0]))
+            d.addCallback(lambda ignored: reader)
+            return d
+        d.addCallback(wait)
+        def read(reader):
+            # Only what fits in the socket buffers has been sent.
+            output = containers.outputs[0]
+            self.assertEqual((output.paused, output.written < output.size / 4),
+                             (True, True))
+            return reader.read()
+        d.addCallback(read)
+        def verify(received):
+            self.assertTrue(received > containers.outputSize)
+        d.addCallback(verify)
+        return d
+
+    def _buildTest(self, config_yml):
+        """
+        POST a build context much bigger than ``twisted.web`` keeps in memory
+        to Docker through the proxy, and check that it arrived intact.
+        """
+        self._configure(config_yml)
+        context = "".join(chr(i % 251) for i in range(3 * 2 ** 20 + 7))
+        d = self.client.post('http://127.0.0.1:%d/build' % (self.proxyPort,),
+                      context,
+                      headers={'Content-Type': ['application/tar']})
+        d.addCallback(treq.json_content)
+        def verify(response):
+            self.assertEqual(response,
+                    {"Length": len(context),
+                     "MD5": hashlib.md5(context).hexdigest()})
+        d.addCallback(verify)
+        return d
+
+    def test_build_context_streamed(self):
+        """
+        A large ``application/tar`` body is passed through to Docker over a
+        keep-alive connection, skipping pre-hooks.
+        """
+        self._getNullAdapter()
+        return self._buildTest("""endpoints:
+  "POST /build":
+    pre: [nothing]
+adapters:
+  nothing: http://127.0.0.1:%d/null-adapter""" % (self.nullPort,))
+
+    def test_build_context_streamed_dedicated(self):
+        """
+        A large ``application/tar`` body is passed through to Docker over a
+        dedicated connection.
+        """
+        return self._buildTest("endpoints: {}\nadapters: {}\n"
+                               "docker_pool: {max_per_host: 0}")
+
+    def _exportTest(self, extra_yml=""):
+        """
+        Export a container through the proxy, with post-hooks configured for
+        the endpoint, and check the tarball was streamed to the client
+        rather than buffered.
+        """
+        self._getAdder(post=True)
+        self._configure("""endpoints:
+  "GET /containers/*/export":
+    post: [adder]
+adapters:
+  adder: http://127.0.0.1:%d/adapter""" % (self.adderPort,) + extra_yml)
+        d = self.client.get(
+            'http://127.0.0.1:%d/containers/abc/export' % (self.proxyPort,))
+        def verify(response):
+            self.assertEqual(response.headers.getRawHeaders("content-type"),
+                             ["application/x-tar"])
+            return treq.content(response)
+        d.addCallback(verify)
+        def verifyContent(content):
+            self.assertEqual(len(content), FAKE_EXPORT_SIZE)
+            self.assertEqual(hashlib.md5(content).hexdigest(),
+                             hashlib.md5("".join(fakeExportChunks())).hexdigest())
+            metrics = self.proxyAPI.root.metrics._values
+            self.assertEqual(
+                (metrics.get(("powerstrip_docker_responses_total",
+                              (("mode", "streaming"),))),
+                 metrics.get(("powerstrip_docker_responses_total",
+                              (("mode", "buffered"),))),
+                 ("powerstrip_response_buffered_bytes", ()) in metrics),
+                (1, None, False))
+        d.addCallback(verifyContent)
+        return d
+
+    def test_export_skips_post_hooks(self):
+        """
+        A tarball response, such as that of ``docker export``, is streamed to
+        the client without being buffered or given to post-hooks, even if
+        post-hooks are configured for the endpoint.
+        """
+        return self._exportTest()
+
+    def test_export_skips_post_hooks_coalescing(self):
+        """
+        Tarball responses are streamed when coalescing is enabled too.
+        """
+        return self._exportTest("""
+coalesce:
+  enabled: true""")
+
+    def test_docker_connections_reused(self):
+        """
+        Requests which get a plain response from Docker reuse keep-alive
+        connections to it.
+        """
+        self._configure("endpoints: {}\nadapters: {}")
+        def get(ignored):
+            return self.client.get(
+                'http://127.0.0.1:%d/info?return=fish' % (self.proxyPort,))
+        d = get(None)
+        d.addCallback(treq.content)
+        d.addCallback(get)
+        d.addCallback(treq.content)
+        def verify(response):
+            self.assertEqual(response, "INFORMATION FOR YOU: fish")
+            pool = self.proxyAPI.root.dockerPool
+            self.assertEqual((pool.misses, pool.hits), (1, 1))
+        d.addCallback(verify)
+        return d
+
+    def test_docker_pool_disabled(self):
+        """
+        With ``docker_pool.max_per_host`` set to 0, every request gets a
+        dedicated connection to Docker.
+        """
+        self._configure("endpoints: {}\nadapters: {}\n"
+                        "docker_pool: {max_per_host: 0}")
+        d = self.client.post('http://127.0.0.1:%d/towel' % (self.proxyPort,),
+                      json.dumps({"hiding": "things"}),
+                      headers={'Content-Type': ['application/json']})
+        d.addCallback(treq.json_content)
+        def verify(response):
+            self.assertEqual(response,
+                    {"hiding": "things", "SeenByFakeDocker": 42})
+            pool = self.proxyAPI.root.dockerPool
+            self.assertEqual((pool.misses, pool.hits), (0, 0))
+        d.addCallback(verify)
+        return d
+
+    def test_post_hook_dedicated(self):
+        """
+        Post-hooks get the Docker response from a dedicated connection too.
+        """
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    post: [adder]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+docker_pool:
+  max_per_host: 0""", adderArgs=dict(post=True))
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 2, "SeenByFakeDocker": 42})
+        d.addCallback(verify)
+        return d
+
+    def test_chunked_endpoint(self):
+        """
+        A chunking endpoint like /pull is permitted with no post-hooks (the
+        Docker response's Content-Encoding is chunked).
+        """
+        self._configure("endpoints: {}\nadapters: {}", dockerArgs=dict(chunkedResponse=True))
+        d = self.client.post('http://127.0.0.1:%d/towel' % (self.proxyPort,),
+                      json.dumps({"chunked": "response"}),
+                      headers={'Content-Type': ['application/json']})
+        d.addCallback(treq.json_content)
+        def verify(response):
+            self.assertEqual(response,
+                             {"chunked": "response", "SeenByFakeDocker": 42})
+        d.addCallback(verify)
+        return d
+
+    def test_endpoint_GET_args(self):
+        """
+        An endpoint is matched when it has ?-style GET arguments (and no JSON
+        body), and the GET request is passed through.
+        """
+        self._configure("endpoints: {}\nadapters: {}", dockerArgs=dict(chunkedResponse=True))
+        d = self.client.get('http://127.0.0.1:%d/info?return=fish' % (self.proxyPort,))
+        d.addCallback(treq.content)
+        def verify(response):
+            self.assertEqual(response,
+                    "INFORMATION FOR YOU: fish")
+        d.addCallback(verify)
+        return d
+
+    def test_stream_endpoint_reject_post_hook(self):
+        """
+        A streaming (aka hijacking) endpoint like /attach is rejected if a
+        post-hook is attached: a runtime error is raised when the Content-Type
+        is detected.
+        """
+    test_stream_endpoint_reject_post_hook.skip = "not implemented yet"
+
     def test_chunked_endpoint_reject_post_hook(self):
         """
         A chunking endpoint like /pull is rejected if a post-hook is attached:
@@ -304,26 +1098,728 @@ adapters:
         """
     test_chunked_endpoint_reject_post_hook.skip = "not implemented yet"
 
+    def _pull(self, config_yml):
+        """
+        Pull an image through the proxy, configured with ``config_yml``, which
+        sends progress messages numbered from 0.
+
+        :return: A ``Deferred`` firing with the response body.
+        """
+        self._configure(config_yml)
+        d = self.client.post(
+            'http://127.0.0.1:%d/images/create?fromImage=busybox' % (
+                self.proxyPort,), "")
+        d.addCallback(treq.content)
+        return d
+
+    def test_message_post_hooks(self):
+        """
+        Post-hooks taking messages are given each message of a streamed JSON
+        response, and what they answer is streamed to the client, rather than
+        the whole response being buffered.
+        """
+        self._getAdder(post=True)
+        d = self._pull("""endpoints:
+  "POST /images/create":
+    post: [adder]
+adapters:
+  adder:
+    uri: http://127.0.0.1:%d/adapter
+    stream: 1""" % (self.adderPort,))
+        def verify(body):
+            metrics = self.proxyAPI.root.metrics._values
+            self.assertEqual(
+                ([json.loads(line) for line in body.split("\r\n") if line],
+                 metrics[("powerstrip_stream_buffered_bytes", ())].count,
+                 ("powerstrip_response_buffered_bytes", ()) in metrics),
+                ([{"status": "Downloading", "Number": n} for n in (1, 2, 3)],
+                 1, False))
+        d.addCallback(verify)
+        return d
+
+    def test_message_observers_batched(self):
+        """
+        Observers taking messages are given batches of them, marked as
+        ``Streamed``, and the stream is passed on as Docker sent it.
+        """
+        self._getObserver()
+        d = self._pull("""endpoints:
+  "POST /images/create":
+    post: [watcher]
+adapters:
+  watcher:
+    uri: http://127.0.0.1:%d/watcher
+    mode: observe
+    stream: 10""" % (self.observerPort,))
+        def verify(body):
+            hooks = self.observerAPI.root.hooks
+            self.assertEqual(
+                ("".join(hook["ServerResponse"]["Body"] for hook in hooks),
+                 set(hook["ServerResponse"]["Streamed"] for hook in hooks)),
+                (body, set([True])))
+            self.assertEqual(
+                [json.loads(line) for line in body.split("\r\n") if line],
+                [{"status": "Downloading", "Number": n} for n in (0, 1, 2)])
+        d.addCallback(verify)
+        return d
+
+    def test_message_post_hooks_whole_response(self):
+        """
+        Post-hooks taking messages are given responses which aren't streams
+        whole, as any other post-hook.
+        """
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    post: [adder]
+adapters:
+  adder:
+    uri: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+    stream: 1""", adderArgs=dict(post=True))
+        def verify(response):
+            self.assertEqual(response, {"Number": 2, "SeenByFakeDocker": 42})
+        d.addCallback(verify)
+        return d
+
+    def test_message_post_hooks_failed(self):
+        """
+        If a post-hook fails in the middle of a stream, the client is
+        dropped.
+        """
+        self._getAdder(post=True, explode=True)
+        d = self._pull("""endpoints:
+  "POST /images/create":
+    post: [adder]
+adapters:
+  adder:
+    uri: http://127.0.0.1:%d/adapter
+    stream: 1""" % (self.adderPort,))
+        d = self.assertFailure(d, ResponseNeverReceived)
+        d.addCallback(lambda ignored: self.assertEqual(
+            len(self.flushLoggedErrors(AdapterFailed)), 1))
+        return d
+
+    def test_header_hooks_streamed(self):
+        """
+        Post-hooks which aren't given bodies are called with the status code
+        and content type, and the body is streamed to the client rather than
+        buffered.
+        """
+        self._getObserver()
+        self._configure("""endpoints:
+  "GET /containers/*/logs":
+    post: [watcher]
+adapters:
+  watcher:
+    uri: http://127.0.0.1:%d/watcher
+    mode: observe
+    body: none""" % (self.observerPort,))
+        d = self.client.get(
+            'http://127.0.0.1:%d/containers/abc/logs?stdout=1' % (
+                self.proxyPort,))
+        d.addCallback(treq.content)
+        def verify(body):
+            [hook] = self.observerAPI.root.hooks
+            self.assertEqual(
+                (len(body), hook["ServerResponse"],
+                 ("powerstrip_response_buffered_bytes", ()) in
+                 self.proxyAPI.root.metrics._values),
+                (self.dockerAPI.root.getStaticEntity("containers").outputSize,
+                 {"Code": 200, "ContentType": "text/plain; charset=utf-8",
+                  "Body": None}, False))
+        d.addCallback(verify)
+        return d
+
+    def test_header_hooks_modify(self):
+        """
+        Post-hooks which aren't given bodies can change the status code and
+        content type, but not the body.
+        """
+        self._getObserver()
+        self._configure("""endpoints:
+  "GET /containers/*/logs":
+    post: [changer]
+adapters:
+  changer:
+    uri: http://127.0.0.1:%d/changer
+    body: none""" % (self.observerPort,))
+        containers = self.dockerAPI.root.getStaticEntity("containers")
+        containers.outputSize = 10
+        d = self.client.get(
+            'http://127.0.0.1:%d/containers/abc/logs?stdout=1' % (
+                self.proxyPort,))
+        def read(response):
+            d = treq.content(response)
+            d.addCallback(lambda body: (
+                response.headers.getRawHeaders("content-type"), len(body)))
+            return d
+        d.addCallback(read)
+        def verify(result):
+            [hook] = self.observerAPI.root.hooks
+            self.assertEqual(
+                (result, hook["ServerResponse"]["Body"]),
+                ((["application/json"], 10), None))
+        d.addCallback(verify)
+        return d
+
+    def test_header_hooks_failed(self):
+        """
+        If a post-hook which isn't given bodies fails, its error is returned
+        to the client instead of the body.
+        """
+        d = self._hookRequest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    post: [adder]
+adapters:
+  adder:
+    uri: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+    body: none""", adderArgs=dict(post=True, explode=True))
+        def read(response):
+            d = treq.content(response)
+            d.addCallback(lambda body: (response.code, body))
+            return d
+        d.addCallback(read)
+        def verify(result):
+            self.assertEqual(result, (500, "sadness for you, today."))
+        d.addCallback(verify)
+        return d
+
+    def _getInfo(self, ignored=None):
+        """
+        GET ``/info`` through the proxy.
+
+        :return: A ``Deferred`` firing with the response code and body.
+        """
+        d = self.client.get('http://127.0.0.1:%d/info?return=cached' % (
+            self.proxyPort,))
+        def read(response):
+            d = treq.content(response)
+            d.addCallback(lambda body: (response.code, body))
+            return d
+        d.addCallback(read)
+        return d
+
+    def _infoCalls(self):
+        return self.dockerAPI.root.getStaticEntity("info").calls
+
+    def test_coalesced(self):
+        """
+        Identical GETs in flight at the same time share one call to Docker,
+        and the number of coalesced requests is counted.
+        """
+        self._configure("""endpoints: {}
+adapters: {}
+coalesce:
+  enabled: true""")
+        info = self.dockerAPI.root.getStaticEntity("info")
+        info.hold = True
+        flights = self.proxyAPI.root.flights
+        requests = defer.gatherResults([self._getInfo() for i in range(3)])
+        d = self._waitFor(lambda: flights.coalesced == 2 and info.calls)
+        def release(ignored):
+            info.release()
+            return requests
+        d.addCallback(release)
+        def verify(results):
+            self.assertEqual(
+                (results, info.calls, flights.flights, len(flights)),
+                ([(200, "INFORMATION FOR YOU: cached")] * 3, 1, 1, 0))
+        d.addCallback(verify)
+        return d
+
+    def test_coalescing_disabled(self):
+        """
+        Identical requests are each sent to Docker unless coalescing is
+        enabled.
+        """
+        self._configure("""endpoints: {}
+adapters: {}""")
+        info = self.dockerAPI.root.getStaticEntity("info")
+        info.hold = True
+        flights = self.proxyAPI.root.flights
+        requests = defer.gatherResults([self._getInfo() for i in range(2)])
+        d = self._waitFor(lambda: info.calls == 2)
+        def release(ignored):
+            info.release()
+            return requests
+        d.addCallback(release)
+        def verify(results):
+            self.assertEqual(
+                (results, flights.flights, flights.coalesced),
+                ([(200, "INFORMATION FOR YOU: cached")] * 2, 0, 0))
+        d.addCallback(verify)
+        return d
+
+    def _coalescedTooLargeTest(self, extra_yml):
+        """
+        Coalesce two requests without post-hooks whose Docker response is
+        larger than can be collected to share it, and check the leader's is
+        streamed while the other request is sent to Docker itself.
+        """
+        self._configure("""endpoints: {}
+adapters: {}""" + extra_yml)
+        info = self.dockerAPI.root.getStaticEntity("info")
+        info.hold = True
+        flights = self.proxyAPI.root.flights
+        metrics = self.proxyAPI.root.metrics
+        requests = defer.gatherResults([self._getInfo() for i in range(2)])
+        d = self._waitFor(lambda: flights.coalesced == 1 and info.calls)
+        def release(ignored):
+            info.release()
+            # The leader aborts its flight, so the other request goes to
+            # Docker, and is held there in turn.
+            d = self._waitFor(lambda: info.calls == 2)
+            d.addCallback(lambda ignored: info.release())
+            d.addCallback(lambda ignored: requests)
+            return d
+        d.addCallback(release)
+        def verify(results):
+            self.assertEqual(
+                (results, len(flights),
+                 metrics._values[("powerstrip_docker_responses_total",
+                                  (("mode", "streaming"),))]),
+                ([(200, "INFORMATION FOR YOU: cached")] * 2, 0, 2))
+        d.addCallback(verify)
+        return d
+
+    def test_coalesced_too_large(self):
+        """
+        A response too large to share is streamed to the client of the
+        request which got it, and the requests waiting for it are sent to
+        Docker themselves.
+        """
+        return self._coalescedTooLargeTest("""
+coalesce:
+  enabled: true
+  max_bytes: 8""")
+
+    def test_coalesced_too_large_dedicated(self):
+        """
+        Responses too large to share are streamed over dedicated connections
+        to Docker too.
+        """
+        return self._coalescedTooLargeTest("""
+coalesce:
+  enabled: true
+  max_bytes: 8
+docker_pool:
+  max_per_host: 0""")
+
+    def test_coalesced_not_refused(self):
+        """
+        A coalesced response without post-hooks is streamed rather than
+        refused when it is over ``response_buffer.max_size``.
+        """
+        return self._coalescedTooLargeTest("""
+coalesce:
+  enabled: true
+response_buffer:
+  max_size: 16""")
+
+    def test_coalesced_not_across_mutation(self):
+        """
+        A GET made after a mutating request has finished doesn't join a
+        flight which took off before it, since that flight's response may
+        not reflect the change.
+        """
+        self._configure("""endpoints: {}
+adapters: {}
+coalesce:
+  enabled: true""")
+        info = self.dockerAPI.root.getStaticEntity("info")
+        info.hold = True
+        flights = self.proxyAPI.root.flights
+        before = self._getInfo()
+        d = self._waitFor(lambda: info.calls == 1)
+        def mutate(ignored):
+            d = self.client.post(
+                'http://127.0.0.1:%d/towel' % (self.proxyPort,),
+                json.dumps({"Number": 1}),
+                headers={'Content-Type': ['application/json']})
+            d.addCallback(treq.content)
+            return d
+        d.addCallback(mutate)
+        def getAgain(ignored):
+            after = self._getInfo()
+            d = self._waitFor(lambda: info.calls == 2)
+            def release(ignored):
+                info.release()
+                return defer.gatherResults([before, after])
+            d.addCallback(release)
+            return d
+        d.addCallback(getAgain)
+        def verify(results):
+            self.assertEqual(
+                (results, info.calls, flights.flights, flights.coalesced),
+                ([(200, "INFORMATION FOR YOU: cached")] * 2, 2, 2, 0))
+        d.addCallback(verify)
+        return d
+
+    def test_coalesced_post_hooks(self):
+        """
+        Coalesced requests each run their own post-hooks on the shared
+        Docker response.
+        """
+        self._getObserver()
+        self._configure("""endpoints:
+  "GET /info":
+    post: [watcher]
+adapters:
+  watcher: http://127.0.0.1:%d/watcher
+coalesce:
+  enabled: true""" % (self.observerPort,))
+        info = self.dockerAPI.root.getStaticEntity("info")
+        info.hold = True
+        requests = defer.gatherResults([self._getInfo() for i in range(2)])
+        d = self._waitFor(
+            lambda: self.proxyAPI.root.flights.coalesced == 1 and info.calls)
+        def release(ignored):
+            info.release()
+            return requests
+        d.addCallback(release)
+        def verify(results):
+            self.assertEqual(
+                ([json.loads(body) for code, body in results], info.calls,
+                 [hook["ServerResponse"]["Body"]
+                  for hook in self.observerAPI.root.hooks]),
+                ([{"Number": 100}] * 2, 1,
+                 ["INFORMATION FOR YOU: cached"] * 2))
+        d.addCallback(verify)
+        return d
+
+    def test_cache_hit(self):
+        """
+        Responses to cacheable endpoints are served from the cache, rather
+        than asking Docker again.
+        """
+        self._configure("""endpoints: {}
+adapters: {}
+response_cache:
+  endpoints: ["GET /info"]""")
+        d = self._getInfo()
+        d.addCallback(self._getInfo)
+        def verify(result):
+            self.assertEqual((result, self._infoCalls()),
+                             ((200, "INFORMATION FOR YOU: cached"), 1))
+        d.addCallback(verify)
+        return d
+
+    def test_cache_invalidated_by_mutation(self):
+        """
+        A mutating request passing through the proxy drops the cached
+        responses.
+        """
+        self._configure("""endpoints: {}
+adapters: {}
+response_cache:
+  endpoints: ["GET /info"]""")
+        d = self._getInfo()
+        def mutate(ignored):
+            return self.client.post(
+                'http://127.0.0.1:%d/towel' % (self.proxyPort,),
+                json.dumps({"Number": 1}),
+                headers={'Content-Type': ['application/json']})
+        d.addCallback(mutate)
+        d.addCallback(treq.content)
+        d.addCallback(self._getInfo)
+        def verify(result):
+            self.assertEqual((result, self._infoCalls()),
+                             ((200, "INFORMATION FOR YOU: cached"), 2))
+        d.addCallback(verify)
+        return d
+
+    def test_cache_invalidated_by_event(self):
+        """
+        An event from Docker drops the cached responses.
+        """
+        self._configure("""endpoints: {}
+adapters: {}
+response_cache:
+  endpoints: ["GET /info"]""")
+        events = self.dockerAPI.root.getStaticEntity("events")
+        cache = self.proxyAPI.root.cache
+        d = events.waitForSubscriber()
+        d.addCallback(self._getInfo)
+        def emit(ignored):
+            self.assertEqual(len(cache), 1)
+            events.emit({"status": "die", "id": "abc"})
+            return self._waitFor(lambda: not len(cache))
+        d.addCallback(emit)
+        d.addCallback(self._getInfo)
+        def verify(result):
+            self.assertEqual(self._infoCalls(), 2)
+        d.addCallback(verify)
+        return d
+
+    def test_events_shared(self):
+        """
+        Clients subscribing to the same ``/events`` stream share one stream
+        from Docker, and each get its events.
+        """
+        self._configure("""endpoints: {}
+adapters: {}""")
+        events = self.dockerAPI.root.getStaticEntity("events")
+        multiplexer = self.proxyAPI.root.events
+        received = [[], []]
+        collected = []
+        def subscribe(chunks):
+            d = self.client.get('http://127.0.0.1:%d/events' % (
+                self.proxyPort,))
+            def collect(response):
+                # The streams are cut off at the end of the test.
+                collected.append(treq.collect(response, chunks.append
+                                              ).addErrback(lambda f: None))
+            d.addCallback(collect)
+            return d
+        d = defer.gatherResults([subscribe(chunks) for chunks in received])
+        def emit(ignored):
+            events.emit({"status": "start", "id": "abc"})
+            return self._waitFor(lambda: all(received))
+        d.addCallback(emit)
+        def verify(ignored):
+            self.assertEqual(
+                ([json.loads("".join(chunks)) for chunks in received],
+                 len(events.subscribers), multiplexer.upstreams(),
+                 multiplexer.subscribers()),
+                ([{"status": "start", "id": "abc"}] * 2, 1, 1, 2))
+            multiplexer.stop()
+            return defer.gatherResults(collected)
+        d.addCallback(verify)
+        return d
+
+    def _waitFor(self, condition):
+        """
+        Return a ``Deferred`` which fires once ``condition()`` is true.
+        """
+        d = defer.Deferred()
+        def check():
+            if condition():
+                d.callback(None)
+            else:
+                reactor.callLater(0.01, check)
+        check()
+        return d
+
+    def _waitForStall(self, output):
+        """
+        Return a ``Deferred`` which fires once a ``FakeContainerOutput`` has
+        written everything, or has stopped making progress.
+        """
+        d = defer.Deferred()
+        def check(last):
+            if output.written in (last, output.size):
+                d.callback(None)
+            else:
+                reactor.callLater(0.05, check, output.written)
+        check(None)
+        return d
+
+    def test_cache_runs_post_hooks(self):
+        """
+        Post-hooks run on responses served from the cache.
+        """
+        self._getObserver()
+        self._configure("""endpoints:
+  "GET /info":
+    post: [watcher]
+adapters:
+  watcher: http://127.0.0.1:%d/watcher
+response_cache:
+  endpoints: ["GET /info"]""" % (self.observerPort,))
+        d = self._getInfo()
+        d.addCallback(self._getInfo)
+        def verify((code, body)):
+            self.assertEqual(
+                (code, json.loads(body), self._infoCalls(),
+                 [hook["ServerResponse"]["Body"]
+                  for hook in self.observerAPI.root.hooks]),
+                (200, {"Number": 100}, 1,
+                 ["INFORMATION FOR YOU: cached"] * 2))
+        d.addCallback(verify)
+        return d
+
+    def test_cache_hook_exempt(self):
+        """
+        With ``hook_exempt``, responses served from the cache skip the
+        post-hooks.
+        """
+        self._getObserver()
+        self._configure("""endpoints:
+  "GET /info":
+    post: [watcher]
+adapters:
+  watcher: http://127.0.0.1:%d/watcher
+response_cache:
+  endpoints: ["GET /info"]
+  hook_exempt: true""" % (self.observerPort,))
+        d = self._getInfo()
+        d.addCallback(self._getInfo)
+        def verify(result):
+            self.assertEqual(
+                (result, self._infoCalls(), len(self.observerAPI.root.hooks)),
+                ((200, "INFORMATION FOR YOU: cached"), 1, 1))
+        d.addCallback(verify)
+        return d
+
     def test_prehook_error_does_not_call_docker(self):
         """
         An error in the pre-hook does not call through to Docker and returns
         the error to the user.
         """
-    test_prehook_error_does_not_call_docker.skip = "not implemented yet"
+        d = self._errorTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [adder]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s""",
+            adderArgs=dict(pre=True, explode=True))
+        # The fake Docker is set up along with the request, which only gets
+        # to it once the adapter has answered.
+        dockerCalls = self._recordDockerCalls()
+        def verify(result):
+            self.assertEqual((result, dockerCalls),
+                             ((500, "sadness for you, today."), []))
+        d.addCallback(verify)
+        return d
 
     def test_prehook_error_stops_chain(self):
         """
         An error in the pre-hook stops the chain when there are multiple
         pre-hooks.
         """
-    test_prehook_error_stops_chain.skip = "not implemented yet"
+        self._getObserver()
+        d = self._errorTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [adder, watcher]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  watcher: http://127.0.0.1:""" + str(self.observerPort) + """/watcher""",
+            adderArgs=dict(pre=True, explode=True))
+        def verify(result):
+            self.assertEqual((result, self.observerAPI.root.hooks),
+                             ((500, "sadness for you, today."), []))
+        d.addCallback(verify)
+        return d
 
     def test_posthook_error_stops_chain(self):
         """
         An error in the post-hook stops the chain and returns the error to the
         user.
         """
-    test_posthook_error_stops_chain.skip = "not implemented yet"
+        self._getObserver()
+        d = self._errorTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    post: [adder, watcher]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  watcher: http://127.0.0.1:""" + str(self.observerPort) + """/watcher""",
+            adderArgs=dict(post=True, explode=True))
+        def verify(result):
+            self.assertEqual((result, self.observerAPI.root.hooks),
+                             ((500, "sadness for you, today."), []))
+        d.addCallback(verify)
+        return d
+
+    def test_fail_open_skips_adapter(self):
+        """
+        An adapter with the ``fail-open`` policy which fails is skipped, and
+        the rest of the chain carries on.
+        """
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [adder, adderTwo]
+adapters:
+  adder:
+    uri: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+    failure_policy: fail-open
+  adderTwo: http://127.0.0.1:%(adderTwoPort)d%(adapterEndpoint)s""",
+            adderArgs=dict(pre=True, explode=True))
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 3, "SeenByFakeDocker": 42})
+        d.addCallback(verify)
+        return d
+
+    def test_adapter_timeout(self):
+        """
+        An adapter which doesn't answer within its ``timeout`` fails the
+        request with a gateway timeout.
+        """
+        self._getObserver(hold=True)
+        d = self._errorTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [watcher]
+adapters:
+  watcher:
+    uri: http://127.0.0.1:""" + str(self.observerPort) + """/watcher
+    timeout: 0.1""")
+        def verify((code, body)):
+            self.assertEqual(
+                (code, body),
+                (504, "Adapter 'watcher' did not answer within 0.1 seconds."))
+        d.addCallback(verify)
+        return d
+
+    def test_adapter_timeout_fail_open(self):
+        """
+        An adapter with the ``fail-open`` policy which doesn't answer within
+        its ``timeout`` is skipped.
+        """
+        self._getObserver(hold=True)
+        d = self._hookTest("""endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [watcher, adder]
+adapters:
+  adder: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+  watcher:
+    uri: http://127.0.0.1:""" + str(self.observerPort) + """/watcher
+    timeout: 0.1
+    failure_policy: fail-open""")
+        def verify(response):
+            self.assertEqual(response,
+                    {"Number": 2, "SeenByFakeDocker": 42})
+        d.addCallback(verify)
+        return d
+
+    def test_breaker_opens(self):
+        """
+        Once an adapter failed often enough, its circuit breaker opens:
+        requests fail without calling the adapter, and the admin site reports
+        the breaker as open.
+        """
+        config = """endpoints:
+  "POST %(dockerEndpoint)s":
+    pre: [adder]
+adapters:
+  adder:
+    uri: http://127.0.0.1:%(adderPort)d%(adapterEndpoint)s
+    breaker:
+      failures: 1"""
+        d = self._errorTest(config, adderArgs=dict(pre=True, explode=True))
+        def again(result):
+            self.assertEqual(result[0], 500)
+            self.adderServer.stopListening()
+            del self.adderServer
+            return self.client.post(
+                'http://127.0.0.1:%(proxyPort)d%(dockerEndpoint)s' % self.args,
+                json.dumps({"Number": 1}),
+                headers={'Content-Type': ['application/json']})
+        d.addCallback(again)
+        def shortCircuited(response):
+            self.assertEqual(response.code, 503)
+            self.metricsServer = reactor.listenTCP(
+                0, self.proxyAPI.metricsSite())
+            return treq.content(response)
+        d.addCallback(shortCircuited)
+        def getBreakers(ignored):
+            return self.client.get('http://127.0.0.1:%d/breakers' % (
+                self.metricsServer.getHost().port,))
+        d.addCallback(getBreakers)
+        d.addCallback(treq.json_content)
+        def verify(breakers):
+            self.assertEqual(
+                (breakers["adder"]["state"], breakers["adder"]["trips"],
+                 breakers["adder"]["short_circuited"]), ("open", 1, 1))
+        d.addCallback(verify)
+        return d
 
     def test_docker_error_does_not_stop_posthooks(self):
         """
@@ -351,3 +1847,108 @@ adapters:
         An endpoint is matched when there are '*' characters in the string
         """
     test_endpoint_globbing.skip = "not implemented yet"
+
+
+class HijackTransport(StringTransport):
+    """
+    A ``StringTransport`` which can be half-closed.
+    """
+    writeDisconnected = False
+
+    def loseWriteConnection(self):
+        self.writeDisconnected = True
+
+
+class HijackRequest(object):
+    """
+    The client's side of a hijacked request.
+    """
+
+    def __init__(self):
+        self.transport = HijackTransport()
+        self.transport.protocol = Protocol()
+        self.responseHeaders = Headers()
+
+    def setResponseCode(self, code, message=None):
+        self.code = code
+
+
+class HijackedStreamTests(TestCase):
+    """
+    Tests for the flow control of hijacked streams by ``DockerProxyClient``.
+    """
+
+    def setUp(self):
+        clock = Clock()
+        self.request = HijackRequest()
+        self.client = DockerProxyClient(
+            "POST", "/containers/abc/attach", "HTTP/1.1", {},
+            StringIO.StringIO(""), self.request)
+        self.client.metrics = Metrics(clock)
+        self.client.started = clock.seconds()
+        self.docker = HijackTransport()
+        self.client.makeConnection(self.docker)
+        self.sender = self.docker.producer
+        self.client.dataReceived(
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: application/vnd.docker.raw-stream\r\n\r\n")
+
+    def _sendBody(self):
+        self.sender.resumeProducing()
+
+    def test_output_paused(self):
+        """
+        Reading Docker's output pauses while the client's write buffer is
+        full.
+        """
+        states = []
+        for event in ["pauseProducing", "resumeProducing"]:
+            getattr(self.request.transport.producer, event)()
+            states.append(self.docker.producerState)
+        self.assertEqual(states, ["paused", "producing"])
+
+    def test_input_paused(self):
+        """
+        Reading the client's input pauses while Docker's write buffer is
+        full, once the request body has been sent.
+        """
+        producer = self.docker.producer
+        self._sendBody()
+        self.docker.producer.pauseProducing()
+        self.assertEqual(
+            (producer, self.request.transport.producerState),
+            (self.sender, "paused"))
+
+    def test_docker_gone(self):
+        """
+        When Docker's connection is lost, the client's is closed, even if it
+        was paused.
+        """
+        self._sendBody()
+        self.request.transport.producer.pauseProducing()
+        self.docker.producer.stopProducing()
+        self.assertEqual(
+            (self.request.transport.producer,
+             self.request.transport.disconnecting),
+            (None, True))
+
+    def test_client_gone(self):
+        """
+        When the client's connection is lost, Docker's is closed.
+        """
+        self._sendBody()
+        self.request.transport.producer.stopProducing()
+        self.assertEqual((self.docker.producer, self.docker.disconnecting),
+                         (None, True))
+
+    def test_half_close(self):
+        """
+        When the client is done sending input, Docker is told so, however
+        far behind reading it is.
+        """
+        self._sendBody()
+        self.docker.producer.pauseProducing()
+        self.request.transport.readConnectionLost(None)
+        self.assertEqual(
+            (self.docker.producer, self.docker.writeDisconnected),
+            (None, True))
@@ -0,0 +1,358 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._events``.
+"""
+
+import json
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionLost, ConnectionRefusedError
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+
+from .._config import EventsConfiguration
+from .._events import EventsMultiplexer
+from .._upstream import NoPostHooks
+
+
+class FakeAgent(object):
+    """
+    A ``DockerAgent`` recording requests, for the test to answer.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.cancelled = []
+
+    def dockerRequest(self, method, rest, headers, body, length):
+        d = defer.Deferred(lambda d: self.cancelled.append(rest))
+        self.requests.append((method, rest, d))
+        return d
+
+
+class FakeBodyTransport(object):
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class FakeResponse(object):
+    """
+    A response from Docker, whose body is sent by the test.
+    """
+
+    def __init__(self, code=200, phrase="OK", headers=None):
+        self.code = code
+        self.phrase = phrase
+        self.headers = Headers(headers or {
+            "content-type": ["application/json"],
+            "transfer-encoding": ["chunked"]})
+        self.transport = FakeBodyTransport()
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(self.transport)
+
+    def emit(self, event):
+        self.protocol.dataReceived(json.dumps(event) + "\n")
+
+    def end(self, reason=ResponseDone()):
+        self.protocol.connectionLost(Failure(reason))
+
+
+class FakeClientTransport(object):
+    aborted = False
+
+    def abortConnection(self):
+        self.aborted = True
+
+
+class FakeRequest(object):
+    """
+    A request from a client, recording the response written to it.
+    """
+
+    code = None
+    producer = None
+    finished = False
+
+    def __init__(self):
+        self.responseHeaders = Headers()
+        self.written = []
+        self.transport = FakeClientTransport()
+        self._finished = defer.Deferred()
+
+    def setResponseCode(self, code, phrase=None):
+        self.code = code
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished = True
+        self._finished.callback(None)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def notifyFinish(self):
+        return self._finished
+
+    def lose(self):
+        """
+        The client goes away.
+        """
+        self._finished.errback(ConnectionLost())
+
+    def events(self):
+        return [json.loads(data) for data in self.written if data]
+
+
+class EventsMultiplexerTests(TestCase):
+    """
+    Tests for ``EventsMultiplexer``.
+    """
+
+    def setUp(self):
+        self.agent = FakeAgent()
+        self.events = EventsMultiplexer(
+            self.agent, EventsConfiguration(buffer=2, replay=2))
+
+    def _subscribe(self, query=""):
+        request = FakeRequest()
+        self.events.subscribe(request, "/v1.16/events", query)
+        return request
+
+    def _answer(self, index=-1, response=None):
+        response = response or FakeResponse()
+        self.agent.requests[index][2].callback(response)
+        return response
+
+    def test_multiplexable(self):
+        """
+        Only ``GET`` requests for ``/events`` without ``until`` are shared,
+        and none once turned off.
+        """
+        multiplexable = self.events.multiplexable
+        results = [multiplexable("GET", "/v1.16/events", "since=1"),
+                   multiplexable("GET", "/events", ""),
+                   multiplexable("POST", "/events", ""),
+                   multiplexable("GET", "/info", ""),
+                   multiplexable("GET", "/events", "since=1&until=2")]
+        self.events.configure(EventsConfiguration(multiplex=False))
+        results.append(multiplexable("GET", "/events", ""))
+        self.assertEquals(results, [True, True, False, False, False, False])
+
+    def test_shared(self):
+        """
+        Subscribers with the same query, in any order, share a stream from
+        Docker, and each get its events and headers.
+        """
+        first = self._subscribe("filters=%7B%7D&since=1")
+        response = self._answer()
+        second = self._subscribe("since=1&filters=%7B%7D")
+        response.emit({"status": "start"})
+        self.assertEquals(
+            ([rest for _, rest, _ in self.agent.requests],
+             first.events(), second.events(),
+             second.code, second.responseHeaders.getRawHeaders("content-type"),
+             second.responseHeaders.hasHeader("transfer-encoding"),
+             self.events.upstreams(), self.events.subscribers(),
+             self.events.events),
+            (["/v1.16/events?filters=%7B%7D&since=1"],
+             [{"status": "start"}], [{"status": "start"}],
+             200, ["application/json"], False, 1, 2, 1))
+
+    def test_different_queries(self):
+        """
+        Subscribers with different queries get streams of their own.
+        """
+        self._subscribe("filters=a")
+        self._subscribe("filters=b")
+        self.assertEquals(
+            ([rest for _, rest, _ in self.agent.requests],
+             self.events.upstreams()),
+            (["/v1.16/events?filters=a", "/v1.16/events?filters=b"], 2))
+
+    def test_no_post_hooks(self):
+        """
+        Subscribers tell the proxy there are no post-hooks to run.
+        """
+        request = FakeRequest()
+        subscriber = self.events.subscribe(request, "/events", "")
+        d = defer.Deferred()
+        subscriber.registerListener(d)
+        self.assertFailure(d, NoPostHooks)
+        return d
+
+    def test_replay(self):
+        """
+        A subscriber joining a stream with ``since`` late is sent the events
+        already read from it.
+        """
+        self._subscribe("since=1")
+        response = self._answer()
+        response.emit({"n": 1})
+        response.emit({"n": 2})
+        late = self._subscribe("since=1")
+        response.emit({"n": 3})
+        self.assertEquals((late.events(), len(self.agent.requests)),
+                          ([{"n": 1}, {"n": 2}, {"n": 3}], 1))
+
+    def test_replay_evicted(self):
+        """
+        Once more events than the replay buffer holds have been read, a late
+        subscriber gets a stream of its own.
+        """
+        self._subscribe("since=1")
+        response = self._answer()
+        for n in range(3):
+            response.emit({"n": n})
+        self._subscribe("since=1")
+        self.assertEquals(
+            (len(self.agent.requests), self.events.upstreams()), (2, 2))
+
+    def test_live_only(self):
+        """
+        A subscriber joining a stream without ``since`` only gets the events
+        from then on.
+        """
+        self._subscribe()
+        response = self._answer()
+        response.emit({"n": 1})
+        late = self._subscribe()
+        response.emit({"n": 2})
+        self.assertEquals(late.events(), [{"n": 2}])
+
+    def test_slow_subscriber(self):
+        """
+        A subscriber falling more than ``buffer`` events behind is
+        disconnected, without holding up the others.
+        """
+        slow = self._subscribe()
+        response = self._answer()
+        fast = self._subscribe()
+        slow.producer.pauseProducing()
+        for n in range(3):
+            response.emit({"n": n})
+        self.assertEquals(
+            (slow.transport.aborted, slow.producer, len(fast.events()),
+             self.events.slowSubscribers),
+            (True, None, 3, 1))
+
+    def test_resume(self):
+        """
+        Events queued while the client is paused are written once it
+        resumes.
+        """
+        request = self._subscribe()
+        response = self._answer()
+        request.producer.pauseProducing()
+        response.emit({"n": 1})
+        response.emit({"n": 2})
+        paused = request.events()
+        request.producer.resumeProducing()
+        self.assertEquals((paused, request.events()),
+                          ([], [{"n": 1}, {"n": 2}]))
+
+    def test_last_subscriber_leaves(self):
+        """
+        Once its last subscriber has gone, the stream from Docker is closed.
+        """
+        first = self._subscribe()
+        second = self._subscribe()
+        response = self._answer()
+        first.lose()
+        stopped = response.transport.stopped
+        second.lose()
+        self.assertEquals(
+            (stopped, response.transport.stopped, self.events.upstreams()),
+            (False, True, 0))
+
+    def test_leave_before_response(self):
+        """
+        If all subscribers leave before Docker answers, the request is
+        cancelled.
+        """
+        self._subscribe().lose()
+        self.assertEquals((self.agent.cancelled, self.events.upstreams()),
+                          (["/v1.16/events"], 0))
+
+    def test_upstream_ends(self):
+        """
+        When the stream from Docker ends, so do the responses to the
+        subscribers, and new subscribers get a new stream.
+        """
+        request = self._subscribe()
+        response = self._answer()
+        response.emit({"n": 1})
+        response.end()
+        self._subscribe()
+        self.assertEquals((request.finished, len(self.agent.requests)),
+                          (True, 2))
+
+    def test_upstream_lost(self):
+        """
+        If the connection to Docker is lost, so are the subscribers'.
+        """
+        request = self._subscribe()
+        self._answer().end(ConnectionLost())
+        self.assertEquals((request.finished, request.transport.aborted),
+                          (False, True))
+
+    def test_error(self):
+        """
+        Error responses from Docker are passed on as they are, and not
+        shared with later subscribers.
+        """
+        request = self._subscribe("filters=bad")
+        response = self._answer(response=FakeResponse(
+            500, "Internal Server Error", {"content-type": ["text/plain"]}))
+        response.protocol.dataReceived("invalid filters\n")
+        response.end()
+        self._subscribe("filters=bad")
+        self.assertEquals(
+            (request.code, request.written, request.finished,
+             len(self.agent.requests)),
+            (500, ["", "invalid filters\n"], True, 2))
+
+    def test_not_json(self):
+        """
+        A stream which isn't JSON is dropped.
+        """
+        request = self._subscribe()
+        response = self._answer()
+        response.protocol.dataReceived("not json\n")
+        self.assertEquals(
+            (request.transport.aborted, response.transport.stopped,
+             len(self.flushLoggedErrors(ValueError))),
+            (True, True, 1))
+
+    def test_connection_failed(self):
+        """
+        If Docker can't be reached, subscribers get a gateway error.
+        """
+        request = self._subscribe()
+        self.agent.requests[0][2].errback(ConnectionRefusedError())
+        self.assertEquals(
+            (request.code, request.finished, self.events.upstreams()),
+            (501, True, 0))
+
+    def test_stop(self):
+        """
+        ``stop`` closes all streams and disconnects their subscribers.
+        """
+        request = self._subscribe()
+        response = self._answer()
+        self.events.stop()
+        self.assertEquals(
+            (request.transport.aborted, response.transport.stopped,
+             self.events.upstreams()),
+            (True, True, 0))
@@ -0,0 +1,81 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._jsonstream``.
+"""
+
+from twisted.trial.unittest import TestCase
+
+from .._jsonstream import JSONStreamParser
+
+
+class JSONStreamParserTests(TestCase):
+    """
+    Tests for ``JSONStreamParser``.
+    """
+
+    def test_back_to_back(self):
+        """
+        Documents sent back to back are split.
+        """
+        parser = JSONStreamParser()
+        self.assertEquals(parser.feed('{"a": 1}{"b": [2]}[3]'),
+                          [('{"a": 1}', {"a": 1}), ('{"b": [2]}', {"b": [2]}),
+                           ('[3]', [3])])
+
+    def test_whitespace_kept(self):
+        """
+        The whitespace around documents is part of their raw bytes, so that
+        newline separated streams stay so.
+        """
+        parser = JSONStreamParser()
+        self.assertEquals(parser.feed('\n{"a": 1}\n{"b": 2}\r\n'),
+                          [('\n{"a": 1}\n', {"a": 1}),
+                           ('{"b": 2}\r\n', {"b": 2})])
+
+    def test_split(self):
+        """
+        Documents split across reads are returned once complete, including
+        when the split is inside a string.
+        """
+        parser = JSONStreamParser()
+        results = [parser.feed(data) for data in
+                   ['{"status": "st', 'art", "id": ', '"abc"}\n{"st',
+                    'atus": "die"}']]
+        self.assertEquals(results, [
+            [], [], [('{"status": "start", "id": "abc"}\n',
+                      {"status": "start", "id": "abc"})],
+            [('{"status": "die"}', {"status": "die"})]])
+
+    def test_pending(self):
+        """
+        ``pending`` returns the bytes of an incomplete document.
+        """
+        parser = JSONStreamParser()
+        parser.feed('{"a": 1}\n{"b": ')
+        self.assertEquals(parser.pending(), '{"b": ')
+
+    def test_brace_in_string(self):
+        """
+        A closing brace inside a string doesn't end a document.
+        """
+        parser = JSONStreamParser()
+        self.assertEquals(
+            (parser.feed('{"a": "}'), parser.feed('"}')),
+            ([], [('{"a": "}"}', {"a": "}"})]))
+
+    def test_not_json(self):
+        """
+        A stream of anything but JSON objects or arrays is rejected.
+        """
+        parser = JSONStreamParser()
+        self.assertRaises(ValueError, parser.feed, 'Error: no such image\n')
+
+    def test_too_big(self):
+        """
+        A document bigger than ``maxSize`` is rejected, rather than buffered
+        forever.
+        """
+        parser = JSONStreamParser(maxSize=10)
+        parser.feed('{"a": ')
+        self.assertRaises(ValueError, parser.feed, '"0123456789')
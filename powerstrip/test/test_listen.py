@@ -0,0 +1,237 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._listen``.
+"""
+
+import os
+import socket
+import stat
+import subprocess
+
+from treq.client import HTTPClient
+from twisted.application.internet import TCPServer
+from twisted.internet import reactor
+from twisted.trial.unittest import TestCase
+from twisted.web import resource, server
+from twisted.web.static import Data
+
+from .._config import (
+        AdminConfiguration, InvalidConfiguration, ListenerConfiguration,
+        PluginConfiguration)
+from .._listen import (
+        DEFAULT_LISTENERS, UNIXServer, configuredAdmin, configuredListeners,
+        listenerService, parseListenAddress)
+from .._upstream import DockerAgent
+
+
+class ParseListenAddressTests(TestCase):
+    """
+    Tests for ``parseListenAddress``.
+    """
+
+    def test_unix(self):
+        """
+        ``unix://`` addresses are UNIX sockets, with settings from the query.
+        """
+        self.assertEquals(
+            parseListenAddress("unix:///var/run/powerstrip.sock"
+                               "?mode=0600&group=docker&owner=0&backlog=5"),
+            ListenerConfiguration(unix="/var/run/powerstrip.sock", mode=0600,
+                                  group="docker", owner=0, backlog=5))
+
+    def test_tcp(self):
+        """
+        ``tcp://`` addresses are TCP ports, on all interfaces if no host is
+        given.
+        """
+        self.assertEquals(
+            [parseListenAddress("tcp://127.0.0.1:2375?backlog=128"),
+             parseListenAddress("tcp://:2376")],
+            [ListenerConfiguration(tcp=2375, interface="127.0.0.1",
+                                   backlog=128),
+             ListenerConfiguration(tcp=2376, interface="")])
+
+    def test_invalid(self):
+        """
+        Addresses without a known scheme, without a port or with invalid
+        settings are rejected.
+        """
+        for address in ["http://127.0.0.1:2375", "tcp://127.0.0.1",
+                        "tcp://127.0.0.1:port", "/var/run/powerstrip.sock",
+                        "tcp://:2375?backlog=many",
+                        "tcp://:2375?mode=0600",
+                        "unix:///tmp/powerstrip.sock?mode=rw",
+                        "unix:///tmp/powerstrip.sock?port=1"]:
+            self.assertRaises(InvalidConfiguration, parseListenAddress,
+                              address)
+
+
+class ConfiguredListenersTests(TestCase):
+    """
+    Tests for ``configuredListeners``.
+    """
+
+    def setUp(self):
+        self.config = PluginConfiguration()
+        self.config._parse_adapters({"endpoints": {}, "adapters": {}})
+
+    def test_default(self):
+        """
+        Without ``POWERSTRIP_LISTEN`` or a ``listen`` section, powerstrip
+        listens on TCP port 2375 on all interfaces.
+        """
+        self.assertEquals(
+            (configuredListeners({}, self.config), DEFAULT_LISTENERS),
+            ((ListenerConfiguration(tcp=2375, interface="0.0.0.0"),),
+             DEFAULT_LISTENERS))
+
+    def test_config(self):
+        """
+        The ``listen`` section of the configuration replaces the default.
+        """
+        self.config._parse_adapters({"endpoints": {}, "adapters": {},
+                                     "listen": [{"tcp": 2376}]})
+        self.assertEquals(configuredListeners({}, self.config),
+                          (ListenerConfiguration(tcp=2376),))
+
+    def test_environment(self):
+        """
+        ``POWERSTRIP_LISTEN`` addresses, separated by spaces or commas, take
+        precedence over the configuration.
+        """
+        self.config._parse_adapters({"endpoints": {}, "adapters": {},
+                                     "listen": [{"tcp": 2376}]})
+        self.assertEquals(
+            configuredListeners({"POWERSTRIP_LISTEN":
+                                 "unix:///tmp/p.sock, tcp://:2377 "
+                                 "tcp://127.0.0.1:2378"}, self.config),
+            (ListenerConfiguration(unix="/tmp/p.sock"),
+             ListenerConfiguration(tcp=2377, interface=""),
+             ListenerConfiguration(tcp=2378, interface="127.0.0.1")))
+
+
+class ConfiguredAdminTests(TestCase):
+    """
+    Tests for ``configuredAdmin``.
+    """
+
+    def setUp(self):
+        self.config = PluginConfiguration()
+        self.config._parse_adapters({"endpoints": {}, "adapters": {}})
+
+    def test_default(self):
+        """
+        Without ``POWERSTRIP_ADMIN_PORT`` or an ``admin`` section, the admin
+        port is 2378, on the loopback interface only.
+        """
+        self.assertEquals(configuredAdmin({}, self.config),
+                          AdminConfiguration(port=2378,
+                                             interface="127.0.0.1"))
+
+    def test_config(self):
+        """
+        The ``admin`` section of the configuration can serve the admin port
+        to other hosts.
+        """
+        self.config._parse_adapters({"endpoints": {}, "adapters": {},
+                                     "admin": {"interface": "0.0.0.0"}})
+        self.assertEquals(configuredAdmin({}, self.config),
+                          AdminConfiguration(port=2378, interface="0.0.0.0"))
+
+    def test_environment(self):
+        """
+        ``POWERSTRIP_ADMIN_PORT`` overrides the port, leaving the interface
+        as configured, and turns the admin port off if it is empty.
+        """
+        self.assertEquals(
+            [configuredAdmin({"POWERSTRIP_ADMIN_PORT": "9100"}, self.config),
+             configuredAdmin({"POWERSTRIP_ADMIN_PORT": ""}, self.config)],
+            [AdminConfiguration(port=9100, interface="127.0.0.1"),
+             AdminConfiguration(port=None, interface="127.0.0.1")])
+
+    def test_invalid_environment(self):
+        """
+        A ``POWERSTRIP_ADMIN_PORT`` which isn't a number is rejected.
+        """
+        self.assertRaises(InvalidConfiguration, configuredAdmin,
+                          {"POWERSTRIP_ADMIN_PORT": "admin"}, self.config)
+
+
+class ListenerServiceTests(TestCase):
+    """
+    Tests for ``listenerService``.
+    """
+
+    def setUp(self):
+        root = resource.Resource()
+        root.putChild("info", Data('{"Containers": 0}', "application/json"))
+        self.site = server.Site(root)
+
+    def test_tcp(self):
+        """
+        TCP listeners are served by a ``TCPServer``.
+        """
+        service = listenerService(
+            ListenerConfiguration(tcp=2375, interface="127.0.0.1",
+                                  backlog=128), self.site)
+        self.assertEquals(
+            (service.__class__, service.args, service.kwargs),
+            (TCPServer, (2375, self.site),
+             {"backlog": 128, "interface": "127.0.0.1"}))
+
+    def test_unix(self):
+        """
+        UNIX listeners are served with the configured mode, and HTTP requests
+        made over them are answered.
+        """
+        path = os.path.abspath(self.mktemp())
+        service = listenerService(
+            ListenerConfiguration(unix=path, mode=0600), self.site)
+        service.startService()
+        self.addCleanup(service.stopService)
+        self.assertEquals(stat.S_IMODE(os.stat(path).st_mode), 0600)
+        client = HTTPClient(DockerAgent(reactor, None, dockerSocket=path))
+        d = client.get("http://docker/info", persistent=False)
+        d.addCallback(lambda response: response.json())
+        d.addCallback(self.assertEquals, {"Containers": 0})
+        return d
+
+    def test_stale_socket(self):
+        """
+        A socket file and lock left behind by a process which died are
+        replaced.
+        """
+        path = os.path.abspath(self.mktemp())
+        skt = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        skt.bind(path)
+        skt.close()
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+        os.symlink(str(dead.pid), path + ".lock")
+        service = listenerService(ListenerConfiguration(unix=path),
+                                  self.site)
+        service.startService()
+        return service.stopService()
+
+    def test_owner(self):
+        """
+        The owner and group of UNIX sockets are set once they are listening,
+        leaving unset ones alone.
+        """
+        path = os.path.abspath(self.mktemp())
+        service = UNIXServer(path, self.site, 50, 0660, gid=123)
+        chowned = []
+        service._chown = lambda *args: chowned.append(args)
+        service.startService()
+        self.addCleanup(service.stopService)
+        self.assertEquals(chowned, [(path, -1, 123)])
+
+    def test_owner_names(self):
+        """
+        Owner and group names are resolved to ids.
+        """
+        service = listenerService(
+            ListenerConfiguration(unix="/tmp/p.sock", owner="root",
+                                  group=0), self.site)
+        self.assertEquals((service.uid, service.gid), (0, 0))
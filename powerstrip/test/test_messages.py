@@ -0,0 +1,172 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._messages``.
+"""
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from .._messages import MessageStream
+from .._metrics import Metrics
+from .test_upstream import StreamingRequest
+
+
+class MessageStreamTests(TestCase):
+    """
+    Tests for ``MessageStream``.
+    """
+
+    def setUp(self):
+        self.request = StreamingRequest()
+        self.producer = StringTransport()
+        self.calls = []
+
+    def _stream(self, batch=1):
+        return MessageStream(self.request, self.producer,
+                             Metrics(Clock()), self._runHooks, batch)
+
+    def _runHooks(self, messages):
+        d = defer.Deferred()
+        self.calls.append((messages, d))
+        return d
+
+    def _answer(self, data=None):
+        """
+        Answer the oldest call of the hooks, with ``data`` or with the
+        messages it was given.
+        """
+        messages, d = self.calls.pop(0)
+        d.callback(messages if data is None else data)
+
+    def test_per_message(self):
+        """
+        Messages are passed through the hooks one at a time, split as
+        Docker sent them whichever way they were read, and what the hooks
+        answer is written to the client.
+        """
+        stream = self._stream()
+        stream.write('{"n": 1}\r\n{"n"')
+        given = [self.calls[0][0]]
+        self._answer('{"n": 10}\r\n')
+        stream.write(': 2}\r\n')
+        given.append(self.calls[0][0])
+        self._answer()
+        self.assertEqual(
+            (given, self.request.transport.value()),
+            (['{"n": 1}\r\n', '{"n": 2}\r\n'], '{"n": 10}\r\n{"n": 2}\r\n'))
+
+    def test_batched(self):
+        """
+        Messages arriving while a batch is with the hooks are passed on
+        together, up to the batch size, and written in order.
+        """
+        stream = self._stream(batch=2)
+        stream.write('{"n": 1}')
+        stream.write('{"n": 2}{"n": 3}{"n": 4}')
+        given = []
+        while self.calls:
+            given.append(self.calls[0][0])
+            self._answer()
+        self.assertEqual(
+            (given, self.request.transport.value()),
+            (['{"n": 1}', '{"n": 2}{"n": 3}', '{"n": 4}'],
+             '{"n": 1}{"n": 2}{"n": 3}{"n": 4}'))
+
+    def test_dropped(self):
+        """
+        Hooks can drop messages by answering with nothing.
+        """
+        stream = self._stream()
+        stream.write('{"n": 1}')
+        self._answer("")
+        stream.finish()
+        self.assertEqual(
+            (self.request.transport.value(), self.request.finished),
+            ("", True))
+
+    def test_paused_while_batch_waits(self):
+        """
+        Docker isn't read from while a whole batch is waiting for the hooks.
+        """
+        stream = self._stream(batch=2)
+        stream.write('{"n": 1}{"n": 2}')
+        waiting = self.producer.producerState
+        stream.write('{"n": 3}{"n": 4}')
+        paused = self.producer.producerState
+        self._answer()
+        self.assertEqual((waiting, paused, self.producer.producerState),
+                         ("producing", "paused", "producing"))
+
+    def test_client_paused(self):
+        """
+        Docker isn't read from while the client's connection is paused.
+        """
+        stream = self._stream()
+        self.request.producer.pauseProducing()
+        paused = self.producer.producerState
+        self.request.producer.resumeProducing()
+        self.assertEqual((self.request.producer, paused,
+                          self.producer.producerState),
+                         (stream, "paused", "producing"))
+
+    def test_finish_waits(self):
+        """
+        The response to the client is only finished once the messages still
+        with the hooks have been written, and then any incomplete message is
+        passed on as it was.
+        """
+        stream = self._stream()
+        stream.write('{"n": 1}{"n"')
+        stream.finish()
+        finished = self.request.finished
+        self._answer()
+        self.assertEqual(
+            (finished, self.request.finished, self.request.producer,
+             self.request.transport.value()),
+            (False, True, None, '{"n": 1}{"n"'))
+
+    def test_hooks_failed(self):
+        """
+        If the hooks fail, the client is dropped and Docker isn't read from
+        any more.
+        """
+        stream = self._stream()
+        stream.write('{"n": 1}{"n": 2}')
+        self.calls.pop(0)[1].errback(ValueError("adapter failed"))
+        self.assertEqual(
+            (self.request.transport.disconnecting,
+             self.producer.producerState, self.calls,
+             len(self.flushLoggedErrors(ValueError))),
+            (True, "stopped", [], 1))
+
+    def test_not_json(self):
+        """
+        A stream which isn't JSON is dropped.
+        """
+        stream = self._stream()
+        stream.write("Error: not JSON\n")
+        self.assertEqual(
+            (self.request.transport.disconnecting,
+             self.producer.producerState,
+             len(self.flushLoggedErrors(ValueError))),
+            (True, "stopped", 1))
+
+    def test_client_gone(self):
+        """
+        Once the client has gone, Docker isn't read from any more, and the
+        answers of the hooks are dropped.
+        """
+        stream = self._stream()
+        stream.write('{"n": 1}')
+        self.request._finished.errback(ConnectionLost())
+        stream.stopProducing()
+        self._answer()
+        stream.write('{"n": 2}')
+        self.assertEqual(
+            (self.producer.producerState, self.calls,
+             self.request.transport.value()),
+            ("stopped", [], ""))
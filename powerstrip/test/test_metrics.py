@@ -0,0 +1,126 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._metrics``.
+"""
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from .._metrics import Histogram, Metrics, poolCollector
+
+
+class HistogramTests(TestCase):
+    """
+    Tests for ``Histogram``.
+    """
+
+    def test_buckets(self):
+        """
+        Values are counted in the first bucket whose upper bound they don't
+        exceed, or after the last bucket.
+        """
+        histogram = Histogram((1, 5))
+        for value in [0.5, 1, 3, 5, 7]:
+            histogram.observe(value)
+        self.assertEqual(
+            (histogram.counts, histogram.sum, histogram.count),
+            ([2, 2, 1], 16.5, 5))
+
+
+class MetricsTests(TestCase):
+    """
+    Tests for ``Metrics``.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Metrics(self.clock)
+
+    def lines(self, prefix):
+        return [line for line in self.metrics.render().splitlines()
+                if line.startswith(prefix)]
+
+    def test_histogram(self):
+        """
+        Histograms are rendered with cumulative buckets, their sum and count,
+        per set of labels.
+        """
+        for value in [0.002, 0.003, 40]:
+            self.metrics.observe("powerstrip_docker_duration_seconds",
+                                 (), value)
+        lines = self.lines("powerstrip_docker_duration_seconds")
+        self.assertEqual(
+            [lines[0], lines[1], lines[2], lines[13], lines[14]] + lines[15:],
+            ['powerstrip_docker_duration_seconds_bucket{le="0.001"} 0',
+             'powerstrip_docker_duration_seconds_bucket{le="0.0025"} 1',
+             'powerstrip_docker_duration_seconds_bucket{le="0.005"} 2',
+             'powerstrip_docker_duration_seconds_bucket{le="30.0"} 2',
+             'powerstrip_docker_duration_seconds_bucket{le="+Inf"} 3',
+             'powerstrip_docker_duration_seconds_sum 40.005',
+             'powerstrip_docker_duration_seconds_count 3'])
+
+    def test_labels(self):
+        """
+        Label values are quoted and escaped.
+        """
+        self.metrics.observe("powerstrip_request_duration_seconds",
+                             (("endpoint", 'POST /"x"'),), 0.5)
+        self.assertIn(
+            'powerstrip_request_duration_seconds_count'
+            '{endpoint="POST /\\"x\\""} 1',
+            self.lines("powerstrip_request_duration_seconds_count"))
+
+    def test_counter(self):
+        """
+        Counters are rendered with their labels.
+        """
+        for mode in ["buffered", "streaming", "buffered"]:
+            self.metrics.increment("powerstrip_docker_responses_total",
+                                   (("mode", mode),))
+        self.assertEqual(
+            self.lines("powerstrip_docker_responses_total"),
+            ['powerstrip_docker_responses_total{mode="buffered"} 2',
+             'powerstrip_docker_responses_total{mode="streaming"} 1'])
+
+    def test_timed(self):
+        """
+        ``timed`` records the time until a ``Deferred`` fires, passing its
+        result on.
+        """
+        d = Deferred()
+        self.metrics.timed(d, "powerstrip_adapter_duration_seconds",
+                           (("adapter", "audit"), ("hook", "pre")))
+        self.clock.advance(0.25)
+        d.callback("result")
+        self.assertEqual(self.successResultOf(d), "result")
+        self.assertEqual(
+            self.lines("powerstrip_adapter_duration_seconds_sum"),
+            ['powerstrip_adapter_duration_seconds_sum'
+             '{adapter="audit",hook="pre"} 0.25'])
+
+    def test_collector(self):
+        """
+        Samples from collectors are rendered after the recorded metrics.
+        """
+        self.metrics.addCollector(lambda: [
+            ("powerstrip_notify_queue_depth", "gauge", "Waiting.", (), 3)])
+        self.assertEqual(self.metrics.render().splitlines()[-3:],
+                         ["# HELP powerstrip_notify_queue_depth Waiting.",
+                          "# TYPE powerstrip_notify_queue_depth gauge",
+                          "powerstrip_notify_queue_depth 3"])
+
+    def test_pool_collector(self):
+        """
+        ``poolCollector`` reports the connections handed out by a pool as
+        reused, and those it had to open as new.
+        """
+        class Pool(object):
+            hits = 3
+            misses = 1
+        self.metrics.addCollector(poolCollector(Pool()))
+        self.assertEqual(
+            self.lines("powerstrip_docker_connections_total"),
+            ['powerstrip_docker_connections_total{result="reused"} 3',
+             'powerstrip_docker_connections_total{result="new"} 1'])
@@ -0,0 +1,220 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._notify``.
+"""
+
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from .._breaker import Breakers, OPEN
+from .._config import (
+        Adapter, BreakerConfiguration, NotifyQueueConfiguration, DROP_NEWEST,
+        DROP_OLDEST)
+from .._notify import NotificationQueue, Notifier
+
+
+class FakePoster(object):
+    """
+    Record batches of notifications, to be answered by the test.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, uri, body):
+        d = Deferred()
+        self.batches.append((uri, body, d))
+        return d
+
+    def notifications(self):
+        return [[n for n in body["Notifications"]]
+                for uri, body, d in self.batches]
+
+
+class NotificationQueueTests(TestCase):
+    """
+    Tests for ``NotificationQueue``.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.post = FakePoster()
+
+    def makeQueue(self, **settings):
+        return NotificationQueue("http://audit/", self.post,
+                                 NotifyQueueConfiguration(**settings),
+                                 self.clock)
+
+    def test_delivered(self):
+        """
+        A notification is delivered straight away when the adapter isn't
+        busy, in a batch of its own.
+        """
+        queue = self.makeQueue()
+        queue.put(1)
+        [(uri, body, d)] = self.post.batches
+        self.assertEqual((uri, body), ("http://audit/", {
+            "PowerstripProtocolVersion": 1, "Type": "notify",
+            "Notifications": [1]}))
+
+    def test_concurrency_and_batching(self):
+        """
+        At most ``concurrency`` batches are delivered at the same time, and
+        notifications queued meanwhile are delivered in batches of up to
+        ``batch_size``.
+        """
+        queue = self.makeQueue(concurrency=2, batch_size=3)
+        for i in range(7):
+            queue.put(i)
+        self.assertEqual((self.post.notifications(), len(queue)),
+                         ([[0], [1]], 5))
+        self.post.batches[0][2].callback(None)
+        self.post.batches[1][2].callback(None)
+        self.assertEqual(self.post.notifications(),
+                         [[0], [1], [2, 3, 4], [5, 6]])
+        self.assertEqual((queue.active, len(queue)), (2, 0))
+
+    def test_drop_oldest(self):
+        """
+        With the ``drop-oldest`` policy, a full queue discards its oldest
+        notification to make room.
+        """
+        queue = self.makeQueue(max_size=2, concurrency=1,
+                               overflow=DROP_OLDEST)
+        for i in range(5):
+            queue.put(i)
+        self.post.batches[0][2].callback(None)
+        self.assertEqual(self.post.notifications(), [[0], [3, 4]])
+        self.assertEqual((queue.enqueued, queue.dropped), (5, 2))
+
+    def test_drop_newest(self):
+        """
+        With the ``drop-newest`` policy, notifications which find the queue
+        full are discarded.
+        """
+        queue = self.makeQueue(max_size=2, concurrency=1,
+                               overflow=DROP_NEWEST)
+        for i in range(5):
+            queue.put(i)
+        self.post.batches[0][2].callback(None)
+        self.assertEqual(self.post.notifications(), [[0], [1, 2]])
+        self.assertEqual((queue.enqueued, queue.dropped), (5, 2))
+
+    def test_latency(self):
+        """
+        The time between queueing and delivery is accounted for every
+        delivered notification.
+        """
+        queue = self.makeQueue(concurrency=1)
+        queue.put(1)
+        self.clock.advance(2)
+        queue.put(2)
+        self.clock.advance(1)
+        self.post.batches[0][2].callback(None)
+        self.clock.advance(4)
+        self.post.batches[1][2].callback(None)
+        self.assertEqual(
+            (queue.delivered, queue.latencyTotal, queue.latencyMax),
+            (2, 3.0 + 5.0, 5.0))
+
+    def test_failed(self):
+        """
+        Failed deliveries are counted, and don't stop later deliveries.
+        """
+        def post(uri, body):
+            return fail(RuntimeError("adapter is down"))
+        queue = NotificationQueue("http://audit/", post,
+                                  NotifyQueueConfiguration(), self.clock)
+        queue.put(1)
+        queue.put(2)
+        self.assertEqual((queue.failed, queue.delivered, queue.active),
+                         (2, 0, 0))
+
+    def test_when_idle(self):
+        """
+        ``whenIdle`` fires once all queued notifications have been delivered.
+        """
+        queue = self.makeQueue(concurrency=1)
+        self.assertEqual(self.successResultOf(queue.whenIdle()), None)
+        queue.put(1)
+        queue.put(2)
+        idle = queue.whenIdle()
+        self.post.batches[0][2].callback(None)
+        self.assertNoResult(idle)
+        self.post.batches[1][2].callback(None)
+        self.assertEqual(self.successResultOf(idle), None)
+
+    def test_configure_shrinks(self):
+        """
+        Reconfiguring a queue with a smaller ``max_size`` drops the
+        notifications which no longer fit.
+        """
+        queue = self.makeQueue(concurrency=1)
+        for i in range(5):
+            queue.put(i)
+        queue.configure(NotifyQueueConfiguration(max_size=2, concurrency=1))
+        self.post.batches[0][2].callback(None)
+        self.assertEqual(self.post.notifications(), [[0], [3, 4]])
+        self.assertEqual(queue.dropped, 2)
+
+
+class NotifierTests(TestCase):
+    """
+    Tests for ``Notifier``.
+    """
+
+    def test_queue_per_adapter(self):
+        """
+        Each adapter has a queue of its own, so that a busy adapter doesn't
+        hold up notifications to others.  ``counters`` sums over them.
+        """
+        post = FakePoster()
+        notifier = Notifier(post, NotifyQueueConfiguration(concurrency=1),
+                            Clock())
+        audit = Adapter("audit", "http://audit/")
+        inventory = Adapter("inventory", "http://inventory/")
+        notifier.notify([audit], 1)
+        notifier.notify([audit, inventory], 2)
+        self.assertEqual([(uri, body["Notifications"])
+                          for uri, body, d in post.batches],
+                         [("http://audit/", [1]), ("http://inventory/", [2])])
+        counters = notifier.counters()
+        self.assertEqual(
+            (counters["depth"], counters["active"], counters["enqueued"]),
+            (1, 2, 3))
+
+    def test_timeout(self):
+        """
+        A delivery which takes longer than the adapter's ``timeout`` is
+        cancelled and counted as failed.
+        """
+        post = FakePoster()
+        clock = Clock()
+        notifier = Notifier(post, NotifyQueueConfiguration(), clock,
+                            Breakers(clock))
+        notifier.notify([Adapter("audit", "http://audit/", timeout=5)], 1)
+        clock.advance(5)
+        counters = notifier.counters()
+        self.assertEqual((counters["active"], counters["failed"]), (0, 1))
+
+    def test_breaker(self):
+        """
+        Failed deliveries count towards the adapter's circuit breaker, and
+        once it is open notifications fail without calling the adapter.
+        """
+        post = FakePoster()
+        clock = Clock()
+        breakers = Breakers(clock)
+        notifier = Notifier(post, NotifyQueueConfiguration(), clock, breakers)
+        audit = Adapter("audit", "http://audit/",
+                        breaker=BreakerConfiguration(failures=2))
+        for i in range(2):
+            notifier.notify([audit], i)
+            post.batches[-1][2].errback(ValueError("refused"))
+        notifier.notify([audit], 2)
+        self.assertEqual(
+            (breakers.breaker(audit).state, len(post.batches),
+             notifier.counters()["failed"]),
+            (OPEN, 2, 3))
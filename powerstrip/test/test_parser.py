@@ -4,8 +4,10 @@
 from twisted.trial.unittest import TestCase
 from twisted.python.filepath import FilePath
 
+import fnmatch
+
 from .._config import PluginConfiguration
-from .._parser import EndpointParser, InvalidRequest
+from .._parser import EndpointParser, EndpointIndex, InvalidRequest
 
 class EndpointParserTests(TestCase):
     """
@@ -83,3 +85,79 @@ adapters:
         The parser raises ```InvalidRequest`` if the request contains a query part.
         """
         self.assertRaises(InvalidRequest, self.parser.match_endpoint, "GET", "/foo?bar")
+
+
+class EndpointIndexTests(TestCase):
+    """
+    Tests for ``EndpointIndex``.
+    """
+
+    endpoints = [
+        "POST /v1.16/containers/create",
+        "POST /*/containers/create",
+        "POST /v1*/containers/create",
+        "POST /*/*/create",
+        "* /*/containers/create",
+        "POST /v[12]/containers/create",
+        "GET /v1.16/images/*/json",
+        "* /v*/images/*/json",
+        "DELETE /*/containers/*",
+        "[GP]* /info",
+        "*/start",
+        "GET /v?/info",
+        "GET /info",
+        "*",
+    ]
+
+    requests = [
+        ("POST", "/v1.16/containers/create"),
+        ("POST", "/v2/containers/create"),
+        ("POST", "/v3/containers/create"),
+        ("GET", "/v1.16/containers/create"),
+        ("GET", "/v1.16/images/*/json"),
+        ("GET", "/v2/images/alpha/json"),
+        ("DELETE", "/v1.16/containers/abc"),
+        ("DELETE", "/v1.16/containers/abc/start"),
+        ("GET", "/info"),
+        ("PUT", "/info"),
+        ("POST", "/info"),
+        ("GET", "/v1/info"),
+        ("GET", "/v10/info"),
+        ("HEAD", "/"),
+    ]
+
+    def test_same_as_fnmatch(self):
+        """
+        ``EndpointIndex.match`` returns the same endpoint expressions as
+        matching each of them with ``fnmatch.fnmatch``.
+        """
+        index = EndpointIndex(self.endpoints)
+        for method, request in self.requests:
+            expected = set(
+                endpoint for endpoint in self.endpoints
+                if fnmatch.fnmatch("%s %s" % (method, request), endpoint))
+            self.assertEquals((method, request, index.match(method, request)),
+                              (method, request, expected))
+
+    def test_many_endpoints(self):
+        """
+        ``EndpointIndex.match`` finds the right expressions among many which
+        share their literal prefix or suffix.
+        """
+        endpoints = ["POST /*/resource%d/*/action" % (i,) for i in range(200)]
+        endpoints += ["GET /v1.16/things/thing%d/*" % (i,) for i in range(200)]
+        index = EndpointIndex(endpoints)
+        self.assertEquals(
+            index.match("POST", "/v1.16/resource7/abc/action"),
+            set(["POST /*/resource7/*/action"]))
+        self.assertEquals(
+            index.match("GET", "/v1.16/things/thing17/json"),
+            set(["GET /v1.16/things/thing17/*"]))
+        self.assertEquals(index.match("PUT", "/v1.16/things/thing17/json"),
+                          set())
+
+    def test_empty(self):
+        """
+        An empty ``EndpointIndex`` matches nothing.
+        """
+        self.assertEquals(EndpointIndex([]).match("GET", "/info"), set())
@@ -76,7 +76,9 @@ class BasicTests(TestCase, GenerallyUsefulPowerstripTestMixin):
 
     def tearDown(self):
         shutdowns = [
-            self.proxyServer.stopListening()]
+            self.proxyServer.stopListening(),
+            self.proxyAPI.root.pool.closeCachedConnections(),
+            self.proxyAPI.root.dockerPool.closeCachedConnections()]
         if hasattr(self, "nullServer"):
             shutdowns.append(self.nullServer.stopListening())
         return defer.gatherResults(shutdowns)
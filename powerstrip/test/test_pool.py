@@ -0,0 +1,86 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._pool``.
+"""
+
+from twisted.internet import reactor, defer
+from twisted.trial.unittest import TestCase
+from twisted.web import server, resource
+from twisted.web.client import Agent
+from treq.client import HTTPClient
+import treq
+
+from .._config import PoolConfiguration
+from .._pool import ConnectionPool
+
+
+class _Hello(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        return "hello"
+
+
+class ConnectionPoolTests(TestCase):
+    """
+    Tests for ``ConnectionPool``.
+    """
+
+    def setUp(self):
+        self.server = reactor.listenTCP(
+            0, server.Site(_Hello()), interface="127.0.0.1")
+        self.port = self.server.getHost().port
+        self.pool = ConnectionPool(reactor)
+        self.client = HTTPClient(Agent(reactor, pool=self.pool))
+        self.uri = "http://127.0.0.1:%d/" % (self.port,)
+
+    def tearDown(self):
+        return defer.gatherResults([
+            self.pool.closeCachedConnections(),
+            self.server.stopListening()])
+
+    def test_configure(self):
+        """
+        ``configure`` applies the settings of a ``PoolConfiguration``.
+        """
+        self.pool.configure(PoolConfiguration(max_per_host=7, idle_timeout=30))
+        self.assertEquals(
+            (self.pool.maxPersistentPerHost, self.pool.cachedConnectionTimeout),
+            (7, 30))
+
+    def test_hits_and_misses(self):
+        """
+        The first request to a host is a miss, and a following one reuses the
+        cached connection and is a hit.
+        """
+        d = self.client.get(self.uri)
+        d.addCallback(treq.content)
+        d.addCallback(lambda ignored: self.client.get(self.uri))
+        d.addCallback(treq.content)
+        def verify(body):
+            self.assertEquals((body, self.pool.misses, self.pool.hits),
+                              ("hello", 1, 1))
+        d.addCallback(verify)
+        return d
+
+    def test_prewarm(self):
+        """
+        ``prewarm`` opens ``maxPersistentPerHost`` connections to every
+        distinct adapter host, so the first request is already a hit.
+        """
+        self.pool.configure(PoolConfiguration(max_per_host=3))
+        d = defer.gatherResults(self.pool.prewarm(
+            [self.uri + "one", self.uri + "two", "https://secure/adapter"]))
+        def prewarmed(ignored):
+            self.assertEquals(
+                len(self.pool._connections[("http", "127.0.0.1", self.port)]),
+                3)
+            self.assertEquals((self.pool.misses, self.pool.hits), (0, 0))
+            return self.client.get(self.uri)
+        d.addCallback(prewarmed)
+        d.addCallback(treq.content)
+        def verify(body):
+            self.assertEquals((self.pool.misses, self.pool.hits), (0, 1))
+        d.addCallback(verify)
+        return d
@@ -0,0 +1,104 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._protocol``.
+"""
+
+from twisted.trial.unittest import TestCase
+
+from .._protocol import (
+        HookBody, bodyFields, postHookResponse, postHookResult,
+        readClientRequest, readHookBody, readServerResponse, UNMODIFIED)
+
+
+class HookBodyTests(TestCase):
+    """
+    Tests for ``HookBody``.
+    """
+
+    def test_fields_v1(self):
+        """
+        Version 1 passes bodies as text, whichever form they were given in.
+        """
+        self.assertEqual(
+            [HookBody('{"a": 1}').fields(1),
+             HookBody(value={"a": 1}).fields(1), bodyFields(None, 1)],
+            [{"Body": '{"a": 1}'}] * 2 + [{"Body": None}])
+
+    def test_fields_v2(self):
+        """
+        Version 2 embeds JSON bodies as values, and passes other bodies as
+        ``RawBody`` text.
+        """
+        self.assertEqual(
+            [HookBody('{"a": 1}').fields(2),
+             HookBody("OK", isJSON=False).fields(2),
+             HookBody('{"a": 1}{"b": 2}').fields(2), HookBody().fields(2)],
+            [{"Body": {"a": 1}},
+             {"Body": None, "RawBody": "OK"},
+             {"Body": None, "RawBody": '{"a": 1}{"b": 2}'},
+             {"Body": None}])
+
+    def test_converted_once(self):
+        """
+        A body is decoded or encoded at most once.
+        """
+        body = HookBody('{"a": [1]}')
+        self.assertIdentical(body.value(), body.value())
+        body = HookBody(value={"a": [1]})
+        self.assertIdentical(body.text(), body.text())
+
+    def test_unchanged_text(self):
+        """
+        A body passed around as text keeps the text it was given in.
+        """
+        self.assertEqual(HookBody('{ "a" : 1 }').text(), '{ "a" : 1 }')
+
+
+class ReadTests(TestCase):
+    """
+    Tests for reading the answers of adapters.
+    """
+
+    def test_read_hook_body(self):
+        """
+        ``readHookBody`` reads a body in the version the adapter answered in.
+        """
+        self.assertEqual(
+            [readHookBody({"Body": '{"a": 1}'}, 1).value(),
+             readHookBody({"Body": {"a": 1}}, 2).text(),
+             readHookBody({"Body": None, "RawBody": "OK"}, 2).text(),
+             readHookBody({"Body": None}, 2).text()],
+            [{"a": 1}, '{"a": 1}', "OK", None])
+
+    def test_unmodified(self):
+        """
+        Answers saying ``Unmodified`` are read as ``UNMODIFIED``, whatever
+        else they contain.
+        """
+        answer = {"PowerstripProtocolVersion": 1, "Unmodified": True,
+                  "ModifiedClientRequest": {"Body": "{}"}}
+        self.assertEqual(
+            (readClientRequest(answer), readServerResponse(answer)),
+            (UNMODIFIED, UNMODIFIED))
+
+    def test_server_response(self):
+        """
+        A Docker response passed through version 2 post-hooks comes back
+        in the form it was given in, its JSON body encoded once.
+        """
+        docker = {"PowerstripProtocolVersion": 1,
+                  "ModifiedServerResponse": {
+                      "Code": 200, "ContentType": "application/json",
+                      "Body": '{"a": 1}'}}
+        response = postHookResponse(docker)
+        answer = {"PowerstripProtocolVersion": 2,
+                  "ModifiedServerResponse": {
+                      "Code": 201, "ContentType": "application/json",
+                      "Body": {"a": response["Body"].value()["a"] + 1}}}
+        self.assertEqual(
+            postHookResult(readServerResponse(answer)),
+            {"PowerstripProtocolVersion": 1,
+             "ModifiedServerResponse": {
+                 "Code": 201, "ContentType": "application/json",
+                 "Body": '{"a": 2}'}})
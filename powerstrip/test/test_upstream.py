@@ -0,0 +1,365 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for ``powerstrip._upstream``.
+"""
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from .._config import BufferConfiguration
+from .._metrics import Metrics
+from .._upstream import (
+        NoPostHooks, PooledDockerClient, StreamedResponse, isBinaryContentType,
+        isPoolable, writeBufferSize)
+
+
+class IsPoolableTests(TestCase):
+    """
+    Tests for ``isPoolable``.
+    """
+
+    def test_plain_requests(self):
+        """
+        Requests with complete, plain responses can use the pool.
+        """
+        for method, path in [("GET", "/info"),
+                             ("GET", "/v1.16/containers/json"),
+                             ("POST", "/v1.16/containers/create"),
+                             ("POST", "/v1.16/containers/abc/start"),
+                             ("DELETE", "/v1.16/containers/abc")]:
+            self.assertTrue(isPoolable(method, path, {}), (method, path))
+
+    def test_hijacked_and_streaming(self):
+        """
+        Requests which hijack the connection or stream their response keep a
+        dedicated connection.
+        """
+        for method, path in [("POST", "/v1.16/containers/abc/attach"),
+                             ("POST", "/containers/abc/attach"),
+                             ("POST", "/v1.16/exec/abc/start"),
+                             ("GET", "/v1.16/events"),
+                             ("GET", "/v1.16/containers/abc/logs"),
+                             ("GET", "/v1.16/containers/abc/export"),
+                             ("GET", "/v1.16/images/ubuntu/get"),
+                             ("POST", "/v1.16/images/create"),
+                             ("POST", "/v1.16/build")]:
+            self.assertFalse(isPoolable(method, path, {}), (method, path))
+
+    def test_upgrade(self):
+        """
+        Requests asking for a protocol upgrade keep a dedicated connection.
+        """
+        self.assertFalse(isPoolable("POST", "/session", {"upgrade": "h2c"}))
+
+
+class IsBinaryContentTypeTests(TestCase):
+    """
+    Tests for ``isBinaryContentType``.
+    """
+
+    def test_binary(self):
+        """
+        Tarballs and opaque binary data are binary, whatever their
+        parameters.
+        """
+        for value in ["application/x-tar", "application/tar",
+                      "application/octet-stream",
+                      "Application/Octet-Stream; charset=binary"]:
+            self.assertTrue(isBinaryContentType(value), value)
+
+    def test_not_binary(self):
+        """
+        JSON, text and Docker's raw streams are not binary content.
+        """
+        for value in ["application/json", "text/plain; charset=utf-8",
+                      "application/vnd.docker.raw-stream"]:
+            self.assertFalse(isBinaryContentType(value), value)
+
+
+class BufferingTransport(StringTransport):
+    """
+    A ``StringTransport`` with the write buffer of a ``FileDescriptor``,
+    holding on to everything written to it.
+    """
+
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.dataBuffer = b""
+        self.offset = 0
+        self._tempDataLen = 0
+
+    def write(self, data):
+        StringTransport.write(self, data)
+        self._tempDataLen += len(data)
+
+
+class StreamingRequest(object):
+    """
+    A ``Request`` from a client, recording the response written to it.
+    """
+
+    producer = None
+    finished = False
+
+    def __init__(self):
+        self.transport = BufferingTransport()
+        self.responseHeaders = Headers()
+        self._finished = defer.Deferred()
+
+    def setResponseCode(self, code, phrase=None):
+        self.code = code
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def finish(self):
+        self.finished = True
+        self._finished.callback(None)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def notifyFinish(self):
+        return self._finished
+
+
+class WriteBufferSizeTests(TestCase):
+    """
+    Tests for ``writeBufferSize``.
+    """
+
+    def test_buffered(self):
+        """
+        The bytes written to a transport and not yet sent are counted.
+        """
+        transport = BufferingTransport()
+        transport.dataBuffer = b"x" * 10
+        transport.offset = 4
+        transport.write(b"y" * 5)
+        self.assertEqual(writeBufferSize(transport), 11)
+
+    def test_unknown(self):
+        """
+        Transports without a ``FileDescriptor`` write buffer have none.
+        """
+        self.assertEqual(writeBufferSize(StringTransport()), 0)
+
+
+class StreamedResponseTests(TestCase):
+    """
+    Tests for ``StreamedResponse``.
+    """
+
+    def setUp(self):
+        self.request = StreamingRequest()
+        self.producer = StringTransport()
+        self.metrics = Metrics(Clock())
+        self.stream = StreamedResponse(self.request, self.producer,
+                                       self.metrics)
+
+    def _peaks(self):
+        histogram = self.metrics._values.get(
+            ("powerstrip_stream_buffered_bytes", ()))
+        return histogram and (histogram.count, histogram.sum)
+
+    def test_relayed(self):
+        """
+        The reads from Docker are registered as the producer of the client's
+        request while the response is written to it, and the most bytes left
+        waiting to be sent are recorded once the response is finished.
+        """
+        self.stream.write(b"abc")
+        self.request.transport.dataBuffer = b"abc"
+        self.request.transport._tempDataLen = 0
+        self.stream.write(b"de")
+        producer = self.request.producer
+        self.stream.finish()
+        self.assertEqual(
+            (producer, self.request.producer, self.request.transport.value(),
+             self.request.finished, self._peaks()),
+            (self.producer, None, b"abcde", True, (1, 5)))
+
+    def test_client_gone(self):
+        """
+        Once the client has gone, nothing more is written to it, and the
+        request isn't finished.
+        """
+        self.request.notifyFinish().errback(ConnectionLost())
+        self.stream.write(b"abc")
+        self.stream.finish()
+        self.assertEqual(
+            (self.request.producer, self.request.transport.value(),
+             self.request.finished, self._peaks()),
+            (None, b"", False, (1, 0)))
+
+    def test_abort(self):
+        """
+        If Docker goes away mid-response, the client is dropped.
+        """
+        self.stream.write(b"abc")
+        self.stream.abort()
+        self.assertEqual(
+            (self.request.producer, self.request.transport.disconnecting,
+             self.request.finished),
+            (None, True, False))
+
+
+class FakeResponse(object):
+    """
+    A response from Docker, whose body is delivered by the test.
+    """
+
+    code = 200
+    phrase = "OK"
+    length = UNKNOWN_LENGTH
+
+    def __init__(self):
+        self.headers = Headers({"content-type": ["text/plain"]})
+        self.transport = StringTransport()
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(self.transport)
+
+
+class FakeAgent(object):
+    def __init__(self, response):
+        self.response = response
+
+    def dockerRequest(self, method, rest, headers, body, length):
+        return defer.succeed(self.response)
+
+
+class PooledDockerClientTests(TestCase):
+    """
+    Tests for ``PooledDockerClient``.
+    """
+
+    def test_streaming_backpressure(self):
+        """
+        In streaming mode, the reads of the response body from Docker are
+        registered as the producer of the client's request until the body
+        ends.
+        """
+        request = StreamingRequest()
+        response = FakeResponse()
+        client = PooledDockerClient(request, BufferConfiguration(1024),
+                                    Metrics(Clock()))
+        client.setStreamingMode(True)
+        client.send(FakeAgent(response), "GET", "/containers/abc/logs", {},
+                    None, 0)
+        response.protocol.dataReceived(b"output\n")
+        producer = request.producer
+        response.protocol.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(
+            (producer, request.producer, request.transport.value(),
+             request.finished),
+            (response.transport, None, b"output\n", True))
+
+    def test_too_large(self):
+        """
+        A response over the most bytes which may be buffered isn't read any
+        further, and the client is answered with an error instead.
+        """
+        request = StreamingRequest()
+        response = FakeResponse()
+        listener = defer.Deferred()
+        client = PooledDockerClient(request, BufferConfiguration(4, 8),
+                                    Metrics(Clock()))
+        client.registerListener(listener)
+        client.send(FakeAgent(response), "GET", "/containers/json", {},
+                    None, 0)
+        response.protocol.dataReceived(b"[1, 2, 3")
+        response.protocol.dataReceived(b"]")
+        self.failureResultOf(listener, NoPostHooks)
+        self.assertEqual(
+            (response.transport.producerState, request.code,
+             request.finished),
+            ("stopped", 502, True))
+        self.assertIn(b"larger than the 8 bytes", request.transport.value())
+
+    def _headerHooks(self, ended=False):
+        """
+        Start a response with post-hooks on its headers, which answer with
+        the returned ``Deferred``.  Part of the body is received before they
+        answer, and all of it if ``ended`` is set.
+        """
+        self.request = StreamingRequest()
+        self.response = FakeResponse()
+        self.listener = defer.Deferred()
+        hooks = defer.Deferred()
+        client = PooledDockerClient(self.request, BufferConfiguration(1024),
+                                    Metrics(Clock()))
+        client.registerListener(self.listener)
+        client.setHeaderHooks(lambda: hooks)
+        client.send(FakeAgent(self.response), "GET", "/containers/json", {},
+                    None, 0)
+        self.response.protocol.dataReceived(b"[]")
+        if ended:
+            self.response.protocol.connectionLost(Failure(ResponseDone()))
+        return hooks
+
+    def test_header_hooks(self):
+        """
+        With post-hooks on the headers only, the body is held back, and
+        Docker isn't read from, until they answer; then it is streamed to
+        the client.
+        """
+        hooks = self._headerHooks()
+        held = (self.response.transport.producerState,
+                self.request.transport.value())
+        hooks.callback(True)
+        self.response.protocol.connectionLost(Failure(ResponseDone()))
+        self.failureResultOf(self.listener, NoPostHooks)
+        self.assertEqual(
+            (held, self.response.transport.producerState,
+             self.request.transport.value(), self.request.finished),
+            (("paused", b""), "producing", b"[]", True))
+
+    def test_header_hooks_body_ended(self):
+        """
+        A body which ended before the post-hooks answered is sent once they
+        do.
+        """
+        hooks = self._headerHooks(ended=True)
+        finished = self.request.finished
+        hooks.callback(True)
+        self.assertEqual(
+            (finished, self.request.transport.value(), self.request.finished),
+            (False, b"[]", True))
+
+    def test_header_hooks_refused(self):
+        """
+        If the client was answered otherwise by the post-hooks, the body is
+        dropped.
+        """
+        hooks = self._headerHooks()
+        hooks.callback(False)
+        self.assertEqual(
+            (self.response.transport.producerState,
+             self.request.transport.value(), self.request.finished),
+            ("stopped", b"", False))
+
+    def test_header_hooks_failed(self):
+        """
+        If the post-hooks fail unexpectedly, the body is dropped along with
+        the client.
+        """
+        hooks = self._headerHooks()
+        hooks.errback(RuntimeError("hooks failed"))
+        self.assertEqual(
+            (self.response.transport.producerState,
+             self.request.transport.disconnecting,
+             len(self.flushLoggedErrors(RuntimeError))),
+            ("stopped", True, 1))
@@ -0,0 +1,368 @@
+# Copyright ClusterHQ Limited. See LICENSE file for details.
+
+"""
+Tests for running the proxy in several worker processes.
+"""
+
+import json
+import os
+import sys
+
+import treq
+from twisted.internet import defer, error, reactor
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import TestCase
+
+from .._config import InvalidConfiguration, ListenerConfiguration
+from .._workers import (
+        CONTROL_FD, LISTEN_FDS, Supervisor, Worker, aggregateMetrics)
+from ..testtools import FakeDockerServer
+
+
+class AggregateMetricsTests(TestCase):
+    """
+    Tests for ``aggregateMetrics``.
+    """
+
+    def test_sums_series(self):
+        """
+        Samples with the same name and labels are summed, and each family is
+        described once.
+        """
+        worker = "\n".join([
+            "# HELP requests_total Requests.",
+            "# TYPE requests_total counter",
+            'requests_total{method="GET"} %d',
+            'requests_total{method="POST"} 1',
+            "# HELP latency_seconds Latency.",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{le="0.5"} 2',
+            "latency_seconds_sum 0.25",
+            "latency_seconds_count 2", ""])
+        self.assertEquals(
+            aggregateMetrics([(0, worker % (3,)), (1, worker % (4,))]),
+            "\n".join([
+                "# HELP requests_total Requests.",
+                "# TYPE requests_total counter",
+                'requests_total{method="GET"} 7',
+                'requests_total{method="POST"} 2',
+                "# HELP latency_seconds Latency.",
+                "# TYPE latency_seconds histogram",
+                'latency_seconds_bucket{le="0.5"} 4',
+                "latency_seconds_sum 0.5",
+                "latency_seconds_count 4", ""]))
+
+    def test_series_of_one_worker(self):
+        """
+        Series only some workers have are kept.
+        """
+        self.assertEquals(
+            aggregateMetrics([(0, "# TYPE up counter\nup 1\n"),
+                              (1, "# TYPE up counter\nup 1\ndown 1\n")]),
+            "# TYPE up counter\nup 2\ndown 1\n")
+
+    def test_gauges_by_worker(self):
+        """
+        Gauges aren't summed, but kept apart by a ``worker`` label, so that
+        e.g. the breaker of an adapter which is open in one worker and closed
+        in another isn't reported half open.
+        """
+        worker = "\n".join([
+            "# HELP powerstrip_adapter_breaker_open Breaker open.",
+            "# TYPE powerstrip_adapter_breaker_open gauge",
+            'powerstrip_adapter_breaker_open{adapter="audit"} %d',
+            "# TYPE powerstrip_notify_queue_depth gauge",
+            "powerstrip_notify_queue_depth 3", ""])
+        self.assertEquals(
+            aggregateMetrics([(0, worker % (1,)), (1, worker % (0,)),
+                              (None, "# TYPE powerstrip_workers gauge\n"
+                                     "powerstrip_workers 2\n")]),
+            "\n".join([
+                "# HELP powerstrip_adapter_breaker_open Breaker open.",
+                "# TYPE powerstrip_adapter_breaker_open gauge",
+                'powerstrip_adapter_breaker_open{adapter="audit",worker="0"} '
+                '1',
+                'powerstrip_adapter_breaker_open{adapter="audit",worker="1"} '
+                '0',
+                "# TYPE powerstrip_notify_queue_depth gauge",
+                'powerstrip_notify_queue_depth{worker="0"} 3',
+                'powerstrip_notify_queue_depth{worker="1"} 3',
+                "# TYPE powerstrip_workers gauge",
+                "powerstrip_workers 2", ""]))
+
+
+class FakeProcessTransport(object):
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.signals = []
+        self.exited = False
+
+    def signalProcess(self, name):
+        if self.exited:
+            raise error.ProcessExitedAlready()
+        self.signals.append(name)
+
+    def ready(self, adminPort=1234):
+        self.protocol.childDataReceived(
+            CONTROL_FD, json.dumps({"admin_port": adminPort}) + "\n")
+
+    def exit(self):
+        self.exited = True
+        self.protocol.processEnded(Failure(error.ProcessTerminated(1)))
+
+
+class FakeReactor(Clock):
+    """
+    A ``Clock`` which records the processes it is asked to spawn.
+    """
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, protocol, executable, args, env, childFDs):
+        transport = FakeProcessTransport(protocol)
+        transport.env = env
+        transport.childFDs = childFDs
+        protocol.makeConnection(transport)
+        self.spawned.append(transport)
+        return transport
+
+
+class SupervisorTests(TestCase):
+    """
+    Tests for ``Supervisor``, with fake processes.
+    """
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        listener = ListenerConfiguration(tcp=0, interface="127.0.0.1")
+        self.supervisor = Supervisor(
+            2, [listener, listener], environ={"DOCKER_HOST": "docker"},
+            reactor=self.reactor, installSignalHandlers=False)
+        self.supervisor.startService()
+        for skt in self.supervisor._sockets:
+            self.addCleanup(skt.close)
+
+    def test_spawn(self):
+        """
+        The workers are passed the listening sockets, and their number.
+        """
+        fds = [skt.fileno() for skt in self.supervisor._sockets]
+        self.assertEquals(
+            [(process.env["POWERSTRIP_WORKER"], process.env["DOCKER_HOST"],
+              process.env["POWERSTRIP_LISTEN_FDS"],
+              process.childFDs[LISTEN_FDS], process.childFDs[LISTEN_FDS + 1],
+              process.childFDs[CONTROL_FD])
+             for process in self.reactor.spawned],
+            [("0", "docker", "2", fds[0], fds[1], "r"),
+             ("1", "docker", "2", fds[0], fds[1], "r")])
+
+    def test_unix_listener(self):
+        """
+        Workers can't share UNIX sockets.
+        """
+        self.assertRaises(
+            InvalidConfiguration, Supervisor, 2,
+            [ListenerConfiguration(unix="/var/run/powerstrip.sock")])
+
+    def test_respawn(self):
+        """
+        A worker which dies is replaced after ``restartDelay``, and counted.
+        """
+        self.reactor.spawned[1].exit()
+        self.assertEquals(len(self.reactor.spawned), 2)
+        self.reactor.advance(self.supervisor.restartDelay)
+        self.assertEquals(
+            (len(self.reactor.spawned),
+             self.reactor.spawned[2].env["POWERSTRIP_WORKER"],
+             self.supervisor.restarts),
+            (3, "1", 1))
+
+    def test_reload_config(self):
+        """
+        ``reloadConfig`` sends ``SIGHUP`` to every worker.
+        """
+        self.supervisor.reloadConfig()
+        self.assertEquals([process.signals
+                           for process in self.reactor.spawned],
+                          [["HUP"], ["HUP"]])
+
+    def test_rolling_restart(self):
+        """
+        ``restartWorkers`` only stops a worker once its replacement is ready,
+        and only replaces the next worker once the previous one has ended.
+        """
+        first, second = self.reactor.spawned
+        d = self.supervisor.restartWorkers()
+        self.assertEquals((len(self.reactor.spawned), first.signals),
+                          (3, []))
+        self.reactor.spawned[2].ready()
+        self.assertEquals((len(self.reactor.spawned), first.signals),
+                          (3, ["TERM"]))
+        first.exit()
+        self.assertEquals((len(self.reactor.spawned), second.signals),
+                          (4, []))
+        self.reactor.spawned[3].ready()
+        second.exit()
+        self.successResultOf(d)
+        self.assertEquals(
+            (self.supervisor.restarts,
+             [process.env["POWERSTRIP_WORKER"]
+              for process in self.reactor.spawned]),
+            (0, ["0", "1", "0", "1"]))
+
+    def test_stop(self):
+        """
+        ``stopService`` sends ``SIGTERM`` to every worker, and fires once
+        they have ended, without replacing them.
+        """
+        d = self.supervisor.stopService()
+        self.assertEquals([process.signals
+                           for process in self.reactor.spawned],
+                          [["TERM"], ["TERM"]])
+        for process in self.reactor.spawned:
+            process.exit()
+        self.successResultOf(d)
+        self.reactor.advance(self.supervisor.restartDelay)
+        self.assertEquals(len(self.reactor.spawned), 2)
+
+    def test_stop_kills(self):
+        """
+        Workers which have not ended some time after the grace period are
+        killed.
+        """
+        self.supervisor.stopService()
+        self.reactor.advance(self.supervisor.gracePeriod + 5)
+        self.assertEquals([process.signals
+                           for process in self.reactor.spawned],
+                          [["TERM", "KILL"], ["TERM", "KILL"]])
+
+
+class FakePort(object):
+    listening = True
+
+    def stopListening(self):
+        self.listening = False
+
+
+class FakeChannel(object):
+    def __init__(self, requests):
+        self.requests = requests
+
+
+class FakeConnection(object):
+    def __init__(self, connections, requests):
+        self.wrappedProtocol = FakeChannel(requests)
+        self.transport = self
+        self.connections = connections
+        connections.protocols[self] = 1
+
+    def loseConnection(self):
+        del self.connections.protocols[self]
+
+
+class FakeConnections(object):
+    def __init__(self):
+        self.protocols = {}
+
+
+class WorkerTests(TestCase):
+    """
+    Tests for ``Worker``.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.port = FakePort()
+        self.connections = FakeConnections()
+        self.stopped = []
+        self.worker = Worker([self.port], self.connections, 10, self.clock,
+                             lambda: self.stopped.append(True))
+
+    def test_idle(self):
+        """
+        ``stop`` stops listening, closes idle connections and stops at once
+        if none are left.
+        """
+        FakeConnection(self.connections, [])
+        self.worker.stop()
+        self.assertEquals((self.port.listening, self.connections.protocols,
+                           self.stopped), (False, {}, [True]))
+
+    def test_busy(self):
+        """
+        ``stop`` waits for connections with requests in progress to finish.
+        """
+        busy = FakeConnection(self.connections, ["request"])
+        self.worker.stop()
+        self.clock.advance(0.1)
+        self.assertEquals(self.stopped, [])
+        busy.wrappedProtocol.requests = []
+        self.clock.advance(0.1)
+        self.assertEquals(self.stopped, [True])
+
+    def test_grace_period(self):
+        """
+        ``stop`` stops anyway once the grace period is over.
+        """
+        FakeConnection(self.connections, ["request"])
+        self.worker.stop()
+        self.clock.advance(9.95)
+        self.assertEquals(self.stopped, [])
+        self.clock.advance(0.1)
+        self.assertEquals(self.stopped, [True])
+
+
+class WorkerProcessesTests(TestCase):
+    """
+    Tests for ``Supervisor`` with real worker processes.
+    """
+
+    def setUp(self):
+        self.dockerServer = reactor.listenTCP(
+            0, FakeDockerServer(), interface="127.0.0.1")
+        self.addCleanup(self.dockerServer.stopListening)
+        config = FilePath(self.mktemp())
+        config.setContent("endpoints: {}\nadapters: {}\n")
+        root = FilePath(__file__).parent().parent().parent().path
+        environ = dict(
+            os.environ,
+            DOCKER_HOST="tcp://127.0.0.1:%d" % (
+                self.dockerServer.getHost().port,),
+            POWERSTRIP_CONFIG=config.path,
+            PYTHONPATH=os.pathsep.join(
+                [root] + filter(None, [os.environ.get("PYTHONPATH")])))
+        self.supervisor = Supervisor(2, [ListenerConfiguration(
+                                         tcp=0, interface="127.0.0.1")],
+                                     environ=environ, gracePeriod=2,
+                                     installSignalHandlers=False,
+                                     executable=sys.executable)
+        self.supervisor.startService()
+        self.addCleanup(self.supervisor.stopService)
+
+    def test_serve(self):
+        """
+        The workers serve requests on the supervisor's port, and their
+        metrics are aggregated.
+        """
+        d = defer.gatherResults([
+            process.whenReady()
+            for process in self.supervisor._processes.values()])
+        d.addCallback(lambda ignored: treq.post(
+            "http://127.0.0.1:%d/towel" % (self.supervisor.ports[0],),
+            json.dumps({"Number": 1}),
+            headers={"Content-Type": ["application/json"]}, persistent=False))
+        d.addCallback(treq.json_content)
+        def served(body):
+            self.assertEquals(body, {"Number": 1, "SeenByFakeDocker": 42})
+            return self.supervisor.metrics()
+        d.addCallback(served)
+        def metrics(text):
+            self.assertIn("powerstrip_workers 2\n", text)
+            self.assertIn("powerstrip_worker_restarts_total 0\n", text)
+        d.addCallback(metrics)
+        return d
+    test_serve.timeout = 30
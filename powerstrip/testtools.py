@@ -5,13 +5,16 @@ Test utilties for testing the proxy.
 """
 
 from twisted.web import server, resource
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+import hashlib
 import json
 
 import testtools, powerstrip
 from ._config import PluginConfiguration
 from ._parser import EndpointParser
 from twisted.python.filepath import FilePath
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 
 class GenerallyUsefulPowerstripTestMixin(object):
     def _getNullAdapter(self):
@@ -65,6 +68,10 @@ class FakeDockerRoot(resource.Resource):
         resource.Resource.__init__(self)
         self.putChild("towel", FakeDockerTowelResource(**kw))
         self.putChild("info", FakeDockerInfoResource(**kw))
+        self.putChild("build", FakeDockerBuildResource(**kw))
+        self.putChild("containers", FakeDockerContainersResource(**kw))
+        self.putChild("events", FakeDockerEventsResource(**kw))
+        self.putChild("images", FakeDockerImagesResource(**kw))
 
 
 class FakeDockerTowelResource(resource.Resource):
@@ -89,67 +96,315 @@ class FakeDockerTowelResource(resource.Resource):
             request.setHeader("Content-Type", "application/json")
         else:
             request.setHeader("Content-Type", "application/vnd.docker.raw-stream")
+        body = json.dumps(jsonParsed)
         if self.chunkedResponse:
-            request.setHeader("Transfer-Encoding", "chunked")
-        return json.dumps(jsonParsed)
+            # Without a Content-Length, twisted.web sends the parts written
+            # to HTTP/1.1 clients in chunked encoding, as Docker does with
+            # progress streams.
+            for i in range(0, len(body), 16):
+                request.write(body[i:i + 16])
+            request.finish()
+            return server.NOT_DONE_YET
+        return body
 
 
 class FakeDockerInfoResource(resource.Resource):
+    """
+    Tell some information, counting the calls.  If ``hold`` is set, only
+    answer once ``release`` is called.
+    """
     isLeaf = True
+    hold = False
 
     def __init__(self, **kw):
         # disregard kwargs for now (they're used in TowelResource...)
         resource.Resource.__init__(self)
+        self.calls = 0
+        self._held = []
 
     def render_GET(self, request):
+        self.calls += 1
+        if self.hold:
+            self._held.append(request)
+            return server.NOT_DONE_YET
+        return self._answer(request)
+
+    def _answer(self, request):
+        return "INFORMATION FOR YOU: %s" % (request.args["return"][0],)
+
+    def release(self):
         """
-        Tell some information.
+        Answer all held calls.
         """
-        return "INFORMATION FOR YOU: %s" % (request.args["return"][0],)
+        held, self._held = self._held, []
+        for request in held:
+            request.write(self._answer(request))
+            request.finish()
+
+
+class FakeDockerBuildResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, **kw):
+        resource.Resource.__init__(self)
+
+    def render_POST(self, request):
+        """
+        Describe the build context that was received.
+        """
+        context = request.content.read()
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps({"Length": len(context),
+                           "MD5": hashlib.md5(context).hexdigest()})
+
+
+# The size of the tarball FakeDockerContainersResource exports: bigger than
+# anything the proxy should hold in memory at once.
+FAKE_EXPORT_SIZE = 8 * 2 ** 20 + 3
+
+
+def fakeExportChunks():
+    """
+    Generate the contents of a fake container export.
+    """
+    chunk = "".join(chr(i % 256) for i in range(2 ** 16))
+    remaining = FAKE_EXPORT_SIZE
+    while remaining:
+        yield chunk[:remaining]
+        remaining -= len(chunk[:remaining])
+
+
+class FakeDockerContainersResource(resource.Resource):
+    """
+    Export containers, attach to them and follow their logs.
+
+    self.outputSize: The number of bytes of output containers send to
+        ``attach`` and ``logs``.
+
+    self.outputs: The ``FakeContainerOutput`` of every ``attach`` and
+        ``logs``.
+    """
+    isLeaf = True
+    outputSize = 2 ** 20
+
+    def __init__(self, **kw):
+        resource.Resource.__init__(self)
+        self.outputs = []
+
+    def render_POST(self, request):
+        """
+        Attach to a container (``POST /containers/<id>/attach``): hijack the
+        connection, and send ``outputSize`` bytes of output.
+        """
+        if request.postpath[-1:] != ["attach"]:
+            request.setResponseCode(404)
+            return ""
+        request.setHeader("Content-Type", "application/vnd.docker.raw-stream")
+        # Send the headers straight away, as Docker does.
+        request.write("")
+        output = FakeContainerOutput(request, self.outputSize)
+        self.outputs.append(output)
+        output.start()
+        return server.NOT_DONE_YET
+
+    def render_GET(self, request):
+        """
+        Export a container (``GET /containers/<id>/export``) as a big binary
+        tarball, written in chunks, or follow its logs (``GET
+        /containers/<id>/logs``): ``outputSize`` bytes of output, chunked.
+        """
+        if request.postpath[-1:] == ["logs"]:
+            request.setHeader("Content-Type", "text/plain; charset=utf-8")
+            output = FakeContainerOutput(request, self.outputSize)
+            self.outputs.append(output)
+            output.start()
+            return server.NOT_DONE_YET
+        if request.postpath[-1:] != ["export"]:
+            request.setResponseCode(404)
+            return ""
+        request.setHeader("Content-Type", "application/x-tar")
+        for chunk in fakeExportChunks():
+            request.write(chunk)
+        request.finish()
+        return server.NOT_DONE_YET
+
+
+class FakeDockerImagesResource(resource.Resource):
+    """
+    Pull images.
+
+    self.progress: The number of progress messages a pull sends.
+    """
+    isLeaf = True
+    progress = 3
+
+    def __init__(self, **kw):
+        resource.Resource.__init__(self)
+
+    def render_POST(self, request):
+        """
+        Pull an image (``POST /images/create``): send a stream of JSON
+        progress messages, each numbered, as Docker does without a length.
+        """
+        if request.postpath != ["create"]:
+            request.setResponseCode(404)
+            return ""
+        request.setHeader("Content-Type", "application/json")
+        for number in range(self.progress):
+            request.write(json.dumps(
+                {"status": "Downloading", "Number": number}) + "\r\n")
+        request.finish()
+        return server.NOT_DONE_YET
+
+
+@implementer(IPushProducer)
+class FakeContainerOutput(object):
+    """
+    The output of a container, written as fast as the connection takes it.
+
+    self.written: The number of bytes written so far.
+
+    self.pauses: The number of times the connection asked to pause.
+    """
+    CHUNK = b"x" * 2 ** 16
+    paused = False
+    pauses = 0
+
+    def __init__(self, request, size):
+        self.request = request
+        self.size = size
+        self.written = 0
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        self.resumeProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        while not self.paused and self.written < self.size:
+            chunk = self.CHUNK[:self.size - self.written]
+            self.written += len(chunk)
+            self.request.write(chunk)
+        if not self.paused:
+            self.request.unregisterProducer()
+            self.request.finish()
+
+    def pauseProducing(self):
+        self.paused = True
+        self.pauses += 1
+
+    def stopProducing(self):
+        self.paused = True
+
+
+class FakeDockerEventsResource(resource.Resource):
+    """
+    A stream of Docker events, sent by the test with ``emit``.
+    """
+    isLeaf = True
+
+    def __init__(self, **kw):
+        resource.Resource.__init__(self)
+        self.subscribers = []
+        self._waiting = []
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        # Send the headers straight away, as Docker does.
+        request.write("")
+        self.subscribers.append(request)
+        request.notifyFinish().addBoth(
+            lambda ignored: self.subscribers.remove(request))
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+        return server.NOT_DONE_YET
+
+    def waitForSubscriber(self):
+        """
+        Return a ``Deferred`` which fires once there is a subscriber.
+        """
+        if self.subscribers:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def whenUnsubscribed(self):
+        """
+        Return a ``Deferred`` which fires once all subscribers have gone.
+        """
+        return defer.DeferredList(
+            [request.notifyFinish() for request in self.subscribers],
+            consumeErrors=True)
+
+    def emit(self, event):
+        """
+        Send an event to all subscribers.
+        """
+        for request in self.subscribers:
+            request.write(json.dumps(event))
 
 
 class AdderPlugin(server.Site):
     """
     The first powerstrip adapter: a pre-hook and post-hook implementation of a
     simple adder which can optionally blow up on demand.
+
+    With ``protocol=2`` it expects hooks, and answers them, in version 2 of
+    the hook protocol, where JSON bodies are embedded as they are.
     """
-    def __init__(self, pre=False, post=False, explode=False, incrementBy=1):
-        self.root = AdderRoot(pre, post, explode, incrementBy)
+    def __init__(self, pre=False, post=False, explode=False, incrementBy=1,
+                 protocol=1):
+        self.root = AdderRoot(pre, post, explode, incrementBy, protocol)
         server.Site.__init__(self, self.root)
 
 
 class AdderResource(resource.Resource):
     isLeaf = True
-    def __init__(self, pre, post, explode, incrementBy):
+    def __init__(self, pre, post, explode, incrementBy, protocol=1):
         self.pre = pre
         self.post = post
         self.explode = explode
         self.incrementBy = incrementBy
+        self.protocol = protocol
         resource.Resource.__init__(self)
 
 
+    def _add(self, body):
+        """
+        Increment the "Number" of a body, as it is passed in the protocol
+        version of this adder.
+        """
+        if self.protocol == 1:
+            body = json.loads(body)
+        body["Number"] += self.incrementBy
+        if self.protocol == 1:
+            body = json.dumps(body)
+        return body
+
+
     def _renderPreHook(self, request, jsonParsed):
-        parsedBody = json.loads(jsonParsed["ClientRequest"]["Body"])
-        parsedBody["Number"] += self.incrementBy
+        if jsonParsed.get("PowerstripProtocolVersion", 1) != self.protocol:
+            raise ValueError("Unexpected protocol version.")
         request.setHeader("Content-Type", "application/json")
-        # TODO: Don't decode the JSON, probably. Or, special-case Content-Type
-        # logic everywhere.
-        return json.dumps({"PowerstripProtocolVersion": 1,
+        return json.dumps({"PowerstripProtocolVersion": self.protocol,
                            "ModifiedClientRequest": {
                                "Method": jsonParsed["ClientRequest"]["Method"],
                                "Request": jsonParsed["ClientRequest"]["Request"],
-                               "Body": json.dumps(parsedBody)}})
+                               "Body": self._add(
+                                   jsonParsed["ClientRequest"]["Body"])}})
 
 
     def _renderPostHook(self, request, jsonParsed):
-        parsedBody = json.loads(jsonParsed["ServerResponse"]["Body"])
-        parsedBody["Number"] += self.incrementBy
+        if jsonParsed.get("PowerstripProtocolVersion", 1) != self.protocol:
+            raise ValueError("Unexpected protocol version.")
         request.setHeader("Content-Type", "application/json")
         return json.dumps({
-            "PowerstripProtocolVersion": 1,
+            "PowerstripProtocolVersion": self.protocol,
             "ModifiedServerResponse": {
                 "ContentType": jsonParsed["ServerResponse"]["ContentType"],
-                "Body": json.dumps(parsedBody),
+                "Body": self._add(jsonParsed["ServerResponse"]["Body"]),
                 "Code": jsonParsed["ServerResponse"]["Code"]}})
 
     def render_POST(self, request):
@@ -181,13 +436,13 @@ class AdderResource(resource.Resource):
 
 class AdderRoot(resource.Resource):
     isLeaf = False
-    def __init__(self, pre, post, explode, incrementBy):
+    def __init__(self, pre, post, explode, incrementBy, protocol=1):
         self.pre = pre
         self.post = post
         self.explode = explode
         self.incrementBy = incrementBy
         resource.Resource.__init__(self)
-        self.putChild("adapter", AdderResource(self.pre, self.post, self.explode, self.incrementBy))
+        self.putChild("adapter", AdderResource(self.pre, self.post, self.explode, self.incrementBy, protocol))
 
 
 class NullAdapterResource(resource.Resource):
@@ -222,6 +477,99 @@ class NullAdapterResource(resource.Resource):
                 requestJson["ServerResponse"]})
 
 
+class ObserverPlugin(server.Site):
+    """
+    An adapter which records the hooks it is called with, and answers them
+    with an attempt to change the number in the request, which must be
+    ignored for observers.  If ``hold`` is set, it only answers once
+    ``release`` is called.
+    """
+    def __init__(self, hold=False):
+        self.root = ObserverResource(hold)
+        server.Site.__init__(self, self.root)
+
+
+class ObserverResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, hold):
+        resource.Resource.__init__(self)
+        self.hold = hold
+        self.hooks = []
+        self._held = []
+        self._waiting = []
+
+    def render_POST(self, request):
+        self.hooks.append(json.loads(request.content.read()))
+        if self.hold:
+            self._held.append(request)
+            result = server.NOT_DONE_YET
+        else:
+            result = self._answer()
+        for count, d in self._waiting[:]:
+            if len(self.hooks) >= count:
+                self._waiting.remove((count, d))
+                d.callback(None)
+        return result
+
+    def _answer(self):
+        return json.dumps({
+            "PowerstripProtocolVersion": 1,
+            "ModifiedClientRequest": {"Body": json.dumps({"Number": 100})},
+            "ModifiedServerResponse": {"Body": json.dumps({"Number": 100}),
+                                       "Code": 200,
+                                       "ContentType": "application/json"}})
+
+    def waitForHooks(self, count):
+        """
+        Return a ``Deferred`` which fires once ``count`` hooks were received.
+        """
+        d = defer.Deferred()
+        if len(self.hooks) >= count:
+            d.callback(None)
+        else:
+            self._waiting.append((count, d))
+        return d
+
+    def release(self):
+        """
+        Answer all held hooks.
+        """
+        held, self._held = self._held, []
+        for request in held:
+            request.write(self._answer())
+            request.finish()
+
+
+class UnmodifiedPlugin(server.Site):
+    """
+    An adapter which leaves every request and response as it was, answering
+    with ``204 No Content`` if ``noContent`` is set, and with
+    ``{"Unmodified": true}`` otherwise.
+    """
+    def __init__(self, noContent=True):
+        self.root = UnmodifiedResource(noContent)
+        server.Site.__init__(self, self.root)
+
+
+class UnmodifiedResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, noContent):
+        resource.Resource.__init__(self)
+        self.noContent = noContent
+        self.hooks = 0
+
+    def render_POST(self, request):
+        self.hooks += 1
+        if self.noContent:
+            request.setResponseCode(204)
+            return ""
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps({"PowerstripProtocolVersion": 1,
+                           "Unmodified": True})
+
+
 def getNullAdapter():
     root = resource.Resource()
     root.putChild("null-adapter", NullAdapterResource())